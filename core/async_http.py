@@ -0,0 +1,304 @@
+# Non-blocking HTTP client for the asyncio tile download engine
+#
+# The thread pool based tile downloaders spend an OS thread per download in progress,
+# which limits how many tiles can be downloaded at once on a high latency connection.
+# This client runs on an asyncio event loop (see core.async_pool), so a single
+# thread can have hundreds of requests in progress.
+#
+# Only the subset of HTTP/1.1 needed for downloading tiles is supported:
+# * GET & HEAD requests, without a request body
+# * response bodies delimited by Content-Length, chunked transfer encoding
+#   or by the server closing the connection
+# * keep-alive - connections to a host are kept open and reused for the next requests,
+#   the number of connections to a single host is limited
+# Compressed responses are not requested, as tile images are already compressed.
+
+import asyncio
+import ssl
+from urllib.parse import urlsplit
+
+import logging
+log = logging.getLogger("core.async_http")
+
+# in seconds
+DEFAULT_TIMEOUT = 10
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 10
+# protection against broken servers sending headers forever
+MAX_HEADER_COUNT = 100
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# marks the client default timeout, as None means no timeout
+_DEFAULT = object()
+
+class ProtocolError(Exception):
+    """The server response is not valid HTTP"""
+    pass
+
+class Response(object):
+    """A HTTP response with the whole body already read"""
+
+    def __init__(self, status, reason, headers, data):
+        """
+        :param int status: HTTP status code
+        :param str reason: reason phrase
+        :param dict headers: response headers with lower case names
+        :param bytes data: response body
+        """
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.data = data
+
+    def getheaders(self):
+        """Get the response headers (same as with urllib3 responses)"""
+        return self.headers
+
+    def __repr__(self):
+        return "Response(%d %s, %d bytes)" % (self.status, self.reason, len(self.data))
+
+class _Host(object):
+    """Connections to a single host"""
+
+    def __init__(self, maxConnections):
+        # limits the number of connections in use at once
+        self.semaphore = asyncio.Semaphore(maxConnections)
+        # open connections waiting to be reused, as (reader, writer) tuples
+        self.idle = []
+
+class HTTPClient(object):
+    """Minimal HTTP/1.1 client with keep-alive connection pooling
+
+    All methods other than the properties have to be called from the event loop thread.
+    """
+
+    def __init__(self, headers=None, maxConnectionsPerHost=DEFAULT_MAX_CONNECTIONS_PER_HOST,
+                 timeout=DEFAULT_TIMEOUT):
+        """
+        :param dict headers: headers sent with every request
+        :param int maxConnectionsPerHost: requests to a host wait once there is this many in progress
+        :param timeout: default request timeout in seconds, None means no timeout
+        """
+        self._headers = dict(headers or {})
+        self._maxConnectionsPerHost = maxConnectionsPerHost
+        self._timeout = timeout
+        # (scheme, host, port) -> _Host
+        self._hosts = {}
+        self._sslContext = None
+        self._requestCount = 0
+        self._connectionCount = 0
+
+    @property
+    def headers(self):
+        return self._headers
+
+    @property
+    def requestCount(self):
+        """Number of requests sent"""
+        return self._requestCount
+
+    @property
+    def connectionCount(self):
+        """Number of connections opened, lower than requestCount once connections are reused"""
+        return self._connectionCount
+
+    async def request(self, method, url, headers=None, timeout=_DEFAULT, maxConnections=None):
+        """Send a request and read the response
+
+        :param str method: HTTP method (GET or HEAD)
+        :param str url: http or https URL
+        :param dict headers: headers to send in addition to (or in place of) the client headers
+        :param timeout: timeout in seconds, None means no timeout,
+                        the client timeout is used by default
+        :param int maxConnections: connection limit for the host in place of the client limit,
+                                   used once the host is first requested
+        :returns: the response
+        :rtype: Response
+        :raises: OSError on connection errors, asyncio.TimeoutError on timeout,
+                 ProtocolError on invalid responses
+        """
+        parts = urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in DEFAULT_PORTS:
+            raise ValueError("unsupported URL: %s" % url)
+        port = parts.port or DEFAULT_PORTS[scheme]
+        key = (scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if parts.query:
+            path = "%s?%s" % (path, parts.query)
+        if parts.port:
+            hostHeader = "%s:%d" % (parts.hostname, port)
+        else:
+            hostHeader = parts.hostname
+        message = self._getRequestMessage(method.upper(), path, hostHeader, headers)
+
+        host = self._hosts.get(key)
+        if host is None:
+            host = _Host(maxConnections or self._maxConnectionsPerHost)
+            self._hosts[key] = host
+        if timeout is _DEFAULT:
+            timeout = self._timeout
+        # waiting for a free connection does not count into the timeout
+        async with host.semaphore:
+            self._requestCount += 1
+            if timeout is None:
+                return await self._request(key, host, method.upper(), message)
+            else:
+                return await asyncio.wait_for(self._request(key, host, method.upper(), message), timeout)
+
+    def _getRequestMessage(self, method, path, hostHeader, headers):
+        requestHeaders = dict(self._headers)
+        if headers:
+            requestHeaders.update(headers)
+        names = set(name.lower() for name in requestHeaders)
+        lines = ["%s %s HTTP/1.1" % (method, path)]
+        if "host" not in names:
+            lines.append("Host: %s" % hostHeader)
+        if "accept-encoding" not in names:
+            lines.append("Accept-Encoding: identity")
+        for name, value in requestHeaders.items():
+            lines.append("%s: %s" % (name, value))
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+    async def _request(self, key, host, method, message):
+        while True:
+            connection, reused = await self._getConnection(key, host)
+            reader, writer = connection
+            try:
+                writer.write(message)
+                response, keepAlive = await self._readResponse(reader, method)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self._close(connection)
+                if reused:
+                    # the server has closed the idle connection in the meantime,
+                    # tile requests are idempotent so just try again
+                    continue
+                raise
+            except BaseException:
+                # including timeouts & cancellation - the response
+                # might not have been fully read, so the connection can't be reused
+                self._close(connection)
+                raise
+            if keepAlive:
+                host.idle.append(connection)
+            else:
+                self._close(connection)
+            return response
+
+    async def _getConnection(self, key, host):
+        """Get an idle connection or open a new one
+
+        :returns: ((reader, writer), reused) tuple
+        """
+        while host.idle:
+            connection = host.idle.pop()
+            if connection[0].at_eof() or connection[1].is_closing():
+                self._close(connection)
+            else:
+                return connection, True
+        scheme, hostname, port = key
+        sslContext = None
+        if scheme == "https":
+            if self._sslContext is None:
+                self._sslContext = ssl.create_default_context()
+            sslContext = self._sslContext
+        connection = await asyncio.open_connection(hostname, port, ssl=sslContext)
+        self._connectionCount += 1
+        return connection, False
+
+    def _close(self, connection):
+        connection[1].close()
+
+    async def _readResponse(self, reader, method):
+        """Read a response
+
+        :returns: (response, keepAlive) tuple
+        """
+        while True:
+            version, status, reason = await self._readStatusLine(reader)
+            headers = await self._readHeaders(reader)
+            # skip informational responses, the real one follows
+            if not 100 <= status < 200:
+                break
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.0":
+            keepAlive = "keep-alive" in connection
+        else:
+            keepAlive = "close" not in connection
+        if method == "HEAD" or status in (204, 304):
+            data = b""
+        elif "chunked" in headers.get("transfer-encoding", "").lower():
+            data = await self._readChunkedBody(reader)
+        elif "content-length" in headers:
+            try:
+                length = int(headers["content-length"])
+            except ValueError:
+                raise ProtocolError("invalid content length: %s" % headers["content-length"])
+            data = await reader.readexactly(length)
+        else:
+            # the body ends once the server closes the connection
+            data = await reader.read()
+            keepAlive = False
+        return Response(status, reason, headers, data), keepAlive
+
+    async def _readStatusLine(self, reader):
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError("connection closed by the server")
+        parts = line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise ProtocolError("invalid status line: %r" % line)
+        try:
+            status = int(parts[1])
+        except ValueError:
+            raise ProtocolError("invalid status line: %r" % line)
+        if len(parts) > 2:
+            reason = parts[2]
+        else:
+            reason = ""
+        return parts[0], status, reason
+
+    async def _readHeaders(self, reader):
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise ConnectionResetError("connection closed by the server")
+            if line in (b"\r\n", b"\n"):
+                return headers
+            if len(headers) >= MAX_HEADER_COUNT:
+                raise ProtocolError("too many headers")
+            name, separator, value = line.decode("latin-1").partition(":")
+            if not separator:
+                raise ProtocolError("invalid header line: %r" % line)
+            name = name.strip().lower()
+            value = value.strip()
+            if name in headers:
+                headers[name] = "%s, %s" % (headers[name], value)
+            else:
+                headers[name] = value
+
+    async def _readChunkedBody(self, reader):
+        chunks = []
+        while True:
+            line = await reader.readline()
+            try:
+                size = int(line.split(b";", 1)[0].strip(), 16)
+            except ValueError:
+                raise ProtocolError("invalid chunk size: %r" % line)
+            if size == 0:
+                # skip any trailer headers
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        return b"".join(chunks)
+            chunks.append(await reader.readexactly(size))
+            # each chunk ends with CRLF
+            await reader.readexactly(2)
+
+    async def close(self):
+        """Close all idle connections"""
+        for host in self._hosts.values():
+            for connection in host.idle:
+                self._close(connection)
+            host.idle = []
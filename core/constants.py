@@ -36,7 +36,10 @@ CONNECTIVITY_UNKNOWN = None
 DEFAULT_TILE_STORAGE_TYPE = "files"
 TILE_STORAGE_FILES = "files"
 TILE_STORAGE_SQLITE = "sqlite"
-TILE_STORAGE_TYPES = [TILE_STORAGE_FILES, TILE_STORAGE_SQLITE]
+TILE_STORAGE_MBTILES = "mbtiles"
+TILE_STORAGE_TYPES = [TILE_STORAGE_FILES, TILE_STORAGE_SQLITE, TILE_STORAGE_MBTILES]
+# read only tile packs, always checked before the other store types
+TILE_STORAGE_PACK = "pack"
 
 # GTK GUI
 PANGO_ON = '<span color="green">ON</span>'
@@ -63,6 +66,15 @@ THREAD_GPSD_CONSUMER = "modRanaGPSDConsumer"
 THREAD_TILE_DOWNLOAD_MANAGER = "modRanaTileDownloadManager"
 THREAD_TILE_DOWNLOAD_WORKER = "modRanaTileDownloadWorker"
 THREAD_TILE_STORAGE_LOADER = "modRanaTileStorageLoader"
+THREAD_TILE_EXISTENCE_FILTER_BUILDER = "modRanaTileExistenceFilterBuilder"
+THREAD_TILE_PACK_BUILDER = "modRanaTilePackBuilder"
+THREAD_TILE_STORAGE_EVICTION = "modRanaTileStorageEviction"
+THREAD_TILE_DEDUPLICATION = "modRanaTileDeduplication"
+THREAD_TILE_STORAGE_EXPIRY = "modRanaTileStorageExpiry"
+THREAD_TILE_STORAGE_MIGRATION = "modRanaTileStorageMigration"
+THREAD_TILE_STORAGE_REPACK = "modRanaTileStorageRepack"
+THREAD_TILE_PRELOAD = "modRanaTilePreload"
+THREAD_ASYNC_DOWNLOAD_LOOP = "modRanaAsyncDownloadLoop"
 # resource checking
 THREAD_CONNECTIVITY_CHECK = "modRanaConnectivityCheck"
 THREAD_LOCATION_CHECK = "modRanaCurrentPositionCheck"
@@ -75,6 +87,7 @@ THREAD_VOICE_WORKER = "modRanaVoiceWorker"
 THREAD_POOL_AUTOMATIC_TILE_DOWNLOAD = "automaticTileDownload"
 THREAD_POOL_BATCH_DOWNLOAD = "batchTileDownload"
 THREAD_POOL_BATCH_SIZE_CHECK = "batchTileSizeCheck"
+THREAD_POOL_TILE_FILTERING = "tileFiltering"
 
 # default thread counts for pools
 DEFAULT_THREAD_COUNT_AUTOMATIC_TILE_DOWNLOAD = 10
@@ -88,12 +101,42 @@ DEFAULT_THREAD_COUNT_BATCH_DOWNLOAD = 5
 # NOTE: even though we are downloading only the headers, for a few thousand tiles this can be an
 #       un-trivial amount of data (so use this with caution on metered connections)
 DEFAULT_THREAD_COUNT_BATCH_SIZE_CHECK = 20
+# decoding, filtering & encoding tiles (such as for the night theme) is CPU bound,
+# so a couple threads are enough
+DEFAULT_THREAD_COUNT_TILE_FILTERING = 2
+# how many tile filtering requests can wait for a free thread,
+# the oldest request is dropped once there are more
+DEFAULT_TILE_FILTERING_QUEUE_SIZE = 50
+
+# tile download engines
+# * threads - each download in progress uses a thread of a thread pool
+# * asyncio - all downloads run on a single asyncio event loop thread
+#   (see core.async_pool & core.async_http), so many more downloads
+#   can be in progress at once
+TILE_DOWNLOAD_ENGINE_THREADS = "threads"
+TILE_DOWNLOAD_ENGINE_ASYNCIO = "asyncio"
+DEFAULT_TILE_DOWNLOAD_ENGINE = TILE_DOWNLOAD_ENGINE_THREADS
+# connections to a single tile server host (unless set for the layer),
+# threads downloading tiles wait for a free connection once there are more
+DEFAULT_CONNECTIONS_PER_HOST = 10
+# number of downloads in progress at once with the asyncio engine
+DEFAULT_ASYNC_TILE_DOWNLOAD_TASK_COUNT = 100
+DEFAULT_ASYNC_BATCH_DOWNLOAD_TASK_COUNT = 50
+# connections to a single tile server with the asyncio engine,
+# the other downloads for the server wait for a free connection
+DEFAULT_ASYNC_DOWNLOAD_CONNECTIONS_PER_HOST = 16
+# threads for blocking calls (such as storing tiles) made by the asyncio engine
+DEFAULT_THREAD_COUNT_ASYNC_BLOCKING_CALLS = 2
 
 # tile download request queue default size
 # * up to 100 download tasks can be stored in the request queue
 # * up to DEFAULT_THREAD_COUNT_AUTOMATIC_TILE_DOWNLOAD tasks can be in progress
 # * if a 101th request comes, it replaces the oldest not in progress task
 DEFAULT_AUTOMATIC_TILE_DOWNLOAD_QUEUE_SIZE = 100
+# waiting tile download requests are downloaded closest to the centre of the map view first,
+# requests for tiles further than this many tiles from the map view are cancelled
+# once the map view changes
+DEFAULT_TILE_DOWNLOAD_VIEWPORT_MARGIN = 2
 
 # in-memory tile cache size
 # * this controls how many tiles modRana keeps in memory
@@ -102,8 +145,32 @@ DEFAULT_AUTOMATIC_TILE_DOWNLOAD_QUEUE_SIZE = 100
 #   requested again, which is often needed by the GTK GUI
 #   and should also help the Qt 5 GUI
 DEFAULT_MEMORY_TILE_CACHE_SIZE = 150
-# how many tiles to remove from cache when it gets full
-DEFAULT_MEMORY_TILE_CACHE_TRIM_SIZE = 30
+# maximum size of the in-memory tile cache in bytes
+# * tile size differs a lot between layers, so the
+#   cache is also limited by the total size of the tiles
+# * once any of the limits is reached, least recently
+#   used tiles are removed from the cache
+DEFAULT_MEMORY_TILE_CACHE_BYTES = 16 * 1024 * 1024
+# filtered tiles (such as inverted tiles for the night theme) are
+# cached separately, keyed by tile and filter, so that switching
+# the filter on and off does not need any tiles to be filtered again
+DEFAULT_FILTERED_TILE_CACHE_SIZE = 150
+DEFAULT_FILTERED_TILE_CACHE_BYTES = 16 * 1024 * 1024
+# adapt the in-memory tile cache budgets to memory pressure
+# * the caches shrink once the device is low on memory and
+#   grow on devices with plenty of free memory (see core.memory)
+DEFAULT_ADAPTIVE_TILE_CACHE_SIZE = True
+# how often to check memory pressure (in seconds)
+MEMORY_PRESSURE_CHECK_INTERVAL = 10
+# preload tiles visible when modRana was last shut down into the in-memory tile cache
+# on startup, so that the first map frame does not need to wait for tile storage
+DEFAULT_TILE_PRELOAD = True
+# name of the file listing the tiles to preload, saved in the cache folder
+TILE_PRELOAD_FILE_NAME = "visible_tiles.json"
+# number of tiles around the visible tiles to preload as well
+TILE_PRELOAD_MARGIN = 1
+# id of the filter used for map tiles with the night theme (see core.tile_filters)
+DEFAULT_NIGHT_TILE_FILTER = "night"
 
 # sqlite tile database commit interval
 # * lower interval - lower amount of tiles in flight and this
@@ -111,6 +178,51 @@ DEFAULT_MEMORY_TILE_CACHE_TRIM_SIZE = 30
 # * longer interval - more tiles in flight, more memory usage but
 #   IO happens less often in longer hopefully more efficient bursts
 DEFAULT_SQLITE_TILE_DATABASE_COMMIT_INTERVAL = 5 # seconds
+# how many tiles are written to the sqlite tile database in a single transaction
+DEFAULT_SQLITE_TILE_DATABASE_BATCH_SIZE = 50
+# use WAL journal mode for sqlite tile databases
+# * tile reads are then not blocked by tile writes and don't
+#   need to be serialized with each other
+# * other processes can read the tile database while modRana is writing to it
+# * the store falls back to serialized access if WAL mode can't be enabled
+DEFAULT_SQLITE_TILE_DATABASE_WAL = True
+# store data of identical tiles (open sea, empty land, blank overlay tiles)
+# only once in sqlite tile databases
+DEFAULT_SQLITE_TILE_DATABASE_DEDUPLICATE = False
+# keep an in-memory filter of stored tiles for each layer,
+# so that lookups of tiles that are not stored don't need to touch the disk
+DEFAULT_TILE_EXISTENCE_FILTER = True
+# remember tiles recently not found in tile storage,
+# so that repeated lookups of a tile that is being
+# downloaded don't need to look into the stores
+# * maximum number of remembered tiles
+DEFAULT_TILE_NEGATIVE_CACHE_SIZE = 1024
+# * for how long to remember a tile has not been found (in seconds)
+TILE_NEGATIVE_CACHE_TTL = 5
+# tile storage size budgets in MiB, 0 means unlimited
+# * the global budget applies to all layers together,
+#   the layer budget to each layer separately
+# * once over budget, least recently accessed tiles are evicted
+#   by a background job
+DEFAULT_TILE_STORAGE_SIZE_LIMIT = 0
+DEFAULT_TILE_STORAGE_LAYER_SIZE_LIMIT = 0
+# how often to check the tile storage size budgets (in seconds)
+TILE_STORAGE_EVICTION_INTERVAL = 600
+# check the size budgets right away once this many tiles have been stored since the last check
+TILE_STORAGE_EVICTION_TILE_COUNT = 1000
+# periodically delete stored tiles that are past the timeout of their layer
+# (and past the maximum staleness for stale-while-revalidate layers)
+DEFAULT_TILE_STORAGE_EXPIRY_SWEEP = True
+# how often to sweep expired tiles (in seconds)
+TILE_STORAGE_EXPIRY_SWEEP_INTERVAL = 3600
+# only sweep once no tiles have been requested for this long (in seconds)
+TILE_STORAGE_EXPIRY_IDLE_TIME = 30
+# pause between deleting chunks of expired tiles (in seconds),
+# so that the sweep does not slow down tile loading
+TILE_STORAGE_EXPIRY_CHUNK_DELAY = 0.5
+# how many threads read tiles from the old store when moving tiles
+# to the store of the current tile storage type
+DEFAULT_TILE_STORAGE_MIGRATION_READER_COUNT = 4
 
 # device types
 DEVICE_TYPE_DESKTOP = 1
@@ -191,3 +303,5 @@ TILE_DOWNLOAD_SUCCESS = 0
 TILE_DOWNLOAD_ERROR = 1
 TILE_DOWNLOAD_TEMPORARY_ERROR = 2
 TILE_DOWNLOAD_QUEUE_FULL = 3
+# the tile moved out of view before the download started
+TILE_DOWNLOAD_CANCELLED = 4
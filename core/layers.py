@@ -1,5 +1,8 @@
 # Map layer representation classes
 
+from core import tiles
+from core.tile_hosts import SELECTION_HASH
+
 class MapLayer(object):
     """A map layer"""
 
@@ -10,6 +13,7 @@ class MapLayer(object):
         """
         self.config = config
         self._layerId = layerId
+        self._url_template = None
 
     @property
     def id(self):
@@ -118,6 +122,38 @@ class MapLayer(object):
         else:
             return tile_timeout
 
+    @property
+    def stale_while_revalidate(self):
+        """Should timed-out tiles still be used while they are being refreshed.
+
+        If enabled, a stored tile that is older than the timeout interval is still
+        shown and a fresh tile is downloaded in the background, instead of the tile
+        being treated as not stored.
+
+        :returns: True if timed-out tiles should be used while being refreshed
+        :rtype: bool
+        """
+        value = self.config.get('stale_while_revalidate', False)
+        if isinstance(value, bool):
+            return value
+        return str(value).lower() in ("1", "true", "yes", "on")
+
+    @property
+    def max_staleness(self):
+        """How old can a tile get before it is no longer used, even while being refreshed.
+
+        Only used with stale_while_revalidate. Tiles older than this are treated
+        as not stored, just as timed-out tiles without stale_while_revalidate.
+
+        :returns: maximum tile age (in hours) or None if not limited
+        :rtype: float or None
+        """
+        max_staleness = self.config.get('max_staleness', None)
+        if max_staleness is not None:
+            return float(max_staleness)
+        else:
+            return max_staleness
+
     @property
     def connection_timeout(self):
         """How long should we wait for tile to be download for this layer.
@@ -137,6 +173,56 @@ class MapLayer(object):
         else:
             return tile_connection_timeout
 
+    @property
+    def subdomains(self):
+        """Subdomains used in place of the {s} placeholder in the layer URL.
+
+        Tile downloads are spread over the subdomains, see core.tile_hosts.
+
+        :returns: list of subdomains, empty if the layer uses a single host
+        :rtype: list
+        """
+        subdomains = self.config.get('subdomains', [])
+        if isinstance(subdomains, str):
+            subdomains = subdomains.split(",")
+        return [subdomain.strip() for subdomain in subdomains if subdomain.strip()]
+
+    @property
+    def subdomain_selection(self):
+        """How to select the subdomain for a tile.
+
+        :returns: "hash" (the same tile always from the same subdomain)
+                  or "round_robin" (subdomains in turn)
+        :rtype: str
+        """
+        return self.config.get('subdomain_selection', SELECTION_HASH)
+
+    @property
+    def max_connections_per_host(self):
+        """Maximum number of connections to a single tile server host.
+
+        :returns: maximum number of connections or None if not set for the layer
+        :rtype: int or None
+        """
+        max_connections = self.config.get('max_connections_per_host', None)
+        if max_connections is not None:
+            return int(max_connections)
+        else:
+            return max_connections
+
+    @property
+    def url_template(self):
+        """Layer URL compiled for fast tile URL formatting.
+
+        Compiled once first needed.
+
+        :rtype: core.tiles.TileUrlTemplate
+        """
+        if self._url_template is None:
+            self._url_template = tiles.TileUrlTemplate(self.url, self.coordinates, self.type,
+                                                       self.subdomains, self.subdomain_selection)
+        return self._url_template
+
 
     @property
     def dict(self):
@@ -157,7 +243,12 @@ class MapLayer(object):
             "group_id" : self.group_id,
             "icon" : self.icon,
             "timeout" : self.timeout,
-            "connection_timeout" : self.connection_timeout
+            "stale_while_revalidate" : self.stale_while_revalidate,
+            "max_staleness" : self.max_staleness,
+            "connection_timeout" : self.connection_timeout,
+            "subdomains" : self.subdomains,
+            "subdomain_selection" : self.subdomain_selection,
+            "max_connections_per_host" : self.max_connections_per_host
         }
 
     def __repr__(self):
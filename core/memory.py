@@ -0,0 +1,169 @@
+# Memory pressure monitoring & adaptive cache sizing
+#
+# A fixed size in-memory tile cache is either too big for low-RAM handsets - where
+# it helps the OOM killer to take modRana down during long navigation sessions -
+# or needlessly small on a desktop with plenty of free memory.
+#
+# The device module reports memory status of the system and of the modRana process
+# (see DeviceModule.memory_status), and the CacheSizeController periodically turns it
+# into a scale for the configured cache budgets:
+# * the caches shrink quickly once available memory gets low
+#   or the process uses too much of the memory
+# * they grow slowly again once there is plenty of available memory
+# * the scale always stays between a minimum and a maximum, so the cache
+#   neither becomes useless nor takes over the memory
+#
+# On Linux (and Android) the memory status comes from /proc/meminfo and /proc/self/statm.
+
+import os
+
+import logging
+log = logging.getLogger("core.memory")
+
+MEMINFO_PATH = "/proc/meminfo"
+STATM_PATH = "/proc/self/statm"
+
+# scale applied to the configured cache budgets
+MIN_CACHE_SCALE = 0.25
+MAX_CACHE_SCALE = 4.0
+# shrink the caches if less than this fraction of memory is available
+LOW_MEMORY_RATIO = 0.1
+# grow the caches if more than this fraction of memory is available
+HIGH_MEMORY_RATIO = 0.3
+# shrink the caches if the process uses more than this fraction of memory
+HIGH_RSS_RATIO = 0.5
+# how much to shrink & grow the scale in a single step
+SHRINK_FACTOR = 0.5
+GROW_FACTOR = 1.25
+
+class MemoryStatus(object):
+    """Memory status of the system and the current process"""
+
+    def __init__(self, total, available, rss=None):
+        """
+        :param int total: total system memory in bytes
+        :param int available: memory available to applications in bytes
+        :param rss: resident set size of the process in bytes (if known)
+        """
+        self.total = total
+        self.available = available
+        self.rss = rss
+
+    @property
+    def available_ratio(self):
+        return self.available / float(self.total)
+
+    @property
+    def rss_ratio(self):
+        if self.rss is None:
+            return None
+        return self.rss / float(self.total)
+
+    def __repr__(self):
+        return "MemoryStatus(total=%d, available=%d, rss=%s)" % (self.total, self.available, self.rss)
+
+def parse_meminfo(text):
+    """Parse content of /proc/meminfo
+
+    :param str text: content of /proc/meminfo
+    :returns: values in bytes keyed by field name
+    :rtype: dict
+    """
+    values = {}
+    for line in text.splitlines():
+        name, _sep, value = line.partition(":")
+        fields = value.split()
+        if not fields:
+            continue
+        try:
+            number = int(fields[0])
+        except ValueError:
+            continue
+        if len(fields) > 1 and fields[1] == "kB":
+            number *= 1024
+        values[name.strip()] = number
+    return values
+
+def get_available_memory(meminfo):
+    """Get memory available to applications from parsed /proc/meminfo
+
+    Older kernels (such as the one on the N900) don't report MemAvailable,
+    free memory & page cache are used as an estimate on those.
+
+    :param dict meminfo: parsed /proc/meminfo
+    :returns: available memory in bytes
+    :rtype: int
+    """
+    if "MemAvailable" in meminfo:
+        return meminfo["MemAvailable"]
+    return meminfo.get("MemFree", 0) + meminfo.get("Buffers", 0) + meminfo.get("Cached", 0)
+
+def read_memory_status(meminfo_path=MEMINFO_PATH, statm_path=STATM_PATH):
+    """Read current memory status from /proc
+
+    :returns: memory status or None if it can't be read
+    :rtype: MemoryStatus or None
+    """
+    try:
+        with open(meminfo_path, "r") as f:
+            meminfo = parse_meminfo(f.read())
+    except (IOError, OSError):
+        return None
+    total = meminfo.get("MemTotal")
+    if not total:
+        return None
+    rss = None
+    try:
+        with open(statm_path, "r") as f:
+            # the second field is resident set size in pages
+            rss = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    return MemoryStatus(total, get_available_memory(meminfo), rss)
+
+def scale_limit(limit, scale):
+    """Scale a cache limit, keeping limits <= 0 (no limit) unchanged
+
+    A positive limit never drops below 1, as that would turn it into no limit.
+
+    :param int limit: configured limit
+    :param float scale: scale to apply
+    :returns: the scaled limit
+    :rtype: int
+    """
+    if limit <= 0:
+        return limit
+    return max(1, int(limit * scale))
+
+class CacheSizeController(object):
+    """Turns memory status into a scale for cache budgets"""
+
+    def __init__(self, min_scale=MIN_CACHE_SCALE, max_scale=MAX_CACHE_SCALE, scale=1.0):
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self._scale = self._clamp(scale)
+
+    def _clamp(self, scale):
+        return min(self.max_scale, max(self.min_scale, scale))
+
+    @property
+    def scale(self):
+        return self._scale
+
+    def update(self, status):
+        """Update the scale according to current memory status
+
+        :param MemoryStatus status: current memory status
+        :returns: the new scale if it has changed, else None
+        :rtype: float or None
+        """
+        scale = self._scale
+        rss_ratio = status.rss_ratio
+        if status.available_ratio < LOW_MEMORY_RATIO or (rss_ratio is not None and rss_ratio > HIGH_RSS_RATIO):
+            scale = self._clamp(scale * SHRINK_FACTOR)
+        elif status.available_ratio > HIGH_MEMORY_RATIO:
+            scale = self._clamp(scale * GROW_FACTOR)
+        if scale == self._scale:
+            return None
+        self._scale = scale
+        return scale
@@ -0,0 +1,163 @@
+# Map tile image filters
+#
+# Filters change the colours of map tiles, such as inverting them for the night theme.
+# Every filter is a colour matrix applied to the RGB channels of each pixel
+# (alpha is kept as it is):
+#
+#   [r', g', b'] = matrix * [r, g, b] + offset
+#
+# so a chain of filters (such as invert & dim) can be combined into a single matrix
+# and applied to the whole tile at once as a NumPy array operation rather than
+# pixel by pixel.
+#
+# Filtering a tile means decoding it, transforming the pixels and encoding it again,
+# which is too slow to be done while the GUI is waiting for the tile, so the map tiles
+# module does it in a thread pool and caches the results (see mod_mapTiles).
+#
+# NumPy and PIL (Pillow) are needed for filtering tiles, filtering is not available
+# if any of them is missing.
+
+from io import BytesIO
+
+try:
+    import numpy
+    from PIL import Image
+    FILTERING_AVAILABLE = True
+except ImportError:
+    numpy = None
+    Image = None
+    FILTERING_AVAILABLE = False
+
+import logging
+log = logging.getLogger("core.tile_filters")
+
+# the same filter is used for images of all formats, tiles are re-encoded as lossless PNG
+FILTERED_TILE_FORMAT = "PNG"
+
+IDENTITY_MATRIX = ((1.0, 0.0, 0.0),
+                   (0.0, 1.0, 0.0),
+                   (0.0, 0.0, 1.0))
+
+def _multiply(a, b):
+    """Multiply two 3x3 matrices given as tuples of rows"""
+    return tuple(tuple(sum(a[row][i] * b[i][column] for i in range(3)) for column in range(3))
+                 for row in range(3))
+
+def _transform(matrix, vector):
+    """Multiply a 3 item vector by a 3x3 matrix"""
+    return tuple(sum(matrix[row][i] * vector[i] for i in range(3)) for row in range(3))
+
+class TileFilter(object):
+    """A colour matrix filter for map tiles"""
+
+    def __init__(self, filterId, matrix=IDENTITY_MATRIX, offset=(0.0, 0.0, 0.0)):
+        """
+        :param str filterId: unique id of the filter, filtered tiles are cached by it
+        :param matrix: 3x3 colour matrix as a tuple of rows
+        :param offset: value added to each channel after the matrix has been applied
+        """
+        self._filterId = filterId
+        self._matrix = tuple(tuple(float(value) for value in row) for row in matrix)
+        self._offset = tuple(float(value) for value in offset)
+
+    @property
+    def filterId(self):
+        return self._filterId
+
+    @property
+    def matrix(self):
+        return self._matrix
+
+    @property
+    def offset(self):
+        return self._offset
+
+    def then(self, other, filterId=None):
+        """Combine this filter with a filter applied after it into a single filter
+
+        :param TileFilter other: filter to apply after this filter
+        :param filterId: id of the combined filter, "<this id>+<other id>" by default
+        :rtype: TileFilter
+        """
+        if filterId is None:
+            filterId = "%s+%s" % (self.filterId, other.filterId)
+        matrix = _multiply(other.matrix, self.matrix)
+        offset = tuple(a + b for a, b in zip(_transform(other.matrix, self.offset), other.offset))
+        return TileFilter(filterId, matrix, offset)
+
+    def applyToArray(self, pixels):
+        """Apply the filter to an array of pixels
+
+        :param pixels: NumPy uint8 array of shape (height, width, channels),
+                       with the RGB channels first
+        :returns: new filtered array of the same shape
+        """
+        rgb = pixels[..., :3].astype(numpy.float32)
+        filtered = numpy.dot(rgb, numpy.array(self._matrix, dtype=numpy.float32).T)
+        filtered += numpy.array(self._offset, dtype=numpy.float32)
+        result = pixels.copy()
+        result[..., :3] = numpy.clip(filtered, 0, 255).astype(numpy.uint8)
+        return result
+
+    def applyToTileData(self, tileData):
+        """Decode tile image data, apply the filter and encode it again
+
+        :param tileData: tile image data (bytes, bytearray or memoryview)
+        :returns: filtered tile image data
+        :rtype: bytearray
+        """
+        image = Image.open(BytesIO(tileData))
+        if image.mode not in ("RGB", "RGBA"):
+            # palette & grayscale images
+            if "transparency" in image.info or image.mode in ("LA", "PA"):
+                image = image.convert("RGBA")
+            else:
+                image = image.convert("RGB")
+        pixels = self.applyToArray(numpy.asarray(image))
+        output = BytesIO()
+        Image.fromarray(pixels, image.mode).save(output, FILTERED_TILE_FORMAT)
+        return bytearray(output.getvalue())
+
+    def __repr__(self):
+        return "TileFilter(%s)" % self._filterId
+
+def invertFilter():
+    """Invert the tile colours"""
+    return TileFilter("invert", ((-1, 0, 0), (0, -1, 0), (0, 0, -1)), (255, 255, 255))
+
+def dimFilter(factor=0.7):
+    """Make the tile darker
+
+    :param float factor: brightness of the filtered tile, 1.0 keeps the tile as it is
+    """
+    return TileFilter("dim%g" % factor, ((factor, 0, 0), (0, factor, 0), (0, 0, factor)))
+
+def grayscaleFilter():
+    """Convert the tile to grayscale (ITU-R 601-2 luma)"""
+    luma = (0.299, 0.587, 0.114)
+    return TileFilter("grayscale", (luma, luma, luma))
+
+def nightFilter():
+    """Invert and dim the tile, so it is not too bright in the dark"""
+    return invertFilter().then(dimFilter(0.8), filterId="night")
+
+# filters that can be selected by id
+FILTERS = {
+    "invert": invertFilter,
+    "dim": dimFilter,
+    "grayscale": grayscaleFilter,
+    "night": nightFilter,
+}
+
+def getFilter(filterId):
+    """Get a filter by id
+
+    :param str filterId: id of the filter
+    :returns: the filter or None if there is no such filter
+    :rtype: TileFilter or None
+    """
+    factory = FILTERS.get(filterId)
+    if factory is None:
+        log.error("unknown tile filter: %s", filterId)
+        return None
+    return factory()
@@ -0,0 +1,149 @@
+# Tile host sharding
+#
+# Many tile servers serve the same tiles from a couple of host names
+# (a.tile.example.org, b.tile.example.org, ...), both to spread the load
+# and because HTTP clients & CDNs limit the number of connections per host name.
+# Layers list such subdomains in their configuration and use the {s} placeholder
+# in their URL (see core.tiles.TileUrlTemplate).
+#
+# HostShards picks the subdomain for each tile download:
+# * hash - the subdomain depends on the tile coordinates, so a tile is always
+#          downloaded from the same host (which plays well with HTTP caches)
+# * round robin - subdomains are used in turn, spreading the load evenly
+# and keeps track of the health of each host - a host is skipped for a while once
+# a couple downloads from it in a row fail, as long as some other host is healthy.
+
+from __future__ import with_statement
+
+import threading
+import time
+
+import logging
+log = logging.getLogger("core.tile_hosts")
+
+SELECTION_HASH = "hash"
+SELECTION_ROUND_ROBIN = "round_robin"
+
+# a host is skipped after this many failed downloads in a row
+FAILURE_THRESHOLD = 3
+# for this long (in seconds)
+RETRY_INTERVAL = 30
+
+class HostStats(object):
+    """Download statistics & health of a single host"""
+
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.consecutiveFailures = 0
+        # the host is skipped until this timestamp
+        self.unhealthyUntil = 0
+
+    def asDict(self):
+        return {"requests": self.requests,
+                "failures": self.failures,
+                "consecutiveFailures": self.consecutiveFailures,
+                "healthy": self.unhealthyUntil <= time.time()}
+
+class HostShards(object):
+    """Spreads tile downloads of a layer over its subdomains"""
+
+    def __init__(self, subdomains, selection=SELECTION_HASH,
+                 failureThreshold=FAILURE_THRESHOLD, retryInterval=RETRY_INTERVAL):
+        """
+        :param list subdomains: subdomains of the layer, an empty list if the layer has just one host
+        :param str selection: SELECTION_HASH or SELECTION_ROUND_ROBIN
+        :param int failureThreshold: number of failed downloads in a row after which a host is skipped
+        :param retryInterval: how long to skip a failing host (in seconds)
+        """
+        if selection not in (SELECTION_HASH, SELECTION_ROUND_ROBIN):
+            log.error("unknown subdomain selection: %s, using %s", selection, SELECTION_HASH)
+            selection = SELECTION_HASH
+        self._subdomains = list(subdomains)
+        self._selection = selection
+        self._failureThreshold = failureThreshold
+        self._retryInterval = retryInterval
+        self._lock = threading.Lock()
+        self._nextIndex = 0
+        self._stats = dict((subdomain, HostStats()) for subdomain in self._subdomains)
+
+    @property
+    def subdomains(self):
+        return self._subdomains
+
+    @property
+    def selection(self):
+        return self._selection
+
+    def select(self, z, x, y):
+        """Select the subdomain to download a tile from
+
+        :returns: the subdomain or None if the layer has no subdomains
+        :rtype: str or None
+        """
+        count = len(self._subdomains)
+        if not count:
+            return None
+        with self._lock:
+            if self._selection == SELECTION_ROUND_ROBIN:
+                index = self._nextIndex
+                self._nextIndex = (index + 1) % count
+            else:
+                index = (x + y) % count
+            # skip unhealthy hosts, but use the selected one if no host is healthy
+            now = time.time()
+            for offset in range(count):
+                subdomain = self._subdomains[(index + offset) % count]
+                if self._stats[subdomain].unhealthyUntil <= now:
+                    return subdomain
+            return self._subdomains[index]
+
+    def isHealthy(self, subdomain):
+        with self._lock:
+            stats = self._stats.get(subdomain)
+            return stats is None or stats.unhealthyUntil <= time.time()
+
+    def reportSuccess(self, subdomain):
+        """Report a successful download from a subdomain"""
+        with self._lock:
+            stats = self._stats.get(subdomain)
+            if stats is not None:
+                stats.requests += 1
+                stats.consecutiveFailures = 0
+                stats.unhealthyUntil = 0
+
+    def reportFailure(self, subdomain):
+        """Report a failed download from a subdomain"""
+        with self._lock:
+            stats = self._stats.get(subdomain)
+            if stats is None:
+                return
+            stats.requests += 1
+            stats.failures += 1
+            stats.consecutiveFailures += 1
+            if stats.consecutiveFailures >= self._failureThreshold:
+                if stats.unhealthyUntil <= time.time():
+                    log.warning("skipping tile host %s for %d s after %d failed downloads",
+                                subdomain, self._retryInterval, stats.consecutiveFailures)
+                stats.unhealthyUntil = time.time() + self._retryInterval
+
+    def reportStatus(self, subdomain, status):
+        """Report a HTTP response from a subdomain
+
+        Server errors & rate limiting count as failures, other responses as success.
+
+        :param int status: HTTP status code
+        """
+        if status >= 500 or status == 429:
+            self.reportFailure(subdomain)
+        else:
+            self.reportSuccess(subdomain)
+
+    def getStats(self):
+        """Get download statistics of all subdomains
+
+        :returns: statistics dictionaries keyed by subdomain
+        :rtype: dict
+        """
+        with self._lock:
+            return dict((subdomain, stats.asDict()) for subdomain, stats in self._stats.items())
@@ -0,0 +1,252 @@
+# Viewport priority tile download scheduler
+#
+# The map views request tiles as they are drawn, so after fast panning or zooming
+# there are many download requests waiting for tiles that are no longer visible.
+# The scheduler keeps the waiting tile download requests ordered by how useful
+# the tiles are for what is currently shown:
+# * tiles close to the centre of a map view viewport are downloaded first
+# * tiles from other zoom levels than the viewport zoom level are downloaded later
+# * requests for tiles outside of all viewports (plus a margin) are cancelled
+#   once the viewports change
+# * requests with the same priority are handled newest first (as with the old
+#   LIFO request stack), so without any viewport set the order is LIFO
+# * low priority requests (such as background refreshes of stored tiles)
+#   are only handled once there are no other requests waiting
+#
+# Once the scheduler is full, the request with the lowest priority is dropped.
+# The scheduler also counts requests that have been dropped or cancelled and
+# downloads that were wasted - finished once the tile was no longer visible.
+
+from __future__ import with_statement
+
+import heapq
+import math
+import threading
+
+# viewport margin in tiles, requests for tiles further away from all viewports are cancelled
+DEFAULT_MARGIN = 2
+# requests for tiles with zoom level differing more from all viewports are cancelled
+DEFAULT_MAX_ZOOM_DIFFERENCE = 2
+# a zoom level of difference counts as this many tiles of distance from the viewport centre
+DEFAULT_ZOOM_WEIGHT = 4.0
+
+class Viewport(object):
+    """Tiles shown in a map view"""
+
+    def __init__(self, layerIds, z, cornerX, cornerY, tilesX, tilesY):
+        """
+        :param layerIds: ids of layers shown in the map view
+        :param int z: zoom level
+        :param int cornerX: x coordinate of the top left tile
+        :param int cornerY: y coordinate of the top left tile
+        :param int tilesX: number of tiles in the x direction
+        :param int tilesY: number of tiles in the y direction
+        """
+        self.layerIds = set(layerIds)
+        self.z = z
+        self.halfWidth = tilesX / 2.0
+        self.halfHeight = tilesY / 2.0
+        self.centerX = cornerX + self.halfWidth
+        self.centerY = cornerY + self.halfHeight
+
+    def rank(self, layerId, z, x, y, margin, maxZoomDifference, zoomWeight):
+        """Rank a tile by its distance from the viewport
+
+        :returns: priority (lower is more important) or None if the tile
+                  is outside of the viewport & its margin
+        :rtype: float or None
+        """
+        if layerId not in self.layerIds:
+            return None
+        zoomDifference = abs(z - self.z)
+        if zoomDifference > maxZoomDifference:
+            return None
+        # tile centre & size in tiles of the viewport zoom level
+        scale = 2.0 ** (self.z - z)
+        halfSize = scale / 2.0
+        dx = abs((x + 0.5) * scale - self.centerX)
+        # tile x coordinates wrap around the antimeridian
+        worldSize = 2 ** self.z
+        dx = min(dx, abs(worldSize - dx))
+        dy = abs((y + 0.5) * scale - self.centerY)
+        # tiles just touching the edge of the margin are outside
+        if dx - halfSize >= self.halfWidth + margin or dy - halfSize >= self.halfHeight + margin:
+            return None
+        return math.sqrt(dx * dx + dy * dy) + zoomWeight * zoomDifference
+
+class TileRequest(object):
+    """A tile download request waiting in the scheduler"""
+
+    __slots__ = ("lzxy", "tag", "timestamp", "overwrite", "lowPriority", "priority", "sequence", "removed")
+
+    def __init__(self, lzxy, tag, timestamp, overwrite, lowPriority):
+        self.lzxy = lzxy
+        self.tag = tag
+        self.timestamp = timestamp
+        self.overwrite = overwrite
+        self.lowPriority = lowPriority
+        self.priority = 0.0
+        self.sequence = 0
+        # removed requests are skipped once they get to the top of the heap
+        self.removed = False
+
+    def _entry(self):
+        # low priority requests after all the others, then by priority, newest first
+        # (the sequence is unique, so the request itself is never compared)
+        return self.lowPriority, self.priority, -self.sequence, self
+
+    def __repr__(self):
+        return "TileRequest(%s, %s, priority=%1.2f)" % (self.lzxy, self.tag, self.priority)
+
+class TileDownloadScheduler(object):
+    """Orders waiting tile download requests by distance from the map view viewports"""
+
+    def __init__(self, maxSize=0, margin=DEFAULT_MARGIN,
+                 maxZoomDifference=DEFAULT_MAX_ZOOM_DIFFERENCE, zoomWeight=DEFAULT_ZOOM_WEIGHT):
+        """
+        :param int maxSize: maximum number of waiting requests, 0 for no limit
+        :param margin: viewport margin in tiles
+        :param int maxZoomDifference: maximum zoom level difference from a viewport
+        :param float zoomWeight: distance in tiles a zoom level of difference counts as
+        """
+        self._maxSize = maxSize
+        self._margin = margin
+        self._maxZoomDifference = maxZoomDifference
+        self._zoomWeight = zoomWeight
+        self._lock = threading.Lock()
+        self._heap = []
+        # (lzxy, tag, lowPriority) -> waiting request
+        self._requests = {}
+        self._viewports = []
+        self._sequence = 0
+        # counters
+        self._added = 0
+        self._dropped = 0
+        self._cancelled = 0
+        self._completed = 0
+        self._wasted = 0
+
+    def _rank(self, lzxy):
+        """Get priority of a tile
+
+        :returns: priority or None if the tile is outside of all viewports
+        """
+        if not self._viewports:
+            # without viewports all tiles are equally important
+            return 0.0
+        layer, z, x, y = lzxy
+        priorities = [viewport.rank(layer.id, z, x, y, self._margin, self._maxZoomDifference, self._zoomWeight)
+                      for viewport in self._viewports]
+        priorities = [priority for priority in priorities if priority is not None]
+        if priorities:
+            return min(priorities)
+        return None
+
+    def add(self, lzxy, tag=None, timestamp=None, overwrite=False, lowPriority=False):
+        """Add a download request
+
+        A tile outside of all viewports is still added - the viewports might not
+        be up to date yet - but with the lowest priority.
+
+        :param tuple lzxy: the tile
+        :param tag: tracking tag of the request
+        :param timestamp: when was the request made
+        :param bool overwrite: download the tile even if it is stored
+        :param bool lowPriority: only handle the request once no other requests are waiting
+        :returns: request dropped because the scheduler is full (which might be the new request)
+                  or None
+        :rtype: TileRequest or None
+        """
+        request = TileRequest(lzxy, tag, timestamp, overwrite, lowPriority)
+        key = (lzxy, tag, lowPriority)
+        with self._lock:
+            self._added += 1
+            previous = self._requests.pop(key, None)
+            if previous is not None:
+                # the same request again, just make it the newest one
+                previous.removed = True
+            priority = self._rank(lzxy)
+            request.priority = float("inf") if priority is None else priority
+            self._sequence += 1
+            request.sequence = self._sequence
+            self._requests[key] = request
+            heapq.heappush(self._heap, request._entry())
+            dropped = None
+            if self._maxSize and len(self._requests) > self._maxSize:
+                dropped = max(self._requests.values(), key=lambda r: r._entry()[:3])
+                self._remove(dropped)
+                self._dropped += 1
+            return dropped
+
+    def _remove(self, request):
+        request.removed = True
+        del self._requests[(request.lzxy, request.tag, request.lowPriority)]
+
+    def pop(self):
+        """Get the most important waiting request
+
+        :returns: the request or None if no requests are waiting
+        :rtype: TileRequest or None
+        """
+        with self._lock:
+            while self._heap:
+                request = heapq.heappop(self._heap)[3]
+                if not request.removed:
+                    self._remove(request)
+                    return request
+            return None
+
+    def setViewports(self, viewports):
+        """Set viewports of the map views & re-rank the waiting requests
+
+        :param list viewports: list of Viewport instances
+        :returns: requests cancelled as their tiles are outside of all viewports
+        :rtype: list
+        """
+        cancelled = []
+        with self._lock:
+            self._viewports = list(viewports)
+            for request in list(self._requests.values()):
+                priority = self._rank(request.lzxy)
+                if priority is None:
+                    self._remove(request)
+                    cancelled.append(request)
+                else:
+                    request.priority = priority
+            self._cancelled += len(cancelled)
+            self._heap = [request._entry() for request in self._requests.values()]
+            heapq.heapify(self._heap)
+        return cancelled
+
+    def isVisible(self, lzxy):
+        """Report if a tile is in a viewport or its margin (or if no viewports are set)"""
+        with self._lock:
+            return self._rank(lzxy) is not None
+
+    def requestDone(self, request):
+        """Report a request has been handled, to count downloads of tiles no longer visible"""
+        visible = self.isVisible(request.lzxy)
+        with self._lock:
+            self._completed += 1
+            if not visible:
+                self._wasted += 1
+
+    def __len__(self):
+        with self._lock:
+            return len(self._requests)
+
+    def getStats(self):
+        """Get scheduler statistics
+
+        :returns: dictionary with the number of requests waiting (queued), added,
+                  dropped when full, cancelled on viewport change, completed
+                  & completed once the tile was no longer visible (wasted)
+        :rtype: dict
+        """
+        with self._lock:
+            return {"queued": len(self._requests),
+                    "added": self._added,
+                    "dropped": self._dropped,
+                    "cancelled": self._cancelled,
+                    "completed": self._completed,
+                    "wasted": self._wasted}
@@ -26,7 +26,17 @@ class BaseTileStore(object):
     def store_path(self):
         return self._store_path
 
-    def store_tile_data(self, lzxy, tile_data):
+    def store_tile_data(self, lzxy, tile_data, etag=None, last_modified=None, timestamp=None):
+        """Store data for a single tile
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+        :param bytes tile_data: tile data to store
+        :param etag: value of the ETag HTTP header the tile has been served with (if any)
+        :param last_modified: value of the Last-Modified HTTP header the tile
+                              has been served with (if any)
+        :param timestamp: UNIX timestamp of the tile, defaults to the current time
+                          (set when moving already stored tiles between stores)
+        """
         pass
 
     def get_tile(self, lzxy):
@@ -35,9 +45,153 @@ class BaseTileStore(object):
     def tile_is_stored(self, lzxy):
         pass
 
+    def get_tiles(self, lzxy_iterable):
+        """Get data and timestamps for multiple tiles at once
+
+        Stores should override this if they can fetch multiple tiles
+        more efficiently than by calling get_tile() for each tile.
+
+        :param lzxy_iterable: an iterable of lzxy tuples
+        :returns: a dictionary with (tile data, timestamp) tuples for all tiles that
+                  have been found in the store under their lzxy tuples
+        :rtype: dict
+        """
+        found_tiles = {}
+        for lzxy in lzxy_iterable:
+            tile_tuple = self.get_tile(lzxy)
+            if tile_tuple is not None:
+                found_tiles[lzxy] = tile_tuple
+        return found_tiles
+
+    def tiles_stored(self, lzxy_iterable):
+        """Report which of the given tiles are stored
+
+        Stores should override this if they can check multiple tiles
+        more efficiently than by calling tile_is_stored() for each tile.
+
+        :param lzxy_iterable: an iterable of lzxy tuples
+        :returns: a dictionary with timestamps for all tiles that have been
+                  found in the store under their lzxy tuples
+        :rtype: dict
+        """
+        stored_tiles = {}
+        for lzxy in lzxy_iterable:
+            tile_tuple = self.tile_is_stored(lzxy)
+            if tile_tuple:
+                stored_tiles[lzxy] = tile_tuple[1]
+        return stored_tiles
+
+    def get_tile_validators(self, lzxy):
+        """Get HTTP cache validators stored together with a tile
+
+        The validators can be used for a conditional request when refreshing the tile,
+        so that an unchanged tile does not need to be downloaded again.
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+        :returns: (etag, last_modified) tuple or None if the store has no validators for the tile
+        :rtype: tuple or None
+        """
+        return None
+
+    def touch_tile(self, lzxy, etag=None, last_modified=None):
+        """Mark a stored tile as fresh without rewriting its data
+
+        Used when the tile server reports the tile has not been modified, the tile timestamp
+        is set to the current time and the validators are replaced if new ones are given.
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+        :param etag: new ETag of the tile or None to keep the current one
+        :param last_modified: new Last-Modified value of the tile or None to keep the current one
+        :returns: True if the tile has been found & touched, else False
+        :rtype: bool
+        """
+        return False
+
     def delete_tile(self, lzxy):
         pass
 
+    def delete_tiles(self, lzxy_iterable):
+        """Delete multiple tiles at once
+
+        Stores should override this if they can delete multiple tiles
+        more efficiently than by calling delete_tile() for each tile.
+
+        :param lzxy_iterable: an iterable of lzxy tuples
+        """
+        for lzxy in lzxy_iterable:
+            self.delete_tile(lzxy)
+
+    def delete_region(self, tile_ranges):
+        """Delete all tiles in the given tile coordinate ranges
+
+        :param tile_ranges: iterable of (z, min x, max x, min y, max y) tuples, inclusive
+        :returns: number of deleted tiles
+        :rtype: int
+        """
+        raise NotImplementedError("deleting regions is not supported by %s" % self)
+
+    def delete_older_than(self, timestamp, chunk_callback=None):
+        """Delete all tiles with timestamp older than the given timestamp
+
+        :param timestamp: UNIX timestamp
+        :param chunk_callback: optional function called with the number of tiles deleted so far
+                               after each chunk of tiles, the deletion stops if it returns False
+                               (can be used to pause the deletion, so that it does not hog the store)
+        :returns: number of deleted tiles
+        :rtype: int
+        """
+        raise NotImplementedError("deleting old tiles is not supported by %s" % self)
+
+    def iter_tiles(self):
+        """Iterate over coordinates of all tiles in the store
+
+        Used for building indexes of stored tiles, such as the tile existence filter.
+
+        :returns: iterator of (z, x, y) tuples
+        """
+        raise NotImplementedError("listing tiles is not supported by %s" % self)
+
+    def get_modification_stamp(self):
+        """Get a stamp that changes whenever tiles are added to or removed from the store
+
+        The stamp is only meaningful once the store has been closed (or flushed) and is used
+        to check if an index of stored tiles (such as the tile existence filter) saved
+        together with the stamp still describes the store.
+
+        :returns: JSON serializable stamp or None if the store can't provide one
+        """
+        return None
+
+    def get_size(self):
+        """Get the amount of space used by the store
+
+        :returns: used space in bytes or None if the store can't report it
+        :rtype: int or None
+        """
+        return None
+
+    def get_stats(self):
+        """Get per zoom level statistics of the stored tiles
+
+        Stores keep the statistics up to date as tiles are stored and deleted,
+        so this should not need to look at all the stored tiles.
+
+        :returns: statistics of the stored tiles or None if the store can't provide them
+        :rtype: TileStats or None
+        """
+        return None
+
+    def evict(self, bytes_to_free):
+        """Delete least recently accessed tiles until the given amount of space is freed
+
+        Stores that don't track tile access (such as read only stores) don't evict anything.
+
+        :param int bytes_to_free: how much space to free
+        :returns: how much space has been actually freed in bytes
+        :rtype: int
+        """
+        return 0
+
     def clear(self):
         """Clear the store from permanent storage"""
         pass
@@ -1 +1,5 @@
 GIBI_BYTE = 2**30
+MEBI_BYTE = 2**20
+# tile access times are only tracked with this resolution, so that reading a tile
+# results in at most one access time update per tile and period
+ACCESS_TIME_RESOLUTION = 3600  # in seconds
@@ -1,4 +1,8 @@
 """Exceptions raised by classes from the Tile Storage module"""
 
 class TileStoreInitializationFailed(Exception):
-    pass
\ No newline at end of file
+    pass
+
+class TileStoreWriteFailed(Exception):
+    """Tiles could not be written to permanent storage"""
+    pass
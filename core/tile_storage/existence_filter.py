@@ -0,0 +1,321 @@
+# An in-memory tile existence filter
+#
+# Looking for a tile that is not stored is the common case when panning to an area
+# that has not been visited before, yet each such miss costs a couple stat/glob calls
+# in the file based store and a couple queries in the SQLite store. The existence filter
+# keeps track of which tiles are stored, so that definite misses can be answered without
+# touching the disk at all.
+#
+# The filter is kept separately for each zoom level:
+# * low zoom levels use an exact bitmap with a bit for every tile on the zoom level
+#   (4^z bits, 128 kB for zoom level 10)
+# * higher zoom levels use a scalable Bloom filter - a list of Bloom filters where a new,
+#   larger and tighter one is added once the last one is full - so we don't need to
+#   know the number of tiles in advance
+#
+# Both can return false positives (a tile is reported as possibly stored when it is not)
+# - this only means the stores are checked as if there was no filter. But there are
+# no false negatives as long as all tiles are added to the filter when stored.
+#
+# The filter can be saved to a file next to the store and loaded again, together with
+# a modification stamp of the stores it describes, so that it does not need to be
+# rebuilt by listing all the stored tiles every time the stores are opened.
+
+from __future__ import with_statement
+
+import os
+import math
+import json
+import struct
+import threading
+
+import logging
+log = logging.getLogger("tile_storage.existence_filter")
+
+EXISTENCE_FILTER_FILE_NAME = "tile_existence.filter"
+EXISTENCE_FILTER_FORMAT_VERSION = 1
+_FILE_MAGIC = b"TEF"
+_HEADER_LENGTH_FORMAT = "!I"
+
+# highest zoom level that uses an exact bitmap
+BITMAP_MAX_ZOOM = 10
+# number of tiles the first Bloom filter of a zoom level can hold
+BLOOM_INITIAL_CAPACITY = 4096
+# false positive rate of the first Bloom filter of a zoom level
+BLOOM_ERROR_RATE = 0.01
+# each following Bloom filter is this many times bigger than the previous one
+BLOOM_GROWTH_FACTOR = 2
+# each following Bloom filter has this many times lower false positive rate,
+# so the overall false positive rate is bounded by BLOOM_ERROR_RATE / (1 - BLOOM_TIGHTENING_RATIO)
+BLOOM_TIGHTENING_RATIO = 0.8
+
+_MASK_64 = 2**64 - 1
+
+def _hash_xy(x, y):
+    """Hash tile coordinates to a 64 bit integer (the SplitMix64 finalizer)"""
+    h = ((x << 32) ^ y) + 0x9E3779B97F4A7C15
+    h = ((h ^ (h >> 30)) * 0xBF58476D1CE4E5B9) & _MASK_64
+    h = ((h ^ (h >> 27)) * 0x94D049BB133111EB) & _MASK_64
+    return h ^ (h >> 31)
+
+def _read_exactly(f, size):
+    """Read exactly size bytes from the file or raise an IOError if it ends too early"""
+    data = f.read(size)
+    if len(data) != size:
+        raise IOError("unexpected end of file")
+    return bytearray(data)
+
+class _Bitmap(object):
+    """An exact tile bitmap for a single zoom level"""
+
+    kind = "bitmap"
+
+    def __init__(self, z, bits=None):
+        self._side = 2**z
+        if bits is None:
+            bits = bytearray((self._side * self._side + 7) // 8)
+        self.bits = bits
+
+    def _in_range(self, x, y):
+        return 0 <= x < self._side and 0 <= y < self._side
+
+    def add(self, x, y):
+        if self._in_range(x, y):
+            index = y * self._side + x
+            self.bits[index >> 3] |= 1 << (index & 7)
+
+    def remove(self, x, y):
+        if self._in_range(x, y):
+            index = y * self._side + x
+            self.bits[index >> 3] &= ~(1 << (index & 7)) & 0xFF
+
+    def __contains__(self, xy):
+        x, y = xy
+        if not self._in_range(x, y):
+            # tiles with invalid coordinates are not tracked
+            return True
+        index = y * self._side + x
+        return bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def get_state(self):
+        return {}, [self.bits]
+
+class _BloomFilter(object):
+    """A fixed size Bloom filter"""
+
+    def __init__(self, capacity, error_rate, bit_count=None, hash_count=None, count=0, bits=None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        if bit_count is None:
+            # optimal filter size & number of hashes for the given capacity and error rate
+            bit_count = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+            hash_count = max(1, int(round(bit_count / float(capacity) * math.log(2))))
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+        self.count = count
+        if bits is None:
+            bits = bytearray((bit_count + 7) // 8)
+        self.bits = bits
+
+    def _indexes(self, x, y):
+        h = _hash_xy(x, y)
+        # double hashing - derive all the indexes from two halves of a single hash
+        h1 = h & 0xFFFFFFFF
+        h2 = (h >> 32) | 1
+        bit_count = self.bit_count
+        return [(h1 + i * h2) % bit_count for i in range(self.hash_count)]
+
+    def add(self, x, y):
+        bits = self.bits
+        new_bit = False
+        for index in self._indexes(x, y):
+            mask = 1 << (index & 7)
+            if not bits[index >> 3] & mask:
+                bits[index >> 3] |= mask
+                new_bit = True
+        if new_bit:
+            # only count tiles that were not (seemingly) added before
+            self.count += 1
+
+    def __contains__(self, xy):
+        bits = self.bits
+        for index in self._indexes(xy[0], xy[1]):
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+class _ScalableBloomFilter(object):
+    """A Bloom filter for a single zoom level that grows as tiles are added"""
+
+    kind = "bloom"
+
+    def __init__(self, filters=None):
+        self._filters = filters or []
+
+    def add(self, x, y):
+        if (x, y) in self:
+            return
+        if not self._filters or self._filters[-1].full:
+            if self._filters:
+                last = self._filters[-1]
+                capacity = last.capacity * BLOOM_GROWTH_FACTOR
+                error_rate = last.error_rate * BLOOM_TIGHTENING_RATIO
+            else:
+                capacity = BLOOM_INITIAL_CAPACITY
+                error_rate = BLOOM_ERROR_RATE
+            self._filters.append(_BloomFilter(capacity, error_rate))
+        self._filters[-1].add(x, y)
+
+    def remove(self, x, y):
+        # tiles can't be removed from a Bloom filter, the tile
+        # will just be a false positive from now on
+        pass
+
+    def __contains__(self, xy):
+        for bloom_filter in self._filters:
+            if xy in bloom_filter:
+                return True
+        return False
+
+    def get_state(self):
+        state = {"filters": [{"capacity": f.capacity, "error_rate": f.error_rate,
+                              "bit_count": f.bit_count, "hash_count": f.hash_count,
+                              "count": f.count} for f in self._filters]}
+        return state, [f.bits for f in self._filters]
+
+class TileExistenceFilter(object):
+    """Tracks which tiles are stored, per zoom level
+
+    Until the filter is marked as ready (once it has been built from all tiles in the stores
+    or loaded from a file) all tiles are reported as possibly stored.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._zoom_filters = {}
+        self._ready = False
+
+    @property
+    def ready(self):
+        return self._ready
+
+    def _get_zoom_filter(self, z):
+        zoom_filter = self._zoom_filters.get(z)
+        if zoom_filter is None:
+            if z <= BITMAP_MAX_ZOOM:
+                zoom_filter = _Bitmap(z)
+            else:
+                zoom_filter = _ScalableBloomFilter()
+            self._zoom_filters[z] = zoom_filter
+        return zoom_filter
+
+    def add(self, z, x, y):
+        """Record that a tile has been stored"""
+        with self._lock:
+            self._get_zoom_filter(z).add(x, y)
+
+    def add_many(self, zxy_iterable):
+        """Record that multiple tiles have been stored"""
+        with self._lock:
+            for z, x, y in zxy_iterable:
+                self._get_zoom_filter(z).add(x, y)
+
+    def remove(self, z, x, y):
+        """Record that a tile has been deleted"""
+        with self._lock:
+            zoom_filter = self._zoom_filters.get(z)
+            if zoom_filter is not None:
+                zoom_filter.remove(x, y)
+
+    def set_ready(self):
+        """Mark the filter as holding all stored tiles"""
+        self._ready = True
+
+    def might_contain(self, z, x, y):
+        """Report if the tile might be stored
+
+        :returns: False if the tile is definitely not stored, True if it might be
+        :rtype: bool
+        """
+        if not self._ready:
+            return True
+        with self._lock:
+            zoom_filter = self._zoom_filters.get(z)
+            if zoom_filter is None:
+                return False
+            return (x, y) in zoom_filter
+
+    def save(self, file_path, stamp):
+        """Save the filter to a file
+
+        :param str file_path: where to save the filter
+        :param stamp: JSON serializable modification stamp of the stores described
+                      by the filter, the filter is only loaded if the stamp matches
+        """
+        with self._lock:
+            zooms = []
+            chunks = []
+            for z, zoom_filter in sorted(self._zoom_filters.items()):
+                state, zoom_chunks = zoom_filter.get_state()
+                state["z"] = z
+                state["kind"] = zoom_filter.kind
+                zooms.append(state)
+                chunks.extend(bytes(chunk) for chunk in zoom_chunks)
+        header = json.dumps({"version": EXISTENCE_FILTER_FORMAT_VERSION,
+                             "stamp": stamp, "zooms": zooms}).encode("utf-8")
+        temporary_file_path = file_path + ".part"
+        with open(temporary_file_path, "wb") as f:
+            f.write(_FILE_MAGIC)
+            f.write(struct.pack(_HEADER_LENGTH_FORMAT, len(header)))
+            f.write(header)
+            for chunk in chunks:
+                f.write(chunk)
+        os.rename(temporary_file_path, file_path)
+
+    @classmethod
+    def load(cls, file_path, stamp):
+        """Load a filter saved by save()
+
+        :param str file_path: path to the saved filter
+        :param stamp: current modification stamp of the stores described by the filter
+        :returns: a ready filter or None if there is no saved filter, it can't be loaded
+                  or it has been saved with a different stamp
+        :rtype: TileExistenceFilter or None
+        """
+        if not os.path.isfile(file_path):
+            return None
+        try:
+            with open(file_path, "rb") as f:
+                if f.read(len(_FILE_MAGIC)) != _FILE_MAGIC:
+                    log.warning("%s is not a tile existence filter", file_path)
+                    return None
+                header_length = struct.unpack(_HEADER_LENGTH_FORMAT,
+                                              f.read(struct.calcsize(_HEADER_LENGTH_FORMAT)))[0]
+                header = json.loads(f.read(header_length).decode("utf-8"))
+                if header["version"] != EXISTENCE_FILTER_FORMAT_VERSION:
+                    return None
+                if header["stamp"] != stamp:
+                    log.debug("stores changed since %s has been saved", file_path)
+                    return None
+                existence_filter = cls()
+                for state in header["zooms"]:
+                    z = state["z"]
+                    if state["kind"] == _Bitmap.kind:
+                        zoom_filter = _Bitmap(z)
+                        zoom_filter.bits = _read_exactly(f, len(zoom_filter.bits))
+                    else:
+                        filters = []
+                        for filter_state in state["filters"]:
+                            bits = _read_exactly(f, (filter_state["bit_count"] + 7) // 8)
+                            filters.append(_BloomFilter(bits=bits, **filter_state))
+                        zoom_filter = _ScalableBloomFilter(filters)
+                    existence_filter._zoom_filters[z] = zoom_filter
+        except Exception:
+            log.exception("loading tile existence filter from %s failed", file_path)
+            return None
+        existence_filter.set_ready()
+        return existence_filter
@@ -1,10 +1,20 @@
 from __future__ import with_statement
 import os
-import glob
+import json
 import shutil
 import re
+import time
+import threading
+
+try:  # Python 3.5+
+    from os import scandir
+except ImportError:
+    scandir = None
+
+from collections import OrderedDict
 
 from .base import BaseTileStore
+from .stats import TileStats, TILE_STATS_FILE_NAME
 from . import utils
 
 import logging
@@ -12,6 +22,103 @@ log = logging.getLogger("tile_storage.files_store")
 
 PARTIAL_TILE_FILE_SUFFIX = ".part"
 
+# how many z/x tile folders to keep in the directory index
+DIRECTORY_INDEX_SIZE = 1024
+# rescan indexed folders after this many seconds to pick up
+# tiles added or removed by other processes
+DIRECTORY_INDEX_MAX_AGE = 300  # in seconds
+# save access times of z/x tile folders once this many are waiting for update
+FILES_ACCESS_TIME_BATCH_SIZE = 100
+# access times of z/x tile folders are kept in a sidecar file in the store folder,
+# as a JSON object keyed by "z/x"
+FOLDER_ACCESS_FILE_NAME = "tile_access.json"
+# HTTP cache validators (ETag & Last-Modified) of tiles in a z/x folder are kept
+# in a sidecar file in the folder, as a JSON object keyed by the y coordinate
+VALIDATORS_FILE_NAME = "validators.json"
+
+def _list_folder(path):
+    """List file names in a folder, using scandir where available
+
+    :param str path: path to the folder
+    :returns: list of file names
+    :rtype: list
+    :raises OSError: if the folder does not exist
+    """
+    if scandir is not None:
+        return [entry.name for entry in scandir(path)]
+    else:
+        return os.listdir(path)
+
+class _TileFolder(object):
+    """Directory index entry for a single z/x tile folder
+
+    Tile files are indexed by the y coordinate and extension. Modification times
+    and results of the image magic number checks are filled in lazily,
+    as they need the file to be stat-ed or opened.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.scan_timestamp = time.time()
+        # y -> extension -> [modification time or None, is an image or None]
+        self.tiles = {}
+        try:
+            file_names = _list_folder(path)
+        except OSError:
+            # the folder does not exist (yet), so there are no tiles in it
+            file_names = []
+        for file_name in file_names:
+            if file_name.endswith(PARTIAL_TILE_FILE_SUFFIX):
+                continue
+            y, _dot, extension = file_name.partition(".")
+            try:
+                self.tiles.setdefault(int(y), {})[extension] = [None, None]
+            except ValueError:
+                pass
+
+    def file_path(self, y, extension):
+        return os.path.join(self.path, "%d.%s" % (y, extension))
+
+    def get_mtime(self, y, extension):
+        """Get modification time of a tile file
+
+        :returns: modification time or None if the file no longer exists
+        """
+        file_info = self.tiles[y][extension]
+        if file_info[0] is None:
+            try:
+                file_info[0] = os.path.getmtime(self.file_path(y, extension))
+            except OSError:
+                # the file has been removed behind our back
+                self.remove(y, extension)
+                return None
+        return file_info[0]
+
+    def is_image(self, y, extension):
+        """Report if the tile file starts with an image magic number"""
+        file_info = self.tiles[y][extension]
+        if file_info[1] is None:
+            file_path = self.file_path(y, extension)
+            try:
+                with open(file_path, "rb") as f:
+                    file_info[1] = utils.is_an_image(f.read(32))
+            except Exception:
+                log.exception("checking if tile file is an image failed for %s", file_path)
+                return False
+            if not file_info[1]:
+                log.warning("%s is not an image", file_path)
+        return file_info[1]
+
+    def add(self, y, extension, mtime, is_image):
+        self.tiles.setdefault(y, {})[extension] = [mtime, is_image]
+
+    def remove(self, y, extension):
+        extensions = self.tiles.get(y)
+        if extensions is not None:
+            extensions.pop(extension, None)
+            if not extensions:
+                del self.tiles[y]
+
 def _get_toplevel_tile_folder_list(path):
     """Return a list of toplevel tile folders
        The toplevel tile folders correspond to the zoom level number.
@@ -44,18 +151,55 @@ class FileBasedTileStore(BaseTileStore):
     def __init__(self, store_path, prevent_media_indexing = False):
         BaseTileStore.__init__(self, store_path, prevent_media_indexing=prevent_media_indexing)
 
+        # index of recently used z/x tile folders, so that tile lookups
+        # don't need to stat or glob tile files on every request
+        # - folders are listed with a single scandir call once and then kept up to date
+        #   as tiles are stored & deleted through this store
+        # - least recently used folders are dropped once the index is full
+        self._folder_index = OrderedDict()
+        self._folder_index_lock = threading.RLock()
+        # access times are tracked per z/x tile folder and saved to the folder access sidecar
+        # file in batches, so reading tiles does not write anything to the tile files
+        # (and this works even on filesystems mounted with noatime)
+        self._access_tracker = utils.AccessTimeTracker()
+        self._access_path = os.path.join(self.store_path, FOLDER_ACCESS_FILE_NAME)
+        self._folder_access_lock = threading.Lock()
+        self._folder_access = self._load_folder_access()
+        # serializes read-modify-write cycles of the validator sidecar files
+        self._validators_lock = threading.Lock()
+
         # make sure the folder for the file based tile store exists and is in a correct state,
         # such as that it contains a file that disables media indexing on platforms where this is needed
         utils.check_folder(self.store_path, prevent_media_indexing=prevent_media_indexing)
 
+        # tile statistics are saved next to the tile folders when the store is closed,
+        # if they can't be loaded they are built by a scan of all tile files once requested
+        self._stats_path = os.path.join(self.store_path, TILE_STATS_FILE_NAME)
+        # the modification stamp needs to be cheap to get, so instead of looking at all the tile
+        # folders it is based on a modification counter saved with the statistics, which is
+        # incremented (and saved right away) once the store is first modified after being opened
+        self._modification_lock = threading.Lock()
+        self._modified = False
+        saved_stamp = TileStats.load_stamp(self._stats_path)
+        if isinstance(saved_stamp, list) and saved_stamp and isinstance(saved_stamp[0], int):
+            self._modification_count = saved_stamp[0]
+        else:
+            self._modification_count = 0
+        self._stats = TileStats.load(self._stats_path, self.get_modification_stamp())
+
     def __str__(self):
         return "file based store @ %s" % self.store_path
 
     def __repr__(self):
         return str(self)
 
-    def store_tile_data(self, lzxy, tile_data):
-        """Store the given tile to a file"""
+    def store_tile_data(self, lzxy, tile_data, etag=None, last_modified=None, timestamp=None):
+        """Store the given tile to a file
+
+        HTTP cache validators of the tile (if any) are stored in the validators
+        sidecar file of the tile folder. If a timestamp is given, it is used
+        as the modification time of the tile file.
+        """
         # get the folder path
         file_path = self._get_tile_file_path(lzxy)
         partial_file_path = file_path + PARTIAL_TILE_FILE_SUFFIX
@@ -76,8 +220,27 @@ class FileBasedTileStore(BaseTileStore):
         try:
             with open(partial_file_path, 'wb') as f:
                 f.write(tile_data)
+            stats = self._stats
+            if stats is not None:
+                if os.path.exists(file_path):
+                    stats.remove(lzxy[1], os.path.getsize(file_path))
+                if timestamp is None:
+                    stats.add(lzxy[1], len(tile_data), int(time.time()))
+                else:
+                    stats.add(lzxy[1], len(tile_data), int(timestamp))
+            if timestamp is not None:
+                os.utime(partial_file_path, (timestamp, timestamp))
+            self._record_modification()
             os.rename(partial_file_path, file_path)
             # TODO: fsync the file (optionally ?)?
+            with self._folder_index_lock:
+                folder = self._get_folder(lzxy[1], lzxy[2])
+                folder.add(lzxy[3], lzxy[0].type, None, utils.is_an_image(tile_data[:32]))
+            if etag or last_modified:
+                self._update_validators(lzxy[1], lzxy[2], {lzxy[3]: [etag, last_modified]})
+            else:
+                # drop any validators of the replaced tile
+                self._update_validators(lzxy[1], lzxy[2], {lzxy[3]: None}, create=False)
         except:
             log.exception("saving tile to file %s failed", file_path)
             try:
@@ -102,18 +265,18 @@ class FileBasedTileStore(BaseTileStore):
         :returns: (tile data, timestamp) or None if tile is not found in the database
         :rtype: a (bytes, int) tuple or None
         """
-        if fuzzy_matching:
-            file_path = self._fuzzy_find_tile(lzxy)
-        else:
-            file_path = self._get_tile_file_path(lzxy)
-
-        if file_path and os.path.isfile(file_path):
+        found_tile = self._find_tile(lzxy, fuzzy_matching)
+        if found_tile:
+            file_path, tile_mtime = found_tile
             try:
-                tile_mtime = os.path.getmtime(file_path)
                 with open(file_path, "rb") as f:
-                    return f.read(), tile_mtime
+                    tile_data = f.read()
+                if self._access_tracker.record([(lzxy[1], lzxy[2])]) >= FILES_ACCESS_TIME_BATCH_SIZE:
+                    self._write_access_times()
+                return tile_data, tile_mtime
             except:
                 log.exception("tile file reading failed for: %s", file_path)
+                self._forget_folder(lzxy[1], lzxy[2])
                 return  None
         else:
             return None
@@ -130,16 +293,565 @@ class FileBasedTileStore(BaseTileStore):
         :returns: True if tile is present in the store, else False
         :rtype: bool
         """
-        if fuzzy_matching:
-            file_path = self._fuzzy_find_tile(lzxy)
-        else:
-            file_path = self._get_tile_file_path(lzxy)
-        if file_path and os.path.isfile(file_path):
-            return True, os.path.getmtime(file_path)
+        found_tile = self._find_tile(lzxy, fuzzy_matching)
+        if found_tile:
+            return True, found_tile[1]
         else:
             return False
 
+    def get_tiles(self, lzxy_iterable, fuzzy_matching=True):
+        """Get data and timestamps for multiple tiles
+
+        The tiles are looked up in the directory index, so we don't need to stat
+        (or glob in case of fuzzy matching) every tile path.
+
+        :param lzxy_iterable: an iterable of lzxy tuples
+        :param bool fuzzy_matching: if fuzzy tile matching should be used
+        :returns: a dictionary with (tile data, timestamp) tuples for all tiles that
+                  have been found in the store under their lzxy tuples
+        :rtype: dict
+        """
+        found_tiles = {}
+        for lzxy in lzxy_iterable:
+            tile_tuple = self.get_tile(lzxy, fuzzy_matching=fuzzy_matching)
+            if tile_tuple is not None:
+                found_tiles[lzxy] = tile_tuple
+        return found_tiles
+
+    def tiles_stored(self, lzxy_iterable, fuzzy_matching=True):
+        """Report which of the given tiles are present in this file based tile store
+
+        :param lzxy_iterable: an iterable of lzxy tuples
+        :param bool fuzzy_matching: if fuzzy tile matching should be used
+        :returns: a dictionary with timestamps for all tiles that have been
+                  found in the store under their lzxy tuples
+        :rtype: dict
+        """
+        stored_tiles = {}
+        for lzxy in lzxy_iterable:
+            found_tile = self._find_tile(lzxy, fuzzy_matching)
+            if found_tile:
+                stored_tiles[lzxy] = found_tile[1]
+        return stored_tiles
+
+    def _get_folder(self, z, x):
+        """Get directory index entry for a z/x tile folder, listing the folder if needed
+
+        NOTE: the caller needs to hold the folder index lock
+
+        :returns: directory index entry for the folder
+        :rtype: _TileFolder
+        """
+        key = (z, x)
+        folder = self._folder_index.pop(key, None)
+        if folder is None or time.time() - folder.scan_timestamp > DIRECTORY_INDEX_MAX_AGE:
+            folder = _TileFolder(os.path.join(self.store_path, str(z), str(x)))
+            if len(self._folder_index) >= DIRECTORY_INDEX_SIZE:
+                # drop the least recently used folder
+                self._folder_index.popitem(last=False)
+        # (re)insert the folder as the most recently used one
+        self._folder_index[key] = folder
+        return folder
+
+    def _forget_folder(self, z, x):
+        """Drop a folder from the directory index, so that it is listed again on next access"""
+        with self._folder_index_lock:
+            self._folder_index.pop((z, x), None)
+
+    def _find_tile(self, lzxy, fuzzy_matching):
+        """Find a tile file in the directory index
+
+        With fuzzy matching any image file on the given coordinates is accepted in case an
+        image file with extension given by the layer.type property is not found in the store.
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+        :param bool fuzzy_matching: if fuzzy tile matching should be used
+        :returns: (tile file path, modification time) tuple or None if no tile file is found
+        :rtype: tuple or None
+        """
+        layer, z, x, y = lzxy
+        with self._folder_index_lock:
+            folder = self._get_folder(z, x)
+            extensions = folder.tiles.get(y)
+            if not extensions:
+                return None
+            if fuzzy_matching:
+                # check the primary extension first, then any other files for the coordinates
+                candidates = sorted(extensions.keys(), key=lambda extension: extension != layer.type)
+            elif layer.type in extensions:
+                candidates = [layer.type]
+            else:
+                return None
+            for extension in candidates:
+                if fuzzy_matching and not folder.is_image(y, extension):
+                    continue
+                mtime = folder.get_mtime(y, extension)
+                if mtime is not None:
+                    return folder.file_path(y, extension), mtime
+            return None
+
+    def _get_validators_file_path(self, z, x):
+        return os.path.join(self.store_path, str(z), str(x), VALIDATORS_FILE_NAME)
+
+    def _load_validators(self, z, x):
+        """Load the validators sidecar file of a tile folder
+
+        :returns: dictionary of [etag, last modified] lists keyed by y coordinate (as string)
+        :rtype: dict
+        """
+        file_path = self._get_validators_file_path(z, x)
+        try:
+            with open(file_path, "r") as f:
+                return json.load(f)
+        except (IOError, OSError):
+            # no tile in the folder has any validators
+            return {}
+        except ValueError:
+            log.exception("tile validators file %s is corrupted, ignoring it", file_path)
+            return {}
+
+    def _update_validators(self, z, x, changes, create=True):
+        """Update the validators sidecar file of a tile folder
+
+        The file is replaced atomically and removed once it holds no validators,
+        so that empty tile folders can still be deleted.
+
+        :param dict changes: [etag, last modified] lists or None (to drop the validators)
+                             keyed by y coordinate
+        :param bool create: if the sidecar file should be created if it does not exist
+        """
+        file_path = self._get_validators_file_path(z, x)
+        with self._validators_lock:
+            if not create and not os.path.exists(file_path):
+                return
+            validators = self._load_validators(z, x)
+            for y, tile_validators in changes.items():
+                if tile_validators is None:
+                    validators.pop(str(y), None)
+                else:
+                    validators[str(y)] = tile_validators
+            try:
+                if validators:
+                    partial_file_path = file_path + PARTIAL_TILE_FILE_SUFFIX
+                    with open(partial_file_path, "w") as f:
+                        json.dump(validators, f)
+                    os.rename(partial_file_path, file_path)
+                elif os.path.exists(file_path):
+                    os.remove(file_path)
+            except (IOError, OSError):
+                log.exception("updating tile validators file %s failed", file_path)
+
+    def get_tile_validators(self, lzxy):
+        """Get HTTP cache validators of the tile from the validators sidecar file
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+        :returns: (etag, last_modified) tuple or None if there are no validators for the tile
+        :rtype: tuple or None
+        """
+        with self._validators_lock:
+            tile_validators = self._load_validators(lzxy[1], lzxy[2]).get(str(lzxy[3]))
+        if tile_validators:
+            return tuple(tile_validators)
+        return None
+
+    def touch_tile(self, lzxy, etag=None, last_modified=None):
+        """Mark a stored tile as fresh by setting modification time of the tile file to now
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+        :param etag: new ETag of the tile or None to keep the current one
+        :param last_modified: new Last-Modified value of the tile or None to keep the current one
+        :returns: True if the tile has been found & touched, else False
+        :rtype: bool
+        """
+        layer, z, x, y = lzxy
+        found_tile = self._find_tile(lzxy, fuzzy_matching=True)
+        if not found_tile:
+            return False
+        file_path = found_tile[0]
+        try:
+            os.utime(file_path, None)
+        except OSError:
+            log.exception("touching tile file %s failed", file_path)
+            return False
+        if self._stats is not None:
+            self._stats.touch(z, int(time.time()))
+        with self._folder_index_lock:
+            # the modification time will be stat-ed again on next access
+            folder = self._folder_index.get((z, x))
+            if folder is not None:
+                extension = os.path.basename(file_path).partition(".")[2]
+                extensions = folder.tiles.get(y)
+                if extensions and extension in extensions:
+                    extensions[extension][0] = None
+        if etag or last_modified:
+            old_validators = self.get_tile_validators(lzxy) or (None, None)
+            self._update_validators(z, x, {y: [etag or old_validators[0],
+                                               last_modified or old_validators[1]]})
+        return True
+
+    def _load_folder_access(self):
+        """Load access times of z/x tile folders from the folder access sidecar file
+
+        :returns: access times keyed by (z, x) tuple
+        :rtype: dict
+        """
+        try:
+            with open(self._access_path, "r") as f:
+                saved_access = json.load(f)
+        except (IOError, OSError):
+            # no tiles have been read from the store yet
+            return {}
+        except ValueError:
+            log.exception("tile access times file %s is corrupted, ignoring it", self._access_path)
+            return {}
+        folder_access = {}
+        for folder, access_time in saved_access.items():
+            z, _slash, x = folder.partition("/")
+            try:
+                folder_access[(int(z), int(x))] = access_time
+            except ValueError:
+                pass
+        return folder_access
+
+    def _write_access_times(self):
+        """Save access times of z/x tile folders that have been read
+
+        All the folders waiting for update are saved with a single write
+        of the folder access sidecar file.
+        """
+        access_time, folders = self._access_tracker.take()
+        if not folders:
+            return
+        with self._folder_access_lock:
+            for folder in folders:
+                self._folder_access[folder] = access_time
+            saved_access = dict(("%d/%d" % folder, folder_access_time)
+                                for folder, folder_access_time in self._folder_access.items())
+            partial_file_path = self._access_path + PARTIAL_TILE_FILE_SUFFIX
+            try:
+                with open(partial_file_path, "w") as f:
+                    json.dump(saved_access, f)
+                os.rename(partial_file_path, self._access_path)
+            except (IOError, OSError):
+                log.exception("saving tile access times to %s failed", self._access_path)
+
+    def _forget_folder_access(self, z, x):
+        """Stop tracking access to a removed z/x tile folder"""
+        self._access_tracker.forget([(z, x)])
+        with self._folder_access_lock:
+            self._folder_access.pop((z, x), None)
+
+    def _iter_tile_files(self):
+        """Iterate over all tile files in the store
+
+        :returns: iterator of (z, x, y, tile file path) tuples
+        """
+        for z_folder in _get_toplevel_tile_folder_list(self.store_path):
+            z_path = os.path.join(self.store_path, z_folder)
+            for x_folder in _list_folder(z_path):
+                x_path = os.path.join(z_path, x_folder)
+                try:
+                    z, x = int(z_folder), int(x_folder)
+                    file_names = _list_folder(x_path)
+                except (ValueError, OSError):
+                    continue
+                for file_name in file_names:
+                    if file_name.endswith(PARTIAL_TILE_FILE_SUFFIX):
+                        continue
+                    try:
+                        yield z, x, int(file_name.split(".")[0]), os.path.join(x_path, file_name)
+                    except ValueError:
+                        pass
+
+    def _list_x_folders(self, z):
+        """List x coordinates of tile folders on a zoom level
+
+        :returns: list of x coordinates
+        :rtype: list
+        """
+        try:
+            folder_names = _list_folder(os.path.join(self.store_path, str(z)))
+        except OSError:
+            return []
+        x_list = []
+        for folder_name in folder_names:
+            try:
+                x_list.append(int(folder_name))
+            except ValueError:
+                pass
+        return x_list
+
+    def _list_tile_files(self, z, x):
+        """List tile files in a z/x tile folder
+
+        :returns: list of (y, tile file path) tuples
+        :rtype: list
+        """
+        x_path = os.path.join(self.store_path, str(z), str(x))
+        try:
+            file_names = _list_folder(x_path)
+        except OSError:
+            return []
+        tile_files = []
+        for file_name in file_names:
+            if file_name.endswith(PARTIAL_TILE_FILE_SUFFIX):
+                continue
+            try:
+                tile_files.append((int(file_name.split(".")[0]), os.path.join(x_path, file_name)))
+            except ValueError:
+                pass
+        return tile_files
+
+    def _delete_tile_files(self, z, x, tile_files):
+        """Delete tile files from a single z/x tile folder
+
+        The validators sidecar file, the directory index & empty folders
+        are updated just once for all the deleted files.
+
+        :param list tile_files: list of (y, tile file path) tuples
+        :returns: number of deleted tile files & their size in bytes
+        :rtype: (int, int) tuple
+        """
+        deleted_count = 0
+        deleted_size = 0
+        deleted_y = {}
+        for y, file_path in tile_files:
+            try:
+                size = os.path.getsize(file_path)
+                os.remove(file_path)
+            except OSError:
+                log.exception("deleting tile %s failed", file_path)
+                continue
+            if self._stats is not None:
+                self._stats.remove(z, size)
+            deleted_y[y] = None
+            deleted_count += 1
+            deleted_size += size
+        if deleted_count:
+            self._record_modification()
+            self._update_validators(z, x, deleted_y, create=False)
+            self._forget_folder(z, x)
+            self._delete_empty_folders(z, x)
+        return deleted_count, deleted_size
+
+    def delete_tiles(self, lzxy_iterable):
+        """Delete multiple tiles, grouped by the z/x tile folder
+
+        All image files on the coordinates of each tile are deleted, regardless of their extension.
+
+        :param lzxy_iterable: an iterable of lzxy tuples
+        """
+        y_by_folder = {}
+        for _layer, z, x, y in lzxy_iterable:
+            y_by_folder.setdefault((z, x), set()).add(y)
+        for (z, x), y_set in y_by_folder.items():
+            tile_files = [(y, file_path) for y, file_path in self._list_tile_files(z, x) if y in y_set]
+            self._delete_tile_files(z, x, tile_files)
+
+    def delete_region(self, tile_ranges):
+        """Delete all tiles in the given tile coordinate ranges
+
+        Only the x-level tile folders within the ranges are listed,
+        the rest of the store is not touched at all.
+
+        :param tile_ranges: iterable of (z, min x, max x, min y, max y) tuples, inclusive
+        :returns: number of deleted tiles
+        :rtype: int
+        """
+        deleted_count = 0
+        for z, min_x, max_x, min_y, max_y in tile_ranges:
+            for x in self._list_x_folders(z):
+                if min_x <= x <= max_x:
+                    tile_files = [(y, file_path) for y, file_path in self._list_tile_files(z, x)
+                                  if min_y <= y <= max_y]
+                    deleted_count += self._delete_tile_files(z, x, tile_files)[0]
+        log.info("%d tiles deleted from region of %s", deleted_count, self)
+        return deleted_count
+
+    def delete_older_than(self, timestamp, chunk_callback=None):
+        """Delete all tiles with modification time older than the given timestamp
+
+        :param timestamp: UNIX timestamp
+        :param chunk_callback: optional function called with the number of tiles deleted so far
+                               after each tile folder with deleted tiles, the deletion stops
+                               if it returns False
+        :returns: number of deleted tiles
+        :rtype: int
+        """
+        deleted_count = 0
+        for z_folder in _get_toplevel_tile_folder_list(self.store_path):
+            try:
+                z = int(z_folder)
+            except ValueError:
+                continue
+            for x in self._list_x_folders(z):
+                old_tile_files = []
+                for y, file_path in self._list_tile_files(z, x):
+                    try:
+                        if os.path.getmtime(file_path) < timestamp:
+                            old_tile_files.append((y, file_path))
+                    except OSError:
+                        pass
+                if old_tile_files:
+                    deleted_count += self._delete_tile_files(z, x, old_tile_files)[0]
+                    if chunk_callback is not None and chunk_callback(deleted_count) is False:
+                        log.info("%d tiles older than %d deleted from %s before the deletion has been stopped",
+                                 deleted_count, timestamp, self)
+                        return deleted_count
+        log.info("%d tiles older than %d deleted from %s", deleted_count, timestamp, self)
+        return deleted_count
+
+    def iter_tiles(self):
+        """Iterate over coordinates of all tiles in the store
+
+        :returns: iterator of (z, x, y) tuples
+        """
+        for z, x, y, _file_path in self._iter_tile_files():
+            yield z, x, y
+
+    def get_size(self):
+        """Get the amount of space used by the tile files
+
+        The size is taken from the tile statistics, so only if they could not be loaded
+        when the store has been opened the first call needs to stat all tile files.
+
+        :returns: used space in bytes
+        :rtype: int
+        """
+        return self.get_stats().byte_count
+
+    def evict(self, bytes_to_free):
+        """Delete tiles from least recently accessed z/x tile folders until the given amount of space is freed
+
+        A folder counts as accessed when a tile has been read from it or stored to it
+        (which changes its modification time). Tile files are only listed & stat-ed
+        one folder at a time, oldest tiles in the folder are deleted first.
+
+        :param int bytes_to_free: how much space to free
+        :returns: how much space has been freed in bytes
+        :rtype: int
+        """
+        self._write_access_times()
+        with self._folder_access_lock:
+            folder_access = dict(self._folder_access)
+        folders = []
+        for z_folder in _get_toplevel_tile_folder_list(self.store_path):
+            try:
+                z = int(z_folder)
+            except ValueError:
+                continue
+            for x in self._list_x_folders(z):
+                try:
+                    mtime = os.path.getmtime(os.path.join(self.store_path, z_folder, str(x)))
+                except OSError:
+                    continue
+                access_time = max(folder_access.get((z, x), 0), utils.get_access_time(mtime))
+                folders.append((access_time, z, x))
+        folders.sort()
+        freed = 0
+        evicted_count = 0
+        for _access_time, z, x in folders:
+            if freed >= bytes_to_free:
+                break
+            tile_files = []
+            for y, file_path in self._list_tile_files(z, x):
+                try:
+                    stat_result = os.stat(file_path)
+                except OSError:
+                    continue
+                tile_files.append((stat_result.st_mtime, stat_result.st_size, y, file_path))
+            tile_files.sort()
+            folder_bytes_to_free = bytes_to_free - freed
+            evicted_files = []
+            for _mtime, size, y, file_path in tile_files:
+                if folder_bytes_to_free <= 0:
+                    break
+                evicted_files.append((y, file_path))
+                folder_bytes_to_free -= size
+            deleted_count, deleted_size = self._delete_tile_files(z, x, evicted_files)
+            evicted_count += deleted_count
+            freed += deleted_size
+        log.info("%d tiles evicted from %s, %d bytes freed", evicted_count, self, freed)
+        return freed
+
+    def get_stats(self):
+        """Get per zoom level statistics of the stored tiles
+
+        NOTE: if the statistics could not be loaded when the store has been opened,
+              the first call needs to stat all tile files to build them
+
+        :returns: statistics of the tiles in the store
+        :rtype: TileStats
+        """
+        stats = self._stats
+        if stats is None:
+            stats = TileStats()
+            for z, _x, _y, file_path in self._iter_tile_files():
+                try:
+                    stat_result = os.stat(file_path)
+                except OSError:
+                    continue
+                stats.add(z, stat_result.st_size, int(stat_result.st_mtime))
+            self._stats = stats
+        return stats
+
+    def flush(self):
+        """Save access times of tile folders that have been read"""
+        self._write_access_times()
+
+    def close(self):
+        self._write_access_times()
+        if self._stats is not None:
+            try:
+                self._stats.save(self._stats_path, self.get_modification_stamp())
+            except (IOError, OSError):
+                log.exception("saving tile statistics of %s failed", self)
+
+    def _record_modification(self):
+        """Record that tiles are being added to or removed from the store
+
+        On the first modification since the store has been opened the modification counter
+        is incremented and saved in place of the tile statistics, so that statistics
+        and other indexes saved with the old stamp are not used if the store is not closed
+        properly. The statistics are saved again with the new stamp once the store is closed.
+        """
+        if self._modified:
+            return
+        with self._modification_lock:
+            if self._modified:
+                return
+            self._modification_count += 1
+            try:
+                TileStats().save(self._stats_path, [self._modification_count])
+            except (IOError, OSError):
+                log.exception("saving modification counter of %s failed", self)
+            self._modified = True
+
+    def get_modification_stamp(self):
+        """Get a stamp that changes whenever tiles are added to or removed from the store
+
+        The stamp is based on the modification counter of the store and modification times
+        of the zoom level folders (that change once x-level folders are added or removed),
+        so only the zoom level folders need to be stat-ed.
+
+        NOTE: tiles added to or removed from existing x-level folders by other programs
+              don't change the stamp
+
+        :returns: [modification counter, [[zoom level, folder modification time], ...]] list
+        :rtype: list
+        """
+        zoom_mtimes = []
+        for z_folder in sorted(_get_toplevel_tile_folder_list(self.store_path)):
+            try:
+                zoom_mtimes.append([z_folder, os.path.getmtime(os.path.join(self.store_path, z_folder))])
+            except OSError:
+                pass
+        return [self._modification_count, zoom_mtimes]
+
     def _delete_empty_folders(self, z, x):
+        folder = (int(z), int(x))
+        z = str(z)
+        x = str(x)
         # x-level folder
         x_path = os.path.join(self.store_path, z, x)
         if not os.listdir(x_path):
@@ -150,9 +862,11 @@ class FileBasedTileStore(BaseTileStore):
                     # most probably caused by something being created in the folder
                     # since the check
                     pass
+                else:
+                    self._forget_folder_access(*folder)
                 # z-level folder
                 z_path = os.path.join(self.store_path, z)
-                if os.listdir(z_path):
+                if not os.listdir(z_path):
                     try:
                         os.rmdir(z_path)
                     except OSError:
@@ -165,9 +879,18 @@ class FileBasedTileStore(BaseTileStore):
     def delete_tile(self, lzxy):
         # TODO: delete empty folders ?
         tile_path = self._get_tile_file_path(lzxy)
+        with self._folder_index_lock:
+            folder = self._folder_index.get((lzxy[1], lzxy[2]))
+            if folder is not None:
+                folder.remove(lzxy[3], lzxy[0].type)
         try:
             if os.path.isfile(tile_path):
+                self._record_modification()
+                size = os.path.getsize(tile_path)
                 os.remove(tile_path)
+                if self._stats is not None:
+                    self._stats.remove(lzxy[1], size)
+                self._update_validators(lzxy[1], lzxy[2], {lzxy[3]: None}, create=False)
                 # remove any empty folders that might have been
                 # left after the deleted tile file
                 self._delete_empty_folders(lzxy[1], lzxy[2])
@@ -185,12 +908,25 @@ class FileBasedTileStore(BaseTileStore):
         is used to store both tiles and sqlite tile storage database and we would
         also remove any databases if we just removed the toplevel folder.
         """
+        with self._folder_index_lock:
+            self._folder_index.clear()
+        self._stats = TileStats()
+        self._access_tracker.take()
+        with self._folder_access_lock:
+            self._folder_access.clear()
         try:
+            for file_path in (self._stats_path, self._access_path):
+                if os.path.exists(file_path):
+                    os.remove(file_path)
             for folder in _get_toplevel_tile_folder_list(self.store_path):
                 folder_path = os.path.join(self.store_path, folder)
                 shutil.rmtree(folder_path)
         except:
             log.exception("clearing of files tile store at path %s failed", self.store_path)
+        # the saved modification counter has been removed with the statistics
+        with self._modification_lock:
+            self._modified = False
+        self._record_modification()
 
     def _get_tile_file_path(self, lzxy):
         """Return full filesystem path to the tile file corresponding to the coordinates
@@ -206,43 +942,3 @@ class FileBasedTileStore(BaseTileStore):
             str(lzxy[2]),
             "%d.%s" % (lzxy[3], lzxy[0].type)
         )
-
-    def _fuzzy_find_tile(self, lzxy):
-        """Try to find a tile image file for the given coordinates
-
-        :returns: path to a suitable tile or None if no can be found
-        :rtype: str or None
-        """
-        # first check if the primary tile path exists
-        tile_path = self._get_tile_file_path(lzxy)
-        # check if the primary file path exists and also if it actually
-        # is an image file
-        if os.path.exists(tile_path):
-            try:
-                with open(tile_path, "rb") as f:
-                    if utils.is_an_image(f.read(32)):
-                        return tile_path
-                    else:
-                        log.warning("%s is not an image", tile_path)
-            except Exception:
-                log.exception("checking if primary tile file is an image failed for %s", lzxy)
-
-        # look also for other supported image formats
-        alternative_tile_path = None
-        # TODO: might be good to investigate the performance impact,
-        #       just to be sure :P
-
-        # replace the extension with a * so that the path can be used
-        # as wildcard in glob
-        wildcard_tile_path = "%s.*" % os.path.splitext(tile_path)[0]
-        # iterate over potential paths returned by the glob iterator
-        for path in glob.iglob(wildcard_tile_path):
-            # go over the paths and check if they point to an image files
-            with open(path, "rb") as f:
-                if utils.is_an_image(f.read(32)):
-                    # once an image file is found, break & returns its path
-                    alternative_tile_path = path
-                    break
-                else:
-                    log.warning("%s is not an image", tile_path)
-        return alternative_tile_path
\ No newline at end of file
@@ -0,0 +1,679 @@
+# A tile store using a single MBTiles file
+#
+# MBTiles (https://github.com/mapbox/mbtiles-spec) is a widely used format for
+# distributing map tile packs - a single SQLite database with a metadata table and
+# a tiles table:
+#
+# table metadata (name text, value text)
+# table tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)
+#
+# Reading MBTiles files directly makes it possible to use tile packs generated
+# elsewhere (such as on a workstation) without converting them to one of the
+# other store types first.
+#
+# Things to keep in mind:
+# * MBTiles uses the TMS tiling scheme, so the y coordinate is flipped
+#   compared to the XYZ scheme used by modRana
+# * tiles might be a view (some tools deduplicate tiles using a map and images table),
+#   such MBTiles files can be only read
+# * MBTiles has no per-tile timestamps, so write times of tiles stored by modRana
+#   are kept in an extra tile_timestamps table (extra tables are allowed by the
+#   specification), tiles without a write time (such as those from a tile pack)
+#   use the modification time the MBTiles file had when it has been opened
+# * the tile_timestamps table also holds coarse access times of the tiles, which are
+#   updated in batches and used to evict least recently accessed tiles once the store
+#   is over its size budget
+#
+# Writes are batched - stored tiles are kept in memory (and visible to reads) until
+# a batch is full or the store is flushed and then written in a single transaction.
+# If the transaction fails the tiles are kept in memory and flush() raises
+# TileStoreWriteFailed, so that nobody treats them as stored.
+
+from __future__ import with_statement
+
+import os
+import glob
+import time
+import sqlite3
+import threading
+from threading import RLock
+
+import logging
+log = logging.getLogger("tile_storage.mbtiles_store")
+
+from .base import BaseTileStore
+from .exceptions import TileStoreWriteFailed
+from .stats import TileStats
+from .sqlite_store import connect_to_db, get_journal_mode, incremental_vacuum, _NoLock, SQLITE_QUEUE_SIZE
+from . import utils
+
+MBTILES_FILE_EXTENSION = ".mbtiles"
+# name of the MBTiles file created if there is none in the store folder
+MBTILES_DEFAULT_FILE_NAME = "tiles.mbtiles"
+# maximum number of tiles fetched by a single bulk query
+MBTILES_BULK_QUERY_SIZE = 500
+# write access times of read tiles once this many are waiting
+MBTILES_ACCESS_TIME_BATCH_SIZE = 100
+# how many tiles to evict in a single transaction
+MBTILES_EVICTION_CHUNK_SIZE = 1000
+
+MBTILES_SCHEMA_SQL = [
+    "create table if not exists metadata (name text, value text)",
+    "create unique index if not exists name on metadata (name)",
+    "create table if not exists tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)",
+    "create unique index if not exists tile_index on tiles (zoom_level, tile_column, tile_row)",
+]
+
+MBTILES_TIMESTAMPS_SQL = [
+    "create table if not exists tile_timestamps (zoom_level integer, tile_column integer, tile_row integer, "
+    "timestamp integer, last_access integer, primary key (zoom_level, tile_column, tile_row))",
+    "create index if not exists tile_timestamps_access on tile_timestamps (last_access)",
+]
+
+# tiles never accessed since access times are tracked (such as tiles from a tile pack)
+MBTILES_UNTRACKED_TILES_SQL = (
+    "select zoom_level, tile_column, tile_row, length(tile_data) from tiles where not exists "
+    "(select 1 from tile_timestamps where tile_timestamps.zoom_level=tiles.zoom_level "
+    "and tile_timestamps.tile_column=tiles.tile_column and tile_timestamps.tile_row=tiles.tile_row) limit ?")
+# other tiles, least recently accessed first
+MBTILES_TRACKED_TILES_SQL = (
+    "select tiles.zoom_level, tiles.tile_column, tiles.tile_row, length(tiles.tile_data) "
+    "from tile_timestamps join tiles on tile_timestamps.zoom_level=tiles.zoom_level "
+    "and tile_timestamps.tile_column=tiles.tile_column and tile_timestamps.tile_row=tiles.tile_row "
+    "order by tile_timestamps.last_access limit ?")
+
+# write time of a row of the tiles table (if any)
+TILE_TIMESTAMP_COLUMN = ("(select timestamp from tile_timestamps where tile_timestamps.zoom_level=tiles.zoom_level "
+                         "and tile_timestamps.tile_column=tiles.tile_column and tile_timestamps.tile_row=tiles.tile_row)")
+
+def flip_y(z, y):
+    """Convert between the XYZ and TMS y tile coordinate (the conversion is symmetric)"""
+    return (2 ** z) - 1 - y
+
+class MBTilesTileStore(BaseTileStore):
+
+    @staticmethod
+    def is_store(path):
+        """We consider the path to be a MBTiles store if it is a folder
+           that contains at least one MBTiles file.
+
+        :param str path: path to test
+        :returns: True if the path is a MBTiles store, else False
+        :rtype: bool
+        """
+        return os.path.isdir(path) and bool(glob.glob(os.path.join(path, "*" + MBTILES_FILE_EXTENSION)))
+
+    def __init__(self, store_path, prevent_media_indexing=False,
+                 batch_size=SQLITE_QUEUE_SIZE, wal_mode=False):
+        """
+        :param str store_path: path to the folder holding the MBTiles file
+        :param bool prevent_media_indexing: prevent media indexers from indexing the store folder
+        :param int batch_size: how many tiles to write in a single transaction
+        :param bool wal_mode: use WAL journal mode & per thread read connections
+        """
+        BaseTileStore.__init__(self, store_path, prevent_media_indexing=prevent_media_indexing)
+        utils.check_folder(self.store_path, prevent_media_indexing=prevent_media_indexing)
+
+        mbtiles_files = sorted(glob.glob(os.path.join(self.store_path, "*" + MBTILES_FILE_EXTENSION)))
+        if mbtiles_files:
+            self._db_path = mbtiles_files[0]
+            if len(mbtiles_files) > 1:
+                log.warning("%d MBTiles files found in %s, only %s will be used",
+                            len(mbtiles_files), self.store_path, self._db_path)
+        else:
+            self._db_path = os.path.join(self.store_path, MBTILES_DEFAULT_FILE_NAME)
+
+        self._db_lock = RLock()
+        self._wal_mode = wal_mode
+        self._connection = connect_to_db(self._db_path, wal_mode=wal_mode)
+        if self._wal_mode and get_journal_mode(self._connection) != "wal":
+            self._wal_mode = False
+        self._writable = self._init_schema()
+        # timestamp of tiles without a write time in the tile_timestamps table
+        self._timestamp = os.path.getmtime(self._db_path)
+        # the tile_timestamps table is only created in writable MBTiles files
+        if self._writable:
+            self._timestamp_column = TILE_TIMESTAMP_COLUMN
+        else:
+            self._timestamp_column = "null"
+
+        # in WAL mode each thread reads using its own connection
+        # and reads are not serialized with writes
+        self._thread_local = threading.local()
+        self._read_connections = []
+        if self._wal_mode:
+            self._read_lock = _NoLock()
+        else:
+            self._read_lock = self._db_lock
+
+        # (tile data, timestamp) tuples waiting to be written, keyed by XYZ z, x, y coordinates
+        self._batch_size = max(1, int(batch_size))
+        self._pending = {}
+        self._pending_lock = RLock()
+        # tile format to record in metadata once the first tile is written
+        self._tile_format = None
+        # tiles that have been read, their access times are written in batches
+        self._access_tracker = utils.AccessTimeTracker()
+
+    def __str__(self):
+        return "MBTiles store @ %s" % self._db_path
+
+    def __repr__(self):
+        return str(self)
+
+    @property
+    def db_path(self):
+        return self._db_path
+
+    @property
+    def wal_mode(self):
+        return self._wal_mode
+
+    def _init_schema(self):
+        """Create the MBTiles tables if they don't exist yet
+
+        :returns: True if tiles can be written to the MBTiles file, False if it is read only
+        :rtype: bool
+        """
+        with self._db_lock:
+            tiles_type = self._connection.execute(
+                "select type from sqlite_master where name='tiles'").fetchone()
+            if tiles_type is None:
+                log.info("creating MBTiles file %s", self._db_path)
+                # needs to be set before any tables are created
+                self._connection.execute("pragma auto_vacuum=incremental")
+                for statement in MBTILES_SCHEMA_SQL + MBTILES_TIMESTAMPS_SQL:
+                    self._connection.execute(statement)
+                metadata = [("name", os.path.basename(self.store_path)),
+                            ("type", "baselayer"),
+                            ("version", "1.0"),
+                            ("description", "modRana tile store")]
+                self._connection.executemany("insert or ignore into metadata (name, value) values (?, ?)", metadata)
+                self._connection.commit()
+                return True
+            elif tiles_type[0] == "view":
+                log.info("tiles in %s are a view, the MBTiles file is read only", self._db_path)
+                return False
+            else:
+                for statement in MBTILES_TIMESTAMPS_SQL:
+                    self._connection.execute(statement)
+                self._connection.commit()
+                return True
+
+    def get_metadata(self):
+        """Get the MBTiles metadata
+
+        :returns: metadata values keyed by name
+        :rtype: dict
+        """
+        with self._read_lock:
+            return dict(self._get_read_connection().execute("select name, value from metadata").fetchall())
+
+    def _get_read_connection(self):
+        """Get a connection for reading
+
+        NOTE: in serialized access mode the caller needs to hold the read lock
+        """
+        if not self._wal_mode:
+            return self._connection
+        connection = getattr(self._thread_local, "connection", None)
+        if connection is None:
+            connection = connect_to_db(self._db_path)
+            connection.execute("pragma query_only=1")
+            self._thread_local.connection = connection
+            with self._db_lock:
+                self._read_connections.append(connection)
+        return connection
+
+    def store_tile_data(self, lzxy, tile_data, etag=None, last_modified=None, timestamp=None):
+        """Queue the tile for writing to the MBTiles file
+
+        NOTE: the MBTiles format has no place for HTTP cache validators, so they are dropped
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+        :param bytes tile_data: tile data to store
+        :param timestamp: UNIX timestamp of the tile, defaults to the current time
+        """
+        if not self._writable:
+            log.error("can't store tile %s to read only %s", lzxy[1:], self)
+            return
+        layer, z, x, y = lzxy
+        if timestamp is None:
+            timestamp = time.time()
+        with self._pending_lock:
+            if self._tile_format is None:
+                self._tile_format = layer.type
+            self._pending[(z, x, y)] = (tile_data, int(timestamp))
+            batch_full = len(self._pending) >= self._batch_size
+        if batch_full:
+            try:
+                self.flush()
+            except TileStoreWriteFailed:
+                # already logged, the tiles are kept pending and written with the next batch
+                pass
+
+    def flush(self):
+        """Write all pending tiles to the MBTiles file
+
+        :raises TileStoreWriteFailed: if the tiles could not be written,
+                                      they are kept pending and written later
+        """
+        self._write_access_times()
+        with self._db_lock:
+            with self._pending_lock:
+                pending_items = list(self._pending.items())
+            if not pending_items:
+                return
+            query = "insert or replace into tiles (zoom_level, tile_column, tile_row, tile_data) values (?, ?, ?, ?)"
+            try:
+                if self._tile_format:
+                    # the format metadata key is required by the MBTiles specification
+                    self._connection.execute("insert or ignore into metadata (name, value) values ('format', ?)",
+                                             (self._tile_format,))
+                self._connection.executemany(query, [(z, x, flip_y(z, y), sqlite3.Binary(tile_data))
+                                                     for (z, x, y), (tile_data, _timestamp) in pending_items])
+                # stored tiles count as accessed when they have been stored
+                self._connection.executemany("insert or replace into tile_timestamps values (?, ?, ?, ?, ?)",
+                                             [(z, x, flip_y(z, y), timestamp, utils.get_access_time(timestamp))
+                                              for (z, x, y), (_tile_data, timestamp) in pending_items])
+                self._connection.commit()
+            except Exception as e:
+                self._connection.rollback()
+                log.exception("writing %d tiles to %s failed", len(pending_items), self)
+                raise TileStoreWriteFailed("writing tiles to %s failed: %s" % (self, e))
+            with self._pending_lock:
+                for zxy, tile_tuple in pending_items:
+                    if self._pending.get(zxy) is tile_tuple:
+                        del self._pending[zxy]
+
+    def _record_access(self, zxy_list):
+        """Record that tiles have been read, writing the access times once enough are waiting"""
+        if self._writable and self._access_tracker.record(zxy_list) >= MBTILES_ACCESS_TIME_BATCH_SIZE:
+            self._write_access_times()
+
+    def _write_access_times(self):
+        """Write access times of tiles that have been read to the tile_timestamps table
+
+        Tiles without a row in the table (such as tiles from a tile pack) get one,
+        without a write time.
+        """
+        access_time, zxy_list = self._access_tracker.take()
+        if not zxy_list:
+            return
+        parameters = [(z, x, flip_y(z, y)) for z, x, y in zxy_list]
+        with self._db_lock:
+            try:
+                self._connection.executemany(
+                    "insert or ignore into tile_timestamps (zoom_level, tile_column, tile_row) "
+                    "select zoom_level, tile_column, tile_row from tiles "
+                    "where zoom_level=? and tile_column=? and tile_row=?", parameters)
+                self._connection.executemany(
+                    "update tile_timestamps set last_access=%d "
+                    "where zoom_level=? and tile_column=? and tile_row=?" % access_time, parameters)
+                self._connection.commit()
+            except Exception:
+                self._connection.rollback()
+                log.exception("writing access times of %d tiles to %s failed", len(parameters), self)
+
+    def get_tile(self, lzxy):
+        """Get tile data and timestamp corresponding to the given coordinate tuple
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+                           (layer is actually not used and can be None)
+        :returns: (tile data, timestamp) or None if tile is not found
+        :rtype: a (bytes, int) tuple or None
+        """
+        _layer, z, x, y = lzxy
+        with self._pending_lock:
+            tile_tuple = self._pending.get((z, x, y))
+        if tile_tuple is not None:
+            return tile_tuple
+        with self._read_lock:
+            result = self._get_read_connection().execute(
+                "select tile_data, %s from tiles where zoom_level=? and tile_column=? and tile_row=?"
+                % self._timestamp_column, (z, x, flip_y(z, y))).fetchone()
+        if result:
+            self._record_access([(z, x, y)])
+            return bytes(result[0]), self._get_timestamp(result[1])
+        else:
+            return None
+
+    def _get_timestamp(self, write_timestamp):
+        """Get timestamp of a tile from its write time (if any)"""
+        if write_timestamp is None:
+            return self._timestamp
+        return write_timestamp
+
+    def tile_is_stored(self, lzxy):
+        """Report if a tile specified by the lzxy tuple is stored
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+        :returns: (True, timestamp) if tile is stored, else False
+        """
+        _layer, z, x, y = lzxy
+        with self._pending_lock:
+            tile_tuple = self._pending.get((z, x, y))
+        if tile_tuple is not None:
+            return True, tile_tuple[1]
+        with self._read_lock:
+            result = self._get_read_connection().execute(
+                "select %s from tiles where zoom_level=? and tile_column=? and tile_row=?"
+                % self._timestamp_column, (z, x, flip_y(z, y))).fetchone()
+        if result:
+            return True, self._get_timestamp(result[0])
+        else:
+            return False
+
+    def _find_tiles(self, lzxy_iterable, with_data):
+        """Look up multiple tiles with one query per tile column
+
+        :param lzxy_iterable: an iterable of lzxy tuples
+        :param bool with_data: if tile data should be fetched as well
+        :returns: (tile data or None, timestamp) tuples keyed by lzxy tuple
+        :rtype: dict
+        """
+        found_tiles = {}
+        # group the tiles by zoom level & column, so that the unique tile index can be used
+        # to look up all tiles in the column with a single query
+        tiles_by_column = {}
+        with self._pending_lock:
+            for lzxy in lzxy_iterable:
+                z, x, y = lzxy[1:]
+                tile_tuple = self._pending.get((z, x, y))
+                if tile_tuple is not None:
+                    found_tiles[lzxy] = tile_tuple
+                else:
+                    tiles_by_column.setdefault((z, x), {})[flip_y(z, y)] = lzxy
+        if with_data:
+            columns = "tile_data, %s" % self._timestamp_column
+        else:
+            columns = "null, %s" % self._timestamp_column
+        with self._read_lock:
+            connection = self._get_read_connection()
+            for (z, x), lzxy_by_row in tiles_by_column.items():
+                rows = list(lzxy_by_row.keys())
+                for i in range(0, len(rows), MBTILES_BULK_QUERY_SIZE):
+                    chunk = rows[i:i + MBTILES_BULK_QUERY_SIZE]
+                    query = "select tile_row, %s from tiles where zoom_level=? and tile_column=? and tile_row in (%s)" % (
+                        columns, ",".join(["?"] * len(chunk)))
+                    for tile_row, tile_data, timestamp in connection.execute(query, [z, x] + chunk).fetchall():
+                        if tile_data is not None:
+                            tile_data = bytes(tile_data)
+                        found_tiles[lzxy_by_row[tile_row]] = tile_data, self._get_timestamp(timestamp)
+        return found_tiles
+
+    def get_tiles(self, lzxy_iterable):
+        """Get data and timestamps for multiple tiles
+
+        :param lzxy_iterable: an iterable of lzxy tuples
+        :returns: a dictionary with (tile data, timestamp) tuples for all tiles that
+                  have been found in the store under their lzxy tuples
+        :rtype: dict
+        """
+        found_tiles = self._find_tiles(lzxy_iterable, with_data=True)
+        self._record_access([lzxy[1:] for lzxy in found_tiles])
+        return found_tiles
+
+    def tiles_stored(self, lzxy_iterable):
+        """Report which of the given tiles are stored
+
+        :param lzxy_iterable: an iterable of lzxy tuples
+        :returns: a dictionary with timestamps for all tiles that have been
+                  found in the store under their lzxy tuples
+        :rtype: dict
+        """
+        return dict((lzxy, timestamp) for lzxy, (_tile_data, timestamp)
+                    in self._find_tiles(lzxy_iterable, with_data=False).items())
+
+    def delete_tile(self, lzxy):
+        """Try to delete tile corresponding to the lzxy coordinate tuple
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+        """
+        if not self._writable:
+            log.error("can't delete tile %s from read only %s", lzxy[1:], self)
+            return
+        _layer, z, x, y = lzxy
+        self._access_tracker.forget([(z, x, y)])
+        with self._db_lock:
+            with self._pending_lock:
+                self._pending.pop((z, x, y), None)
+            for table in ("tiles", "tile_timestamps"):
+                self._connection.execute("delete from %s where zoom_level=? and tile_column=? and tile_row=?" % table,
+                                         (z, x, flip_y(z, y)))
+            self._connection.commit()
+
+    def delete_tiles(self, lzxy_iterable):
+        """Delete multiple tiles in a single transaction
+
+        :param lzxy_iterable: an iterable of lzxy tuples
+        """
+        if not self._writable:
+            log.error("can't delete tiles from read only %s", self)
+            return
+        zxy_list = [lzxy[1:] for lzxy in lzxy_iterable]
+        self._access_tracker.forget(zxy_list)
+        with self._db_lock:
+            with self._pending_lock:
+                for zxy in zxy_list:
+                    self._pending.pop(zxy, None)
+            for table in ("tiles", "tile_timestamps"):
+                self._connection.executemany(
+                    "delete from %s where zoom_level=? and tile_column=? and tile_row=?" % table,
+                    [(z, x, flip_y(z, y)) for z, x, y in zxy_list])
+            self._connection.commit()
+
+    def delete_region(self, tile_ranges):
+        """Delete all tiles in the given tile coordinate ranges
+
+        :param tile_ranges: iterable of (z, min x, max x, min y, max y) tuples, inclusive
+        :returns: number of deleted tiles
+        :rtype: int
+        """
+        if not self._writable:
+            log.error("can't delete tiles from read only %s", self)
+            return 0
+        # write pending tiles first, so that they are deleted as well
+        self.flush()
+        deleted_count = 0
+        with self._db_lock:
+            try:
+                for z, min_x, max_x, min_y, max_y in tile_ranges:
+                    # the y coordinate flip reverses the y range
+                    parameters = (z, min_x, max_x, flip_y(z, max_y), flip_y(z, min_y))
+                    cursor = self._connection.execute(
+                        "delete from tiles where zoom_level=? and tile_column between ? and ? "
+                        "and tile_row between ? and ?", parameters)
+                    deleted_count += cursor.rowcount
+                    self._connection.execute(
+                        "delete from tile_timestamps where zoom_level=? and tile_column between ? and ? "
+                        "and tile_row between ? and ?", parameters)
+                self._connection.commit()
+            except Exception:
+                self._connection.rollback()
+                raise
+        log.info("%d tiles deleted from region of %s", deleted_count, self)
+        return deleted_count
+
+    def delete_older_than(self, timestamp, chunk_callback=None):
+        """Delete all tiles with write time older than the given timestamp
+
+        Only tiles stored by modRana have a write time, other tiles (such as those
+        from a tile pack) are never deleted based on their age.
+
+        :param timestamp: UNIX timestamp
+        :param chunk_callback: optional function called with the number of tiles deleted so far
+                               after each zoom level with deleted tiles, the deletion stops
+                               if it returns False
+        :returns: number of deleted tiles
+        :rtype: int
+        """
+        if not self._writable:
+            return 0
+        # write pending tiles first, so that they are deleted as well
+        self.flush()
+        deleted_count = 0
+        with self._db_lock:
+            zoom_levels = [row[0] for row in self._connection.execute(
+                "select distinct zoom_level from tile_timestamps where timestamp<?", (timestamp,))]
+        for z in zoom_levels:
+            with self._db_lock:
+                try:
+                    cursor = self._connection.execute(
+                        "delete from tiles where zoom_level=? and exists (select 1 from tile_timestamps "
+                        "where tile_timestamps.zoom_level=tiles.zoom_level "
+                        "and tile_timestamps.tile_column=tiles.tile_column "
+                        "and tile_timestamps.tile_row=tiles.tile_row and timestamp<?)", (z, timestamp))
+                    deleted_count += cursor.rowcount
+                    self._connection.execute("delete from tile_timestamps where zoom_level=? and timestamp<?",
+                                             (z, timestamp))
+                    self._connection.commit()
+                except Exception:
+                    self._connection.rollback()
+                    raise
+            if chunk_callback is not None and chunk_callback(deleted_count) is False:
+                log.info("%d tiles older than %d deleted from %s before the deletion has been stopped",
+                         deleted_count, timestamp, self)
+                return deleted_count
+        log.info("%d tiles older than %d deleted from %s", deleted_count, timestamp, self)
+        return deleted_count
+
+    def get_size(self):
+        """Get the amount of space used by the MBTiles file
+
+        Free pages (such as those left after deleting tiles from MBTiles files that don't use
+        incremental auto vacuum) are not counted, as SQLite reuses them for new tiles.
+        Read only MBTiles files don't report their size, as no tiles can be evicted from them.
+
+        :returns: used space in bytes or None for read only MBTiles files
+        :rtype: int or None
+        """
+        if not self._writable:
+            return None
+        with self._db_lock:
+            page_size = self._connection.execute("pragma page_size").fetchone()[0]
+            page_count = self._connection.execute("pragma page_count").fetchone()[0]
+            freelist_count = self._connection.execute("pragma freelist_count").fetchone()[0]
+        return (page_count - freelist_count) * page_size
+
+    def get_stats(self):
+        """Get per zoom level statistics of the stored tiles
+
+        MBTiles files have no statistics table, so they are computed by a single query
+        grouped by zoom level. Tiles waiting to be written are not yet counted,
+        flush() the store first if they should be.
+
+        :returns: statistics of the tiles in the store
+        :rtype: TileStats
+        """
+        timestamp = int(self._timestamp)
+        query = ("select zoom_level, count(*), sum(length(tile_data)), min(coalesce(%s, ?)), max(coalesce(%s, ?)) "
+                 "from tiles group by zoom_level" % (self._timestamp_column, self._timestamp_column))
+        with self._read_lock:
+            rows = self._get_read_connection().execute(query, (timestamp, timestamp)).fetchall()
+        return TileStats.from_zooms((z, count, size or 0, oldest, newest) for z, count, size, oldest, newest in rows)
+
+    def evict(self, bytes_to_free):
+        """Delete least recently accessed tiles until the given amount of space is freed
+
+        Tiles never accessed since access times are tracked (such as tiles from a tile pack)
+        are evicted first, followed by the other tiles ordered by their access time.
+        Tiles are deleted in chunks, each in its own transaction, and freed pages are then
+        returned to the filesystem (for MBTiles files created with incremental auto vacuum).
+
+        :param int bytes_to_free: how much space to free
+        :returns: how much space has been freed in bytes
+        :rtype: int
+        """
+        if not self._writable:
+            return 0
+        # pending tiles & access times need to be written first,
+        # so that recently accessed tiles are not evicted
+        self.flush()
+        start_size = self.get_size()
+        freed = 0
+        evicted_count = 0
+        for query in (MBTILES_UNTRACKED_TILES_SQL, MBTILES_TRACKED_TILES_SQL):
+            while freed < bytes_to_free:
+                with self._db_lock:
+                    rows = self._connection.execute(query, (MBTILES_EVICTION_CHUNK_SIZE,)).fetchall()
+                    if not rows:
+                        break
+                    # don't evict (many) more tiles than needed
+                    chunk = []
+                    chunk_size = 0
+                    for z, x, tms_y, size in rows:
+                        if freed + chunk_size >= bytes_to_free:
+                            break
+                        chunk.append((z, x, tms_y))
+                        chunk_size += size or 0
+                    try:
+                        for table in ("tiles", "tile_timestamps"):
+                            self._connection.executemany(
+                                "delete from %s where zoom_level=? and tile_column=? and tile_row=?" % table, chunk)
+                        self._connection.commit()
+                    except Exception:
+                        self._connection.rollback()
+                        raise
+                    self._access_tracker.forget((z, x, flip_y(z, tms_y)) for z, x, tms_y in chunk)
+                    evicted_count += len(chunk)
+                    freed = start_size - self.get_size()
+        with self._db_lock:
+            incremental_vacuum(self._connection)
+        log.info("%d tiles evicted from %s, %d bytes freed", evicted_count, self, freed)
+        return freed
+
+    def iter_tiles(self):
+        """Iterate over coordinates of all tiles in the store
+
+        :returns: iterator of (z, x, y) tuples
+        """
+        with self._pending_lock:
+            pending_zxy_list = list(self._pending.keys())
+        for zxy in pending_zxy_list:
+            yield zxy
+        # list the tiles one tile column at a time, so that neither the whole
+        # tile list needs to be in memory nor the read lock held for the whole iteration
+        with self._read_lock:
+            columns = self._get_read_connection().execute(
+                "select distinct zoom_level, tile_column from tiles").fetchall()
+        for z, x in columns:
+            with self._read_lock:
+                rows = self._get_read_connection().execute(
+                    "select tile_row from tiles where zoom_level=? and tile_column=?", (z, x)).fetchall()
+            for (tms_y,) in rows:
+                yield z, x, flip_y(z, tms_y)
+
+    def get_modification_stamp(self):
+        """Get a stamp that changes whenever tiles are added to or removed from the store
+
+        :returns: [MBTiles file size, MBTiles file modification time] list
+        :rtype: list
+        """
+        stamp = [os.path.getsize(self._db_path), os.path.getmtime(self._db_path)]
+        wal_path = self._db_path + "-wal"
+        if os.path.exists(wal_path) and os.path.getsize(wal_path):
+            stamp.extend([os.path.getsize(wal_path), os.path.getmtime(wal_path)])
+        return stamp
+
+    def close(self):
+        """Write all pending tiles and close all database connections"""
+        try:
+            self.flush()
+        except TileStoreWriteFailed:
+            log.error("%d tiles could not be written before closing %s", len(self._pending), self)
+        with self._db_lock:
+            self._connection.close()
+            for connection in self._read_connections:
+                connection.close()
+            self._read_connections = []
+
+    def clear(self):
+        """Delete the MBTiles file"""
+        with self._db_lock:
+            with self._pending_lock:
+                self._pending.clear()
+            self.close()
+            for path in (self._db_path, self._db_path + "-wal", self._db_path + "-shm"):
+                if os.path.exists(path):
+                    os.remove(path)
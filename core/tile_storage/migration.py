@@ -0,0 +1,278 @@
+# Moving tiles between tile stores
+#
+# Once the tile storage type is switched, tiles stored so far stay in the store of the
+# old type and both stores have to be checked for every tile. A migration moves all the tiles
+# from the old store to the new one, after which the old store can be dropped.
+#
+# Reading the tiles is usually the slow part (a file based store needs to open every tile file),
+# so the tiles are read by a couple of reader threads, each reading a chunk of tiles at a time.
+# A single writer (the thread running the migration) stores the chunks to the target store,
+# flushes the target store and only then deletes the tiles the target store reports as stored
+# from the source store. So every tile is in at least one of the stores at all times and tiles
+# that have already been moved don't need to be moved again if the migration is interrupted.
+#
+# Progress is recorded in a small JSON journal file after every chunk, so an interrupted
+# migration can be resumed (even after a restart) and still report progress of the whole
+# migration. The journal is removed once the migration finishes.
+
+from __future__ import with_statement
+
+import os
+import json
+import time
+import threading
+
+try:  # Python 3
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+import logging
+log = logging.getLogger("tile_storage.migration")
+
+TILE_MIGRATION_JOURNAL_FILE_NAME = "tile_migration.json"
+TILE_MIGRATION_JOURNAL_FORMAT_VERSION = 1
+# how many tiles to read, write & delete at once
+MIGRATION_CHUNK_SIZE = 256
+# how many threads read tiles from the source store
+MIGRATION_READER_COUNT = 4
+# how often reader threads blocked on a full queue check if the migration has been stopped
+MIGRATION_QUEUE_TIMEOUT = 0.1  # in seconds
+
+class MigrationJournal(object):
+    """Progress of a tile migration, saved to a file after every migrated chunk of tiles"""
+
+    def __init__(self, path, source_type, target_type, total_count=None, migrated_count=0, started=None):
+        """
+        :param str path: where to save the journal
+        :param str source_type: type of the store the tiles are moved from
+        :param str target_type: type of the store the tiles are moved to
+        :param total_count: number of tiles to migrate (if known)
+        :param int migrated_count: number of tiles migrated so far
+        :param started: when the migration has been started (UNIX timestamp)
+        """
+        self.path = path
+        self.source_type = source_type
+        self.target_type = target_type
+        self.total_count = total_count
+        self.migrated_count = migrated_count
+        if started is None:
+            started = int(time.time())
+        self.started = started
+
+    @classmethod
+    def load(cls, path):
+        """Load a journal saved by save()
+
+        :param str path: path to the journal
+        :returns: the journal or None if there is no journal or it can't be loaded
+        :rtype: MigrationJournal or None
+        """
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            if data["version"] != TILE_MIGRATION_JOURNAL_FORMAT_VERSION:
+                return None
+            return cls(path, data["source"], data["target"], total_count=data["total"],
+                       migrated_count=data["migrated"], started=data["started"])
+        except Exception:
+            log.exception("loading tile migration journal %s failed", path)
+            return None
+
+    def save(self):
+        data = json.dumps({"version": TILE_MIGRATION_JOURNAL_FORMAT_VERSION,
+                           "source": self.source_type,
+                           "target": self.target_type,
+                           "total": self.total_count,
+                           "migrated": self.migrated_count,
+                           "started": self.started})
+        temporary_file_path = self.path + ".part"
+        with open(temporary_file_path, "w") as f:
+            f.write(data)
+        os.rename(temporary_file_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class TileMigration(object):
+    """Move all tiles of a layer from one store to another"""
+
+    def __init__(self, source_store, target_store, layer, journal,
+                 reader_count=MIGRATION_READER_COUNT, chunk_size=MIGRATION_CHUNK_SIZE):
+        """
+        :param source_store: the store to move the tiles from
+        :param target_store: the store to move the tiles to
+        :param layer: the layer the tiles belong to
+        :param MigrationJournal journal: journal of the migration, possibly loaded
+                                         from an interrupted migration
+        :param int reader_count: number of threads reading tiles from the source store
+        :param int chunk_size: how many tiles to read, write & delete at once
+        """
+        self._source_store = source_store
+        self._target_store = target_store
+        self._layer = layer
+        self._journal = journal
+        self._reader_count = max(1, int(reader_count))
+        self._chunk_size = max(1, int(chunk_size))
+        self._stop_event = threading.Event()
+        self._failed = False
+        # set once all tiles have been listed by the readers
+        self._exhausted = False
+
+    @property
+    def journal(self):
+        return self._journal
+
+    def stop(self):
+        """Stop the migration after the current chunk, it can be resumed later using the journal"""
+        self._stop_event.set()
+
+    def _iter_chunks(self):
+        chunk = []
+        for z, x, y in self._source_store.iter_tiles():
+            chunk.append((self._layer, z, x, y))
+            if len(chunk) >= self._chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _put(self, chunk_queue, item):
+        """Put an item to the queue unless the migration is stopped while waiting for free space
+
+        :returns: True if the item has been queued, else False
+        :rtype: bool
+        """
+        while not self._stop_event.is_set():
+            try:
+                chunk_queue.put(item, timeout=MIGRATION_QUEUE_TIMEOUT)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _reader(self, chunks, chunks_lock, chunk_queue):
+        """Read chunks of tiles from the source store and queue them for the writer"""
+        try:
+            while not self._stop_event.is_set():
+                with chunks_lock:
+                    chunk = next(chunks, None)
+                if chunk is None:
+                    self._exhausted = True
+                    break
+                found_tiles = self._source_store.get_tiles(chunk)
+                validators = {}
+                for lzxy in found_tiles.keys():
+                    tile_validators = self._source_store.get_tile_validators(lzxy)
+                    if tile_validators is not None:
+                        validators[lzxy] = tile_validators
+                if not self._put(chunk_queue, (chunk, found_tiles, validators)):
+                    break
+        except Exception:
+            log.exception("reading tiles from %s failed", self._source_store)
+            self._failed = True
+            self._stop_event.set()
+        finally:
+            # let the writer know this reader is done, the writer
+            # keeps taking items from the queue until it gets this
+            chunk_queue.put(None)
+
+    def _write_chunk(self, chunk, found_tiles, validators):
+        """Store a chunk of tiles to the target store & delete it from the source store"""
+        for lzxy in chunk:
+            tile_tuple = found_tiles.get(lzxy)
+            if tile_tuple is None:
+                # deleted in the meantime
+                continue
+            tile_data, timestamp = tile_tuple
+            etag, last_modified = validators.get(lzxy, (None, None))
+            self._target_store.store_tile_data(lzxy, bytes(tile_data), etag=etag,
+                                               last_modified=last_modified, timestamp=timestamp)
+        # the tiles need to be safely stored before they are deleted from the source store
+        # - flush() raises if the tiles can't be written, but not all stores report
+        #   failed writes, so also check that the tiles have actually been stored
+        self._target_store.flush()
+        stored_tiles = self._target_store.tiles_stored(found_tiles.keys())
+        self._source_store.delete_tiles([lzxy for lzxy in chunk if lzxy in stored_tiles])
+        if len(stored_tiles) < len(found_tiles):
+            raise IOError("%d of %d tiles have not been stored to %s"
+                          % (len(found_tiles) - len(stored_tiles), len(found_tiles), self._target_store))
+
+    def run(self, progress_callback=None):
+        """Move the tiles, blocking until all tiles are moved or the migration is stopped
+
+        :param progress_callback: optional function called with the number of migrated tiles
+                                  and the total number of tiles to migrate (None if not known)
+                                  after each chunk
+        :returns: True if all tiles have been moved, False if the migration
+                  has been stopped or has failed
+        :rtype: bool
+        """
+        start = time.time()
+        journal = self._journal
+        if journal.total_count is None:
+            source_stats = self._source_store.get_stats()
+            if source_stats is not None:
+                journal.total_count = journal.migrated_count + source_stats.tile_count
+        journal.save()
+        chunks = self._iter_chunks()
+        chunks_lock = threading.Lock()
+        chunk_queue = queue.Queue(maxsize=self._reader_count * 2)
+        readers = []
+        for i in range(self._reader_count):
+            reader = threading.Thread(target=self._reader, args=(chunks, chunks_lock, chunk_queue),
+                                      name="TileMigrationReader%d" % i)
+            reader.daemon = True
+            reader.start()
+            readers.append(reader)
+        running_readers = len(readers)
+        migrated_count = 0
+        completed = False
+        try:
+            while running_readers:
+                if self._stop_event.is_set():
+                    break
+                try:
+                    item = chunk_queue.get(timeout=MIGRATION_QUEUE_TIMEOUT)
+                except queue.Empty:
+                    continue
+                if item is None:
+                    running_readers -= 1
+                    continue
+                chunk, found_tiles, validators = item
+                self._write_chunk(chunk, found_tiles, validators)
+                migrated_count += len(found_tiles)
+                journal.migrated_count += len(found_tiles)
+                if journal.total_count is not None:
+                    # tiles might have been added to the source store since the migration started
+                    journal.total_count = max(journal.total_count, journal.migrated_count)
+                journal.save()
+                if progress_callback:
+                    progress_callback(journal.migrated_count, journal.total_count)
+            # each reader queues all its chunks before it is done,
+            # so all the chunks have been written
+            completed = not running_readers
+        except Exception:
+            log.exception("migrating tiles from %s to %s failed", self._source_store, self._target_store)
+            self._failed = True
+        finally:
+            # stop the readers & drop any chunks read but not written if the migration
+            # is stopping early, the tiles are still in the source store
+            self._stop_event.set()
+            while running_readers:
+                if chunk_queue.get() is None:
+                    running_readers -= 1
+            for reader in readers:
+                reader.join()
+        finished = completed and self._exhausted and not self._failed
+        if finished:
+            journal.remove()
+            log.info("%d tiles migrated from %s to %s in %1.2f s",
+                     migrated_count, self._source_store, self._target_store, time.time() - start)
+        else:
+            log.info("tile migration from %s to %s stopped after %d tiles (%d in total)",
+                     self._source_store, self._target_store, migrated_count, journal.migrated_count)
+        return finished
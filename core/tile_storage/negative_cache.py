@@ -0,0 +1,103 @@
+# A short lived cache of tile lookup misses
+#
+# While a tile is being downloaded, the GUI keeps asking for it - the image provider,
+# the tile availability checks and the downloader itself all look the tile up again,
+# and each lookup goes through all the stores of the layer. The existence filter
+# answers most of these without touching the disk, but not once it reports false
+# positives or when it is disabled.
+#
+# The negative cache remembers tiles recently not found in any store for a couple
+# seconds, so repeated lookups of the same missing tile are answered from memory.
+# Entries are dropped once the tile is stored, the download of the tile finishes
+# or they get too old, and the least recently added entries are dropped once
+# the cache is full.
+#
+# A lookup can race with storing the tile - the lookup misses, the tile is stored
+# (and its entry dropped) and only then the lookup adds the entry. To avoid caching
+# such a stale miss, lookups take a generation number before looking at the stores
+# and entries are only added if nothing has been invalidated since.
+
+from __future__ import with_statement
+
+import time
+import threading
+from collections import OrderedDict
+
+# how long to remember a missing tile (in seconds)
+NEGATIVE_CACHE_TTL = 5
+# maximum number of remembered missing tiles
+NEGATIVE_CACHE_SIZE = 1024
+
+class NegativeTileCache(object):
+    """Remembers recent tile lookup misses for a short time"""
+
+    def __init__(self, max_size=NEGATIVE_CACHE_SIZE, ttl=NEGATIVE_CACHE_TTL):
+        """
+        :param int max_size: maximum number of remembered misses
+        :param ttl: how long to remember a miss (in seconds)
+        """
+        self._lock = threading.Lock()
+        # lzxy -> expiry timestamp, oldest entry first
+        self._misses = OrderedDict()
+        self._max_size = max(1, int(max_size))
+        self._ttl = ttl
+        self._generation = 0
+        self._hits = 0
+
+    @property
+    def generation(self):
+        """Current generation, to be passed to add() after a lookup miss"""
+        return self._generation
+
+    @property
+    def hits(self):
+        """Number of lookups answered by the cache"""
+        return self._hits
+
+    def is_missing(self, lzxy):
+        """Report if the tile has recently not been found
+
+        :param tuple lzxy: the tile
+        :returns: True if the tile is known to be missing, False if it is not known
+        :rtype: bool
+        """
+        with self._lock:
+            expiry = self._misses.get(lzxy)
+            if expiry is None:
+                return False
+            if expiry < time.time():
+                del self._misses[lzxy]
+                return False
+            self._hits += 1
+            return True
+
+    def add(self, lzxy, generation):
+        """Remember that a tile has not been found
+
+        :param tuple lzxy: the tile
+        :param int generation: value of the generation property before the lookup started,
+                               the miss is not remembered if anything has been invalidated since
+        """
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._misses.pop(lzxy, None)
+            self._misses[lzxy] = time.time() + self._ttl
+            while len(self._misses) > self._max_size:
+                self._misses.popitem(last=False)
+
+    def discard(self, lzxy):
+        """Forget a miss of the given tile, as it might be available now"""
+        with self._lock:
+            self._generation += 1
+            self._misses.pop(lzxy, None)
+
+    def clear(self):
+        """Forget all misses (such as once a store is added)"""
+        with self._lock:
+            self._generation += 1
+            self._misses.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._misses)
@@ -0,0 +1,324 @@
+# A read-only tile store using memory mapped tile pack files
+#
+# Tile packs are meant for big offline regions shipped to devices - they can't be modified
+# once built, but tile lookups are very cheap:
+# * the pack file is memory mapped, so the operating system pages in only the parts that are used
+# * tiles are looked up with a binary search in a sorted index
+# * tile data is returned as a memoryview slice of the mapped file, without any copying
+#
+# Tile pack file layout (all integers are little endian):
+#
+# header:
+#   magic (4 bytes, "MRTP"), format version (uint16), flags (uint16, unused),
+#   tile count (uint64), index offset (uint64), build timestamp (uint64)
+# data section:
+#   tile data blobs, one after another
+# index:
+#   tile count entries of tile key (uint64), data offset (uint64), data length (uint32),
+#   tile timestamp (uint32), sorted by tile key
+#
+# The tile key is the same packed z/x/y key used by the SQLite tile store.
+#
+# The index is at the end of the file so that packs can be built in a single streaming pass -
+# tile data is written as it is read from the source store and only the index entries
+# (24 bytes per tile) need to be kept in memory until the end.
+
+from __future__ import with_statement
+
+import os
+import glob
+import mmap
+import time
+import struct
+from array import array
+
+import logging
+log = logging.getLogger("tile_storage.pack_store")
+
+from .base import BaseTileStore
+from .stats import TileStats
+from .sqlite_store import get_tile_key, get_tile_zxy
+
+TILE_PACK_FILE_EXTENSION = ".tilepack"
+TILE_PACK_FORMAT_VERSION = 1
+TILE_PACK_MAGIC = b"MRTP"
+HEADER_FORMAT = "<4sHHQQQ"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+INDEX_ENTRY_FORMAT = "<QQII"
+INDEX_ENTRY_SIZE = struct.calcsize(INDEX_ENTRY_FORMAT)
+# how many tiles to fetch from the source store at once when building a pack
+PACK_BUILD_CHUNK_SIZE = 256
+
+class TilePackError(Exception):
+    """Raised when a tile pack file is invalid"""
+    pass
+
+class TilePack(object):
+    """A single memory mapped tile pack file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty files can't be mapped
+            self._file.close()
+            raise TilePackError("%s is empty" % path)
+        magic, version, _flags, self.tile_count, self._index_offset, self.build_timestamp = \
+            struct.unpack_from(HEADER_FORMAT, self._mmap, 0)
+        if magic != TILE_PACK_MAGIC or version != TILE_PACK_FORMAT_VERSION:
+            self.close()
+            raise TilePackError("%s is not a version %d tile pack" % (path, TILE_PACK_FORMAT_VERSION))
+        if self._index_offset + self.tile_count * INDEX_ENTRY_SIZE > len(self._mmap):
+            self.close()
+            raise TilePackError("%s is truncated" % path)
+        self._view = memoryview(self._mmap)
+
+    def _find(self, tile_key):
+        """Binary search for the tile key in the index
+
+        :returns: (data offset, data length, timestamp) tuple or None if not found
+        :rtype: tuple or None
+        """
+        lo = 0
+        hi = self.tile_count
+        index_offset = self._index_offset
+        buffer = self._mmap
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key, offset, length, timestamp = struct.unpack_from(
+                INDEX_ENTRY_FORMAT, buffer, index_offset + mid * INDEX_ENTRY_SIZE)
+            if key < tile_key:
+                lo = mid + 1
+            elif key > tile_key:
+                hi = mid
+            else:
+                return offset, length, timestamp
+        return None
+
+    def get_tile(self, tile_key):
+        """Get tile data as a memoryview slice of the pack file and timestamp
+
+        :returns: (memoryview, timestamp) tuple or None if not found
+        :rtype: tuple or None
+        """
+        entry = self._find(tile_key)
+        if entry is None:
+            return None
+        offset, length, timestamp = entry
+        return self._view[offset:offset + length], timestamp
+
+    def get_timestamp(self, tile_key):
+        """Get timestamp of the tile or None if not found"""
+        entry = self._find(tile_key)
+        if entry is None:
+            return None
+        return entry[2]
+
+    def iter_entries(self):
+        """Iterate over index entries of all tiles in the pack in ascending tile key order
+
+        :returns: iterator of (tile key, data offset, data length, timestamp) tuples
+        """
+        for i in range(self.tile_count):
+            yield struct.unpack_from(INDEX_ENTRY_FORMAT, self._mmap, self._index_offset + i * INDEX_ENTRY_SIZE)
+
+    def iter_keys(self):
+        """Iterate over keys of all tiles in the pack in ascending order"""
+        for i in range(self.tile_count):
+            yield struct.unpack_from("<Q", self._mmap, self._index_offset + i * INDEX_ENTRY_SIZE)[0]
+
+    def close(self):
+        view = getattr(self, "_view", None)
+        try:
+            if view is not None:
+                view.release()
+            self._mmap.close()
+        except BufferError:
+            # tile data memoryviews are still in use somewhere,
+            # the mapping will be closed once they are garbage collected
+            log.debug("tile data from %s still in use, not unmapping it right away", self.path)
+        self._file.close()
+
+class TilePackStore(BaseTileStore):
+
+    @staticmethod
+    def is_store(path):
+        """We consider the path to be a tile pack store if it is a folder
+           that contains at least one tile pack file.
+
+        :param str path: path to test
+        :returns: True if the path is a tile pack store, else False
+        :rtype: bool
+        """
+        return os.path.isdir(path) and bool(glob.glob(os.path.join(path, "*" + TILE_PACK_FILE_EXTENSION)))
+
+    def __init__(self, store_path, prevent_media_indexing=False):
+        """
+        :param str store_path: path to the folder holding the tile pack files
+        :param bool prevent_media_indexing: unused, tile pack stores never create any files
+        """
+        BaseTileStore.__init__(self, store_path, prevent_media_indexing=prevent_media_indexing)
+        self._packs = []
+        for pack_path in sorted(glob.glob(os.path.join(self.store_path, "*" + TILE_PACK_FILE_EXTENSION))):
+            try:
+                self._packs.append(TilePack(pack_path))
+            except (TilePackError, EnvironmentError):
+                log.exception("can't open tile pack %s", pack_path)
+        # tile packs can't change, so the statistics are computed only once, when first requested
+        self._stats = None
+
+    def __str__(self):
+        return "tile pack store @ %s" % self.store_path
+
+    def __repr__(self):
+        return str(self)
+
+    def store_tile_data(self, lzxy, tile_data, etag=None, last_modified=None, timestamp=None):
+        log.error("can't store tile %s to read only %s", lzxy[1:], self)
+
+    def get_tile(self, lzxy):
+        """Get tile data and timestamp corresponding to the given coordinate tuple
+
+        NOTE: the tile data is a memoryview of the memory mapped pack file, not bytes
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+                           (layer is actually not used and can be None)
+        :returns: (tile data, timestamp) or None if tile is not found
+        :rtype: a (memoryview, int) tuple or None
+        """
+        tile_key = get_tile_key(lzxy[1], lzxy[2], lzxy[3])
+        for pack in self._packs:
+            tile_tuple = pack.get_tile(tile_key)
+            if tile_tuple is not None:
+                return tile_tuple
+        return None
+
+    def tile_is_stored(self, lzxy):
+        """Report if a tile specified by the lzxy tuple is stored
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+        :returns: (True, timestamp) if tile is stored, else False
+        """
+        tile_key = get_tile_key(lzxy[1], lzxy[2], lzxy[3])
+        for pack in self._packs:
+            timestamp = pack.get_timestamp(tile_key)
+            if timestamp is not None:
+                return True, timestamp
+        return False
+
+    def delete_tile(self, lzxy):
+        log.error("can't delete tile %s from read only %s", lzxy[1:], self)
+
+    def delete_tiles(self, lzxy_iterable):
+        log.error("can't delete tiles from read only %s", self)
+
+    def delete_region(self, tile_ranges):
+        log.error("can't delete tiles from read only %s", self)
+        return 0
+
+    def delete_older_than(self, timestamp, chunk_callback=None):
+        # tile packs are meant to be kept until replaced as a whole
+        return 0
+
+    def iter_tiles(self):
+        """Iterate over coordinates of all tiles in the store
+
+        :returns: iterator of (z, x, y) tuples
+        """
+        for pack in self._packs:
+            for tile_key in pack.iter_keys():
+                yield get_tile_zxy(tile_key)
+
+    def get_stats(self):
+        """Get per zoom level statistics of the tiles in the tile packs
+
+        :returns: statistics of the tiles in the store
+        :rtype: TileStats
+        """
+        if self._stats is None:
+            stats = TileStats()
+            for pack in self._packs:
+                for tile_key, _offset, length, timestamp in pack.iter_entries():
+                    stats.add(get_tile_zxy(tile_key)[0], length, timestamp)
+            self._stats = stats
+        return self._stats
+
+    def get_modification_stamp(self):
+        """Get a stamp that changes whenever tile packs are added, removed or replaced
+
+        :returns: list of [pack file name, size, modification time] lists
+        :rtype: list
+        """
+        return [[os.path.basename(pack.path), os.path.getsize(pack.path), os.path.getmtime(pack.path)]
+                for pack in self._packs]
+
+    def close(self):
+        for pack in self._packs:
+            pack.close()
+        self._packs = []
+
+def build_tile_pack(source_store, layer, pack_path, progress_callback=None):
+    """Build a tile pack from all tiles in a tile store
+
+    The source store is read in a single streaming pass and tile data is written to the
+    pack as it is read, so the whole pack never needs to fit in memory.
+
+    :param source_store: tile store to read the tiles from
+    :param layer: layer object passed to the source store in lzxy tuples
+                  (for example the file based store needs the layer type)
+    :param str pack_path: path to the tile pack file to create
+    :param progress_callback: optional function called with the number
+                              of tiles written so far after each chunk
+    :returns: number of tiles in the pack
+    :rtype: int
+    """
+    keys = array("Q")
+    offsets = array("Q")
+    lengths = array("L")
+    timestamps = array("L")
+    partial_pack_path = pack_path + ".part"
+    with open(partial_pack_path, "wb") as f:
+        # header placeholder, the header is written once the index is known
+        f.write(b"\0" * HEADER_SIZE)
+        offset = HEADER_SIZE
+        chunk = []
+
+        def write_chunk(offset):
+            for lzxy, (tile_data, timestamp) in source_store.get_tiles(chunk).items():
+                f.write(tile_data)
+                keys.append(get_tile_key(lzxy[1], lzxy[2], lzxy[3]))
+                offsets.append(offset)
+                lengths.append(len(tile_data))
+                timestamps.append(int(timestamp))
+                offset += len(tile_data)
+            del chunk[:]
+            if progress_callback:
+                progress_callback(len(keys))
+            return offset
+
+        for z, x, y in source_store.iter_tiles():
+            chunk.append((layer, z, x, y))
+            if len(chunk) >= PACK_BUILD_CHUNK_SIZE:
+                offset = write_chunk(offset)
+        if chunk:
+            offset = write_chunk(offset)
+
+        # write the index sorted by tile key, skipping any tiles
+        # listed more than once by the source store
+        index_offset = offset
+        tile_count = 0
+        last_key = None
+        for i in sorted(range(len(keys)), key=keys.__getitem__):
+            if keys[i] == last_key:
+                continue
+            last_key = keys[i]
+            f.write(struct.pack(INDEX_ENTRY_FORMAT, keys[i], offsets[i], lengths[i], timestamps[i]))
+            tile_count += 1
+        f.seek(0)
+        f.write(struct.pack(HEADER_FORMAT, TILE_PACK_MAGIC, TILE_PACK_FORMAT_VERSION, 0,
+                            tile_count, index_offset, int(time.time())))
+    os.rename(partial_pack_path, pack_path)
+    log.info("tile pack with %d tiles built from %s: %s", tile_count, source_store, pack_path)
+    return tile_count
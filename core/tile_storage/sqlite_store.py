@@ -21,46 +21,158 @@
 # store.sqlite.2
 # etc.
 #
-# The storage database looks schema like this:
+# The lookup database schema looks like this:
 #
-# table tiles (z integer, x integer, y integer, store_filename string, extension varchar(10), unix_epoch_timestamp integer, primary key (z, x, y, extension))
+# table tiles_v2 (tile_key integer not null primary key, store_filename text, extension varchar(10), unix_epoch_timestamp integer, last_access integer, etag text, last_modified text) without rowid
+#
+# table tile_stats (zoom integer primary key, tile_count integer, byte_count integer, oldest integer, newest integer)
 #
 # The storage databases schema look like this:
 #
-# table tiles (z integer, x integer, y integer, tile blob, extension varchar(10), unix_epoch_timestamp integer, primary key (z, x, y, extension))
+# table tiles_v2 (tile_key integer primary key, tile blob, extension varchar(10), unix_epoch_timestamp integer, tile_hash blob)
+# table tile_blobs (hash blob not null primary key, tile blob, refcount integer not null)
 #
 # The only difference in the structure is that the lookup databases only stores the name of the store
 # for given coordinates and the store database stores the actual blob.
 # Both also have a table called version which has an integer column called v.
-# There is a single 1 inserted, which indicates the current version of the table.
+# There is a single 2 inserted, which indicates the current version of the table.
+#
+# The tile key is a single 64 bit integer packing the tile coordinates - the zoom level is stored
+# in the top bits and the x and y coordinates are bit-interleaved (Morton/Z-order code) below it.
+# So tiles are ordered by zoom level first and tiles close to each other on the map are close to each
+# other in the key space and thus on disk. The lookup table is a WITHOUT ROWID table clustered on the
+# tile key. The storage tables use the tile key as an alias for the rowid, which is also clustered on
+# the tile key but better suited for tables holding large blobs.
+#
+# When looking for a tile in the database, the lookup database is checked first and if the tile key
+# is found the corresponding storage database is queried for the actual data.
+#
+# Version 1 of the format used a composite (z, x, y, extension) primary key in a table
+# called tiles, both in the lookup and storage databases. Version 1 stores are migrated
+# to version 2 in place and online - the version 2 tables are added next to the version 1
+# tables and the writer thread moves the tiles to them in chunks while it is otherwise idle.
+# Until the migration finishes, tiles are looked up in both the version 1 and version 2 tables.
+# Once all tiles are migrated, the version 1 tables are dropped.
+#
+# Writes are write-behind:
+# store_tile_data() only puts the tile to an in-memory pending dictionary and returns
+# immediately. A single writer thread owned by the store gathers the pending tiles and
+# writes them in batches - each batch is written to the lookup database and all the
+# storage databases it touches in a single transaction per database file, so that
+# we pay for one commit (and the fsync that comes with it) per batch, not per tile.
+# A batch is written once enough tiles have been gathered or once the flush interval
+# elapses, whichever comes first. Tiles waiting in the pending dictionary are visible
+# to all the read methods and flush() blocks until all tiles stored before it was called
+# are on disk. Tiles that fail to be written are kept pending and retried after the flush
+# interval, flush() raises TileStoreWriteFailed if it could not write them.
+#
+# Optionally the databases can be used in WAL journal mode. In WAL mode each thread reading
+# from the store gets its own read connections and reads are not serialized with each other
+# or with the writer thread, which is still the only thread writing to the databases.
+# A busy timeout is set on all connections so that other processes (such as a tile pre-seeding
+# tool) can access the store at the same time without "database is locked" errors.
+#
+# The lookup database also tracks when each tile has been last accessed, so that least recently
+# used tiles can be evicted once the store gets too big. Access times are coarse (see
+# ACCESS_TIME_RESOLUTION) and updated in batches by the writer thread, so reading a tile
+# does not result in a write. New databases use incremental auto vacuum, so that space freed
+# by evicting tiles is returned to the filesystem.
+#
+# Many tiles are byte-identical (open sea, empty land, blank overlay tiles), so the store can
+# optionally deduplicate tile data. Deduplicated tiles have no data in the tile column, only
+# a hash of the data, and the data itself is stored once per storage database in the tile blob
+# table together with a reference count. The reference counts are maintained by triggers on the
+# tile table, so tiles can be deleted the same way regardless of being deduplicated or not.
+# Reads transparently use the blob data for tiles without data in the tile column, so stores
+# can contain both kinds of tiles and deduplication can be switched on and off at any time.
+#
+# The lookup database also keeps the HTTP cache validators (ETag and Last-Modified) the tile
+# has been served with, so that expired tiles can be refreshed with a conditional request.
+# If the tile has not been modified, only its timestamp is updated ("touched") - touches are
+# write-behind just like new tiles, but don't rewrite the tile data.
+#
+# Per zoom level tile statistics (see stats.py) are kept in the tile stats table of the lookup
+# database and updated in the same transaction as the tiles they describe. Stores that don't
+# have the table yet get it filled from the storage databases once, when they are opened.
 #
-# When looking for a tile in the database, the lookup database is checked first and if the coordinates
-# are found the corresponding storage database is queried for the actual data.
+# For reading, the storage databases are attached to a connection to the lookup database,
+# so that a tile can be looked up and its data fetched with a single query joining the lookup
+# table with the tile tables of the storage databases. Storage databases added at runtime are
+# attached on the next read. If there are more storage databases than SQLite can attach,
+# the lookup database and the storage database are queried separately.
+#
+# Once many tiles are deleted, the storage databases can end up only partially full.
+# Repacking moves tiles from the last storage databases to the first ones that have
+# free space and deletes the emptied storage databases. Read connections of all threads
+# are reconnected once a storage database is deleted (see the store generation counter).
 
 from __future__ import with_statement
 
 import os
+import re
 import sqlite3
+import hashlib
 import glob
 import time
+import threading
 from threading import RLock
 
 import logging
 log = logging.getLogger("tile_storage.sqlite_store")
 
 from .base import BaseTileStore
-from .constants import GIBI_BYTE
+from .exceptions import TileStoreWriteFailed
+from .constants import GIBI_BYTE, ACCESS_TIME_RESOLUTION
+from .stats import TileStats
 from . import utils
 
 # the storage database files can be only this big to avoid
 # maximum file size limitations on FAT32 and possibly elsewhere
 MAX_STORAGE_DB_FILE_SIZE = 3.7  # in Gibi Bytes
+# how many tiles to write to the databases in a single transaction
 SQLITE_QUEUE_SIZE = 50
-SQLITE_TILE_STORAGE_FORMAT_VERSION = 1
+# how often to write pending tiles even if the batch is not yet full
+SQLITE_FLUSH_INTERVAL = 5  # in seconds
+# once this many batches are pending, store_tile_data() will block until
+# the writer thread catches up, so that the pending tiles don't eat all memory
+SQLITE_MAX_PENDING_BATCHES = 4
+# how long to wait for a database lock held by another connection before giving up
+SQLITE_BUSY_TIMEOUT = 30  # in seconds
+SQLITE_TILE_STORAGE_FORMAT_VERSION = 2
+# how many tiles to migrate from version 1 tables in a single transaction
+SQLITE_MIGRATION_CHUNK_SIZE = 500
+# how long the writer thread should wait for new tiles to write
+# between migrating chunks of tiles
+SQLITE_MIGRATION_PAUSE = 0.1  # in seconds
+# the maximum zoom level that fits to a tile key
+# - 5 bits for the zoom level + 2 * 28 bits for the x and y coordinates
+#   fit into a signed 64 bit integer
+MAX_TILE_KEY_ZOOM = 28
 LOOKUP_DB_NAME = "lookup.sqlite"
 STORE_DB_NAME_PREFIX = "store.sqlite."
+STORE_DB_NAME_RE = re.compile(r"^store\.sqlite\.[0-9]+$")
+# how many tiles to query at once in bulk reads
+# - SQLite by default limits the number of query parameters to 999
+SQLITE_BULK_QUERY_SIZE = 900
+# version 1 tables need 3 parameters per tile
+SQLITE_V1_BULK_QUERY_SIZE = 300
+# SQLite by default supports at most 10 attached databases per connection,
+# if there are more storage databases than that, tiles are read with one query
+# to the lookup database and one query per storage database
+SQLITE_MAX_ATTACHED_STORES = 10
+# how many tiles to evict in a single transaction
+SQLITE_EVICTION_CHUNK_SIZE = 1000
+# how many tiles to delete in a single transaction when deleting regions or old tiles
+SQLITE_DELETION_CHUNK_SIZE = 1000
+# how many tiles to convert to deduplicated tiles in a single transaction
+SQLITE_DEDUPLICATION_CHUNK_SIZE = 500
+# how many tiles to move between storage databases in a single transaction when repacking
+SQLITE_REPACK_CHUNK_SIZE = 500
+# write access times of read tiles once this many are waiting,
+# otherwise they are written together with the next batch of tiles
+SQLITE_ACCESS_TIME_BATCH_SIZE = 500
 
-def connect_to_db(path_to_database):
+def connect_to_db(path_to_database, wal_mode=False):
     """Setting check_same_thread to False fixes a Sqlite exception
     that happens when a thread tries to access a database read connection
     that was created in a different thread. All write connections are "owned"
@@ -77,10 +189,289 @@ def connect_to_db(path_to_database):
     found that it has some serious disadvantages, some of these alternative
     solutions could be used.
 
+    NOTE: In WAL mode per thread read connections are used, but check_same_thread
+          is still set to False so that the connections can be closed from the thread
+          closing the store.
+
+    The busy timeout makes SQLite wait for a lock held by another connection
+    (possibly from another process) instead of failing right away with
+    "database is locked".
+
     :param str path_to_database: path to the database
+    :param bool wal_mode: switch the database to WAL journal mode
     :returns: Sqlite database connection
     """
-    return sqlite3.connect(path_to_database, check_same_thread=False)
+    connection = sqlite3.connect(path_to_database, check_same_thread=False,
+                                 timeout=SQLITE_BUSY_TIMEOUT)
+    if wal_mode:
+        # the journal mode is persistent, but switching a database that already
+        # is in WAL mode is a no-op so we can safely do it every time
+        journal_mode = connection.execute("pragma journal_mode=wal").fetchone()[0]
+        if journal_mode.lower() == "wal":
+            # in WAL mode syncing on every commit is not needed for consistency,
+            # only on checkpoints
+            connection.execute("pragma synchronous=normal")
+        else:
+            log.warning("WAL journal mode not supported for %s, using %s mode",
+                        path_to_database, journal_mode)
+    return connection
+
+def get_journal_mode(connection):
+    """Get journal mode of the database the connection is connected to
+
+    :param connection: Sqlite database connection
+    :returns: journal mode name in lower case
+    :rtype: str
+    """
+    return connection.execute("pragma journal_mode").fetchone()[0].lower()
+
+LOOKUP_TABLE_SQL = "create table if not exists tiles_v2 (tile_key integer not null primary key, store_filename text, extension varchar(10), unix_epoch_timestamp integer, last_access integer, etag text, last_modified text) without rowid"
+LOOKUP_ACCESS_INDEX_SQL = "create index if not exists tiles_v2_last_access on tiles_v2 (last_access)"
+STORE_TABLE_SQL = "create table if not exists tiles_v2 (tile_key integer primary key, tile blob, extension varchar(10), unix_epoch_timestamp integer, tile_hash blob)"
+BLOB_TABLE_SQL = "create table if not exists tile_blobs (hash blob not null primary key, tile blob, refcount integer not null)"
+# keep reference counts of deduplicated tile data up to date & drop unreferenced tile data
+# - "insert or replace" deletes the replaced row, which only fires the delete trigger
+#   with recursive triggers enabled
+BLOB_TRIGGERS_SQL = [
+    "create trigger if not exists tiles_v2_blob_ref after insert on tiles_v2 when new.tile_hash is not null "
+    "begin update tile_blobs set refcount=refcount+1 where hash=new.tile_hash; end",
+    "create trigger if not exists tiles_v2_blob_unref after delete on tiles_v2 when old.tile_hash is not null "
+    "begin update tile_blobs set refcount=refcount-1 where hash=old.tile_hash; "
+    "delete from tile_blobs where hash=old.tile_hash and refcount<=0; end",
+]
+# tile data of tiles in a storage table aliased as "s", regardless of being deduplicated or not
+# - needs to be formatted with the schema name prefix of the storage database (if any)
+TILE_DATA_SQL = "coalesce(s.tile, (select b.tile from %stile_blobs as b where b.hash=s.tile_hash))"
+STATS_TABLE_SQL = "create table if not exists tile_stats (zoom integer primary key, tile_count integer, byte_count integer, oldest integer, newest integer)"
+
+def get_tile_hash(tile_data):
+    """Get the hash used to deduplicate tile data
+
+    :param bytes tile_data: tile data
+    :returns: hash of the tile data
+    :rtype: bytes
+    """
+    return hashlib.sha256(tile_data).digest()
+
+def _spread_bits(value):
+    """Insert a zero bit after each of the lower 32 bits of the value"""
+    value &= 0xffffffff
+    value = (value | (value << 16)) & 0x0000ffff0000ffff
+    value = (value | (value << 8)) & 0x00ff00ff00ff00ff
+    value = (value | (value << 4)) & 0x0f0f0f0f0f0f0f0f
+    value = (value | (value << 2)) & 0x3333333333333333
+    value = (value | (value << 1)) & 0x5555555555555555
+    return value
+
+def _compact_bits(value):
+    """Inverse of _spread_bits() - take every other bit of the value"""
+    value &= 0x5555555555555555
+    value = (value | (value >> 1)) & 0x3333333333333333
+    value = (value | (value >> 2)) & 0x0f0f0f0f0f0f0f0f
+    value = (value | (value >> 4)) & 0x00ff00ff00ff00ff
+    value = (value | (value >> 8)) & 0x0000ffff0000ffff
+    value = (value | (value >> 16)) & 0x00000000ffffffff
+    return value
+
+def get_tile_key(z, x, y):
+    """Pack tile coordinates into a single 64 bit integer tile key
+
+    The zoom level is stored in the top bits, followed by a Morton code
+    of the x and y coordinates.
+
+    :param int z: zoom level
+    :param int x: x coordinate
+    :param int y: y coordinate
+    :returns: tile key
+    :rtype: int
+    """
+    if not 0 <= z <= MAX_TILE_KEY_ZOOM:
+        raise ValueError("zoom level %s can't be stored in a tile key" % z)
+    return (z << (2 * MAX_TILE_KEY_ZOOM)) | (_spread_bits(y) << 1) | _spread_bits(x)
+
+def get_tile_zxy(tile_key):
+    """Unpack tile coordinates from a tile key
+
+    :param int tile_key: tile key
+    :returns: z, x, y tuple
+    :rtype: tuple
+    """
+    morton_code = tile_key & ((1 << (2 * MAX_TILE_KEY_ZOOM)) - 1)
+    return tile_key >> (2 * MAX_TILE_KEY_ZOOM), _compact_bits(morton_code), _compact_bits(morton_code >> 1)
+
+def _key_chunks(key_list, chunk_size=SQLITE_BULK_QUERY_SIZE):
+    """Split a list of tile keys to chunks small enough for a single bulk query
+
+    :param list key_list: list of tile keys
+    :param int chunk_size: maximum number of tiles per chunk
+    :returns: iterator of (query placeholders, query parameters) tuples
+    """
+    for i in range(0, len(key_list), chunk_size):
+        chunk = key_list[i:i + chunk_size]
+        yield ",".join(["?"] * len(chunk)), chunk
+
+def _get_store_number(store_name):
+    """Get number of a storage database from its store.sqlite.<number> name"""
+    return int(store_name[len(STORE_DB_NAME_PREFIX):])
+
+def _zxy_chunks(zxy_list):
+    """Split a list of z, x, y tuples to chunks small enough
+    for a single bulk query on the version 1 tables
+
+    :param list zxy_list: list of z, x, y tuples
+    :returns: iterator of (query condition, query parameters) tuples
+    """
+    for i in range(0, len(zxy_list), SQLITE_V1_BULK_QUERY_SIZE):
+        chunk = zxy_list[i:i + SQLITE_V1_BULK_QUERY_SIZE]
+        condition = " or ".join(["(z=? and x=? and y=?)"] * len(chunk))
+        parameters = [coordinate for zxy in chunk for coordinate in zxy]
+        yield condition, parameters
+
+def incremental_vacuum(connection):
+    """Return free pages of a database using incremental auto vacuum to the filesystem
+
+    NOTE: this commits any pending transaction on the connection
+
+    :param connection: Sqlite database connection
+    """
+    # the pragma frees a single page per statement step, but it returns no rows,
+    # so the statement needs to be run to completion with executescript()
+    connection.executescript("pragma incremental_vacuum;")
+
+def _add_stats_change(stats_changes, z, count, size, timestamp=None):
+    """Record a change of tile statistics to be written together with the tiles
+
+    :param dict stats_changes: [count change, size change, oldest, newest] lists keyed by zoom level
+    :param int z: zoom level of the tile(s)
+    :param int count: tile count change
+    :param int size: tile data size change
+    :param timestamp: timestamp of added or touched tiles
+    """
+    change = stats_changes.get(z)
+    if change is None:
+        change = [0, 0, None, None]
+        stats_changes[z] = change
+    change[0] += count
+    change[1] += size
+    if timestamp is not None:
+        change[2] = timestamp if change[2] is None else min(change[2], timestamp)
+        change[3] = timestamp if change[3] is None else max(change[3], timestamp)
+
+def _write_stats_changes(connection, stats_changes):
+    """Apply tile statistics changes to the tile stats table of the lookup database
+
+    NOTE: the changes are part of the current transaction, the caller commits them
+    """
+    for z, (count, size, oldest, newest) in stats_changes.items():
+        connection.execute("insert or ignore into tile_stats (zoom, tile_count, byte_count) values (?, 0, 0)", (z,))
+        # the SQLite min() & max() functions return null if any of the arguments is null
+        connection.execute(
+            "update tile_stats set tile_count=tile_count+?, byte_count=byte_count+?, "
+            "oldest=coalesce(min(oldest, ?), oldest, ?), newest=coalesce(max(newest, ?), newest, ?) "
+            "where zoom=?", (count, size, oldest, oldest, newest, newest, z))
+    connection.execute("delete from tile_stats where tile_count<=0")
+
+def _get_tile_sizes(store_connection, tile_keys):
+    """Get tile data sizes of tiles in a storage database
+
+    :returns: list of (tile key, tile data size) tuples
+    :rtype: list
+    """
+    sizes = []
+    for placeholders, parameters in _key_chunks(tile_keys):
+        sizes.extend(store_connection.execute(
+            "select s.tile_key, length(%s) from tiles_v2 as s where s.tile_key in (%s)" % (TILE_DATA_SQL % "", placeholders),
+            parameters).fetchall())
+    return sizes
+
+def _table_exists(connection, table_name):
+    """Report if a table with the given name exists in the database"""
+    return bool(connection.execute("select name from sqlite_master where type='table' and name=?",
+                                   (table_name,)).fetchall())
+
+class _AttachedReadConnection(object):
+    """A connection to the lookup database with the storage databases attached to it
+
+    This makes it possible to look up a tile and fetch its data with a single
+    query joining the lookup table with the tile tables of the storage databases.
+    """
+
+    def __init__(self, lookup_db_path, store_path):
+        self._store_path = store_path
+        self.connection = connect_to_db(lookup_db_path)
+        self.connection.execute("pragma query_only=1")
+        # storage database name -> schema name the database is attached as
+        self._attached_stores = {}
+        self.tile_query = None
+
+    def sync(self, store_names):
+        """Attach storage databases that have not yet been attached
+
+        :param store_names: names of all the storage databases of the store
+        :returns: True if all the storage databases are attached, False if there
+                  are too many storage databases to attach them all
+        :rtype: bool
+        """
+        if len(self._attached_stores) == len(store_names):
+            return True
+        if len(store_names) > SQLITE_MAX_ATTACHED_STORES:
+            return False
+        for store_name in sorted(store_names):
+            if store_name not in self._attached_stores:
+                schema_name = "store_%d" % len(self._attached_stores)
+                self.connection.execute("attach database ? as %s" % schema_name,
+                                        (os.path.join(self._store_path, store_name),))
+                self._attached_stores[store_name] = schema_name
+        self.tile_query = self.get_query("l.tile_key=:tile_key")
+        return True
+
+    @property
+    def store_count(self):
+        return len(self._attached_stores)
+
+    def get_query(self, condition):
+        """Get a query returning tile key, tile data and timestamp of tiles
+        matching the condition, regardless of the storage database they are stored in
+
+        Each storage database has its own branch of the query,
+        so that SQLite can use the primary key indexes of both
+        the lookup table and the tile table in each branch.
+
+        :param str condition: condition on the lookup table, aliased as "l"
+        :returns: the query
+        :rtype: str
+        """
+        branches = []
+        for store_name, schema_name in sorted(self._attached_stores.items()):
+            # store names are always in the store.sqlite.<number> form,
+            # so they can be safely used in the query as literals
+            branches.append(
+                "select l.tile_key, %s, s.unix_epoch_timestamp from main.tiles_v2 as l "
+                "join %s.tiles_v2 as s on s.tile_key=l.tile_key "
+                "where l.store_filename='%s' and (%s)" % (TILE_DATA_SQL % (schema_name + "."),
+                                                          schema_name, store_name, condition)
+            )
+        return " union all ".join(branches)
+
+    def close(self):
+        self.connection.close()
+
+class _NoLock(object):
+    """A no-op stand in for a lock, used to skip locking on WAL mode reads"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+class _FlushRequest(object):
+    """A thread waiting in flush() for the pending tiles to be written"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        # the exception that prevented the pending tiles from being written (if any)
+        self.error = None
 
 class SqliteTileStore(BaseTileStore):
 
@@ -104,8 +495,20 @@ class SqliteTileStore(BaseTileStore):
                 is_store = True
         return is_store
 
-    def __init__(self, store_path, prevent_media_indexing = False):
+    def __init__(self, store_path, prevent_media_indexing = False,
+                 batch_size=SQLITE_QUEUE_SIZE, flush_interval=SQLITE_FLUSH_INTERVAL,
+                 wal_mode=False, deduplicate=False):
+        """
+        :param str store_path: path to the folder holding the store databases
+        :param bool prevent_media_indexing: prevent media indexers from indexing the store folder
+        :param int batch_size: how many tiles to write to the databases in a single transaction
+        :param float flush_interval: how often (in seconds) to write pending tiles,
+                                     even if the batch is not yet full
+        :param bool wal_mode: use WAL journal mode & per thread read connections
+        :param bool deduplicate: store data of identical tiles only once (per storage database)
+        """
         BaseTileStore.__init__(self, store_path, prevent_media_indexing=prevent_media_indexing)
+        self._deduplicate = deduplicate
 
         # SQLite tends to blow up with the infamous "sqlite3.OperationalError: database is locked"
         # if the database is accessed from multiple threads an/or processes at the same time.
@@ -119,7 +522,14 @@ class SqliteTileStore(BaseTileStore):
         # We should try to compensate for this by batching read and write requests,
         # which should ot be that difficult as for example modRana often needs to fetch a full
         # screen of tiles and we can quite easily cache write requests and submit them in batch.
+        #
+        # In WAL mode readers don't block the writer and the writer does not block readers,
+        # so each thread gets its own read connections and reads don't need the database lock.
+        # Only the writer still needs to be serialized, which is handled by the writer thread
+        # taking the database lock. The busy timeout set on all connections then takes care
+        # of any remaining lock contention, such as with other processes accessing the store.
         self._db_lock = RLock()
+        self._wal_mode = wal_mode
         # to avoid possible race conditions we needs to mutually exclude operations concerning
         # storage database free space checking and the related adding of new stores
         self._storage_db_management_lock = RLock()
@@ -132,7 +542,30 @@ class SqliteTileStore(BaseTileStore):
         # (hitting the 4 GB file size limit while storing only tile coordinates
         #  should hopefully never happen)
         self._lookup_db_path = os.path.join(self.store_path, LOOKUP_DB_NAME)
+        # set to True by _get_lookup_db_connection() if the store still has version 1 tables
+        # that need to be migrated
+        self._v1_tables_present = False
         self._lookup_db_connection = self._get_lookup_db_connection()
+        if self._wal_mode and get_journal_mode(self._lookup_db_connection) != "wal":
+            # WAL mode is not supported (SQLite older than 3.7.0 or unsuitable filesystem),
+            # fall back to the serialized access mode
+            self._wal_mode = False
+        # per thread read connections used in WAL mode
+        self._thread_local = threading.local()
+        # connections to the lookup database with the storage databases attached,
+        # per thread in WAL mode, shared in serialized access mode
+        self._shared_attached_connection = None
+        # incremented whenever a storage database is deleted, so that threads
+        # know they need to reconnect their read connections
+        self._store_generation = 0
+        # per thread read connections keyed by the thread owning them,
+        # so that we can close them once the thread dies or the store is closed
+        self._read_connections = {}
+        self._read_connections_lock = RLock()
+        if self._wal_mode:
+            self._read_lock = _NoLock()
+        else:
+            self._read_lock = self._db_lock
         # there is always one or more storage databases that hold the actual tile data
         # - once a storage database hits the max file size limit (actually se to 3.7 GB just in case)
         #   a new storage database file is added
@@ -144,12 +577,41 @@ class SqliteTileStore(BaseTileStore):
         # storage databases are full
         # - we just connect the storage with the lowest number at startup and let the usable
         #   storage database finding logic do its job in case  it is too full
+        self._init_stats()
+
         sorted_store_names = list(sorted(self._storage_databases.keys()))
         store_name = sorted_store_names[0]
         store_connection = self._storage_databases[store_name]
         self._new_tiles_store_name = store_name
         self._new_tiles_store_connection = store_connection
 
+        # write-behind tile queue
+        # - tiles waiting to be written are stored in the pending dictionary
+        #   under their (z, x, y) coordinates, so that reads can see them
+        #   and a tile that is stored again before it is written is written only once
+        # - the pending condition guards the pending dictionary and is used to wake up
+        #   the writer thread and any threads waiting for the writer thread to catch up
+        self._batch_size = max(1, int(batch_size))
+        self._flush_interval = flush_interval
+        self._pending = {}
+        # timestamps & validators of stored tiles that have been touched,
+        # keyed by (z, x, y) just like the pending tiles
+        self._pending_touches = {}
+        self._pending_condition = threading.Condition(RLock())
+        # threads waiting in flush() for the pending tiles to be written
+        self._flush_requests = []
+        # the exception raised by the last failed write, failed tiles are kept pending
+        # and the writer thread waits for the flush interval before trying again
+        self._write_error = None
+        # tiles that have been read, so that the writer thread can update their access times
+        self._access_tracker = utils.AccessTimeTracker()
+        # the writer thread also migrates version 1 tables while it is otherwise idle
+        self._migration_pending = self._v1_tables_present
+        self._writer_running = True
+        self._writer_thread = threading.Thread(target=self._writer, name="SqliteTileStoreWriter")
+        self._writer_thread.daemon = True
+        self._writer_thread.start()
+
     def __str__(self):
         return "sqlite store @ %s" % self.store_path
 
@@ -163,14 +625,39 @@ class SqliteTileStore(BaseTileStore):
         """
         log.debug("initializing lookup db: %s" % self._lookup_db_path)
         if os.path.exists(self._lookup_db_path): #does the lookup db exist ?
-            connection = connect_to_db(self._lookup_db_path) # connect to the lookup db
+            with self._db_lock:
+                connection = connect_to_db(self._lookup_db_path, wal_mode=self._wal_mode) # connect to the lookup db
+                if _table_exists(connection, "tiles"):
+                    # version 1 store, add the version 2 table next to the version 1 table
+                    # and let the writer thread migrate the tiles
+                    log.info("sqlite tiles: version 1 tables found in %s, migrating to version %d",
+                             self.store_path, SQLITE_TILE_STORAGE_FORMAT_VERSION)
+                    connection.execute(LOOKUP_TABLE_SQL)
+                    connection.commit()
+                    self._v1_tables_present = True
+                columns = [row[1] for row in connection.execute("pragma table_info(tiles_v2)")]
+                if "last_access" not in columns:
+                    # tiles stored before access times were tracked count as last accessed
+                    # when they were stored
+                    log.info("sqlite tiles: adding access time tracking to %s", self.store_path)
+                    connection.execute("alter table tiles_v2 add column last_access integer")
+                    connection.execute("update tiles_v2 set last_access=unix_epoch_timestamp/? * ?",
+                                       (ACCESS_TIME_RESOLUTION, ACCESS_TIME_RESOLUTION))
+                if "etag" not in columns:
+                    log.info("sqlite tiles: adding HTTP cache validators to %s", self.store_path)
+                    connection.execute("alter table tiles_v2 add column etag text")
+                    connection.execute("alter table tiles_v2 add column last_modified text")
+                connection.execute(LOOKUP_ACCESS_INDEX_SQL)
+                connection.commit()
         else:  # create new lookup database
             with self._db_lock:
-                connection = connect_to_db(self._lookup_db_path)
+                connection = connect_to_db(self._lookup_db_path, wal_mode=self._wal_mode)
                 cursor = connection.cursor()
                 log.info("sqlite tiles: creating lookup table")
-                cursor.execute(
-                    "create table tiles (z integer, x integer, y integer, store_filename string, extension varchar(10), unix_epoch_timestamp integer, primary key (z, x, y, extension))")
+                # needs to be set before any tables are created
+                cursor.execute("pragma auto_vacuum=incremental")
+                cursor.execute(LOOKUP_TABLE_SQL)
+                cursor.execute(LOOKUP_ACCESS_INDEX_SQL)
                 cursor.execute("create table version (v integer)")
                 cursor.execute("insert into version values (?)", (SQLITE_TILE_STORAGE_FORMAT_VERSION,))
                 connection.commit()
@@ -185,7 +672,11 @@ class SqliteTileStore(BaseTileStore):
         if existing_stores:
             for store_path in existing_stores:
                 store_name = os.path.basename(store_path)
-                connections[store_name] = connect_to_db(store_path)
+                connection = connect_to_db(store_path, wal_mode=self._wal_mode)
+                # make sure version 1 storage databases have the version 2 table
+                connection.execute(STORE_TABLE_SQL)
+                self._prepare_storage_db(connection)
+                connections[store_name] = connection
         else:  # no stores yet, create the first one
             store_name, store_connection = self._add_store()
             connections = {store_name : store_connection}
@@ -208,7 +699,7 @@ class SqliteTileStore(BaseTileStore):
                     # eq. something that fails to parse to an integer
                     pass
             if integer_list:
-                highest_number = sorted(number_candidate_list)[-1]
+                highest_number = sorted(integer_list)[-1]
                 new_highest_number = highest_number + 1
 
         store_name = "store.sqlite.%d" % new_highest_number
@@ -220,15 +711,53 @@ class SqliteTileStore(BaseTileStore):
         :param str path: path to the file path where the database should be created
         """
         log.debug("creating a new storage database in %s" % path)
-        connection = connect_to_db(path)
+        connection = connect_to_db(path, wal_mode=self._wal_mode)
         cursor = connection.cursor()
-        cursor.execute(
-            "create table tiles (z integer, x integer, y integer, tile blob, extension varchar(10), unix_epoch_timestamp integer, primary key (z, x, y, extension))")
+        # needs to be set before any tables are created
+        cursor.execute("pragma auto_vacuum=incremental")
+        cursor.execute(STORE_TABLE_SQL)
         cursor.execute("create table version (v integer)")
         cursor.execute("insert into version values (?)", (SQLITE_TILE_STORAGE_FORMAT_VERSION,))
         connection.commit()
+        self._prepare_storage_db(connection)
         return connection
 
+    def _init_stats(self):
+        """Make sure the lookup database has the tile stats table
+
+        If the table is missing, it is filled with statistics of the tiles in the storage databases.
+        """
+        with self._db_lock:
+            connection = self._lookup_db_connection
+            if _table_exists(connection, "tile_stats"):
+                return
+            log.info("sqlite tiles: adding tile statistics to %s", self.store_path)
+            connection.execute(STATS_TABLE_SQL)
+            stats_changes = {}
+            for store_connection in self._storage_databases.values():
+                query = "select s.tile_key >> %d, count(*), sum(length(%s)), min(s.unix_epoch_timestamp), " \
+                        "max(s.unix_epoch_timestamp) from tiles_v2 as s group by 1" % (2 * MAX_TILE_KEY_ZOOM, TILE_DATA_SQL % "")
+                for z, count, size, oldest, newest in store_connection.execute(query).fetchall():
+                    _add_stats_change(stats_changes, z, count, size or 0, oldest)
+                    _add_stats_change(stats_changes, z, 0, 0, newest)
+            _write_stats_changes(connection, stats_changes)
+            connection.commit()
+
+    def _prepare_storage_db(self, connection):
+        """Make sure the storage database supports tile deduplication & set up the connection for it
+
+        :param connection: writer connection to the storage database
+        """
+        # needed for the blob reference counting triggers to handle "insert or replace"
+        connection.execute("pragma recursive_triggers=1")
+        columns = [row[1] for row in connection.execute("pragma table_info(tiles_v2)")]
+        if "tile_hash" not in columns:
+            connection.execute("alter table tiles_v2 add column tile_hash blob")
+        connection.execute(BLOB_TABLE_SQL)
+        for trigger_sql in BLOB_TRIGGERS_SQL:
+            connection.execute(trigger_sql)
+        connection.commit()
+
     def _get_name_connection_to_available_store(self, data_size):
         """Return a path to a store that can be used to store a tile specified by its size"""
         with self._storage_db_management_lock:
@@ -248,6 +777,7 @@ class SqliteTileStore(BaseTileStore):
                 # if we got there it means we have not found space for the request in any existing
                 # storage database file, so we need to create a new one
                 new_store_name, new_store_connection = self._add_store()
+                self._storage_databases[new_store_name] = new_store_connection
                 # again cache the connection to the store
                 self._new_tiles_store_name = new_store_name
                 self._new_tiles_store_connection = new_store_connection
@@ -256,10 +786,14 @@ class SqliteTileStore(BaseTileStore):
     def _list_store_files(self):
         """Return a list of available storage database files
 
+        NOTE: SQLite journal files (such as store.sqlite.0-wal in WAL mode)
+              are not storage databases and are skipped
+
         :returns: list of found storage database paths
         :rtype: list of strings
         """
-        return glob.glob(os.path.join(self.store_path, "%s*" % STORE_DB_NAME_PREFIX))
+        store_files = glob.glob(os.path.join(self.store_path, "%s*" % STORE_DB_NAME_PREFIX))
+        return [path for path in store_files if STORE_DB_NAME_RE.match(os.path.basename(path))]
 
     def _will_it_fit_in(self, storage_database_name, size_in_bytes):
         """Report if the given amount of data in bytes will still fit into the currently used
@@ -282,110 +816,787 @@ class SqliteTileStore(BaseTileStore):
         else:
             return False  # the database will be larger
 
-    def store_tile_data(self, lzxy, tile_data):
+    @property
+    def wal_mode(self):
+        """Report if the store is using WAL mode with per thread read connections"""
+        return self._wal_mode
+
+    @property
+    def deduplicate(self):
+        """Report if data of identical tiles is stored only once"""
+        return self._deduplicate
+
+    @property
+    def migrating(self):
+        """Report if tiles are still being migrated from version 1 tables"""
+        return self._v1_tables_present
+
+    def _get_read_connections(self):
+        """Get connections for reading from the lookup and storage databases
+
+        In WAL mode each thread gets its own connections and any storage databases
+        added since the last call are connected lazily. Otherwise the connections
+        shared with the writer are returned and reads need to hold the database lock.
+
+        :returns: lookup database connection & dictionary of storage database connections
+        :rtype: (connection, dict) tuple
+        """
+        if not self._wal_mode:
+            return self._lookup_db_connection, self._storage_databases
+        lookup_connection = getattr(self._thread_local, "lookup_connection", None)
+        if lookup_connection is None:
+            lookup_connection = self._connect_for_reading(self._lookup_db_path)
+            self._thread_local.lookup_connection = lookup_connection
+            self._thread_local.store_connections = {}
+            self._thread_local.store_generation = self._store_generation
+        elif self._thread_local.store_generation != self._store_generation:
+            # some storage databases have been deleted, a new one might reuse the name of a deleted one
+            for connection in self._thread_local.store_connections.values():
+                connection.close()
+            self._thread_local.store_connections = {}
+            self._thread_local.store_generation = self._store_generation
+        store_connections = self._thread_local.store_connections
+        if len(store_connections) != len(self._storage_databases):
+            for store_name in list(self._storage_databases.keys()):
+                if store_name not in store_connections:
+                    store_path = os.path.join(self.store_path, store_name)
+                    store_connections[store_name] = self._connect_for_reading(store_path)
+        return lookup_connection, store_connections
+
+    def _get_attached_connection(self):
+        """Get a lookup database connection with all storage databases attached
+
+        NOTE: in serialized access mode the caller needs to hold the read lock
+
+        :returns: an attached read connection or None if there are too many
+                  storage databases to attach them to a single connection
+        :rtype: _AttachedReadConnection or None
+        """
+        if self._wal_mode:
+            attached_connection = getattr(self._thread_local, "attached_connection", None)
+            if attached_connection is not None and \
+                    self._thread_local.attached_generation != self._store_generation:
+                # some of the attached storage databases have been deleted
+                attached_connection.close()
+                attached_connection = None
+        else:
+            attached_connection = self._shared_attached_connection
+        if attached_connection is None:
+            attached_connection = _AttachedReadConnection(self._lookup_db_path, self.store_path)
+            if self._wal_mode:
+                self._thread_local.attached_connection = attached_connection
+                self._thread_local.attached_generation = self._store_generation
+            else:
+                self._shared_attached_connection = attached_connection
+            with self._read_connections_lock:
+                self._read_connections.setdefault(threading.current_thread(), []).append(attached_connection)
+        # attach any storage databases added since the last call
+        if attached_connection.sync(list(self._storage_databases.keys())):
+            return attached_connection
+        else:
+            return None
+
+    def _connect_for_reading(self, path):
+        """Open a read only connection for the current thread"""
+        connection = connect_to_db(path)
+        connection.execute("pragma query_only=1")
+        current_thread = threading.current_thread()
+        with self._read_connections_lock:
+            if current_thread not in self._read_connections:
+                # a new thread is reading from the store, this is a good time to close
+                # connections of threads that are no longer running (such as those
+                # from thread pools of finished batch downloads)
+                for thread in list(self._read_connections.keys()):
+                    if not thread.is_alive():
+                        for dead_thread_connection in self._read_connections.pop(thread):
+                            dead_thread_connection.close()
+            self._read_connections.setdefault(current_thread, []).append(connection)
+        return connection
+
+    def store_tile_data(self, lzxy, tile_data, etag=None, last_modified=None, timestamp=None):
+        """Queue the tile for writing to the database
+
+        The tile is written asynchronously by the writer thread, but is visible
+        to all read methods right away. Use flush() to make sure the tile is actually
+        written to permanent storage.
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+        :param bytes tile_data: tile data to store
+        :param etag: ETag HTTP header value of the tile (if any)
+        :param last_modified: Last-Modified HTTP header value of the tile (if any)
+        :param timestamp: UNIX timestamp of the tile, defaults to the current time
+        """
+        layer, z, x, y = lzxy
+        if timestamp is None:
+            timestamp = time.time()
+        pending_tile = (layer.type, tile_data, int(timestamp), etag, last_modified)
+        with self._pending_condition:
+            if self._writer_running:
+                # don't let the pending tiles grow without limit if the writer
+                # thread can't keep up
+                max_pending = self._batch_size * SQLITE_MAX_PENDING_BATCHES
+                # (unless writing fails, the tiles would never be written then)
+                while len(self._pending) >= max_pending and self._writer_running and \
+                        self._write_error is None:
+                    self._pending_condition.notify_all()
+                    self._pending_condition.wait()
+            self._pending[(z, x, y)] = pending_tile
+            # the new tile supersedes any touch of the old one
+            self._pending_touches.pop((z, x, y), None)
+            if len(self._pending) >= self._batch_size or not self._writer_running:
+                self._pending_condition.notify_all()
+        if not self._writer_running:
+            # the writer thread is not running (the store has been closed),
+            # so write the tile synchronously
+            self._write_pending()
+
+    def _writer(self):
+        """Writer thread main loop - writes pending tiles in batches"""
+        while True:
+            with self._pending_condition:
+                if self._migration_pending:
+                    # give new tiles only a short while to arrive before migrating
+                    # the next chunk of tiles from the version 1 tables
+                    deadline = time.time() + SQLITE_MIGRATION_PAUSE
+                else:
+                    deadline = time.time() + self._flush_interval
+                # after a failed write wait for the whole interval before trying again
+                while self._writer_running and not self._flush_requests and \
+                        (self._write_error is not None or
+                         len(self._pending) < self._batch_size and
+                         len(self._pending_touches) < self._batch_size):
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    self._pending_condition.wait(timeout)
+                running = self._writer_running
+            self._write_pending()
+            try:
+                self._write_access_times()
+            except Exception:
+                log.exception("updating tile access times in %s failed", self)
+            if not running:
+                break
+            if self._migration_pending:
+                try:
+                    self._migrate_chunk()
+                except Exception:
+                    log.exception("migrating tiles from version 1 tables of %s failed", self)
+                    # don't retry over and over, the migration will be retried
+                    # once the store is opened again
+                    self._migration_pending = False
+
+    def _write_pending(self):
+        """Write all pending tiles & touches to the databases in batches and wake up any
+        threads waiting for the pending tiles to be written
+
+        If a batch can't be written, its tiles are kept pending so that they
+        can be written on the next attempt.
+
+        :returns: None if all pending tiles have been written, the exception
+                  that prevented writing them otherwise
+        """
+        try:
+            self._write_touches()
+        except Exception:
+            log.exception("updating timestamps of touched tiles in %s failed", self)
+        error = None
+        while True:
+            with self._db_lock:
+                with self._pending_condition:
+                    batch = list(self._pending.items())[:self._batch_size]
+                    if not batch:
+                        # all pending tiles have been written
+                        break
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    log.exception("writing batch of %d tiles to %s failed", len(batch), self)
+                    error = e
+                    break
+                # the batch is now on disk, so remove it from the pending dictionary
+                # unless some of the tiles have been updated in the meantime
+                with self._pending_condition:
+                    for key, pending_tile in batch:
+                        if self._pending.get(key) is pending_tile:
+                            del self._pending[key]
+                    self._pending_condition.notify_all()
+        with self._pending_condition:
+            self._write_error = error
+            flush_requests = self._flush_requests
+            self._flush_requests = []
+            self._pending_condition.notify_all()
+        for flush_request in flush_requests:
+            flush_request.error = error
+            flush_request.event.set()
+        return error
+
+    def _write_batch(self, batch):
+        """Write a batch of tiles to the lookup database and the storage databases
+        in a single transaction per database
+
+        NOTE: the caller needs to hold the database lock
+
+        :param list batch: list of ((z, x, y), (extension, tile data, timestamp, etag, last modified)) tuples
+        """
+        lookup_connection = self._lookup_db_connection
+        lookup_cursor = lookup_connection.cursor()
+        # connections of storage databases touched by this batch
+        store_connections = {}
+        # data added to each storage database by this batch, the storage
+        # database files don't grow until the transaction is committed,
+        # so we need to account for it when checking for free space
+        batch_sizes = {}
+        # version 1 copies of tiles in the batch, to be removed from storage databases
+        # once the lookup database no longer points to them
+        v1_deletions = {}
+        stats_changes = {}
+        try:
+            for (z, x, y), (extension, tile_data, integer_timestamp, etag, last_modified) in batch:
+                tile_key = get_tile_key(z, x, y)
+                data_size = len(tile_data)
+                _add_stats_change(stats_changes, z, 1, data_size, integer_timestamp)
+                # storing a tile counts as accessing it
+                access_time = utils.get_access_time(integer_timestamp)
+                if self._v1_tables_present:
+                    # the tile might not have been migrated yet, drop the version 1 copy
+                    # so that it does not shadow the new tile
+                    v1_stores = lookup_cursor.execute(
+                        "select store_filename from tiles where z=? and x=? and y=?",
+                        (z, x, y)).fetchall()
+                    if v1_stores:
+                        lookup_cursor.execute("delete from tiles where z=? and x=? and y=?", (z, x, y))
+                        for (v1_store_name,) in v1_stores:
+                            v1_deletions.setdefault(v1_store_name, []).append((z, x, y))
+                tile_exists = lookup_cursor.execute(
+                    "select store_filename from tiles_v2 where tile_key=?",
+                    (tile_key,)).fetchone()
+                if tile_exists and tile_exists[0] in self._storage_databases:
+                    # tile is already in the database, update it
+                    for _tile_key, old_size in _get_tile_sizes(self._storage_databases[tile_exists[0]], [tile_key]):
+                        _add_stats_change(stats_changes, z, -1, -(old_size or 0))
+                    # check if the new tile will fit to the storage database where the tile currently is
+                    # (we count as we would add the tile to the database, not replace it du to
+                    # database file size uncertainties caused by metadata updates, etc.)
+                    store_name = tile_exists[0]
+                    if self._will_it_fit_in(store_name, data_size + batch_sizes.get(store_name, 0)):
+                        # update the tile data and its timestamp in place
+                        # - use "insert or replace" in case that the storage database is missing the tile for some reason
+                        # - this should never happen as long as the database is properly managed, but better be safe than sorry
+                        store_connection = self._storage_databases[store_name]
+                        data_size = self._write_store_tile(store_connection, tile_key, tile_data,
+                                                           extension, integer_timestamp)
+                        # update the extension and timestamp in the lookup database
+                        lu_query = "update tiles_v2 set extension=?, unix_epoch_timestamp=?, last_access=?, etag=?, last_modified=? where tile_key=?"
+                        lookup_cursor.execute(lu_query, [extension, integer_timestamp, access_time, etag, last_modified, tile_key])
+                    else:
+                        # remove the tile from the current storage database file
+                        old_store_connection = self._storage_databases[store_name]
+                        old_store_connection.execute("delete from tiles_v2 where tile_key=?", (tile_key,))
+                        store_connections[store_name] = old_store_connection
+                        # find a suitable storage database file and store the tile to it
+                        store_name, store_connection = self._get_name_connection_to_available_store(
+                            data_size + batch_sizes.get(self._new_tiles_store_name, 0))
+                        data_size = self._write_store_tile(store_connection, tile_key, tile_data,
+                                                           extension, integer_timestamp)
+                        # update the store path, extension and timestamp in the lookup database
+                        lu_query = "update tiles_v2 set store_filename=?, extension=?, unix_epoch_timestamp=?, last_access=?, etag=?, last_modified=? where tile_key=?"
+                        lookup_cursor.execute(lu_query, [store_name, extension, integer_timestamp, access_time, etag, last_modified, tile_key])
+                else:   # tile is not yet in the database, so just store it
+                    # get a store that can store this tile
+                    store_name, store_connection = self._get_name_connection_to_available_store(
+                        data_size + batch_sizes.get(self._new_tiles_store_name, 0))
+                    # write in the lookup db
+                    lookup_query = "insert or replace into tiles_v2 (tile_key, store_filename, extension, unix_epoch_timestamp, last_access, etag, last_modified) values (?, ?, ?, ?, ?, ?, ?)"
+                    lookup_cursor.execute(lookup_query, [tile_key, store_name, extension, integer_timestamp, access_time, etag, last_modified])
+                    # write in the store
+                    data_size = self._write_store_tile(store_connection, tile_key, tile_data,
+                                                       extension, integer_timestamp)
+                store_connections[store_name] = store_connection
+                batch_sizes[store_name] = batch_sizes.get(store_name, 0) + data_size
+            _write_stats_changes(lookup_connection, stats_changes)
+            # commit the storage databases first so that the lookup database never
+            # points to tile data that has not yet been committed
+            for store_connection in store_connections.values():
+                store_connection.commit()
+            lookup_connection.commit()
+        except Exception:
+            for store_connection in store_connections.values():
+                store_connection.rollback()
+            lookup_connection.rollback()
+            raise
+        if v1_deletions:
+            self._delete_v1_store_tiles(v1_deletions)
+
+    def _write_touches(self):
+        """Write timestamps & validators of touched tiles to the databases
+
+        The storage databases are updated first, just like when writing new tiles.
+        Touches of tiles that are only in the version 1 tables are dropped,
+        the tiles will be refreshed again once they are migrated.
+        """
         with self._db_lock:
-            layer, z, x, y = lzxy
-            extension = layer.type
+            with self._pending_condition:
+                touches = list(self._pending_touches.items())
+            if not touches:
+                return
+            touch_by_key = dict((get_tile_key(*zxy), touch) for zxy, touch in touches)
             lookup_connection = self._lookup_db_connection
-            lookup_cursor = lookup_connection.cursor()
-            data_size = len(tile_data)
-            integer_timestamp = int(time.time())
-            tile_exists = lookup_cursor.execute(
-                "select store_filename from tiles where z=? and x=? and y=?",
-                (z, x, y)).fetchone()
-            if tile_exists:  # tile is already in the database, update it
-                # check if the new tile will fit to the storage database where the tile currently is
-                # (we count as we would add the tile to the database, not replace it du to
-                # database file size uncertainties caused by metadata updates, etc.)
-                store_name = tile_exists[0]
-                if self._will_it_fit_in(store_name, data_size):
-                    # update the tile data and its timestamp in place
-                    store_connection = self._storage_databases[store_name]
-                    store_cursor = store_connection.cursor()
-                    # update the storage database
-                    su_query = "insert or replace into tiles (z, x, y, tile, extension, unix_epoch_timestamp) values (?, ?, ?, ?, ?, ?)"
-                    # use "insert or replace" in case that the storage database is missing the tile for some reason
-                    # - this should never happen as long as the database is properly managed, but better be safe than sorry
-                    store_cursor.execute(su_query, [z, x, y, sqlite3.Binary(tile_data), extension, integer_timestamp])
+            keys_by_store_name = {}
+            for placeholders, parameters in _key_chunks(list(touch_by_key.keys())):
+                query = "select tile_key, store_filename from tiles_v2 where tile_key in (%s)" % placeholders
+                for tile_key, store_name in lookup_connection.execute(query, parameters).fetchall():
+                    keys_by_store_name.setdefault(store_name, []).append(tile_key)
+            store_connections = []
+            stats_changes = {}
+            for zxy, (timestamp, _etag, _last_modified) in touches:
+                _add_stats_change(stats_changes, zxy[0], 0, 0, timestamp)
+            try:
+                for store_name, tile_keys in keys_by_store_name.items():
+                    store_connection = self._storage_databases.get(store_name)
+                    if store_connection is None:
+                        continue
+                    store_connection.executemany(
+                        "update tiles_v2 set unix_epoch_timestamp=? where tile_key=?",
+                        [(touch_by_key[tile_key][0], tile_key) for tile_key in tile_keys])
+                    store_connections.append(store_connection)
+                for store_connection in store_connections:
                     store_connection.commit()
-                    # update the extension and timestamp in the lookup database
-                    lu_query = "update tiles set extension=?, unix_epoch_timestamp=? where z=? and x=? and y=?"
-                    lookup_cursor.execute(lu_query, [extension, integer_timestamp, z, x, y])
-                    lookup_connection.commit()
-                else:
-                    # remove the tile from the current storage database file
-                    old_store_connection = self._storage_databases[store_name]
-                    old_store_cursor = old_store_connection.cursor()
-                    old_store_cursor.execute("delete from tiles where z=? and x=? and y=?", (z, x, y))
-                    old_store_connection.commit()
-                    # find a suitable storage database file
-                    new_store_name, new_store_connection = self._get_name_connection_to_available_store(data_size)
-                    # store the tile to it
-                    store_query = "insert or replace into tiles (z, x, y, tile, extension, unix_epoch_timestamp) values (?, ?, ?, ?, ?, ?)"
-                    # we use "insert or replace" in case there already is an unexpected leftover tile in the store for the coordinates
-                    # - this should never happen as long as the database is properly managed, but better be safe than sorry
-                    store_cursor = new_store_connection.cursor()
-                    store_cursor.execute(store_query, [z, x, y, sqlite3.Binary(tile_data), extension, integer_timestamp])
-                    new_store_connection.commit()
-                    # update the store path, extension and timestamp in the lookup database
-                    lu_query = "update tiles set store_filename=?, extension=?, unix_epoch_timestamp=? where where z=? and x=? and y=?"
-                    lookup_cursor.execute(lu_query, [new_store_name, extension, integer_timestamp, z, x, y])
-                    lookup_connection.commit()
-
-            else:   # tile is not yet in the database, so just store it
-                # get a store that can store this tile
-                store_name, store_connection = self._get_name_connection_to_available_store(data_size)
-                # write in the lookup db
-                lookup_query = "insert into tiles (z, x, y, store_filename, extension, unix_epoch_timestamp) values (?, ?, ?, ?, ?, ?)"
-                lookup_cursor = lookup_connection.cursor()
-                lookup_cursor.execute(lookup_query, [z, x, y, store_name, extension, integer_timestamp])
+                # keep the current validators if the server did not send new ones
+                lookup_connection.executemany(
+                    "update tiles_v2 set unix_epoch_timestamp=?, etag=coalesce(?, etag), "
+                    "last_modified=coalesce(?, last_modified) where tile_key=?",
+                    [(timestamp, etag, last_modified, tile_key)
+                     for tile_key, (timestamp, etag, last_modified) in touch_by_key.items()])
+                _write_stats_changes(lookup_connection, stats_changes)
                 lookup_connection.commit()
-                # write in the store
-                store_query = "insert into tiles (z, x, y, tile, extension, unix_epoch_timestamp) values (?, ?, ?, ?, ?, ?)"
-                store_cursor = store_connection.cursor()
-                store_cursor.execute(store_query, [z, x, y, sqlite3.Binary(tile_data), extension, integer_timestamp])
+            except Exception:
+                for store_connection in store_connections:
+                    store_connection.rollback()
+                lookup_connection.rollback()
+                raise
+            finally:
+                # drop the written touches unless the tiles have been touched again in the meantime
+                with self._pending_condition:
+                    for zxy, touch in touches:
+                        if self._pending_touches.get(zxy) is touch:
+                            del self._pending_touches[zxy]
+
+    def _write_store_tile(self, store_connection, tile_key, tile_data, extension, integer_timestamp):
+        """Write a tile to a storage database
+
+        In deduplication mode the tile data is written only if the storage database
+        does not already contain identical tile data.
+
+        NOTE: the caller needs to hold the database lock
+
+        :returns: number of tile data bytes actually written
+        :rtype: int
+        """
+        if self._deduplicate:
+            tile_hash = sqlite3.Binary(get_tile_hash(tile_data))
+            # if the tile replaces a tile with the same hash, the blob is dropped once the
+            # old tile is deleted and then stored again below, as it is no longer referenced
+            store_connection.execute(
+                "insert or replace into tiles_v2 (tile_key, tile, extension, unix_epoch_timestamp, tile_hash) "
+                "values (?, null, ?, ?, ?)", [tile_key, extension, integer_timestamp, tile_hash])
+            cursor = store_connection.execute(
+                "insert or ignore into tile_blobs (hash, tile, refcount) values (?, ?, 1)",
+                [tile_hash, sqlite3.Binary(tile_data)])
+            if cursor.rowcount > 0:
+                return len(tile_data)
+            else:
+                return 0
+        else:
+            store_connection.execute(
+                "insert or replace into tiles_v2 (tile_key, tile, extension, unix_epoch_timestamp) values (?, ?, ?, ?)",
+                [tile_key, sqlite3.Binary(tile_data), extension, integer_timestamp])
+            return len(tile_data)
+
+    def _delete_v1_store_tiles(self, zxy_by_store_name):
+        """Delete tiles from version 1 tables of storage databases
+
+        NOTE: the caller needs to hold the database lock
+
+        :param dict zxy_by_store_name: lists of z, x, y tuples keyed by storage database name
+        """
+        for store_name, zxy_list in zxy_by_store_name.items():
+            store_connection = self._storage_databases.get(store_name)
+            if store_connection is not None:
+                store_connection.executemany("delete from tiles where z=? and x=? and y=?", zxy_list)
                 store_connection.commit()
 
+    def _migrate_chunk(self):
+        """Migrate a chunk of tiles from version 1 tables to version 2 tables
+
+        The tile data is first copied to the version 2 storage tables, then the lookup
+        database is switched to the version 2 entries in a single transaction and only
+        then the tile data is removed from the version 1 storage tables. Readers looking
+        for the tile in the version 1 tables first and in the version 2 tables second
+        will find it at all times.
+        """
+        with self._db_lock:
+            lookup_connection = self._lookup_db_connection
+            rows = lookup_connection.execute(
+                "select z, x, y, store_filename, extension, unix_epoch_timestamp from tiles limit ?",
+                (SQLITE_MIGRATION_CHUNK_SIZE,)).fetchall()
+            if not rows:
+                self._finish_migration()
+                return
+            zxy_by_store_name = {}
+            for z, x, y, store_name, _extension, _timestamp in rows:
+                zxy_by_store_name.setdefault(store_name, []).append((z, x, y))
+            # tiles already stored to version 2 tables are counted in the statistics & not migrated
+            already_stored_keys = set()
+            for placeholders, parameters in _key_chunks([get_tile_key(z, x, y) for z, x, y, _s, _e, _t in rows]):
+                already_stored_keys.update(row[0] for row in lookup_connection.execute(
+                    "select tile_key from tiles_v2 where tile_key in (%s)" % placeholders, parameters))
+            stats_changes = {}
+            # copy the tile data
+            migrated_zxy = set()
+            try:
+                for store_name, zxy_list in zxy_by_store_name.items():
+                    store_connection = self._storage_databases.get(store_name)
+                    if store_connection is None:
+                        log.warning("store %s/%s is mentioned in lookup db for %d tiles but does not exist, "
+                                    "dropping the tiles", self.store_path, store_name, len(zxy_list))
+                        continue
+                    for condition, parameters in _zxy_chunks(zxy_list):
+                        tiles = store_connection.execute(
+                            "select z, x, y, tile, extension, unix_epoch_timestamp from tiles where %s" % condition,
+                            parameters).fetchall()
+                        # newer tiles might already be stored in the version 2 table, don't overwrite them
+                        store_connection.executemany(
+                            "insert or ignore into tiles_v2 (tile_key, tile, extension, unix_epoch_timestamp) values (?, ?, ?, ?)",
+                            [(get_tile_key(z, x, y), tile, extension, timestamp)
+                             for z, x, y, tile, extension, timestamp in tiles])
+                        migrated_zxy.update((z, x, y) for z, x, y, _tile, _extension, _timestamp in tiles)
+                        for z, x, y, tile, _extension, timestamp in tiles:
+                            if get_tile_key(z, x, y) not in already_stored_keys:
+                                _add_stats_change(stats_changes, z, 1, len(tile or b""), timestamp)
+                    store_connection.commit()
+                # switch the lookup database over to the version 2 entries
+                lookup_connection.executemany(
+                    "insert or ignore into tiles_v2 (tile_key, store_filename, extension, unix_epoch_timestamp, last_access) values (?, ?, ?, ?, ?)",
+                    [(get_tile_key(z, x, y), store_name, extension, timestamp, utils.get_access_time(timestamp))
+                     for z, x, y, store_name, extension, timestamp in rows if (z, x, y) in migrated_zxy])
+                lookup_connection.executemany("delete from tiles where z=? and x=? and y=?",
+                                              [(z, x, y) for z, x, y, _store_name, _extension, _timestamp in rows])
+                _write_stats_changes(lookup_connection, stats_changes)
+                lookup_connection.commit()
+            except Exception:
+                for store_connection in self._storage_databases.values():
+                    store_connection.rollback()
+                lookup_connection.rollback()
+                raise
+            # finally drop the tile data from the version 1 tables
+            self._delete_v1_store_tiles(zxy_by_store_name)
+            log.debug("migrated %d tiles of %s to version %d tables",
+                      len(migrated_zxy), self, SQLITE_TILE_STORAGE_FORMAT_VERSION)
+
+    def _finish_migration(self):
+        """Drop the (now empty) version 1 tables and bump the format version
+
+        NOTE: the caller needs to hold the database lock
+        """
+        for store_connection in self._storage_databases.values():
+            store_connection.execute("drop table if exists tiles")
+            store_connection.execute("update version set v=?", (SQLITE_TILE_STORAGE_FORMAT_VERSION,))
+            store_connection.commit()
+        self._lookup_db_connection.execute("drop table if exists tiles")
+        self._lookup_db_connection.execute("update version set v=?", (SQLITE_TILE_STORAGE_FORMAT_VERSION,))
+        self._lookup_db_connection.commit()
+        self._v1_tables_present = False
+        self._migration_pending = False
+        log.info("migration of %s to version %d tables finished", self, SQLITE_TILE_STORAGE_FORMAT_VERSION)
+
+    def _get_pending_tile(self, z, x, y):
+        """Get a tile that is waiting to be written to the database
+
+        :returns: (extension, tile data, timestamp, etag, last modified) tuple
+                  or None if no such tile is pending
+        :rtype: tuple or None
+        """
+        with self._pending_condition:
+            return self._pending.get((z, x, y))
+
+    def _get_touch_timestamp(self, zxy, timestamp):
+        """Get timestamp of a tile, taking touches not yet written to the database into account"""
+        touch = self._pending_touches.get(zxy)
+        if touch is None:
+            return timestamp
+        return touch[0]
+
+    def _apply_touches(self, found_tiles, timestamp_only):
+        """Replace timestamps of found tiles that have been touched but not yet written
+
+        :param dict found_tiles: lzxy keyed timestamps or (tile data, timestamp) tuples
+        :param bool timestamp_only: if the found tiles dictionary holds only timestamps
+        """
+        if not self._pending_touches:
+            return
+        with self._pending_condition:
+            for lzxy, value in found_tiles.items():
+                touch = self._pending_touches.get(tuple(lzxy[1:]))
+                if touch is not None:
+                    if timestamp_only:
+                        found_tiles[lzxy] = touch[0]
+                    else:
+                        found_tiles[lzxy] = (value[0], touch[0])
+
     def get_tile(self, lzxy):
         """Get tile data and timestamp corresponding to the given coordinate tuple from the database.
-           The timestamp correspond to the time the tile has been last modified.
+           The timestamp correspond to the time the tile has been last modified
+           or last confirmed to be unmodified by the tile server.
 
         :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
                            (layer is actually not used and can be None)
         :returns: (tile data, timestamp) or None if tile is not found in the database
         :rtype: a (bytes, int) tuple or None
         """
+        result = self._get_tile(lzxy)
+        if result and self._pending_touches:
+            result = result[0], self._get_touch_timestamp(tuple(lzxy[1:]), result[1])
+        return result
+
+    def _get_tile(self, lzxy):
+        """Get tile data and timestamp as stored in the database (or pending)"""
         _layer, z, x, y = lzxy
-        with self._db_lock:
-            lookup_connection = self._lookup_db_connection
+        pending_tile = self._get_pending_tile(z, x, y)
+        if pending_tile:  # the tile has not yet been written to the database
+            return pending_tile[1], pending_tile[2]
+        tile_key = get_tile_key(z, x, y)
+        with self._read_lock:
+            if self._v1_tables_present:
+                # the tile might not have been migrated yet
+                result = self._get_tile_v1(z, x, y)
+                if result:
+                    return result
+            attached_connection = self._get_attached_connection()
+            if attached_connection:
+                # look up the tile & fetch its data with a single query
+                # - fetch all rows (there is at most one) so that the statement is finished
+                #   and does not hold a read lock on the databases
+                results = attached_connection.connection.execute(
+                    attached_connection.tile_query, {"tile_key": tile_key}).fetchall()
+                if results:
+                    result = results[0]
+                    if not utils.is_an_image(result[1]):
+                        log.warning("%s,%s,%s in %s is probably not an image", x, y, z, self.store_path)
+                    self._record_access([tile_key])
+                    return result[1], result[2]
+                else:
+                    return None
+            lookup_connection, store_connections = self._get_read_connections()
             lookup_cursor = lookup_connection.cursor()
             lookup_result = lookup_cursor.execute(
-                "select store_filename, unix_epoch_timestamp from tiles where z=? and x=? and y=?",
-                (z, x, y)).fetchone()
+                "select store_filename, unix_epoch_timestamp from tiles_v2 where tile_key=?",
+                (tile_key,)).fetchone()
             if lookup_result:  # the tile was found in the lookup db
                 # now search for in the specified store
                 store_name = lookup_result[0]
-                store_connection = self._storage_databases.get(store_name)
+                store_connection = store_connections.get(store_name)
                 if store_connection is None:
                     log.warning("store %s/%s is mentioned in lookup db for %s/%s/%s but does not exist",
                                 self.store_path, store_name, z, x, y)
                     return None
                 store_cursor = store_connection.cursor()
-                # as the x,y & z are used as the primary key, all rows need to have a unique
-                # x, y & z combination and thus there can be only one result for a select
-                # over x, y & z
+                # the tile key is the primary key, so there can be only one result
                 result = store_cursor.execute(
-                    "select tile, unix_epoch_timestamp from tiles where z=? and x=? and y=?",
-                    (z, x, y)).fetchone()
+                    "select %s, s.unix_epoch_timestamp from tiles_v2 as s where s.tile_key=?" % (TILE_DATA_SQL % ""),
+                    (tile_key,)).fetchone()
                 if result:
                     if not utils.is_an_image(result[0]):
                         log.warning("%s,%s,%s in %s/%s is probably not an image", x, y, z, self.store_path, store_name)
+                    self._record_access([tile_key])
                     return result
                 else:
                     log.warning("%s,%s,%s is mentioned in lookup db but missing from store %s/%s", x, y, z, self.store_path, store_name)
             else:  # the tile was not found in the lookup database
                 return None
 
+    def _get_tile_v1(self, z, x, y):
+        """Get a tile from the version 1 tables that are being migrated
+
+        A tile missing from the version 1 tables (even due to being migrated right now
+        or to the tables being already dropped) is reported as not found,
+        the caller should then look for it in the version 2 tables.
+
+        NOTE: the caller needs to hold the read lock
+
+        :returns: (tile data, timestamp) or None if tile is not found in the version 1 tables
+        :rtype: a (bytes, int) tuple or None
+        """
+        lookup_connection, store_connections = self._get_read_connections()
+        try:
+            lookup_result = lookup_connection.execute(
+                "select store_filename from tiles where z=? and x=? and y=?",
+                (z, x, y)).fetchone()
+            store_connection = store_connections.get(lookup_result[0]) if lookup_result else None
+            if store_connection is None:
+                return None
+            return store_connection.execute(
+                "select tile, unix_epoch_timestamp from tiles where z=? and x=? and y=?",
+                (z, x, y)).fetchone()
+        except sqlite3.OperationalError:
+            # the version 1 tables have been dropped in the meantime
+            return None
+
+    def _get_tiles_v1(self, zxy_to_lzxy, found_tiles, timestamp_only):
+        """Bulk version of _get_tile_v1() & the version 1 part of tile_is_stored()
+
+        Tiles that have been found are removed from the z, x, y to lzxy dictionary.
+
+        NOTE: the caller needs to hold the read lock
+
+        :param dict zxy_to_lzxy: z, x, y to lzxy mapping of the tiles to look for
+        :param dict found_tiles: dictionary for the tiles that have been found
+        :param bool timestamp_only: only check the lookup database and store only
+                                    timestamps, not (tile data, timestamp) tuples
+        """
+        lookup_connection, store_connections = self._get_read_connections()
+        try:
+            # group the tiles by the storage database they are stored in
+            zxy_by_store_name = {}
+            for condition, parameters in _zxy_chunks(list(zxy_to_lzxy.keys())):
+                query = "select z, x, y, store_filename, unix_epoch_timestamp from tiles where %s" % condition
+                for z, x, y, store_name, timestamp in lookup_connection.execute(query, parameters).fetchall():
+                    if timestamp_only:
+                        # version 1 tables might have the tile stored under multiple extensions
+                        lzxy = zxy_to_lzxy.pop((z, x, y), None)
+                        if lzxy:
+                            found_tiles[lzxy] = timestamp
+                    else:
+                        zxy_by_store_name.setdefault(store_name, []).append((z, x, y))
+            for store_name, store_zxy_list in zxy_by_store_name.items():
+                store_connection = store_connections.get(store_name)
+                if store_connection is None:
+                    continue
+                for condition, parameters in _zxy_chunks(store_zxy_list):
+                    query = "select z, x, y, tile, unix_epoch_timestamp from tiles where %s" % condition
+                    for z, x, y, tile_data, timestamp in store_connection.execute(query, parameters).fetchall():
+                        lzxy = zxy_to_lzxy.pop((z, x, y), None)
+                        if lzxy:
+                            found_tiles[lzxy] = (tile_data, timestamp)
+        except sqlite3.OperationalError:
+            # the version 1 tables have been dropped in the meantime,
+            # any tiles not yet found are in the version 2 tables
+            pass
+
+    def get_tiles(self, lzxy_iterable):
+        """Get data and timestamps for multiple tiles
+
+        Instead of querying the lookup and storage database once per tile, the
+        tiles are looked up and fetched in bulk by joining the lookup table with the
+        attached storage databases or, if there are too many storage databases to attach,
+        looked up in bulk in the lookup database and then fetched in bulk from each storage
+        database holding some of them.
+
+        :param lzxy_iterable: an iterable of lzxy tuples
+        :returns: a dictionary with (tile data, timestamp) tuples for all tiles that
+                  have been found in the store under their lzxy tuples
+        :rtype: dict
+        """
+        found_tiles = self._get_tiles(lzxy_iterable)
+        self._apply_touches(found_tiles, timestamp_only=False)
+        return found_tiles
+
+    def _get_tiles(self, lzxy_iterable):
+        """Bulk version of _get_tile()"""
+        found_tiles = {}
+        zxy_to_lzxy = self._get_non_pending_tiles(lzxy_iterable, found_tiles, timestamp_only=False)
+        if not zxy_to_lzxy:
+            return found_tiles
+        with self._read_lock:
+            if self._v1_tables_present:
+                self._get_tiles_v1(zxy_to_lzxy, found_tiles, timestamp_only=False)
+            key_to_lzxy = dict((get_tile_key(*zxy), lzxy) for zxy, lzxy in zxy_to_lzxy.items())
+            if not key_to_lzxy:
+                return found_tiles
+            attached_connection = self._get_attached_connection()
+            if attached_connection:
+                # each branch of the query needs its own parameters
+                branch_count = max(1, attached_connection.store_count)
+                chunk_size = max(1, SQLITE_BULK_QUERY_SIZE // branch_count)
+                found_keys = []
+                for placeholders, parameters in _key_chunks(list(key_to_lzxy.keys()), chunk_size):
+                    query = attached_connection.get_query("l.tile_key in (%s)" % placeholders)
+                    for tile_key, tile_data, timestamp in attached_connection.connection.execute(
+                            query, parameters * branch_count).fetchall():
+                        found_tiles[key_to_lzxy[tile_key]] = (tile_data, timestamp)
+                        found_keys.append(tile_key)
+                self._record_access(found_keys)
+                return found_tiles
+            lookup_connection, store_connections = self._get_read_connections()
+            # group the tiles by the storage database they are stored in
+            keys_by_store_name = {}
+            for placeholders, parameters in _key_chunks(list(key_to_lzxy.keys())):
+                query = "select tile_key, store_filename from tiles_v2 where tile_key in (%s)" % placeholders
+                for tile_key, store_name in lookup_connection.execute(query, parameters):
+                    keys_by_store_name.setdefault(store_name, []).append(tile_key)
+            for store_name, store_key_list in keys_by_store_name.items():
+                store_connection = store_connections.get(store_name)
+                if store_connection is None:
+                    log.warning("store %s/%s is mentioned in lookup db for %d tiles but does not exist",
+                                self.store_path, store_name, len(store_key_list))
+                    continue
+                for placeholders, parameters in _key_chunks(store_key_list):
+                    query = "select s.tile_key, %s, s.unix_epoch_timestamp from tiles_v2 as s " \
+                            "where s.tile_key in (%s)" % (TILE_DATA_SQL % "", placeholders)
+                    for tile_key, tile_data, timestamp in store_connection.execute(query, parameters):
+                        found_tiles[key_to_lzxy[tile_key]] = (tile_data, timestamp)
+                self._record_access(store_key_list)
+        return found_tiles
+
+    def tiles_stored(self, lzxy_iterable):
+        """Report which of the given tiles are stored in the database
+
+        NOTE: Just like tile_is_stored() this only checks the lookup database.
+
+        :param lzxy_iterable: an iterable of lzxy tuples
+        :returns: a dictionary with timestamps for all tiles that have been
+                  found in the store under their lzxy tuples
+        :rtype: dict
+        """
+        stored_tiles = {}
+        zxy_to_lzxy = self._get_non_pending_tiles(lzxy_iterable, stored_tiles, timestamp_only=True)
+        if not zxy_to_lzxy:
+            return stored_tiles
+        with self._read_lock:
+            if self._v1_tables_present:
+                self._get_tiles_v1(zxy_to_lzxy, stored_tiles, timestamp_only=True)
+            key_to_lzxy = dict((get_tile_key(*zxy), lzxy) for zxy, lzxy in zxy_to_lzxy.items())
+            lookup_connection, _store_connections = self._get_read_connections()
+            for placeholders, parameters in _key_chunks(list(key_to_lzxy.keys())):
+                query = "select tile_key, unix_epoch_timestamp from tiles_v2 where tile_key in (%s)" % placeholders
+                for tile_key, timestamp in lookup_connection.execute(query, parameters):
+                    stored_tiles[key_to_lzxy[tile_key]] = timestamp
+        self._apply_touches(stored_tiles, timestamp_only=True)
+        return stored_tiles
+
+    def _get_non_pending_tiles(self, lzxy_iterable, found_tiles, timestamp_only):
+        """Put pending tiles to the found tiles dictionary and return the rest
+
+        :param lzxy_iterable: an iterable of lzxy tuples
+        :param dict found_tiles: dictionary for the pending tiles
+        :param bool timestamp_only: store only timestamps of the pending tiles,
+                                    not (tile data, timestamp) tuples
+        :returns: z, x, y to lzxy mapping for tiles that are not pending
+        :rtype: dict
+        """
+        zxy_to_lzxy = {}
+        with self._pending_condition:
+            for lzxy in lzxy_iterable:
+                zxy = tuple(lzxy[1:])
+                pending_tile = self._pending.get(zxy)
+                if pending_tile is None:
+                    zxy_to_lzxy[zxy] = lzxy
+                elif timestamp_only:
+                    found_tiles[lzxy] = pending_tile[2]
+                else:
+                    found_tiles[lzxy] = (pending_tile[1], pending_tile[2])
+        return zxy_to_lzxy
+
     def delete_tile(self, lzxy):
         """Try to delete tile corresponding to the lzxy coordinate tuple from the database
 
@@ -394,18 +1605,121 @@ class SqliteTileStore(BaseTileStore):
         """
         with self._db_lock:
             _layer, z, x, y = lzxy
+            tile_key = get_tile_key(z, x, y)
+            # the writer thread only takes tiles from the pending dictionary
+            # while holding the database lock, so the tile can't get resurrected
+            # by a batch write once we remove it here
+            with self._pending_condition:
+                self._pending.pop((z, x, y), None)
+                self._pending_touches.pop((z, x, y), None)
+            self._access_tracker.forget([tile_key])
             lookup_connection = self._lookup_db_connection
             lookup_cursor = lookup_connection.cursor()
-            store_name = lookup_cursor.execute(
-                "select store_filename from tiles where z=? and x=? and y=?", (z, x, y)
-            ).fetchone()[0]
-            if store_name:
+            lookup_result = lookup_cursor.execute(
+                "select store_filename from tiles_v2 where tile_key=?", (tile_key,)
+            ).fetchone()
+            store_name = lookup_result[0] if lookup_result else None
+            stats_changes = {}
+            if store_name in self._storage_databases:
                 store_connection = self._storage_databases[store_name]
+                for _tile_key, size in _get_tile_sizes(store_connection, [tile_key]):
+                    _add_stats_change(stats_changes, z, -1, -(size or 0))
                 store_cursor = store_connection.cursor()
-                store_cursor.execute("delete from tiles where z=? and x=? and y=?", (z, x, y))
+                store_cursor.execute("delete from tiles_v2 where tile_key=?", (tile_key,))
                 store_connection.commit()
-            lookup_cursor.execute("delete from tiles where z=? and x=? and y=?", (z, x, y))
+            lookup_cursor.execute("delete from tiles_v2 where tile_key=?", (tile_key,))
+            _write_stats_changes(lookup_connection, stats_changes)
+            v1_store_names = []
+            if self._v1_tables_present:
+                # the tile might not have been migrated yet
+                v1_store_names = [row[0] for row in lookup_cursor.execute(
+                    "select store_filename from tiles where z=? and x=? and y=?", (z, x, y))]
+                lookup_cursor.execute("delete from tiles where z=? and x=? and y=?", (z, x, y))
             lookup_connection.commit()
+            if v1_store_names:
+                self._delete_v1_store_tiles(dict((name, [(z, x, y)]) for name in v1_store_names))
+
+    def delete_tiles(self, lzxy_iterable):
+        """Delete multiple tiles in a single transaction per database
+
+        :param lzxy_iterable: an iterable of lzxy tuples
+        """
+        zxy_list = [lzxy[1:] for lzxy in lzxy_iterable]
+        if self._v1_tables_present:
+            # tiles that have not yet been migrated need to be deleted from version 1 tables as well
+            for zxy in zxy_list:
+                self.delete_tile((None,) + zxy)
+            return
+        with self._db_lock:
+            with self._pending_condition:
+                for zxy in zxy_list:
+                    self._pending.pop(zxy, None)
+                    self._pending_touches.pop(zxy, None)
+            rows = []
+            for placeholders, parameters in _key_chunks([get_tile_key(*zxy) for zxy in zxy_list]):
+                rows.extend(self._lookup_db_connection.execute(
+                    "select tile_key, store_filename from tiles_v2 where tile_key in (%s)" % placeholders,
+                    parameters).fetchall())
+            if rows:
+                self._delete_tile_rows(rows)
+
+    def get_tile_validators(self, lzxy):
+        """Get HTTP cache validators stored together with the tile
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+        :returns: (etag, last_modified) tuple or None if there are no validators for the tile
+        :rtype: tuple or None
+        """
+        _layer, z, x, y = lzxy
+        with self._pending_condition:
+            pending_tile = self._pending.get((z, x, y))
+            touch = self._pending_touches.get((z, x, y))
+        if pending_tile:
+            validators = pending_tile[3], pending_tile[4]
+        else:
+            with self._read_lock:
+                lookup_connection, _store_connections = self._get_read_connections()
+                validators = lookup_connection.execute(
+                    "select etag, last_modified from tiles_v2 where tile_key=?",
+                    (get_tile_key(z, x, y),)).fetchone()
+            if validators is None:
+                return None
+            if touch is not None:
+                validators = touch[1] or validators[0], touch[2] or validators[1]
+        if validators[0] is None and validators[1] is None:
+            return None
+        return tuple(validators)
+
+    def touch_tile(self, lzxy, etag=None, last_modified=None):
+        """Mark a stored tile as fresh without rewriting its data
+
+        The new timestamp (and validators) are written by the writer thread,
+        together with the next batch of tiles.
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+        :param etag: new ETag of the tile or None to keep the current one
+        :param last_modified: new Last-Modified value of the tile or None to keep the current one
+        :returns: True if the tile has been found & touched, else False
+        :rtype: bool
+        """
+        _layer, z, x, y = lzxy
+        timestamp = int(time.time())
+        with self._pending_condition:
+            pending_tile = self._pending.get((z, x, y))
+            if pending_tile:
+                # the tile has not yet been written, just update the pending tile
+                self._pending[(z, x, y)] = (pending_tile[0], pending_tile[1], timestamp,
+                                            etag or pending_tile[3], last_modified or pending_tile[4])
+                return True
+        if not self.tile_is_stored(lzxy):
+            return False
+        with self._pending_condition:
+            self._pending_touches[(z, x, y)] = (timestamp, etag, last_modified)
+            if len(self._pending_touches) >= self._batch_size or not self._writer_running:
+                self._pending_condition.notify_all()
+        if not self._writer_running:
+            self._write_pending()
+        return True
 
     def tile_is_stored(self, lzxy):
         """Report if a tile specified by the lzxy tuple is stored in the database
@@ -420,28 +1734,560 @@ class SqliteTileStore(BaseTileStore):
         :rtype: bool
         """
         _layer, z, x, y = lzxy
-        lookup_connection = self._lookup_db_connection
-        lookup_cursor = lookup_connection.cursor()
-        query = "select store_filename, unix_epoch_timestamp from tiles where z=? and x=? and y=?"
-        lookupResult = lookup_cursor.execute(query, (z, x, y)).fetchone()
+        pending_tile = self._get_pending_tile(z, x, y)
+        if pending_tile:  # the tile has not yet been written to the database
+            return True, pending_tile[2]
+        with self._read_lock:
+            lookup_connection, _store_connections = self._get_read_connections()
+            lookup_cursor = lookup_connection.cursor()
+            lookupResult = None
+            if self._v1_tables_present:
+                try:
+                    query = "select store_filename, unix_epoch_timestamp from tiles where z=? and x=? and y=?"
+                    lookupResult = lookup_cursor.execute(query, (z, x, y)).fetchone()
+                except sqlite3.OperationalError:
+                    # the version 1 tables have been dropped in the meantime
+                    pass
+            if not lookupResult:
+                query = "select store_filename, unix_epoch_timestamp from tiles_v2 where tile_key=?"
+                lookupResult = lookup_cursor.execute(query, (get_tile_key(z, x, y),)).fetchone()
         if lookupResult:
-            return True, lookupResult[1]  # the tile is in the database
+            # the tile is in the database
+            return True, self._get_touch_timestamp((z, x, y), lookupResult[1])
         else:
             return False # the tile is not in the database
 
+    def _record_access(self, tile_keys):
+        """Record that tiles have been read, so that their access times get updated
+
+        Access times are written by the writer thread together with the next batch of tiles
+        or once enough of them are waiting.
+        """
+        if self._access_tracker.record(tile_keys) >= SQLITE_ACCESS_TIME_BATCH_SIZE:
+            with self._pending_condition:
+                self._pending_condition.notify_all()
+
+    def _write_access_times(self):
+        """Write access times of tiles that have been read to the lookup database"""
+        access_time, tile_keys = self._access_tracker.take()
+        if not tile_keys:
+            return
+        with self._db_lock:
+            connection = self._lookup_db_connection
+            try:
+                for placeholders, parameters in _key_chunks(tile_keys):
+                    connection.execute("update tiles_v2 set last_access=? where tile_key in (%s)" % placeholders,
+                                       [access_time] + parameters)
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+
+    def get_stats(self):
+        """Get per zoom level statistics of the stored tiles
+
+        The statistics are kept up to date in the lookup database, so this does not need
+        to look at the tiles at all. Tiles waiting to be written are not yet counted,
+        flush() the store first if they should be.
+
+        :returns: statistics of the tiles in the store
+        :rtype: TileStats
+        """
+        with self._read_lock:
+            lookup_connection, _store_connections = self._get_read_connections()
+            rows = lookup_connection.execute(
+                "select zoom, tile_count, byte_count, oldest, newest from tile_stats").fetchall()
+        return TileStats.from_zooms(rows)
+
+    def _get_database_size(self, connection):
+        """Get number of bytes used by tables & indexes of the database, not counting free pages"""
+        page_size = connection.execute("pragma page_size").fetchone()[0]
+        page_count = connection.execute("pragma page_count").fetchone()[0]
+        freelist_count = connection.execute("pragma freelist_count").fetchone()[0]
+        return (page_count - freelist_count) * page_size
+
+    def get_size(self):
+        """Get the amount of space used by the store
+
+        Free pages (such as those left after evicting tiles from databases that don't use
+        incremental auto vacuum) are not counted, as SQLite reuses them for new tiles.
+
+        :returns: used space in bytes
+        :rtype: int
+        """
+        with self._db_lock:
+            size = self._get_database_size(self._lookup_db_connection)
+            for connection in self._storage_databases.values():
+                size += self._get_database_size(connection)
+            return size
+
+    def _delete_tile_rows(self, rows):
+        """Delete tiles from the storage databases & the lookup database
+
+        NOTE: the caller needs to hold the database lock
+
+        :param list rows: list of (tile key, storage database name) tuples
+        """
+        lookup_connection = self._lookup_db_connection
+        keys_by_store_name = {}
+        for tile_key, store_name in rows:
+            keys_by_store_name.setdefault(store_name, []).append(tile_key)
+        stats_changes = {}
+        try:
+            # delete from the storage databases first, so that the lookup database never
+            # misses tiles still stored in a storage database
+            for store_name, tile_keys in keys_by_store_name.items():
+                store_connection = self._storage_databases.get(store_name)
+                if store_connection is None:
+                    continue
+                for tile_key, size in _get_tile_sizes(store_connection, tile_keys):
+                    _add_stats_change(stats_changes, get_tile_zxy(tile_key)[0], -1, -(size or 0))
+                for placeholders, parameters in _key_chunks(tile_keys):
+                    store_connection.execute("delete from tiles_v2 where tile_key in (%s)" % placeholders,
+                                             parameters)
+                store_connection.commit()
+            tile_keys = [row[0] for row in rows]
+            for placeholders, parameters in _key_chunks(tile_keys):
+                lookup_connection.execute("delete from tiles_v2 where tile_key in (%s)" % placeholders,
+                                          parameters)
+            _write_stats_changes(lookup_connection, stats_changes)
+            lookup_connection.commit()
+        except Exception:
+            for store_connection in self._storage_databases.values():
+                store_connection.rollback()
+            lookup_connection.rollback()
+            raise
+        self._access_tracker.forget(tile_keys)
+
+    def _delete_matching_tiles(self, condition, parameters, tile_filter=None, chunk_callback=None):
+        """Delete all tiles matching a condition on the lookup table
+
+        The lookup table is walked in tile key order, a chunk of tiles at a time, and each
+        chunk is deleted in its own transaction. The database lock is only held for a single
+        chunk, so the store can be used normally while the tiles are being deleted.
+
+        :param str condition: condition on the lookup table
+        :param list parameters: parameters of the condition
+        :param tile_filter: optional function called with z, x & y of each tile matching the condition,
+                            only tiles for which it returns True are deleted
+        :param chunk_callback: optional function called with the number of tiles deleted so far
+                               after each chunk, the deletion stops if it returns False
+        :returns: number of deleted tiles
+        :rtype: int
+        """
+        # pending tiles (and touches changing tile timestamps) need to be written first
+        self.flush()
+        deleted_count = 0
+        last_key = -1
+        while True:
+            with self._db_lock:
+                rows = self._lookup_db_connection.execute(
+                    "select tile_key, store_filename from tiles_v2 where tile_key>? and (%s) "
+                    "order by tile_key limit ?" % condition,
+                    [last_key] + list(parameters) + [SQLITE_DELETION_CHUNK_SIZE]).fetchall()
+                if not rows:
+                    break
+                last_key = rows[-1][0]
+                if tile_filter is not None:
+                    rows = [row for row in rows if tile_filter(*get_tile_zxy(row[0]))]
+                if rows:
+                    self._delete_tile_rows(rows)
+                    deleted_count += len(rows)
+            if chunk_callback is not None and rows and chunk_callback(deleted_count) is False:
+                break
+        if deleted_count:
+            with self._db_lock:
+                for connection in [self._lookup_db_connection] + list(self._storage_databases.values()):
+                    incremental_vacuum(connection)
+        return deleted_count
+
+    def _delete_v1_tiles(self, condition, parameters):
+        """Delete tiles matching a condition from the version 1 tables that are being migrated
+
+        :returns: number of deleted tiles
+        :rtype: int
+        """
+        with self._db_lock:
+            lookup_connection = self._lookup_db_connection
+            try:
+                rows = lookup_connection.execute(
+                    "select z, x, y, store_filename from tiles where %s" % condition, parameters).fetchall()
+            except sqlite3.OperationalError:
+                # the version 1 tables have been dropped in the meantime
+                return 0
+            if not rows:
+                return 0
+            zxy_by_store_name = {}
+            for z, x, y, store_name in rows:
+                zxy_by_store_name.setdefault(store_name, []).append((z, x, y))
+            lookup_connection.execute("delete from tiles where %s" % condition, parameters)
+            lookup_connection.commit()
+            self._delete_v1_store_tiles(zxy_by_store_name)
+            return len(rows)
+
+    def delete_region(self, tile_ranges):
+        """Delete all tiles in the given tile coordinate ranges
+
+        The tile keys of tiles in a rectangle are all between the tile keys of its top left
+        and bottom right corners, so each rectangle is deleted with a key range scan.
+
+        :param tile_ranges: iterable of (z, min x, max x, min y, max y) tuples, inclusive
+        :returns: number of deleted tiles
+        :rtype: int
+        """
+        deleted_count = 0
+        for z, min_x, max_x, min_y, max_y in tile_ranges:
+            def in_range(_z, x, y):
+                return min_x <= x <= max_x and min_y <= y <= max_y
+            deleted_count += self._delete_matching_tiles(
+                "tile_key between ? and ?", [get_tile_key(z, min_x, min_y), get_tile_key(z, max_x, max_y)],
+                tile_filter=in_range)
+            if self._v1_tables_present:
+                deleted_count += self._delete_v1_tiles("z=? and x between ? and ? and y between ? and ?",
+                                                       (z, min_x, max_x, min_y, max_y))
+        log.info("%d tiles deleted from region of %s", deleted_count, self)
+        return deleted_count
+
+    def delete_older_than(self, timestamp, chunk_callback=None):
+        """Delete all tiles with timestamp older than the given timestamp
+
+        :param timestamp: UNIX timestamp
+        :param chunk_callback: optional function called with the number of tiles deleted so far
+                               after each chunk of tiles, the deletion stops if it returns False
+                               (can be used to pause the deletion, so that it does not hog the store)
+        :returns: number of deleted tiles
+        :rtype: int
+        """
+        deleted_count = self._delete_matching_tiles("unix_epoch_timestamp<?", [int(timestamp)],
+                                                    chunk_callback=chunk_callback)
+        if self._v1_tables_present:
+            deleted_count += self._delete_v1_tiles("unix_epoch_timestamp<?", (int(timestamp),))
+        log.info("%d tiles older than %d deleted from %s", deleted_count, timestamp, self)
+        return deleted_count
+
+    def evict(self, bytes_to_free):
+        """Delete least recently accessed tiles until the given amount of space is freed
+
+        Tiles are deleted in large transactions, each holding the database lock only
+        for a single chunk of tiles. Freed pages are then returned to the filesystem
+        with incremental vacuum (for databases created with incremental auto vacuum).
+
+        :param int bytes_to_free: how much space to free
+        :returns: how much space has been freed in bytes
+        :rtype: int
+        """
+        # pending tiles & access times need to be written first,
+        # so that recently accessed tiles are not evicted
+        self.flush()
+        self._write_access_times()
+        start_size = self.get_size()
+        with self._db_lock:
+            tile_count = self._lookup_db_connection.execute("select count(*) from tiles_v2").fetchone()[0]
+        # don't evict (many) more tiles than needed, based on the average tile size
+        average_tile_size = max(1, start_size // max(1, tile_count))
+        freed = 0
+        evicted_count = 0
+        while freed < bytes_to_free:
+            chunk_size = min(SQLITE_EVICTION_CHUNK_SIZE, (bytes_to_free - freed) // average_tile_size + 1)
+            with self._db_lock:
+                lookup_connection = self._lookup_db_connection
+                rows = lookup_connection.execute(
+                    "select tile_key, store_filename from tiles_v2 order by last_access limit ?",
+                    (chunk_size,)).fetchall()
+                if not rows:
+                    break
+                self._delete_tile_rows(rows)
+                evicted_count += len(rows)
+                freed = start_size - self.get_size()
+        with self._db_lock:
+            for connection in [self._lookup_db_connection] + list(self._storage_databases.values()):
+                incremental_vacuum(connection)
+        log.info("%d tiles evicted from %s, %d bytes freed", evicted_count, self, freed)
+        return freed
+
+    def deduplicate_tiles(self, progress_callback=None):
+        """Convert all tiles stored with their own copy of tile data to deduplicated tiles
+
+        This can be used to deduplicate existing stores, regardless of the store currently
+        deduplicating newly stored tiles or not. Tiles are converted in chunks, each in its own
+        transaction, so the store can be used normally while the conversion is running.
+
+        :param progress_callback: optional function called with the number
+                                  of tiles converted so far after each chunk
+        :returns: number of converted tiles and the number of bytes saved
+        :rtype: (int, int) tuple
+        """
+        self.flush()
+        start_size = self.get_size()
+        converted_count = 0
+        with self._storage_db_management_lock:
+            store_connections = list(self._storage_databases.values())
+        for store_connection in store_connections:
+            last_tile_key = None
+            while True:
+                with self._db_lock:
+                    if last_tile_key is None:
+                        rows = store_connection.execute(
+                            "select tile_key, tile from tiles_v2 where tile is not null order by tile_key limit ?",
+                            (SQLITE_DEDUPLICATION_CHUNK_SIZE,)).fetchall()
+                    else:
+                        rows = store_connection.execute(
+                            "select tile_key, tile from tiles_v2 where tile is not null and tile_key>? "
+                            "order by tile_key limit ?", (last_tile_key, SQLITE_DEDUPLICATION_CHUNK_SIZE)).fetchall()
+                    if not rows:
+                        break
+                    try:
+                        for tile_key, tile_data in rows:
+                            tile_hash = sqlite3.Binary(get_tile_hash(tile_data))
+                            store_connection.execute(
+                                "insert or ignore into tile_blobs (hash, tile, refcount) values (?, ?, 0)",
+                                [tile_hash, tile_data])
+                            store_connection.execute(
+                                "update tile_blobs set refcount=refcount+1 where hash=?", [tile_hash])
+                            store_connection.execute(
+                                "update tiles_v2 set tile=null, tile_hash=? where tile_key=?", [tile_hash, tile_key])
+                        store_connection.commit()
+                    except Exception:
+                        store_connection.rollback()
+                        raise
+                last_tile_key = rows[-1][0]
+                converted_count += len(rows)
+                if progress_callback:
+                    progress_callback(converted_count)
+            with self._db_lock:
+                # return the space freed by the duplicate tile data to the filesystem
+                incremental_vacuum(store_connection)
+        saved = start_size - self.get_size()
+        log.info("%d tiles in %s deduplicated, %d bytes saved", converted_count, self, saved)
+        return converted_count, saved
+
+    def _move_tiles(self, rows, source_name, target_name):
+        """Move tiles from one storage database to another
+
+        The tile data is copied first, then the lookup database is switched to the new
+        copy and only then the old copy is deleted, so the tile can be found at all times.
+        Tiles the lookup database does not point to are just deleted.
+
+        NOTE: the caller needs to hold the database lock
+
+        :param list rows: list of (tile key, tile data, extension, timestamp) tuples
+        :param str source_name: name of the storage database the tiles are moved from
+        :param str target_name: name of the storage database the tiles are moved to
+        """
+        lookup_connection = self._lookup_db_connection
+        source_connection = self._storage_databases[source_name]
+        target_connection = self._storage_databases[target_name]
+        tile_keys = [row[0] for row in rows]
+        referenced_keys = set()
+        for placeholders, parameters in _key_chunks(tile_keys):
+            referenced_keys.update(row[0] for row in lookup_connection.execute(
+                "select tile_key from tiles_v2 where store_filename=? and tile_key in (%s)" % placeholders,
+                [source_name] + parameters))
+        try:
+            for tile_key, tile_data, extension, timestamp in rows:
+                if tile_key in referenced_keys:
+                    self._write_store_tile(target_connection, tile_key, tile_data or b"", extension, timestamp)
+            target_connection.commit()
+            lookup_connection.executemany("update tiles_v2 set store_filename=? where tile_key=?",
+                                          [(target_name, tile_key) for tile_key in referenced_keys])
+            lookup_connection.commit()
+        except Exception:
+            target_connection.rollback()
+            lookup_connection.rollback()
+            raise
+        for placeholders, parameters in _key_chunks(tile_keys):
+            source_connection.execute("delete from tiles_v2 where tile_key in (%s)" % placeholders, parameters)
+        source_connection.commit()
+
+    def _remove_storage_database(self, store_name):
+        """Close and delete a storage database that no longer holds any tiles
+
+        NOTE: the caller needs to hold the database lock
+        """
+        with self._storage_db_management_lock:
+            self._storage_databases.pop(store_name).close()
+            if self._new_tiles_store_name == store_name:
+                first_store_name = min(self._storage_databases.keys(), key=_get_store_number)
+                self._new_tiles_store_name = first_store_name
+                self._new_tiles_store_connection = self._storage_databases[first_store_name]
+            # make all threads reconnect their read connections
+            self._store_generation += 1
+            if self._shared_attached_connection is not None:
+                self._shared_attached_connection.close()
+                self._shared_attached_connection = None
+            store_path = os.path.join(self.store_path, store_name)
+            for path in (store_path, store_path + "-wal", store_path + "-shm"):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def repack(self, progress_callback=None):
+        """Move tiles to as few storage databases as possible and delete the emptied storage databases
+
+        Tiles from the last storage database are moved to the first storage databases
+        with enough free space, a chunk at a time, until the last storage database
+        is empty and can be deleted. This is repeated until the remaining storage
+        databases are full. The first storage database is never deleted.
+
+        :param progress_callback: optional function called with the number
+                                  of tiles moved so far after each chunk
+        :returns: number of moved tiles and the number of deleted storage databases
+        :rtype: (int, int) tuple
+        """
+        if self._v1_tables_present:
+            # version 1 tiles can't be moved, they would be lost with the deleted storage databases
+            log.warning("can't repack %s while tiles are being migrated from version 1 tables", self)
+            return 0, 0
+        self.flush()
+        with self._storage_db_management_lock:
+            store_names = sorted(self._storage_databases.keys(), key=_get_store_number)
+        moved_count = 0
+        removed_count = 0
+        while len(store_names) > 1:
+            source_name = store_names[-1]
+            target_names = store_names[:-1]
+            emptied = False
+            while True:
+                with self._db_lock:
+                    rows = self._storage_databases[source_name].execute(
+                        "select s.tile_key, %s, s.extension, s.unix_epoch_timestamp from tiles_v2 as s "
+                        "order by s.tile_key limit ?" % (TILE_DATA_SQL % ""),
+                        (SQLITE_REPACK_CHUNK_SIZE,)).fetchall()
+                    if not rows:
+                        # delete the storage database right away, before the writer
+                        # thread gets a chance to store new tiles to it
+                        self._remove_storage_database(source_name)
+                        emptied = True
+                        break
+                    chunk_size = sum(len(row[1] or b"") for row in rows)
+                    target_name = None
+                    for store_name in target_names:
+                        if self._will_it_fit_in(store_name, chunk_size):
+                            target_name = store_name
+                            break
+                    if target_name is None:
+                        # the other storage databases are full
+                        break
+                    self._move_tiles(rows, source_name, target_name)
+                moved_count += len(rows)
+                if progress_callback:
+                    progress_callback(moved_count)
+            if not emptied:
+                break
+            removed_count += 1
+            store_names = target_names
+        if moved_count:
+            with self._db_lock:
+                for connection in self._storage_databases.values():
+                    incremental_vacuum(connection)
+        log.info("%d tiles in %s repacked, %d storage databases deleted", moved_count, self, removed_count)
+        return moved_count, removed_count
+
+    def iter_tiles(self):
+        """Iterate over coordinates of all tiles in the store
+
+        The lookup database is read in chunks in tile key order, so that the
+        read lock is not held for the whole (possibly long) iteration.
+        Tiles written while iterating might be listed more than once.
+
+        :returns: iterator of (z, x, y) tuples
+        """
+        with self._pending_condition:
+            pending_zxy_list = list(self._pending.keys())
+        for zxy in pending_zxy_list:
+            yield zxy
+        if self._v1_tables_present:
+            with self._read_lock:
+                lookup_connection, _store_connections = self._get_read_connections()
+                try:
+                    v1_zxy_list = lookup_connection.execute("select z, x, y from tiles").fetchall()
+                except sqlite3.OperationalError:
+                    # the version 1 tables have been dropped in the meantime
+                    v1_zxy_list = []
+            for zxy in v1_zxy_list:
+                yield zxy
+        last_key = -1
+        while True:
+            with self._read_lock:
+                lookup_connection, _store_connections = self._get_read_connections()
+                keys = lookup_connection.execute(
+                    "select tile_key from tiles_v2 where tile_key>? order by tile_key limit ?",
+                    (last_key, SQLITE_MIGRATION_CHUNK_SIZE)).fetchall()
+            if not keys:
+                break
+            for (tile_key,) in keys:
+                yield get_tile_zxy(tile_key)
+            last_key = keys[-1][0]
+
+    def get_modification_stamp(self):
+        """Get a stamp that changes whenever tiles are added to or removed from the store
+
+        All changes of stored tiles go through the lookup database,
+        so it is enough to check its size and modification time
+        (and that of its WAL file, if it is not empty).
+
+        :returns: [lookup database size, lookup database modification time] list
+        :rtype: list
+        """
+        stamp = [os.path.getsize(self._lookup_db_path), os.path.getmtime(self._lookup_db_path)]
+        wal_path = self._lookup_db_path + "-wal"
+        if os.path.exists(wal_path) and os.path.getsize(wal_path):
+            stamp.extend([os.path.getsize(wal_path), os.path.getmtime(wal_path)])
+        return stamp
+
+    def flush(self):
+        """Block until all tiles stored so far have been written to the database
+
+        :raises TileStoreWriteFailed: if the tiles could not be written,
+                                      they are kept pending and written later
+        """
+        flush_request = None
+        with self._pending_condition:
+            if self._writer_running and self._writer_thread is not threading.current_thread():
+                # let the writer thread write the pending tiles
+                flush_request = _FlushRequest()
+                self._flush_requests.append(flush_request)
+                self._pending_condition.notify_all()
+        if flush_request:
+            flush_request.event.wait()
+            error = flush_request.error
+        else:
+            error = self._write_pending()
+        if error is not None:
+            raise TileStoreWriteFailed("writing tiles to %s failed: %s" % (self, error))
+
+    def _stop_writer(self):
+        """Stop the writer thread once it writes all pending tiles"""
+        with self._pending_condition:
+            self._writer_running = False
+            self._pending_condition.notify_all()
+        if self._writer_thread is not threading.current_thread():
+            self._writer_thread.join()
+
     def close(self):
-        """Close all database connections"""
+        """Write all pending tiles and close all database connections"""
+        self._stop_writer()
         with self._db_lock:
             self._lookup_db_connection.close()
             for connection in self._storage_databases.values():
                 connection.close()
+            with self._read_connections_lock:
+                for connections in self._read_connections.values():
+                    for connection in connections:
+                        connection.close()
+                self._read_connections = {}
 
     def clear(self):
         """Delete all database files belonging to this SQLite store"""
+        # drop any pending tiles as they would be deleted anyway
+        with self._pending_condition:
+            self._pending.clear()
+            self._pending_touches.clear()
+        # make sure the connections are closed before we remove
+        # the data bases under them
+        # - close() joins the writer thread, which needs the database lock
+        #   to finish, so the lock must not be held while closing
+        self.close()
         with self._db_lock:
-            # make sure the connections are closed before we remove
-            # the data bases under them
-            self.close()
             with self._storage_db_management_lock:
                 # delete the lookup database
                 os.remove(self._lookup_db_path)
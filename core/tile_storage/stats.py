@@ -0,0 +1,189 @@
+# Tile store statistics
+#
+# Stores keep running per zoom level counters of the tiles they hold - number of tiles,
+# total tile data size and the timestamp range - so that storage usage can be reported
+# without listing (and stat-ing or reading) all the stored tiles.
+#
+# The counters are updated as tiles are stored & deleted. The oldest & newest timestamps
+# are only widened by new tiles, so once tiles are deleted they are a bound of the real
+# timestamp range rather than the exact range (they are reset once a zoom level
+# becomes empty).
+
+from __future__ import with_statement
+
+import os
+import json
+import threading
+
+import logging
+log = logging.getLogger("tile_storage.stats")
+
+TILE_STATS_FILE_NAME = "tile_stats.json"
+TILE_STATS_FORMAT_VERSION = 1
+
+def _min(a, b):
+    """Minimum of two values, any of which can be None"""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return min(a, b)
+
+def _max(a, b):
+    """Maximum of two values, any of which can be None"""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return max(a, b)
+
+class TileStats(object):
+    """Tile count, tile data size & timestamp range per zoom level"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # z -> [tile count, byte count, oldest timestamp, newest timestamp]
+        self._zooms = {}
+
+    def _get_zoom(self, z):
+        zoom = self._zooms.get(z)
+        if zoom is None:
+            zoom = [0, 0, None, None]
+            self._zooms[z] = zoom
+        return zoom
+
+    def add(self, z, size, timestamp):
+        """Record that a tile has been stored
+
+        NOTE: replacing a tile should be recorded as removal of the old tile
+              followed by addition of the new tile
+        """
+        with self._lock:
+            zoom = self._get_zoom(z)
+            zoom[0] += 1
+            zoom[1] += size
+            zoom[2] = _min(zoom[2], timestamp)
+            zoom[3] = _max(zoom[3], timestamp)
+
+    def remove(self, z, size):
+        """Record that a tile has been deleted"""
+        with self._lock:
+            zoom = self._zooms.get(z)
+            if zoom is None:
+                return
+            zoom[0] -= 1
+            zoom[1] -= size
+            if zoom[0] <= 0:
+                del self._zooms[z]
+
+    def touch(self, z, timestamp):
+        """Record that timestamp of a stored tile has been updated"""
+        with self._lock:
+            zoom = self._zooms.get(z)
+            if zoom is not None:
+                zoom[3] = _max(zoom[3], timestamp)
+
+    def merge(self, other):
+        """Add statistics of another store (such as another store of the same layer)"""
+        with self._lock:
+            for z, (count, size, oldest, newest) in other.get_zooms().items():
+                zoom = self._get_zoom(z)
+                zoom[0] += count
+                zoom[1] += size
+                zoom[2] = _min(zoom[2], oldest)
+                zoom[3] = _max(zoom[3], newest)
+
+    def get_zooms(self):
+        """Get a copy of the per zoom level statistics
+
+        :returns: [tile count, byte count, oldest timestamp, newest timestamp] lists
+                  keyed by zoom level
+        :rtype: dict
+        """
+        with self._lock:
+            return dict((z, list(zoom)) for z, zoom in self._zooms.items())
+
+    @property
+    def tile_count(self):
+        with self._lock:
+            return sum(zoom[0] for zoom in self._zooms.values())
+
+    @property
+    def byte_count(self):
+        with self._lock:
+            return sum(zoom[1] for zoom in self._zooms.values())
+
+    def as_dict(self):
+        """Get the statistics as a JSON serializable dictionary
+
+        :returns: dictionary with count, bytes, oldest & newest keys
+                  for each zoom level, keyed by zoom level (as string)
+        :rtype: dict
+        """
+        with self._lock:
+            return dict((str(z), {"count": count, "bytes": size, "oldest": oldest, "newest": newest})
+                        for z, (count, size, oldest, newest) in self._zooms.items())
+
+    @classmethod
+    def from_zooms(cls, zooms):
+        """Create statistics from an iterable of (z, count, bytes, oldest, newest) tuples"""
+        stats = cls()
+        for z, count, size, oldest, newest in zooms:
+            if count:
+                stats._zooms[z] = [count, size, oldest, newest]
+        return stats
+
+    def save(self, file_path, stamp):
+        """Save the statistics to a file
+
+        :param str file_path: where to save the statistics
+        :param stamp: JSON serializable modification stamp of the store described
+                      by the statistics, they are only loaded if the stamp matches
+        """
+        data = json.dumps({"version": TILE_STATS_FORMAT_VERSION, "stamp": stamp, "zooms": self.as_dict()})
+        temporary_file_path = file_path + ".part"
+        with open(temporary_file_path, "w") as f:
+            f.write(data)
+        os.rename(temporary_file_path, file_path)
+
+    @staticmethod
+    def load_stamp(file_path):
+        """Get the modification stamp saved together with the statistics by save()
+
+        :param str file_path: path to the saved statistics
+        :returns: the stamp or None if there are no saved statistics or they can't be loaded
+        """
+        if not os.path.isfile(file_path):
+            return None
+        try:
+            with open(file_path, "r") as f:
+                return json.load(f)["stamp"]
+        except Exception:
+            log.exception("loading tile statistics stamp from %s failed", file_path)
+            return None
+
+    @classmethod
+    def load(cls, file_path, stamp):
+        """Load statistics saved by save()
+
+        :param str file_path: path to the saved statistics
+        :param stamp: current modification stamp of the store
+        :returns: the statistics or None if there are no saved statistics, they can't be loaded
+                  or they have been saved with a different stamp
+        :rtype: TileStats or None
+        """
+        if not os.path.isfile(file_path):
+            return None
+        try:
+            with open(file_path, "r") as f:
+                data = json.load(f)
+            if data["version"] != TILE_STATS_FORMAT_VERSION:
+                return None
+            if data["stamp"] != stamp:
+                log.debug("store changed since %s has been saved", file_path)
+                return None
+            return cls.from_zooms((int(z), zoom["count"], zoom["bytes"], zoom["oldest"], zoom["newest"])
+                                  for z, zoom in data["zooms"].items())
+        except Exception:
+            log.exception("loading tile statistics from %s failed", file_path)
+            return None
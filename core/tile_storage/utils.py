@@ -3,9 +3,12 @@ import six
 from six import b
 import sys
 import os
+import time
+import threading
 import logging
 
 from .tile_types import ID_TO_CLASS_MAP
+from .constants import ACCESS_TIME_RESOLUTION
 
 log = logging.getLogger("tile_storage.utils")
 
@@ -73,3 +76,65 @@ def check_folder(folder_path, prevent_media_indexing=False):
                 open(nomedia_file_path, "w").close()
             except Exception:
                 log.exception(".nomedia file creation failed in: %s", nomedia_file_path)
+
+def get_access_time(timestamp=None):
+    """Round the timestamp (current time by default) down to the access time resolution
+
+    :param timestamp: UNIX timestamp or None for current time
+    :returns: coarse access time
+    :rtype: int
+    """
+    if timestamp is None:
+        timestamp = time.time()
+    return int(timestamp) // ACCESS_TIME_RESOLUTION * ACCESS_TIME_RESOLUTION
+
+class AccessTimeTracker(object):
+    """Gathers tile accesses, so that access times can be updated in batches
+
+    Each tile is reported as accessed at most once per access time period,
+    so that frequently read tiles don't result in frequent access time updates.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._access_time = None
+        # tiles already reported in the current period
+        self._recorded = set()
+        # tiles waiting for their access time to be updated
+        self._pending = set()
+
+    def record(self, keys):
+        """Record access to tiles
+
+        :param keys: iterable of tile keys (of any hashable type)
+        :returns: number of tiles waiting for access time update
+        :rtype: int
+        """
+        access_time = get_access_time()
+        with self._lock:
+            if access_time != self._access_time:
+                self._access_time = access_time
+                self._recorded = set()
+            for key in keys:
+                if key not in self._recorded:
+                    self._recorded.add(key)
+                    self._pending.add(key)
+            return len(self._pending)
+
+    def forget(self, keys):
+        """Stop tracking access to the given tiles (such as when they are deleted)"""
+        with self._lock:
+            for key in keys:
+                self._pending.discard(key)
+                self._recorded.discard(key)
+
+    def take(self):
+        """Take all tiles waiting for access time update
+
+        :returns: access time and list of tile keys
+        :rtype: (int, list) tuple
+        """
+        with self._lock:
+            pending = list(self._pending)
+            self._pending = set()
+            return self._access_time, pending
@@ -1,24 +1,14 @@
 """a modRana module with tile handling functionality"""
 # -*- coding: utf-8 -*-
+import re
 import string
 
-def getOSMUrl(lzxy):
-    return '%s%d/%d/%d.%s' % (lzxy[0].url, lzxy[1], lzxy[2], lzxy[3], lzxy[0].type)
+from core.tile_hosts import HostShards, SELECTION_HASH
 
-def getWebMercatorSubstitutionUrl(lzxy):
-    template = string.Template(lzxy[0].url)
-    return str(template.substitute(z=lzxy[1], x=lzxy[2], y=lzxy[3]))
-
-def getYahooUrl(lzxy):
-    layer, z, x, y = lzxy
-    y = ((2 ** (z - 1) - 1) - y)
-    z += 1
-    # I have no idea what the r parameter is, r=0 or no r => grey square
-    # -> maybe revision ?
-    return '%s&x=%d&y=%d&z=%d&r=1' % (layer.url, x, y, z)
-
-def getGoogleUrl(lzxy):
-    return '%s&x=%d&y=%d&z=%d' % (lzxy[0].url, lzxy[2], lzxy[3], lzxy[1])
+# placeholder for the subdomain in layer URLs, such as "https://{s}.tile.example.org/"
+SUBDOMAIN_PLACEHOLDER = "{s}"
+# substitution URLs can also use ${s}, so only replace {s} not preceded by $
+_SUBDOMAIN_PATTERN = re.compile(r"(?<!\$)\{s\}")
 
 # modified from:
 # http://www.maptiler.org/google-maps-coordinates-tile-bounds-projection/globalmaptiles.py
@@ -43,27 +33,190 @@ def quadTree(tx, ty, zoom):
         quadKey += str(digit)
     return quadKey
 
-def getQuadtreeUrl(lzxy):
-    quadKey = quadTree(lzxy[2], lzxy[3], lzxy[1])
-    #  don't know what the g argument is, maybe revision ?
-    #  looks like it isn't optional
-    return '%s%s?g=452' % (lzxy[0].url, quadKey)
-
-def getQuadtreeSubstitutionUrl(lzxy):
-    quadKey = quadTree(lzxy[2], lzxy[3], lzxy[1])
-    template = string.Template(lzxy[0].url)
-    return str(template.substitute(quadindex=quadKey))
-
-URL_FUNCTIONS = {
-    'osm' : getOSMUrl,
-    'web_mercator_substitution' : getWebMercatorSubstitutionUrl,
-    'yahoo' : getYahooUrl,
-    'google' : getGoogleUrl,
-    'quadtree' : getQuadtreeUrl,
-    'quadtree_substitution' : getQuadtreeSubstitutionUrl
-}
+def _yahooValues(z, x, y):
+    # I have no idea what the r parameter is, r=0 or no r => grey square
+    # -> maybe revision ?
+    return x, (2 ** (z - 1) - 1) - y, z + 1
+
+def _googleValues(z, x, y):
+    return x, y, z
+
+def _quadtreeValues(z, x, y):
+    return quadTree(x, y, z),
+
+def _quadtreeSubstitutionValues(z, x, y):
+    return {"quadindex": quadTree(x, y, z)}
+
+def _escape(text):
+    """Escape text for use in a %-format string"""
+    return text.replace("%", "%%")
+
+def _compileSubstitution(url):
+    """Turn a string.Template style URL into a %-format string with named fields"""
+    parts = []
+    end = 0
+    for match in string.Template.pattern.finditer(url):
+        parts.append(_escape(url[end:match.start()]))
+        if match.group("escaped") is not None:
+            parts.append("$")
+        else:
+            name = match.group("named") or match.group("braced")
+            if name is None:
+                raise ValueError("invalid placeholder in tile URL: %s" % url)
+            parts.append("%%(%s)s" % name)
+        end = match.end()
+    parts.append(_escape(url[end:]))
+    return "".join(parts)
+
+def compileUrl(url, coordinates, tileType):
+    """Compile a layer URL pattern to a %-format string
+
+    Substitution URLs are compiled to a format string with named fields (such as %(x)s),
+    the other URLs to a format string with positional fields, with the subdomain placeholders
+    first - these are faster to format, which matters as URLs of all tiles are formatted
+    when downloading a batch of tiles.
+
+    :param str url: layer URL
+    :param str coordinates: layer coordinate type
+    :param str tileType: tile image type (file extension)
+    :returns: (format string, values function, subdomain count) tuple,
+              the values function turns z, x, y tile coordinates into a dictionary
+              or a tuple for the format string (None if the tuple is (z, x, y)),
+              subdomain count is the number of subdomain placeholders in the URL
+              (for positional format strings)
+    :rtype: tuple
+    """
+    if coordinates in ("web_mercator_substitution", "quadtree_substitution"):
+        urlFormat = _compileSubstitution(_SUBDOMAIN_PATTERN.sub("${s}", url))
+        subdomainCount = urlFormat.count("%(s)s")
+        if coordinates == "quadtree_substitution":
+            return urlFormat, _quadtreeSubstitutionValues, subdomainCount
+        return urlFormat, _zxyDict, subdomainCount
+    subdomainCount = len(_SUBDOMAIN_PATTERN.findall(url))
+    prefix = _SUBDOMAIN_PATTERN.sub("%s", _escape(url))
+    if coordinates == "yahoo":
+        return prefix + "&x=%d&y=%d&z=%d&r=1", _yahooValues, subdomainCount
+    elif coordinates == "google":
+        return prefix + "&x=%d&y=%d&z=%d", _googleValues, subdomainCount
+    elif coordinates == "quadtree":
+        #  don't know what the g argument is, maybe revision ?
+        #  looks like it isn't optional
+        return prefix + "%s?g=452", _quadtreeValues, subdomainCount
+    else:
+        # OSM coordinates are the default
+        return prefix + "%d/%d/%d." + _escape(tileType), None, subdomainCount
+
+def _zxyDict(z, x, y):
+    return {"z": z, "x": x, "y": y}
+
+class TileUrlTemplate(object):
+    """Layer URL pattern compiled once for fast tile URL formatting"""
+
+    def __init__(self, url, coordinates="osm", tileType="png", subdomains=None, selection=SELECTION_HASH):
+        """
+        :param str url: layer URL
+        :param str coordinates: layer coordinate type
+        :param str tileType: tile image type (file extension)
+        :param list subdomains: values for the {s} placeholder in the URL
+        :param str selection: how to select the subdomain for a tile (see core.tile_hosts)
+        """
+        self._url = url
+        self._format, self._values, self._subdomainCount = compileUrl(url, coordinates, tileType)
+        self._named = coordinates in ("web_mercator_substitution", "quadtree_substitution")
+        self._shards = HostShards(subdomains or [], selection)
+        if self._subdomainCount and not self._shards.subdomains:
+            raise ValueError("tile URL %s has a subdomain placeholder, but no subdomains" % url)
+
+    @property
+    def url(self):
+        return self._url
+
+    @property
+    def shards(self):
+        """Subdomain selection & host health tracking
+
+        :rtype: core.tile_hosts.HostShards
+        """
+        return self._shards
+
+    def getUrl(self, z, x, y, subdomain=None):
+        """Get URL of a tile
+
+        :param int z: zoom level
+        :param int x: x coordinate
+        :param int y: y coordinate
+        :param str subdomain: subdomain to use, selected by the host shards by default
+        :returns: tile URL
+        :rtype: str
+        """
+        if self._values is None:
+            values = (z, x, y)
+        else:
+            values = self._values(z, x, y)
+        if self._subdomainCount:
+            if subdomain is None:
+                subdomain = self._shards.select(z, x, y)
+            if self._named:
+                values["s"] = subdomain
+            else:
+                values = (subdomain,) * self._subdomainCount + values
+        return self._format % values
 
 def getTileUrl(lzxy):
-    handler = URL_FUNCTIONS.get(lzxy[0].coordinates, getOSMUrl)
-    return handler(lzxy)
+    return lzxy[0].url_template.getUrl(lzxy[1], lzxy[2], lzxy[3])
+
+
+def getConditionalHeaders(validators, headers=None):
+    """Get request headers for a conditional tile request
+
+    NOTE: urllib3 uses the headers passed to a request in place of the
+          connection pool headers, so pass the pool headers here to keep them
 
+    :param validators: (etag, last_modified) tuple of a stored tile or None
+    :param dict headers: headers to send with the request in any case
+    :returns: request headers
+    :rtype: dict
+    """
+    requestHeaders = dict(headers or {})
+    if validators:
+        etag, lastModified = validators
+        if etag:
+            requestHeaders['If-None-Match'] = etag
+        if lastModified:
+            requestHeaders['If-Modified-Since'] = lastModified
+    return requestHeaders
+
+def getResponseValidators(response):
+    """Get HTTP cache validators from a tile download response
+
+    :param response: urllib3 response
+    :returns: (etag, last_modified) tuple, any of the values can be None
+    :rtype: tuple
+    """
+    headers = response.getheaders()
+    return headers.get('etag'), headers.get('last-modified')
+
+def getViewportTiles(z, cornerX, cornerY, tilesX, tilesY, margin=0):
+    """Get coordinates of tiles in a rectangular map viewport
+
+    Tile x coordinates wrap around the antimeridian, tiles outside
+    of the map in the y direction are skipped.
+
+    :param int z: zoom level
+    :param int cornerX: x coordinate of the top left tile
+    :param int cornerY: y coordinate of the top left tile
+    :param int tilesX: number of tiles in the x direction
+    :param int tilesY: number of tiles in the y direction
+    :param int margin: number of tiles to add around the viewport on each side
+    :returns: list of (z, x, y) tuples
+    :rtype: list
+    """
+    tileCount = 2 ** z
+    zxyList = []
+    for y in range(cornerY - margin, cornerY + tilesY + margin):
+        if y < 0 or y >= tileCount:
+            continue
+        for x in range(cornerX - margin, cornerX + tilesX + margin):
+            zxyList.append((z, x % tileCount, y))
+    # tiles might repeat if the viewport is wider than the world
+    return sorted(set(zxyList))
@@ -315,6 +315,24 @@ def create_connection_pool(url, max_threads=1):
         import urllib3
     return urllib3.connection_from_url(url, timeout=constants.INTERNET_CONNECTIVITY_TIMEOUT,
                                        maxsize=max_threads, block=False)
+
+def create_pool_manager(max_threads=1):
+    """Create a pool manager -> a connection pool for each host
+
+    Needed for downloading tiles of layers spread over a couple of hosts
+    (see core.tile_hosts), as a connection pool only handles a single host.
+
+    :param int max_threads: capacity of the pool for each host
+    :returns: pool manager instance
+    """
+    # only import urllib3 once needed
+    if sys.version_info[:2] <= (2, 5):
+        from core.backports import urllib3_python25 as urllib3
+    else:
+        import urllib3
+    return urllib3.PoolManager(timeout=constants.INTERNET_CONNECTIVITY_TIMEOUT,
+                               maxsize=max_threads, block=False)
+
 def get_time_hash_string():
     """Get a "hash" like time based string useable for use in file names.
 
@@ -22,6 +22,7 @@ from __future__ import with_statement  # for Python 2.5
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #---------------------------------------------------------------------------
 from core import constants
+from core import memory
 from modules.base_module import RanaModule
 from core.signal import Signal
 
@@ -356,6 +357,30 @@ class DeviceModule(RanaModule):
         """
         return constants.DEFAULT_THEME_ID, constants.DEFAULT_THEME_NAME
 
+    @property
+    def memory_status(self):
+        """Report current memory status of the device and of the modRana process
+
+        Used to adapt in-memory cache sizes to memory pressure. By default the status
+        is read from /proc, which works on Linux based platforms (including Android).
+
+        :returns: memory status or None if memory status is not available
+        :rtype: core.memory.MemoryStatus or None
+        """
+        return memory.read_memory_status()
+
+    @property
+    def memory_cache_scale_range(self):
+        """Range the in-memory cache budgets can be scaled in based on memory pressure
+
+        Devices with little memory might want to never grow the caches
+        over the configured size.
+
+        :returns: (minimum scale, maximum scale) tuple
+        :rtype: tuple
+        """
+        return memory.MIN_CACHE_SCALE, memory.MAX_CACHE_SCALE
+
     @property
     def defaultTileStorageType(self):
         """Default tile storage type for the platform
@@ -28,6 +28,7 @@ import logging
 import dbus.glib
 
 from core import gs, constants
+from core import memory
 import hildon
 import location
 import conic # provide by python-conic on Maemo 5
@@ -623,6 +624,11 @@ class DeviceN900(DeviceModule):
     def device_type(self):
         return DEVICE_TYPE_SMARTPHONE
 
+    @property
+    def memory_cache_scale_range(self):
+        # 256 MB of RAM, don't grow the caches over the configured size
+        return memory.MIN_CACHE_SCALE, 1.0
+
     @property
     def offline_routing_providers(self):
         return [constants.ROUTING_PROVIDER_MONAV_SERVER]
\ No newline at end of file
@@ -44,6 +44,7 @@ from core import modrana_log
 from core import utils
 from core import paths
 from core import point
+from core.tile_cache import asBuffer
 
 import logging
 no_prefix_log = logging.getLogger()
@@ -174,6 +175,9 @@ class QMLGUI(GUIModule):
         # turn by turn navigation
         self.navigation = Navigation(self)
 
+        # map tile management
+        self.mapTiles = MapTiles(self)
+
     def firstTime(self):
         # trigger the first time signal
         self.firstTimeSignal()
@@ -362,8 +366,17 @@ class QMLGUI(GUIModule):
         :rtype: dict
         """
         available_tiles = {}
+        lzxy_by_tile_id = {}
         for tile_id in tile_ids:
-            available_tiles[tile_id] = self.isTileAvailable(tile_id)
+            lzxy_by_tile_id[tile_id] = self._tileId2lzxy(tile_id)
+        # check all the tiles in a single round-trip to tile storage
+        stored_tiles = self.modules.mapTiles.tilesInStorage(list(lzxy_by_tile_id.values()))
+        for tile_id, lzxy in lzxy_by_tile_id.items():
+            if lzxy in stored_tiles:
+                available_tiles[tile_id] = True
+            else:
+                self._addTileDownloadRequest(lzxy, tile_id)
+                available_tiles[tile_id] = False
         return available_tiles
 
     def isTileAvailable(self, tileId):
@@ -761,7 +774,9 @@ class TileImageProvider(ImageProvider):
                 return self._tileNotFoundImage, (1,1), pyotherside.format_argb32
                 #log.debug("%s NOT FOUND" % imageId)
             #log.debug("RETURNING STUFF %d %s" % (imageSize[0], imageId))
-            return bytearray(tileData), imageSize, pyotherside.format_data
+            # pyotherside needs a bytearray, tiles from the in-memory tile
+            # cache already are one, so they are not copied on every redraw
+            return asBuffer(tileData), imageSize, pyotherside.format_data
         except Exception:
             log.error("tile image provider: loading tile failed")
             log.error(imageId)
@@ -771,6 +786,29 @@ class TileImageProvider(ImageProvider):
 class MapTiles(object):
     def __init__(self, gui):
         self.gui = gui
+        self.gui.firstTimeSignal.connect(self._firstTimeCB)
+
+    def _firstTimeCB(self):
+        # forward tile migration progress to the QML context
+        self.gui.modules.storeTiles.tile_migration_progress.connect(self._tileMigrationProgressCB)
+        self.gui.modules.storeTiles.tile_migration_finished.connect(self._tileMigrationFinishedCB)
+
+    def _tileMigrationProgressCB(self, layer, migratedCount, totalCount):
+        pyotherside.send("tileMigrationProgress", {
+            "layerId" : layer.id,
+            "migrated" : migratedCount,
+            "total" : totalCount
+        })
+
+    def _tileMigrationFinishedCB(self, layer, finished):
+        pyotherside.send("tileMigrationFinished", {
+            "layerId" : layer.id,
+            "finished" : finished
+        })
+
+    def setViewport(self, mapName, layerIds, z, cornerX, cornerY, tilesX, tilesY):
+        """Report tiles visible in a map view, they are preloaded on next start"""
+        self.gui.modules.mapTiles.setViewport(mapName, layerIds, z, cornerX, cornerY, tilesX, tilesY)
 
     @property
     def tileserverPort(self):
@@ -799,6 +837,63 @@ class MapTiles(object):
             #      log.debug("downloading, try later")
             return False
 
+    def getTileStats(self, layerId):
+        """Get per zoom level statistics of tiles stored for a layer
+
+        :param str layerId: id of the layer
+        :returns: dictionary with count, bytes, oldest & newest keys for each zoom level,
+                  keyed by zoom level (empty if the stores of the layer can't provide statistics)
+        :rtype: dict
+        """
+        layer = self.gui.modules.mapLayers.getLayerById(layerId)
+        if layer is None:
+            return {}
+        stats = self.gui.modules.storeTiles.get_tile_stats(layer)
+        if stats is None:
+            return {}
+        return stats.as_dict()
+
+    def migrateTiles(self, layerId):
+        """Move tiles of a layer to the store of the current tile storage type
+
+        Progress is reported with the tileMigrationProgress event.
+
+        :param str layerId: id of the layer
+        :returns: True if the migration has been started, else False
+        :rtype: bool
+        """
+        layer = self.gui.modules.mapLayers.getLayerById(layerId)
+        if layer is None:
+            return False
+        return self.gui.modules.storeTiles.migrate_tiles(layer) is not None
+
+    def migrateAllTiles(self):
+        """Move tiles of all layers to the store of the current tile storage type
+
+        Progress is reported with the tileMigrationProgress event and the
+        tileMigrationFinished event is sent once each of the migrations is done.
+
+        :returns: number of migrations started
+        :rtype: int
+        """
+        return self.gui.modules.storeTiles.migrate_all_tiles()
+
+    def stopAllTileMigrations(self):
+        """Stop all tile migrations, they are resumed on next start"""
+        self.gui.modules.storeTiles.stop_all_tile_migrations()
+
+    def stopTileMigration(self, layerId):
+        """Stop migration of tiles of a layer, it is resumed on next start"""
+        layer = self.gui.modules.mapLayers.getLayerById(layerId)
+        if layer is not None:
+            self.gui.modules.storeTiles.stop_tile_migration(layer)
+
+    def repackTiles(self, layerId):
+        """Move tiles of a layer to as few sqlite storage databases as possible"""
+        layer = self.gui.modules.mapLayers.getLayerById(layerId)
+        if layer is not None:
+            self.gui.modules.storeTiles.repack_tiles(layer)
+
 class _Search(object):
     _addressSignal = signal.Signal()
 
@@ -11,6 +11,50 @@ BasePage {
     qsTr("path lookup in progress"), function(v){mapFolderPath=v})
     property string freeSpace : rWin.dcall("modrana.gui.modules.mapData.getFreeSpaceString", [],
     qsTr("unknown"), function(v){freeSpace=v})
+    property string layerId : rWin.get("layer", "mapnik", function(v){
+        layerId = v
+        updateTileStats()
+    })
+    property string tileStats : qsTr("unknown")
+    // number of tile migrations (one per layer) still running
+    property int runningMigrations : 0
+    property bool migrationRunning : runningMigrations > 0
+    property real migrationProgress : 0
+    property string migrationStatus : ""
+
+    function updateTileStats() {
+        rWin.python.call("modrana.gui.mapTiles.getTileStats", [mapOptionsPage.layerId], function(stats){
+            var count = 0
+            var bytes = 0
+            for (var z in stats) {
+                count += stats[z].count
+                bytes += stats[z].bytes
+            }
+            mapOptionsPage.tileStats = qsTr("%1 tiles, %2 MiB").arg(count).arg((bytes / 1048576).toFixed(1))
+        })
+    }
+
+    Component.onCompleted : {
+        rWin.python.setHandler("tileMigrationProgress", function(progress){
+            if (progress.total) {
+                mapOptionsPage.migrationProgress = progress.migrated / progress.total
+                mapOptionsPage.migrationStatus = qsTr("%1: %2 of %3 tiles moved")
+                    .arg(progress.layerId).arg(progress.migrated).arg(progress.total)
+            } else {
+                mapOptionsPage.migrationStatus = qsTr("%1: %2 tiles moved")
+                    .arg(progress.layerId).arg(progress.migrated)
+            }
+        })
+        rWin.python.setHandler("tileMigrationFinished", function(result){
+            mapOptionsPage.runningMigrations = Math.max(0, mapOptionsPage.runningMigrations - 1)
+            if (!mapOptionsPage.migrationRunning) {
+                if (result.finished) {
+                    mapOptionsPage.migrationStatus = qsTr("all tiles moved")
+                }
+                mapOptionsPage.updateTileStats()
+            }
+        })
+    }
 
     content : ContentColumn {
         SectionHeader {
@@ -57,11 +101,65 @@ BasePage {
                     text : QT_TRANSLATE_NOOP("TileStorageComboBox", "Sqlite")
                     value : "sqlite"
                 }
+                ListElement {
+                    text : QT_TRANSLATE_NOOP("TileStorageComboBox", "MBTiles")
+                    value : "mbtiles"
+                }
                 }
             Component.onCompleted : {
                 key = "tileStorageType"
             }
         }
+        Label {
+            text : qsTr("Tiles stored for the current layer") + ": <b>" + mapOptionsPage.tileStats + "</b>"
+            wrapMode : Text.Wrap
+            width : parent.width
+        }
+        Button {
+            text : qsTr("Move stored tiles to the selected storage")
+            width : parent.width
+            enabled : !mapOptionsPage.migrationRunning
+            onClicked : {
+                rWin.python.call("modrana.gui.mapTiles.migrateAllTiles", [], function(migrationCount){
+                    if (migrationCount) {
+                        mapOptionsPage.migrationProgress = 0
+                        mapOptionsPage.runningMigrations = migrationCount
+                        mapOptionsPage.migrationStatus = qsTr("moving tiles")
+                    } else {
+                        rWin.notify(qsTr("No tiles need to be moved"))
+                    }
+                })
+            }
+        }
+        ProgressBar {
+            width : parent.width
+            value : mapOptionsPage.migrationProgress
+            visible : mapOptionsPage.migrationRunning
+        }
+        Label {
+            text : mapOptionsPage.migrationStatus
+            visible : mapOptionsPage.migrationStatus != ""
+            wrapMode : Text.Wrap
+            width : parent.width
+        }
+        Button {
+            text : qsTr("Stop moving tiles")
+            width : parent.width
+            visible : mapOptionsPage.migrationRunning
+            onClicked : {
+                rWin.python.call("modrana.gui.mapTiles.stopAllTileMigrations", [], function(){
+                    mapOptionsPage.migrationStatus = qsTr("stopped, moving tiles will continue on next start")
+                })
+            }
+        }
+        Button {
+            text : qsTr("Repack tile databases of the current layer")
+            width : parent.width
+            enabled : !mapOptionsPage.migrationRunning
+            onClicked : {
+                rWin.python.call("modrana.gui.mapTiles.repackTiles", [mapOptionsPage.layerId], function(){})
+            }
+        }
         Label {
             text : qsTr("Map folder path:") + newline + mapOptionsPage.mapFolderPath
             property string newline : rWin.inPortrait ? "<br>" : " "
@@ -307,6 +307,8 @@ Rectangle {
             anotherTilesModelUpdateNeeded = true
         } else {
             tilesModelUpdateRunning = true
+            // tell Python what tiles are visible, so they can be preloaded on next start
+            reportViewport()
             // turn off the tile requests timer until the tiles model update is done
             tileRequestTimer.stop()
             tileRequestTimerPause = true
@@ -336,6 +338,20 @@ Rectangle {
         }
     }
 
+    function reportViewport() {
+        if (!pinchmap.layersReady) {
+            return
+        }
+        var layerIds = []
+        for (var i=0; i<layers.count; i++) {
+            layerIds.push(layers.get(i).layerId)
+        }
+        rWin.python.call("modrana.gui.mapTiles.setViewport",
+                         [pinchmap.name, layerIds, pinchmap.zoomLevel,
+                          pinchmap.cornerTileX, pinchmap.cornerTileY,
+                          pinchmap.numTilesX, pinchmap.numTilesY], function(){})
+    }
+
     function tilesAvailabilityCB(tileAvailabilityDict) {
         for (var tileId in tileAvailabilityDict) {
             var tileAvailable = tileAvailabilityDict[tileId]
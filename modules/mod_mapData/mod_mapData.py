@@ -31,6 +31,7 @@ from core.tilenames import *
 import threading
 from .pools import BatchSizeCheckPool
 from .pools import BatchTileDownloadPool
+from .pools import AsyncBatchTileDownloadPool
 
 # socket timeout
 import socket
@@ -74,6 +75,12 @@ class MapData(RanaModule):
         self.midZ = 15
         self.maxZ = MAX_ZOOMLEVEL
 
+    def firstTime(self):
+        engine = self.get("tileDownloadEngine", constants.DEFAULT_TILE_DOWNLOAD_ENGINE)
+        if engine == constants.TILE_DOWNLOAD_ENGINE_ASYNCIO:
+            self.log.debug("using the asyncio batch tile download engine")
+            self._downloadPool = AsyncBatchTileDownloadPool()
+
     def addDownloadRequests(self, requests):
         """Add download requests to the download request set
 
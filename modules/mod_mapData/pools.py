@@ -2,6 +2,7 @@
 # Tile checking & batch download pools
 from __future__ import with_statement
 
+import asyncio
 import threading
 import time
 from core import constants
@@ -10,6 +11,8 @@ from core import tiles
 from core.signal import Signal
 from core import utils
 from core.pool import ThreadPool
+from core.async_pool import AsyncTaskPool, getDownloadLoop
+from core import async_http
 from core.singleton import modrana
 
 import logging
@@ -17,6 +20,8 @@ log = logging.getLogger("mod.mapData.pools")
 
 MAX_RETRIES = 3
 RETRY_WAIT = 0.1  # 100 ms
+# how many tiles to check for local availability with a single tile storage request
+BULK_CHECK_SIZE = 256
 
 DEFAULT_THREAD_POOL_NAME = "modRanaBatchPool"
 _threadPoolIndex = 1
@@ -33,19 +38,6 @@ returned by the server)\nURL:%s" % self.url
 
         return message
 
-def getAnUrl(batch, layer):
-    """Get a random url from the set so we can init the pool"""
-    if batch:
-        tile = None
-        for t in batch:
-            tile = t
-            break
-        (x, y, z) = (tile[0], tile[1], tile[2])
-        url = tiles.getTileUrl((layer, z, x, y))
-    else:
-        url = ""
-    return url
-
 def _getBatchPoolName():
     global _threadPoolIndex
     name = "%s%d" % (DEFAULT_THREAD_POOL_NAME, _threadPoolIndex)
@@ -76,8 +68,7 @@ class BatchPool(object):
                 self._running = True
                 self._batch = batch
 
-                self._pool = ThreadPool(name=self.name,
-                                        maxThreads=self._maxThreads())
+                self._pool = self._createPool()
 
                 # start the loading thread
                 t = threads.ModRanaThread(name=self.name+"Loader", target=self._loadItems)
@@ -148,6 +139,9 @@ class BatchPool(object):
         self._pool = None
 
     # subclassing interface
+    def _createPool(self):
+        return ThreadPool(name=self.name, maxThreads=self._maxThreads())
+
     def _processBatch(self):
         pass
 
@@ -214,7 +208,8 @@ class TileBatchPool(BatchPool):
         if self.layer is None:
             log.error("tile batch pool: layer is None, aborting")
             return
-        self._connPool = utils.create_connection_pool(getAnUrl(self._batch, self._layer))
+        # tiles of the layer might be spread over a couple of hosts
+        self._connPool = utils.create_pool_manager(self._maxThreads())
 
 class BatchSizeCheckPool(TileBatchPool):
     def __init__(self):
@@ -251,9 +246,39 @@ class BatchSizeCheckPool(TileBatchPool):
         # again, so we need to reset the size estimate
         super(BatchSizeCheckPool, self)._processBatch()
         self._downloadSize = 0
+        chunk = []
         for item in self._batch:
             if self._shutdown:
                 break
+            chunk.append(item)
+            if len(chunk) >= BULK_CHECK_SIZE:
+                self._processChunk(chunk)
+                chunk = []
+        if chunk and not self._shutdown:
+            self._processChunk(chunk)
+
+    def _processChunk(self, chunk):
+        """Check which tiles from the chunk are locally available in a single
+        tile storage request and submit the rest for size checking
+
+        :param list chunk: list of batch items
+        """
+        itemsByLzxy = {}
+        for item in chunk:
+            x, y, z = item
+            itemsByLzxy[(self._layer, z, x, y)] = item
+        try:
+            storedTiles = self._storeTiles.tiles_are_stored(list(itemsByLzxy.keys()))
+        except Exception:
+            log.exception("bulk local tile availability check failed")
+            storedTiles = set()
+        for lzxy, item in itemsByLzxy.items():
+            if lzxy in storedTiles:
+                # remove locally available tiles from request set
+                self._mapData.removeTileDownloadRequest(item)
+                with self._mutex:
+                    self._foundLocally+=1
+                    self._doneCount+=1
             else:
                 self._pool.submit(self._handleItemWrapper, item)
 
@@ -264,32 +289,22 @@ class BatchSizeCheckPool(TileBatchPool):
         if size:
             with self._mutex:
                 self._downloadSize+=size
-        elif size is None:
-            # remove locally available tiles from request set
-            self._mapData.removeTileDownloadRequest(item)
-            with self._mutex:
-                self._foundLocally+=1
 
     def _checkTileSize(self, lzxy):
-        """Get a size of a tile from HTTP header,
-        if the tile is locally available remove it form the
-        download request set
+        """Get a size of a tile from HTTP header
 
-        :returns: size in bytes, None if tile is available and
-                  0 if the header check raised an exception
-        :rtype: int or None
+        NOTE: local tile availability has already been checked in bulk by _processChunk()
+
+        :returns: size in bytes or 0 if the header check raised an exception
+        :rtype: int
         """
         size = 0
         url = "unknown url"
         try:
             url = tiles.getTileUrl(lzxy)
-            # does the tile exist ?
-            if self._storeTiles.tile_is_stored(lzxy): # if the file does not exist
-                size = None # it exists, return None
-            else:
-                # the tile does not exist, get its HTTP header
-                request = self._connPool.urlopen('HEAD', url)
-                size = int(request.getheaders()['content-length'])
+            # the tile is not stored locally, get its HTTP header
+            request = self._connPool.urlopen('HEAD', url)
+            size = int(request.getheaders()['content-length'])
         except IOError:
             log.error("Could not open document: %s", url)
             # the url errored out, so we just say it  has zero size
@@ -363,20 +378,37 @@ class BatchTileDownloadPool(TileBatchPool):
                 size = self._saveTileForURL(lzxy)
             except Exception:
                 log.exception("exception in batch download thread:")
-            if size != False:  # download successful
+            if size is not False:  # download successful
                 with self._mutex:
                     self._downloadedDataSize+=size
                 break
             # wait a bit before retry
             time.sleep(RETRY_WAIT)
-        if size == False:
+        if size is False:
             with self._mutex:
                 self._failedCount+=1
 
     def _saveTileForURL(self, lzxy):
         """save a tile for url created from its coordinates"""
         url = tiles.getTileUrl(lzxy)
+        goAhead, validators = self._checkTile(lzxy)
+        if goAhead: # if the file does not exist
+            if validators:
+                headers = tiles.getConditionalHeaders(validators, self._connPool.headers)
+                request = self._connPool.request('get', url, headers=headers)
+            else:
+                request = self._connPool.request('get', url)
+            return self._storeResponse(lzxy, url, request)
+        else:
+            return False # nothing was downloaded
+
+    def _checkTile(self, lzxy):
+        """Check if a tile should be downloaded
 
+        :returns: (download, validators) tuple, validators are the HTTP cache
+                  validators of the stored tile when updating stored tiles
+        :rtype: tuple
+        """
         goAhead = False
         redownload = int(modrana.get('batchRedownloadAvailableTiles', False))
         # TODO: use constants for the ENUM
@@ -389,27 +421,42 @@ class BatchTileDownloadPool(TileBatchPool):
         elif redownload == 2: # update
             # only download tiles in the area that already exist
             goAhead = self._storeTiles.tile_is_stored(lzxy)
-        if goAhead: # if the file does not exist
-            request = self._connPool.request('get', url)
-            size = int(request.getheaders()['content-length'])
-            content = request.data
-            # The tileserver sometimes returns a HTML error page
-            # instead of the tile, which is then saved instead of the tile an
-            # users are then confused why tiles they have downloaded don't show up.
-
-            # To raise a proper error on this behaviour, we check the tiles magic number
-            # and if is not an image we raise the TileNotImageException.
-
-            # TODO: does someone supply non-bitmap/SVG tiles ?
-            if utils.is_the_string_an_image(content):
-                #its an image, save it
-                self._storeTiles.store_tile_data(lzxy, content)
-            else:
-                # its not ana image, raise exception
-                raise TileNotImageException(url)
-            return size # something was actually downloaded and saved
+        validators = None
+        if goAhead and redownload:
+            # when updating stored tiles, only download the tiles that have changed
+            validators = self._storeTiles.get_tile_validators(lzxy)
+        return goAhead, validators
+
+    def _storeResponse(self, lzxy, url, request):
+        """Store a downloaded tile
+
+        :param request: urllib3 or core.async_http response
+        :returns: downloaded data size
+        :rtype: int
+        """
+        etag, lastModified = tiles.getResponseValidators(request)
+        if request.status == 304:
+            # the stored tile is still current, nothing was downloaded
+            self._storeTiles.touch_tile(lzxy, etag=etag, last_modified=lastModified)
+            return 0
+        content = request.data
+        # chunked responses have no content length
+        size = int(request.getheaders().get('content-length', len(content)))
+        # The tileserver sometimes returns a HTML error page
+        # instead of the tile, which is then saved instead of the tile an
+        # users are then confused why tiles they have downloaded don't show up.
+
+        # To raise a proper error on this behaviour, we check the tiles magic number
+        # and if is not an image we raise the TileNotImageException.
+
+        # TODO: does someone supply non-bitmap/SVG tiles ?
+        if utils.is_the_string_an_image(content):
+            #its an image, save it
+            self._storeTiles.store_tile_data(lzxy, content, etag=etag, last_modified=lastModified)
         else:
-            return False # nothing was downloaded
+            # its not ana image, raise exception
+            raise TileNotImageException(url)
+        return size # something was actually downloaded and saved
 
     def _cleanup(self):
         super(BatchTileDownloadPool, self)._cleanup()
@@ -418,3 +465,83 @@ class BatchTileDownloadPool(TileBatchPool):
         # tell the mapData module a batch tile
         # download was in progress and just ended
         self._mapData._batchDone = True
+
+
+class AsyncBatchTileDownloadPool(BatchTileDownloadPool):
+    """Batch tile download pool running the downloads as coroutines on an asyncio event loop
+
+    Only the batch loader uses a thread of its own, all the downloads
+    run in the download event loop thread.
+    """
+
+    def __init__(self):
+        BatchTileDownloadPool.__init__(self)
+        self._loopThread = getDownloadLoop()
+        self._client = None
+
+    def _maxThreads(self):
+        return int(modrana.get('maxAsyncBatchDownloads', constants.DEFAULT_ASYNC_BATCH_DOWNLOAD_TASK_COUNT))
+
+    def _createPool(self):
+        return AsyncTaskPool(self._loopThread, self._maxThreads(), name=self.name)
+
+    def _processBatch(self):
+        if self.layer is None:
+            log.error("tile batch pool: layer is None, aborting")
+            return
+        self._client = async_http.HTTPClient(
+            headers={'User-Agent': modrana.configs.user_agent},
+            maxConnectionsPerHost=int(modrana.get("asyncDownloadConnectionsPerHost",
+                                                  constants.DEFAULT_ASYNC_DOWNLOAD_CONNECTIONS_PER_HOST))
+        )
+        self._initialBatchSize = len(self._batch)
+        while not self._shutdown:
+            try:
+                item = self._batch.pop()
+            except (KeyError, IndexError):
+                break
+            # blocks once there are enough downloads waiting
+            self._pool.submit(self._handleItemWrapper, item)
+
+    async def _handleItemWrapper(self, item):
+        await self._handleItem(item)
+        # one item processed
+        with self._mutex:
+            self._doneCount+=1
+
+    async def _handleItem(self, item):
+        x, y, z = item
+        lzxy = (self._layer, z, x, y)
+        size = False
+        # 1. attempt + 3 retries
+        for i in range(0, MAX_RETRIES+1):
+            try:
+                size = await self._saveTileForURL(lzxy)
+            except Exception:
+                log.exception("exception in batch download task:")
+            if size is not False:  # download successful
+                with self._mutex:
+                    self._downloadedDataSize+=size
+                break
+            # wait a bit before retry
+            await asyncio.sleep(RETRY_WAIT)
+        if size is False:
+            with self._mutex:
+                self._failedCount+=1
+
+    async def _saveTileForURL(self, lzxy):
+        """save a tile for url created from its coordinates"""
+        url = tiles.getTileUrl(lzxy)
+        # tile storage access blocks, so it is done in a thread
+        goAhead, validators = await self._loopThread.run_blocking(self._checkTile, lzxy)
+        if goAhead:
+            response = await self._client.request('GET', url, headers=tiles.getConditionalHeaders(validators))
+            return await self._loopThread.run_blocking(self._storeResponse, lzxy, url, response)
+        else:
+            return False # nothing was downloaded
+
+    def _cleanup(self):
+        super(AsyncBatchTileDownloadPool, self)._cleanup()
+        if self._client is not None:
+            self._loopThread.submit(self._client.close())
+            self._client = None
@@ -21,6 +21,7 @@ from __future__ import with_statement # for python 2.5
 from modules.base_module import RanaModule
 import threading
 import os
+import json
 import time
 import sys
 import traceback
@@ -28,6 +29,7 @@ import traceback
 
 from urllib.request import urlopen
 from urllib.error import HTTPError, URLError
+from urllib.parse import urlsplit
 import urllib3
 
 from core import utils
@@ -38,8 +40,13 @@ from core.tilenames import *
 from core.backports import six
 from core.signal import Signal
 from core import threads
+from core.tile_cache import TileCache, FilteredTileCache, dataSize, asBuffer
+from core import tile_filters
+from core.pool import LifoThreadPool
+from core.memory import CacheSizeController, scale_limit
+from core.tile_scheduler import Viewport
 
-from .tile_downloader import Downloader
+from .tile_downloader import Downloader, AsyncDownloader
 
 StringIO = six.moves.cStringIO
 
@@ -50,9 +57,6 @@ StringIO = six.moves.cStringIO
 import logging
 log = logging.getLogger("mod.mapTiles")
 
-# if image manipulation tools are available, import them
-# and otherwise disable tile image manipulation
-IMAGE_MANIPULATION_IMPORT_SUCCESS = False
 NORMAL_TILE = "normal"
 LOADING_TILE = "loadingTile"
 COMPOSITE_TILE = "composite"
@@ -76,19 +80,21 @@ class MapTiles(RanaModule):
 
     def __init__(self, *args, **kwargs):
         RanaModule.__init__(self, *args, **kwargs)
-        self.images = [{}, {}] # the first dict contains normal image data, the second contains special tiles
-        self.imagesLock = threading.RLock()
         # we need to limit the size of the tile cache to avoid a memory leak
         memoryTileCacheSize = int(self.get("memoryTileCacheSize", constants.DEFAULT_MEMORY_TILE_CACHE_SIZE))
-        self.log.info("in memory tile cache size: %d", memoryTileCacheSize)
-        self.maxImagesInMemory = memoryTileCacheSize
-        self.imagesTrimmingAmount = constants.DEFAULT_MEMORY_TILE_CACHE_TRIM_SIZE
-        # how many tiles to remove once the maximum is reached
-        # so that trim does not run always run after adding a tile
-        # TODO: analyse memory usage,
-        #       set appropriate value,
-        #       platform dependent value,
-        #       user configurable
+        memoryTileCacheBytes = int(self.get("memoryTileCacheBytes", constants.DEFAULT_MEMORY_TILE_CACHE_BYTES))
+        self.log.info("in memory tile cache size: %d tiles, %d bytes", memoryTileCacheSize, memoryTileCacheBytes)
+        # items of the tile cache are (tile data, metadata) tuples
+        self._tileCache = TileCache(memoryTileCacheSize, memoryTileCacheBytes,
+                                    sizeFunction=lambda item: dataSize(item[0]))
+        # configured cache limits, scaled according to memory pressure
+        self._tileCacheLimits = memoryTileCacheSize, memoryTileCacheBytes
+        self._cacheSizeController = None
+        self._memoryPressureTimerId = None
+        # the first item is the LRU cache of normal image data,
+        # the second a dict of special tiles that exist only once in memory
+        self.images = [self._tileCache, {}]
+        self.imagesLock = threading.RLock()
         self.tileSide = 256 # by default, the tiles are squares, side=256
         self.scalingInfo = (1, 15, 256)
         self.downloadRequestTimeout = 30 # in seconds
@@ -114,10 +120,27 @@ class MapTiles(RanaModule):
 
         self.cacheImageSurfaces = False  # only GTK GUI used this
 
-        self._filterTile = self._nop
+        # the filter applied to tiles (such as the night theme filter), None if tiles are not filtered
+        self._tileFilter = None
+        # filtered tiles are kept in a separate cache keyed by (lzxy, filter id),
+        # so that tiles don't need to be filtered again when the filter is switched
+        # off and on again
+        filteredCacheSize = int(self.get("filteredTileCacheSize", constants.DEFAULT_FILTERED_TILE_CACHE_SIZE))
+        filteredCacheBytes = int(self.get("filteredTileCacheBytes", constants.DEFAULT_FILTERED_TILE_CACHE_BYTES))
+        self._filteredTileCache = FilteredTileCache(filteredCacheSize, filteredCacheBytes)
+        self._filteredTileCacheLimits = filteredCacheSize, filteredCacheBytes
+        # tiles are filtered in a thread pool, off the GUI path
+        self._filterPool = None
+        # (lzxy, filter id, tag) tuples of filtering requests queued or in progress
+        self._filteringRequests = set()
+        self._filteringRequestsLock = threading.Lock()
 
         self._tileDownloaded = Signal()
 
+        # viewports of the map views keyed by map name, saved on
+        # shutdown so that the tiles can be preloaded on next start
+        self._viewports = {}
+
         self._dlRequestQueue = six.moves.queue.Queue()
         self._downloader = None
 
@@ -135,6 +158,11 @@ class MapTiles(RanaModule):
         self._mapLayersModule = self.m.get('mapLayers', None) # get the map layers module
 
         # map tile filtering
+        filterThreads = int(self.get("tileFilteringThreads", constants.DEFAULT_THREAD_COUNT_TILE_FILTERING))
+        self._filterPool = LifoThreadPool(filterThreads,
+                                          name=constants.THREAD_POOL_TILE_FILTERING,
+                                          taskBufferSize=constants.DEFAULT_TILE_FILTERING_QUEUE_SIZE,
+                                          leak=True)
         self.modrana.watch('currentTheme', self._updateTileFilteringCB, runNow=True)
         self.modrana.watch('invertMapTiles', self._updateTileFilteringCB, runNow=True)
         # check if tile filtering is enabled or should be enabled with current theme
@@ -144,22 +172,195 @@ class MapTiles(RanaModule):
         taskQueueSize = int(self.get("autoDownloadQueueSize",
                                      constants.DEFAULT_AUTOMATIC_TILE_DOWNLOAD_QUEUE_SIZE))
         self.log.debug("automatic tile download queue size: %d", taskQueueSize)
-        self._downloader = Downloader(maxThreads,
-                                      taskBufferSize=taskQueueSize)
+        viewportMargin = int(self.get("tileDownloadViewportMargin",
+                                      constants.DEFAULT_TILE_DOWNLOAD_VIEWPORT_MARGIN))
+        engine = self.get("tileDownloadEngine", constants.DEFAULT_TILE_DOWNLOAD_ENGINE)
+        if engine == constants.TILE_DOWNLOAD_ENGINE_ASYNCIO:
+            maxTasks = int(self.get("maxAsyncTileDownloads",
+                                    constants.DEFAULT_ASYNC_TILE_DOWNLOAD_TASK_COUNT))
+            self.log.debug("using the asyncio tile download engine (%d downloads at once)", maxTasks)
+            self._downloader = AsyncDownloader(maxTasks,
+                                               taskBufferSize=taskQueueSize,
+                                               viewportMargin=viewportMargin)
+        else:
+            self._downloader = Downloader(maxThreads,
+                                          taskBufferSize=taskQueueSize,
+                                          viewportMargin=viewportMargin)
+        # refresh timed-out tiles of stale-while-revalidate layers in the background
+        self._storeTiles.stale_tile_loaded.connect(self._staleTileLoadedCB)
+        if self.get("adaptiveTileCacheSize", constants.DEFAULT_ADAPTIVE_TILE_CACHE_SIZE):
+            self._startMemoryPressureMonitoring()
+        if self.get("tilePreload", constants.DEFAULT_TILE_PRELOAD):
+            # load tiles visible at last shutdown to the tile cache before the GUI asks for them
+            t = threads.ModRanaThread(name=constants.THREAD_TILE_PRELOAD,
+                                      target=self._preloadTiles)
+            threads.threadMgr.add(t)
         self._startTileLoadingManager()
 
+    def setViewport(self, mapName, layerIds, z, cornerX, cornerY, tilesX, tilesY):
+        """Record which tiles are currently visible in a map view
+
+        The visible tiles of all map views are saved on shutdown
+        and preloaded to the in-memory tile cache on next start.
+        Waiting tile downloads are re-ranked by distance from the map views
+        and downloads of tiles no longer in view are cancelled.
+
+        :param str mapName: name of the map view
+        :param list layerIds: ids of layers shown in the map view
+        :param int z: zoom level
+        :param int cornerX: x coordinate of the top left tile
+        :param int cornerY: y coordinate of the top left tile
+        :param int tilesX: number of tiles in the x direction
+        :param int tilesY: number of tiles in the y direction
+        """
+        self._viewports[mapName] = (list(layerIds), int(z), int(cornerX), int(cornerY), int(tilesX), int(tilesY))
+        if self._downloader:
+            self._downloader.setViewports([Viewport(*viewport) for viewport in self._viewports.values()])
+
+    def getTileDownloadStats(self):
+        """Get automatic tile download statistics
+
+        :returns: number of download requests waiting (queued), added, dropped
+                  when the queue was full, cancelled once out of view, completed
+                  & completed once the tile was no longer in view (wasted),
+                  None if the downloader is not yet running
+        :rtype: dict or None
+        """
+        if self._downloader:
+            return self._downloader.stats
+        else:
+            return None
+
+    def _getPreloadFilePath(self):
+        return os.path.join(self.modrana.paths.cache_folder_path, constants.TILE_PRELOAD_FILE_NAME)
+
+    def _saveVisibleTiles(self):
+        """Save tiles visible in the map views (with a margin) for preloading on next start"""
+        visibleTiles = []
+        for layerIds, z, cornerX, cornerY, tilesX, tilesY in self._viewports.values():
+            zxyList = tiles.getViewportTiles(z, cornerX, cornerY, tilesX, tilesY,
+                                             margin=constants.TILE_PRELOAD_MARGIN)
+            for layerId in layerIds:
+                visibleTiles.extend([layerId, z, x, y] for z, x, y in zxyList)
+        if not visibleTiles:
+            return
+        try:
+            path = self._getPreloadFilePath()
+            temporaryPath = path + ".part"
+            with open(temporaryPath, "w") as f:
+                json.dump({"tiles": visibleTiles}, f)
+            os.rename(temporaryPath, path)
+            self.log.debug("%d visible tiles saved for preloading", len(visibleTiles))
+        except Exception:
+            self.log.exception("saving visible tiles for preloading failed")
+
+    def _preloadTiles(self):
+        """Load tiles saved by _saveVisibleTiles() to the in-memory tile cache
+
+        Runs in a background thread on startup and reads all the tiles with a single
+        bulk store read, so the first map frame finds them in memory.
+        """
+        start = time.time()
+        path = self._getPreloadFilePath()
+        if not os.path.isfile(path):
+            return
+        try:
+            with open(path, "r") as f:
+                savedTiles = json.load(f)["tiles"]
+            lzxyList = []
+            for layerId, z, x, y in savedTiles:
+                layer = self._mapLayersModule.getLayerById(layerId)
+                if layer is not None:
+                    lzxyList.append((layer, z, x, y))
+            lzxyList = [lzxy for lzxy in lzxyList if lzxy not in self._tileCache]
+            foundTiles = self._storeTiles.get_tiles_data(lzxyList)
+            for lzxy, tileData in foundTiles.items():
+                # don't replace tiles the GUI already loaded in the meantime
+                if lzxy not in self._tileCache:
+                    self.storeInMemory(tileData, lzxy)
+            self.log.info("%d of %d visible tiles preloaded in %1.2f ms",
+                          len(foundTiles), len(lzxyList), (time.time() - start) * 1000)
+        except Exception:
+            self.log.exception("preloading visible tiles failed")
+
+    def _startMemoryPressureMonitoring(self):
+        """Periodically adapt tile cache budgets to memory pressure"""
+        if self.dmod.memory_status is None:
+            self.log.info("memory status not available, tile cache size will not be adapted")
+            return
+        cron = self.m.get('cron', None)
+        if cron:
+            minScale, maxScale = self.dmod.memory_cache_scale_range
+            self._cacheSizeController = CacheSizeController(min_scale=minScale, max_scale=maxScale)
+            self._memoryPressureTimerId = cron.addTimeout(self._checkMemoryPressureCB,
+                                                          constants.MEMORY_PRESSURE_CHECK_INTERVAL * 1000,
+                                                          self, "adapt tile cache size to memory pressure")
+
+    def _checkMemoryPressureCB(self):
+        status = self.dmod.memory_status
+        if status is None:
+            return True
+        scale = self._cacheSizeController.update(status)
+        if scale is not None:
+            self._resizeTileCaches(scale, status)
+        return True
+
+    def _resizeTileCaches(self, scale, status):
+        """Scale the configured tile cache budgets
+
+        :param float scale: scale to apply to the configured budgets
+        :param status: memory status that triggered the resize
+        """
+        for cache, (maxItems, maxBytes) in ((self._tileCache, self._tileCacheLimits),
+                                            (self._filteredTileCache, self._filteredTileCacheLimits)):
+            # limits <= 0 mean no limit, so only positive ones are scaled
+            cache.setLimits(maxItems=scale_limit(maxItems, scale), maxBytes=scale_limit(maxBytes, scale))
+        self.log.info("tile cache resized to %d%% (%d tiles, %d bytes), %d of %d bytes available, "
+                      "RSS: %s bytes", scale * 100, self._tileCache.maxItems, self._tileCache.maxBytes,
+                      status.available, status.total, status.rss)
+
+    def _staleTileLoadedCB(self, lzxy):
+        """A timed-out tile has been loaded from storage, download a fresh one"""
+        if self.get('network', 'full') == 'full':
+            self._downloader.refreshTile(lzxy)
+
     def getTile(self, lzxy, asynchronous=False, tag=None, download=True):
         """Return a tile specified by layerID, z, x & y
         * first look if such a tile is available from cache
           or persistent storage
         * if not, download it
+        * if tile filtering is enabled, return the filtered tile
+
+        NOTE: tile data cached in memory is returned without copying it,
+              so it must not be modified
+
+        When asynchronous, a tile that is available but has not yet been
+        filtered is filtered in the background and None is returned - the
+        tileDownloaded signal is triggered once the filtered tile is ready.
 
         :param tuple lzxy: tile description tuple
         :returns: tile data or None
         :rtype: data or None
         """
+        tileFilter = self._tileFilter
+        if tileFilter is None:
+            return self._getRawTile(lzxy, asynchronous, tag, download)
+        filteredTileData = self._filteredTileCache.get((lzxy, tileFilter.filterId))
+        if filteredTileData is not None:
+            return filteredTileData
+        tileData = self._getRawTile(lzxy, asynchronous, tag, download)
+        if tileData is None:
+            return None
+        if asynchronous:
+            self._addTileFilteringRequest(lzxy, tag, tileData, tileFilter)
+            return None
+        else:
+            return self._filterTileData(lzxy, tileData, tileFilter)
+
+    def _getRawTile(self, lzxy, asynchronous, tag, download):
+        """Return unfiltered tile data from cache, storage or network (see getTile())"""
         # check if the tile is in the recently-downloaded cache
-        cacheItem = self.images[0].get(lzxy, None)
+        cacheItem = self._tileCache.get(lzxy)
         if cacheItem:
         #      self.log.debug("got tile FROM memory CACHE")
             return cacheItem[0]
@@ -167,7 +368,12 @@ class MapTiles(RanaModule):
         tileData = self._storeTiles.get_tile_data(lzxy)
         if tileData:
             #self.log.debug("got tile FROM disk CACHE")
-            # tile was available from storage
+            # tile was available from storage, cache it in memory
+            # so that it does not need to be loaded & copied again
+            # when requested the next time
+            if not self.cacheImageSurfaces:
+                tileData = asBuffer(tileData)
+                self.storeInMemory(tileData, lzxy)
             return tileData
         if download:
             if asynchronous:
@@ -191,17 +397,53 @@ class MapTiles(RanaModule):
         :rtype: data or None
         """
 
-        tileUrl = tiles.getTileUrl(lzxy)
+        layer, z, x, y = lzxy
+        # spread the downloads over the hosts of the layer
+        shards = layer.url_template.shards
+        subdomain = shards.select(z, x, y)
+        tileUrl = layer.url_template.getUrl(z, x, y, subdomain)
         # self.log.debug("GET TILE")
         # self.log.debug(tileUrl)
-        response = self._getConnPool(lzxy[0], tileUrl).request('GET', tileUrl)
+        pool = self._getConnPool(layer, tileUrl)
+        # if we have the tile stored (it has timed out), only download it if it has changed
+        validators = self._storeTiles.get_tile_validators(lzxy)
+        try:
+            if validators:
+                headers = tiles.getConditionalHeaders(validators, pool.headers)
+                response = pool.request('GET', tileUrl, headers=headers)
+            else:
+                response = pool.request('GET', tileUrl)
+        except Exception:
+            shards.reportFailure(subdomain)
+            raise
+        shards.reportStatus(subdomain, response.status)
         # self.log.debug("RESPONSE")
         # self.log.debug(response)
+        return self._handleTileResponse(lzxy, tileUrl, response)
+
+    def _handleTileResponse(self, lzxy, tileUrl, response):
+        """Store a downloaded tile
+
+        Used by both the threaded & the asyncio tile download engine.
+
+        :param tuple lzxy: tile description tuple
+        :param str tileUrl: URL the tile has been downloaded from
+        :param response: urllib3 or core.async_http response
+        :returns: tile data or None
+        :rtype: data or None
+        """
+        etag, lastModified = tiles.getResponseValidators(response)
+        if response.status == 304:
+            # not modified, just mark the stored tile as fresh
+            if self._storeTiles.touch_tile(lzxy, etag=etag, last_modified=lastModified):
+                return self._storeTiles.get_tile_data(lzxy)
+            else:
+                return None
         tileData = response.data
         if tileData:
             # check if the data is actually an image, and not an error page
             if utils.is_the_string_an_image(tileData):
-                self._storeTiles.store_tile_data(lzxy, tileData)
+                self._storeTiles.store_tile_data(lzxy, tileData, etag=etag, last_modified=lastModified)
                 #        self.log.debug("STORED")
                 return tileData
             else:
@@ -215,40 +457,52 @@ class MapTiles(RanaModule):
         else:
             return None
 
+    def _getDownloadTimeout(self, layer):
+        """Get tile download timeout for the given layer
+
+        :param layer: the layer
+        :returns: timeout in seconds or None for no timeout
+        """
+        connection_timeout = constants.TILE_DOWNLOAD_TIMEOUT
+        if layer.connection_timeout is not None:  # some value was set in the config
+            if layer.connection_timeout < 0:  # -1 == no timeout
+                connection_timeout = None  # None means no timeout for the connections
+            else:
+                connection_timeout = layer.connection_timeout
+        return connection_timeout
+
     def _getConnPool(self, layer, baseUrl):
-        """Get a connection pool for the given layer id
-        Each layer ID has it's own connection pool
-        (as each connection pool handles only one base URL)
+        """Get a connection pool for the given layer & host
+        Each layer has it's own connection pool for each of its hosts
+        (as each connection pool handles only one host)
         and non-existent pools are automatically created once requested
         NOTE: connection pools reuse open connections
 
-        :param str layerId: pool id (mapped to layer id)
+        :param layer: the layer
         :param str baseUrl: a URL used to initialize the connection pool
                            (basically just the domain name needs to be correct)
         """
-        pool = self.connPools.get(layer.id, None)
+        poolKey = (layer.id, urlsplit(baseUrl).netloc)
+        pool = self.connPools.get(poolKey, None)
         if pool:
             return pool
         else: # create pool
             #headers = { 'User-Agent' : "Mozilla/5.0 (compatible; MSIE 5.5; Linux)" }
             userAgent = self.modrana.configs.user_agent
             headers = {'User-Agent': userAgent}
-            connection_timeout = constants.TILE_DOWNLOAD_TIMEOUT
-            if layer.connection_timeout is not None:  # some value was set in the config
-                if layer.connection_timeout < 0:  # -1 == no timeout
-                    connection_timeout = None  # None means no timeout for Urllib 3 connection pools
-                else:
-                    connection_timeout = layer.connection_timeout
+            connection_timeout = self._getDownloadTimeout(layer)
             if connection_timeout is None:
                 self.log.debug("creating tile download pool for %s without a connection timeout", layer.id)
             else:
                 self.log.debug("creating tile download pool for %s with connection timeout %s s", layer.id, connection_timeout)
+            maxConnections = layer.max_connections_per_host or constants.DEFAULT_CONNECTIONS_PER_HOST
+            # the pool blocks once all connections are in use, limiting connections to the host
             newPool = urllib3.connection_from_url(url=baseUrl,
                                                   headers=headers,
-                                                  maxsize=10,
+                                                  maxsize=maxConnections,
                                                   timeout=connection_timeout,
-                                                  block=False)
-            self.connPools[layer.id] = newPool
+                                                  block=True)
+            self.connPools[poolKey] = newPool
             return newPool
 
     def addTileDownloadRequest(self, lzxy, tag=None):
@@ -272,7 +526,7 @@ class MapTiles(RanaModule):
         :returns: True if tile is cached, False otherwise
         :rtype: bool
         """
-        return lzxy in self.images[0]
+        return lzxy in self._tileCache
 
     def tileInStorage(self, lzxy):
         """Report if tile is available from local persistent storage
@@ -282,6 +536,18 @@ class MapTiles(RanaModule):
         """
         return self._storeTiles.tile_is_stored(lzxy)
 
+    def tilesInStorage(self, lzxyList):
+        """Report which of the given tiles are available from local persistent storage
+
+        The tiles are checked in bulk, which is much faster than calling
+        tileInStorage() for each of them.
+
+        :param list lzxyList: list of tile description tuples
+        :returns: set of tiles that are in storage
+        :rtype: set
+        """
+        return self._storeTiles.tiles_are_stored(lzxyList)
+
     def _updateScalingCB(self, key='mapScale', oldValue=1, newValue=1):
         """as this only needs to be updated once on startup and then only
         when scaling settings change this callback driven method is used"""
@@ -342,8 +608,7 @@ class MapTiles(RanaModule):
                             sprint("auto tile dl enabled - adding dl request for %s", lzxy)
                             # switch the status tile to "Waiting for download slot"
                             if self.cacheImageSurfaces:
-                                with self.imagesLock:
-                                    self.images[0][lzxy] = self.waitingTile
+                                self._tileCache.put(lzxy, self.waitingTile)
                             droppedRequest = self._downloader.downloadTile(lzxy, tag)
                             if droppedRequest:
                                 # this tile download request has been dropped from
@@ -376,12 +641,14 @@ class MapTiles(RanaModule):
 
         # remove an image from memory
         if self.cacheImageSurfaces:
-            # make sure no one fiddles with the cache while we are working with it
-            with self.imagesLock:
-                if name in self.images[dictIndex]:
-                    del self.images[dictIndex][name]
-                else:
-                    self.log.debug("can't remove unknown %s from memory tile cache", name)
+            if dictIndex == 0:
+                removed = self._tileCache.remove(name)
+            else:
+                # make sure no one fiddles with the cache while we are working with it
+                with self.imagesLock:
+                    removed = self.images[dictIndex].pop(name, None) is not None
+            if not removed:
+                self.log.debug("can't remove unknown %s from memory tile cache", name)
 
     def _fakeDebugLog(self, *argv):
         """Log function that does nothing"""
@@ -402,15 +669,22 @@ class MapTiles(RanaModule):
         metadata = {'addedTimestamp': time.time(), 'type': imageType}
         if expireTimestamp:
             metadata['expireTimestamp'] = expireTimestamp
-        with self.imagesLock: #make sure no one fiddles with the cache while we are working with it
-            self.images[dictIndex][name] = (surface, metadata) # store the image in memory
-
-            # check cache size,
-            # if there are too many images, delete them
-            if len(self.images[0]) > self.maxImagesInMemory:
-                self._trimCache()
-                # new tile available, make redraw request TODO: what overhead does this create ?
-            self._tileLoadedNotify(imageType)
+        if dictIndex == 0:
+            if imageType == NORMAL_TILE:
+                if not self.cacheImageSurfaces:
+                    # convert raw tile data once, so that it can be handed over
+                    # to the GUI again and again without copying it
+                    surface = asBuffer(surface)
+                # the tile might have been downloaded or refreshed,
+                # so any filtered version of it is out of date
+                self._filteredTileCache.removeTile(name)
+            # the tile cache evicts least recently used tiles once it gets full
+            self._tileCache.put(name, (surface, metadata))
+        else:
+            with self.imagesLock: #make sure no one fiddles with the cache while we are working with it
+                self.images[dictIndex][name] = (surface, metadata) # store the image in memory
+        # new tile available, make redraw request TODO: what overhead does this create ?
+        self._tileLoadedNotify(imageType)
 
     def _tileLoadedNotify(self, imageType):
         """redraw the screen when a new tile is available in the cache
@@ -419,50 +693,29 @@ class MapTiles(RanaModule):
         # TODO: is this still needed ?
         pass
 
-    def _trimCache(self):
-        """To avoid a memory leak, the maximum size of the image cache is fixed
-           when we reach the maximum size, we start removing images,
-           starting from the oldest ones with an amount of images specified
-           in imagesTrimmingAmount, so that trim does not run every time
-           an image is added to a full cache
-           -> only the normal image cache needs trimming (images[0]),
-           as the special image cache (images[1]) is just created once and not updated dynamically
-           NOTE: the storeInMemory method which is calling this function
-                 already locked images, so we don't have to"""
-        trimmingAmount = self.imagesTrimmingAmount
-        imagesLength = len(self.images[0])
-        if trimmingAmount >= imagesLength:
-            # this means that the trimming amount was set higher,
-            # than current length of the cache
-            # the result is basically flushing the cache every time it fills back
-            # well, I don't have an idea why would someone want to do that
-            self.images[0] = {}
-        else:
-            oldestKeys = sorted(self.images[0], key=lambda image: self.images[0][image][1]['addedTimestamp'])[
-                         0:trimmingAmount]
-            for key in oldestKeys:
-                del self.images[0][key]
+    @property
+    def tileCache(self):
+        """The in memory LRU tile cache
+
+        Items are (tile data, metadata) tuples keyed by lzxy.
+
+        :rtype: core.tile_cache.TileCache
+        """
+        return self._tileCache
 
     def _clearTileCache(self):
         """completely clear the in memory image cache"""
-        with self.imagesLock:
-            self.log.info('fully clearing the in memory tile cache (%d tiles)', len(self.images[0]))
-            self.images[0] = {}
+        self.log.info('fully clearing the in memory tile cache (%d tiles)', len(self._tileCache))
+        self._tileCache.clear()
 
     def _removeTilesFromCache(self, imageTypes):
         """Remove tiles of the given types from the in memory tile cache.
 
         :param list imageTypes: list if image types to remove
         """
-        with self.imagesLock:
-            self.log.info("removing %s from the tile cache", imageTypes)
-            removedCounter = 0
-            keys = list(self.images[0].keys())
-            for key in keys:
-                if self.images[0][key][1]["type"] in imageTypes:
-                    del self.images[0][key]
-                    removedCounter += 1
-            self.log.debug("removed %d tiles from total of %d", removedCounter, len(keys))
+        self.log.info("removing %s from the tile cache", imageTypes)
+        removedCounter = self._tileCache.removeMatching(lambda lzxy, item: item[1]["type"] in imageTypes)
+        self.log.debug("removed %d tiles from the tile cache", removedCounter)
 
     def _updateTileFilteringCB(self, key='mapScale', oldValue=1, newValue=1):
         if key == 'invertMapTiles':
@@ -490,30 +743,77 @@ class MapTiles(RanaModule):
                     # -> do nothing
 
     def _enableTileFiltering(self):
-        """assign the real filtering method, if possible
-        and flush the cache afterwards"""
-        if IMAGE_MANIPULATION_IMPORT_SUCCESS:
-            self._filterTile = self._invertPixbuf
-            self._clearTileCache()
+        """Start filtering tiles with the night theme filter, if possible
+
+        Tiles that have already been filtered are kept in the filtered tile cache,
+        so the in-memory tile cache does not need to be cleared.
+        """
+        if not tile_filters.FILTERING_AVAILABLE:
+            self.log.warning("NumPy or PIL not available, tiles can't be filtered")
+            return
+        filterId = self.get("nightTileFilter", constants.DEFAULT_NIGHT_TILE_FILTER)
+        self._tileFilter = tile_filters.getFilter(filterId)
+        self.log.info("tile filter enabled: %s", self._tileFilter)
 
     def _disableTileFiltering(self):
-        """assign the NOP filtering method
-        and flush the cache if needed"""
-        if IMAGE_MANIPULATION_IMPORT_SUCCESS:
-            self._filterTile = self._nop
-            # as image manipulation is possible,
-            # a cache flush is needed
-            self._clearTileCache()
-
-    def _filterTile(self, tilePb):
-        """function hook for image tile processing"""
-        return tilePb
-
-    def _nop(self, arg):
-        """A NOP function used for replacing functions that are not
-        currently used for some reason (such as for example _invertPixbuf)
+        """Stop filtering tiles, unfiltered tiles are still cached"""
+        if self._tileFilter is not None:
+            self.log.info("tile filter disabled: %s", self._tileFilter)
+        self._tileFilter = None
+
+    def _addTileFilteringRequest(self, lzxy, tag, tileData, tileFilter):
+        """Filter a tile in the tile filtering thread pool
+
+        The tileDownloaded signal is triggered once the filtered tile is available.
+        """
+        request = (lzxy, tileFilter.filterId, tag)
+        with self._filteringRequestsLock:
+            if request in self._filteringRequests:
+                return
+            self._filteringRequests.add(request)
+        try:
+            leakedItem = self._filterPool.submit(self._handleTileFiltering, lzxy, tag, tileData, tileFilter)
+        except RuntimeError:
+            # the pool has been shut down
+            return
+        if leakedItem:
+            # the oldest request has been dropped from the bottom of the request stack,
+            # let the listener know it will not be filtered
+            leakedLzxy, leakedTag, _leakedData, leakedFilter = leakedItem[1]
+            with self._filteringRequestsLock:
+                self._filteringRequests.discard((leakedLzxy, leakedFilter.filterId, leakedTag))
+            self.tileDownloaded(constants.TILE_DOWNLOAD_QUEUE_FULL, leakedLzxy, leakedTag)
+
+    def _handleTileFiltering(self, lzxy, tag, tileData, tileFilter):
+        try:
+            self._filterTileData(lzxy, tileData, tileFilter)
+        finally:
+            with self._filteringRequestsLock:
+                self._filteringRequests.discard((lzxy, tileFilter.filterId, tag))
+        self.tileDownloaded(constants.TILE_DOWNLOAD_SUCCESS, lzxy, tag)
+
+    def _filterTileData(self, lzxy, tileData, tileFilter):
+        """Filter tile data and store the result in the filtered tile cache
+
+        :returns: filtered tile data or unfiltered data if the tile can't be filtered
+        :rtype: bytearray
+        """
+        try:
+            filteredTileData = tileFilter.applyToTileData(tileData)
+        except Exception:
+            self.log.exception("filtering tile %s with %s failed", lzxy, tileFilter)
+            # cache the tile unfiltered, so that filtering is not tried again and again
+            filteredTileData = asBuffer(tileData)
+        self._filteredTileCache.put((lzxy, tileFilter.filterId), filteredTileData)
+        return filteredTileData
+
+    @property
+    def filteredTileCache(self):
+        """The in memory cache of filtered tiles keyed by (lzxy, filter id)
+
+        :rtype: core.tile_cache.FilteredTileCache
         """
-        return arg
+        return self._filteredTileCache
 
     def _batchDownloadCompleteDB(self):
         # Clear all special tiles once batch download finishes,
@@ -525,6 +825,8 @@ class MapTiles(RanaModule):
         self._removeTilesFromCache([LOADING_TILE, SPECIAL_TILE, COMPOSITE_TILE])
 
     def shutdown(self):
+        # remember what tiles were visible, so they can be preloaded on next start
+        self._saveVisibleTiles()
         #    # shutdown the tile loading thread
         #    try:
         #      self.loadingNotifyQueue.put(('shutdown', ()),block=False)
@@ -535,4 +837,10 @@ class MapTiles(RanaModule):
         self._dlRequestQueue.put(TERMINATOR)
 
         # tell the tile downloader to shutdown the thread pool
-        self._downloader.shutdown()
\ No newline at end of file
+        self.log.debug("automatic tile download statistics: %s", self._downloader.stats)
+        self._downloader.shutdown()
+        self._filterPool.shutdown(now=True)
+        if self._memoryPressureTimerId is not None:
+            cron = self.m.get('cron', None)
+            if cron:
+                cron.removeTimeout(self._memoryPressureTimerId)
@@ -16,41 +16,55 @@ from __future__ import with_statement
 
 from urllib.error import HTTPError, URLError
 
+import asyncio
 import threading
 import time
 import urllib3
 from core.pool import LifoThreadPool
+from core.async_pool import AsyncTaskPool, getDownloadLoop
+from core import async_http
 from core.singleton import modrana
 from core import tiles
 from core import constants
+from core.tile_scheduler import TileDownloadScheduler
 
 import logging
 log = logging.getLogger("mod.mapTiles.tile_downloader")
 
 class Downloader(object):
     def __init__(self, maxThreads, taskBufferSize=0,
-                 taskTimeout=0):
+                 taskTimeout=0, viewportMargin=constants.DEFAULT_TILE_DOWNLOAD_VIEWPORT_MARGIN):
         self._mapTiles = modrana.m.get("mapTiles")
         self._storeTiles = modrana.m.get("storeTiles")
-        # if task buffer size is set, start leaking
-        # old tile download requests from the bottom of the
-        # request stack once it becomes full, as we don't want
-        # the work queue to block and discarding old tile
-        # download requests is not an issue
-        leak = taskBufferSize >= 0
-        self._pool = LifoThreadPool(maxThreads,
-                                    name=constants.THREAD_POOL_AUTOMATIC_TILE_DOWNLOAD,
-                                    taskBufferSize=taskBufferSize,
-                                    leak=leak)
+        # waiting download requests are ordered by distance from the map view
+        # viewports - if task buffer size is set, the least important request
+        # is dropped once the scheduler becomes full, as we don't want
+        # the work queue to block and discarding tile download requests
+        # for tiles far from the map view is not an issue
+        if taskBufferSize >= 0:
+            maxSize = maxThreads + taskBufferSize
+        else:
+            maxSize = 0
+        self._scheduler = TileDownloadScheduler(maxSize=maxSize, margin=viewportMargin)
+        # the pool just runs a worker task for each request added to the scheduler,
+        # the worker then handles the most important request waiting
+        self._pool = self._createPool(maxThreads)
         # in seconds, 0 == no task timeout
         self._taskTimeout = taskTimeout
         self._running = set()
         self._runningLock = threading.RLock()
+        # tiles with a background refresh queued or in progress
+        self._refreshing = set()
         # due to GIL, we don't have a lock
         # for the set of tile downloads
         # in progress (hopefully)
         self._imageSurface = self._mapTiles.cacheImageSurfaces
 
+    def _createPool(self, maxThreads):
+        return LifoThreadPool(maxThreads,
+                              name=constants.THREAD_POOL_AUTOMATIC_TILE_DOWNLOAD,
+                              taskBufferSize=-1)
+
     def shutdown(self):
         self._pool.shutdown(now=True)
 
@@ -61,8 +75,8 @@ class Downloader(object):
     def downloadTile(self, lzxy, tag=None, overwrite=False):
         """Add a tile download request, if this download
         request replaces another not yet handled request
-        from the bottom of the work stack, the old
-        lzxy will be returned
+        (the one for a tile furthest from the map view),
+        the old lzxy will be returned
 
         :param tuple lzxy: tile to download represented by a tuple
         :param str tag: tracking tag for the download request
@@ -71,37 +85,102 @@ class Downloader(object):
         :rtype: None or tuple
         """
         discardedRequest = None
-        discardedTile = None
         with self._runningLock:
             if lzxy not in self._running:
                 # drop download requests for tiles that are already
                 # being downloaded
-                discardedRequest = self._pool.submit(
-                    self._handleDownload, lzxy, tag, time.time(), overwrite
-                )
+                discardedRequest = self._addRequest(lzxy, tag, time.time(), overwrite)
         # return lzxy & tag for any discarded request or return None
         # if no request was discarded
         if discardedRequest:
-            discardedTile = discardedRequest[1][0], discardedRequest[1][1]
-        return discardedTile
+            return self._discardRequest(discardedRequest)
+        else:
+            return None
 
-    def _handleDownload(self, lzxy, tag, timestamp, overwrite):
-        download = True
-        error = constants.TILE_DOWNLOAD_ERROR
+    def _addRequest(self, lzxy, tag, timestamp, overwrite=False, lowPriority=False):
+        """Add a request to the scheduler & start a worker for it
+
+        :returns: request dropped from the full scheduler or None
+        """
+        dropped = self._scheduler.add(lzxy, tag, timestamp, overwrite, lowPriority)
+        if dropped is None or (dropped.lzxy, dropped.tag, dropped.lowPriority) != (lzxy, tag, lowPriority):
+            # workers left over by dropped or cancelled requests just find the scheduler empty
+            self._pool.submit(self._handleNextRequest)
+        return dropped
+
+    def _discardRequest(self, request):
+        """Forget a request dropped or cancelled by the scheduler
+
+        :returns: lzxy & tag of a tile download request, None for a background refresh
+        """
+        if request.lowPriority:
+            # a background refresh has been discarded, nobody is waiting for it
+            with self._runningLock:
+                self._refreshing.discard(request.lzxy)
+            return None
+        else:
+            return request.lzxy, request.tag
+
+    def setViewports(self, viewports):
+        """Set tiles visible in the map views, so that requests for tiles closest
+        to the centre of a map view are handled first
+
+        Requests for tiles outside of all viewports and their margin are cancelled.
+
+        :param list viewports: core.tile_scheduler.Viewport instances
+        """
+        for request in self._scheduler.setViewports(viewports):
+            discardedTile = self._discardRequest(request)
+            if discardedTile:
+                # remove the "Waiting..." tile & let any listener know the tile won't be downloaded
+                self._mapTiles.removeImageFromMemory(request.lzxy)
+                self._tileDownloaded(constants.TILE_DOWNLOAD_CANCELLED, request.lzxy, request.tag)
+
+    def refreshTile(self, lzxy):
+        """Add a low priority request to download a fresh copy of a stored tile
+
+        The request is handled only once there are no other download requests waiting
+        and it is the first one to be dropped if the request stack gets full. The stored
+        tile is kept if the download fails, so a failed refresh is never shown.
+
+        :param tuple lzxy: tile to refresh represented by a tuple
+        """
         with self._runningLock:
-            if (lzxy, tag) in self._running:
-                # tile is already being downloaded
-                download = False
+            if lzxy in self._refreshing:
+                return
+            self._refreshing.add(lzxy)
+        discardedRequest = self._addRequest(lzxy, None, time.time(), lowPriority=True)
+        if discardedRequest:
+            # the scheduler is full, so the request (or another refresh) has been dropped
+            self._discardRequest(discardedRequest)
+
+    def _handleNextRequest(self):
+        request = self._scheduler.pop()
+        if request is None:
+            return
+        try:
+            if request.lowPriority:
+                self._handleRefresh(request.lzxy)
             else:
-                # tile is not yet being downloaded
-                # so register we are handling it
-                self._running.add((lzxy, tag))
+                self._handleDownload(request.lzxy, request.tag, request.timestamp, request.overwrite)
+        finally:
+            self._scheduler.requestDone(request)
 
-        if self._taskTimeout:
-            dt = time.time() - timestamp
-            if dt >= self._taskTimeout:
-                # download request timed out
-                download = False
+    def _handleRefresh(self, lzxy):
+        try:
+            content = self._mapTiles._downloadTile(lzxy)
+            if content is not None:
+                # the fresh tile has been stored by _downloadTile(), replace the stale one in memory
+                self._mapTiles.storeInMemory(content, lzxy)
+        except Exception:
+            log.debug("refreshing timed-out tile %s failed, keeping the stored one", lzxy, exc_info=True)
+        finally:
+            with self._runningLock:
+                self._refreshing.discard(lzxy)
+
+    def _handleDownload(self, lzxy, tag, timestamp, overwrite):
+        error = constants.TILE_DOWNLOAD_ERROR
+        download = self._startDownload(lzxy, tag, timestamp)
 
         if not download and not overwrite:
             # check if the tile has been already downloaded
@@ -124,30 +203,60 @@ class Downloader(object):
             except Exception:
                 import sys
                 e = sys.exc_info()[1]
-                self._printErrorMessage(e, lzxy)
-                # remove the status tile
-                self._mapTiles.removeImageFromMemory(lzxy)
-                error = constants.TILE_DOWNLOAD_ERROR
+                error = self._unexpectedDownloadError(e, lzxy)
             finally:
-                # done, unregister the tile from the tracking set
-                with self._runningLock:
-                    try:
-                        self._running.remove((lzxy, tag))
-                    except KeyError:
-                        pass
-                        # TODO: find why this happens (well, it appears to be harmless)
-                        #       and maybe forward it to debug log once we have one ?
-                        #print("auto tile dl pool: warning, tuple already removed from tracking!")
-                        #print(lzxy)
-                # report that tha tile has or has not bee successfully downloaded
-                self._tileDownloaded(error, lzxy, tag)
+                self._finishDownload(lzxy, tag, error)
         else:
-            # don't download tile and remove
-            # any "downloading" tiles that might
-            # be in the image cache
-            self._mapTiles.removeImageFromMemory(lzxy)
-            # report the tile as not been downloaded
-            self._tileDownloaded(error, lzxy, tag)
+            self._skipDownload(lzxy, tag, error)
+
+    def _startDownload(self, lzxy, tag, timestamp):
+        """Register a download request as being handled
+
+        :returns: False if the tile is already being downloaded or the request
+                  timed out, True otherwise
+        :rtype: bool
+        """
+        download = True
+        with self._runningLock:
+            if (lzxy, tag) in self._running:
+                # tile is already being downloaded
+                download = False
+            else:
+                # tile is not yet being downloaded
+                # so register we are handling it
+                self._running.add((lzxy, tag))
+
+        if self._taskTimeout:
+            dt = time.time() - timestamp
+            if dt >= self._taskTimeout:
+                # download request timed out
+                download = False
+        return download
+
+    def _finishDownload(self, lzxy, tag, error):
+        """Unregister a finished download & report the result"""
+        # the tile might be stored now, make sure it is looked up again
+        self._storeTiles.tile_download_finished(lzxy)
+        # done, unregister the tile from the tracking set
+        with self._runningLock:
+            try:
+                self._running.remove((lzxy, tag))
+            except KeyError:
+                pass
+                # TODO: find why this happens (well, it appears to be harmless)
+                #       and maybe forward it to debug log once we have one ?
+                #print("auto tile dl pool: warning, tuple already removed from tracking!")
+                #print(lzxy)
+        # report that tha tile has or has not bee successfully downloaded
+        self._tileDownloaded(error, lzxy, tag)
+
+    def _skipDownload(self, lzxy, tag, error):
+        # don't download tile and remove
+        # any "downloading" tiles that might
+        # be in the image cache
+        self._mapTiles.removeImageFromMemory(lzxy)
+        # report the tile as not been downloaded
+        self._tileDownloaded(error, lzxy, tag)
 
 
     def _downloadTile(self, lzxy):
@@ -158,8 +267,9 @@ class Downloader(object):
                 raise urllib3.exceptions.HTTPError
 
             # cache the raw data
+            # - the tile (together with its HTTP cache validators) has been already
+            #   stored by _downloadTile(), storing it again would drop the validators
             self._mapTiles.storeInMemory(content, lzxy)
-            self._storeTiles.store_tile_data(lzxy, content)
 
     def _downloadInProgress(self, lzxy):
         if self._imageSurface:
@@ -192,6 +302,12 @@ class Downloader(object):
             #    after it is flushed with old tiles from the memory
         return constants.TILE_DOWNLOAD_ERROR
 
+    def _unexpectedDownloadError(self, e, lzxy):
+        self._printErrorMessage(e, lzxy)
+        # remove the status tile
+        self._mapTiles.removeImageFromMemory(lzxy)
+        return constants.TILE_DOWNLOAD_ERROR
+
     def _printErrorMessage(self, e, lzxy):
         url = tiles.getTileUrl(lzxy)
         error = "mapTiles: download thread reports error\n"
@@ -210,4 +326,127 @@ class Downloader(object):
 
     @property
     def qsize(self):
-        return self._pool.qsize()
+        return len(self._scheduler)
+
+    @property
+    def stats(self):
+        """Download request statistics (see TileDownloadScheduler.getStats())"""
+        return self._scheduler.getStats()
+
+
+class AsyncDownloader(Downloader):
+    """Tile downloader running the downloads as coroutines on an asyncio event loop
+
+    Has the same interface as the thread pool based Downloader, but as all downloads
+    run in a single thread, many more of them can be in progress at once (maxTasks).
+    """
+
+    def __init__(self, maxTasks, taskBufferSize=0, taskTimeout=0,
+                 viewportMargin=constants.DEFAULT_TILE_DOWNLOAD_VIEWPORT_MARGIN):
+        self._loopThread = getDownloadLoop()
+        self._client = async_http.HTTPClient(
+            headers={'User-Agent': modrana.configs.user_agent},
+            maxConnectionsPerHost=int(modrana.get("asyncDownloadConnectionsPerHost",
+                                                  constants.DEFAULT_ASYNC_DOWNLOAD_CONNECTIONS_PER_HOST))
+        )
+        Downloader.__init__(self, maxTasks, taskBufferSize=taskBufferSize, taskTimeout=taskTimeout,
+                            viewportMargin=viewportMargin)
+
+    def _createPool(self, maxThreads):
+        return AsyncTaskPool(self._loopThread, maxThreads,
+                             name=constants.THREAD_POOL_AUTOMATIC_TILE_DOWNLOAD,
+                             taskBufferSize=-1)
+
+    def shutdown(self):
+        self._pool.shutdown(now=True)
+        self._loopThread.submit(self._client.close())
+
+    @property
+    def client(self):
+        return self._client
+
+    async def _handleNextRequest(self):
+        request = self._scheduler.pop()
+        if request is None:
+            return
+        try:
+            if request.lowPriority:
+                await self._handleRefresh(request.lzxy)
+            else:
+                await self._handleDownload(request.lzxy, request.tag, request.timestamp, request.overwrite)
+        finally:
+            self._scheduler.requestDone(request)
+
+    async def _handleRefresh(self, lzxy):
+        try:
+            content = await self._fetchTile(lzxy)
+            if content is not None:
+                # the fresh tile has been stored by _fetchTile(), replace the stale one in memory
+                self._mapTiles.storeInMemory(content, lzxy)
+        except Exception:
+            log.debug("refreshing timed-out tile %s failed, keeping the stored one", lzxy, exc_info=True)
+        finally:
+            with self._runningLock:
+                self._refreshing.discard(lzxy)
+
+    async def _handleDownload(self, lzxy, tag, timestamp, overwrite):
+        error = constants.TILE_DOWNLOAD_ERROR
+        download = self._startDownload(lzxy, tag, timestamp)
+
+        if not download and not overwrite:
+            # check if the tile has been already downloaded
+            download = not await self._loopThread.run_blocking(self._storeTiles.tile_is_stored, lzxy)
+
+        if download:
+            try:
+                await self._downloadTile(lzxy)
+                error = constants.TILE_DOWNLOAD_SUCCESS
+            except (urllib3.exceptions.HTTPError, async_http.ProtocolError):
+                # we got to the server but it didn't like us for some reason
+                error = self._fatalDownloadError(lzxy)
+            except (OSError, asyncio.TimeoutError):
+                # this is most probably caused by a loss of network connectivity
+                error = self._temporaryDownloadError(lzxy)
+            except Exception as e:
+                error = self._unexpectedDownloadError(e, lzxy)
+            finally:
+                self._finishDownload(lzxy, tag, error)
+        else:
+            self._skipDownload(lzxy, tag, error)
+
+    async def _downloadTile(self, lzxy):
+        """Downloads a tile image image from network"""
+        self._downloadInProgress(lzxy)
+        content = await self._fetchTile(lzxy)
+        if content is None:
+            raise urllib3.exceptions.HTTPError
+        # the tile has been already stored by _fetchTile()
+        self._mapTiles.storeInMemory(content, lzxy)
+
+    async def _fetchTile(self, lzxy):
+        """Download & store a tile, asyncio counterpart of MapTiles._downloadTile()
+
+        :returns: tile data or None
+        """
+        layer, z, x, y = lzxy
+        # spread the downloads over the hosts of the layer
+        shards = layer.url_template.shards
+        subdomain = shards.select(z, x, y)
+        tileUrl = layer.url_template.getUrl(z, x, y, subdomain)
+        # tile storage access blocks, so it is done in a thread
+        validators = await self._loopThread.run_blocking(self._storeTiles.get_tile_validators, lzxy)
+        try:
+            response = await self._client.request('GET', tileUrl,
+                                                  headers=tiles.getConditionalHeaders(validators),
+                                                  timeout=self._mapTiles._getDownloadTimeout(layer),
+                                                  maxConnections=layer.max_connections_per_host)
+        except Exception:
+            shards.reportFailure(subdomain)
+            raise
+        shards.reportStatus(subdomain, response.status)
+        return await self._loopThread.run_blocking(self._mapTiles._handleTileResponse,
+                                                   lzxy, tileUrl, response)
+
+    @property
+    def maxThreads(self):
+        return self._pool.maxTasks
@@ -34,7 +34,7 @@ except Exception:
 import os
 import time
 from collections import defaultdict
-from threading import RLock
+from threading import RLock, Event
 
 try:  # Python 2.7+
     from collections import OrderedDict as OrderedDict
@@ -43,8 +43,17 @@ except ImportError:
 
 from core import constants
 from core import utils
+from core import threads
+from core import tilenames
+from core.signal import Signal
 from core.tile_storage.files_store import FileBasedTileStore
 from core.tile_storage.sqlite_store import SqliteTileStore
+from core.tile_storage.mbtiles_store import MBTilesTileStore
+from core.tile_storage.pack_store import TilePackStore, build_tile_pack, TILE_PACK_FILE_EXTENSION
+from core.tile_storage.existence_filter import TileExistenceFilter, EXISTENCE_FILTER_FILE_NAME
+from core.tile_storage.stats import TileStats
+from core.tile_storage.negative_cache import NegativeTileCache
+from core.tile_storage.migration import TileMigration, MigrationJournal, TILE_MIGRATION_JOURNAL_FILE_NAME
 
 def getModule(*args, **kwargs):
     return StoreTiles(*args, **kwargs)
@@ -75,6 +84,50 @@ class StoreTiles(RanaModule):
         #   be automatically updated if store type changes at runtime
         self._primary_tile_storage_type = constants.DEFAULT_TILE_STORAGE_TYPE
         self._stores = FlexibleDefaultDict(factory=self._get_existing_stores_for_layer)
+        # tile existence filters for layers, created together with the stores
+        # for the layer and used to skip the stores for tiles that are definitely not stored
+        self._existence_filters = {}
+        self._use_existence_filter = constants.DEFAULT_TILE_EXISTENCE_FILTER
+        # tiles recently not found in any store, so that repeated lookups
+        # of a tile that is being downloaded don't reach the stores
+        negative_cache_size = int(self.get("tileNegativeCacheSize", constants.DEFAULT_TILE_NEGATIVE_CACHE_SIZE))
+        self._negative_cache = NegativeTileCache(max_size=negative_cache_size,
+                                                 ttl=constants.TILE_NEGATIVE_CACHE_TTL)
+
+        # tile storage size budgets in bytes, 0 means unlimited
+        self._size_limit = 0
+        self._layer_size_limit = 0
+        # the eviction job enforcing the size budgets runs periodically
+        # and also once enough tiles have been stored since it last ran
+        self._eviction_event = Event()
+        self._eviction_thread = None
+        self._eviction_stop_requested = False
+        self._tiles_stored_since_eviction = 0
+
+        # the expiry sweeper deletes timed-out tiles once tiles have not been requested for a while
+        self._expiry_sweep_enabled = False
+        self._expiry_event = Event()
+        self._expiry_thread = None
+        self._last_tile_request = 0
+
+        # emitted with the lzxy tuple of timed-out tiles returned by stale-while-revalidate
+        # layers, so that a fresh tile can be downloaded in the background
+        self._stale_tile_loaded = Signal()
+
+        # running tile migrations keyed by layer
+        self._migrations = {}
+        self._migration_threads = []
+        # stores all tiles have been moved away from, keyed by layer & store type
+        # - they are no longer used for reading, but other threads might still be using them,
+        #   so they are only deleted on shutdown (or used again if a store of the same type
+        #   is needed for the layer)
+        self._retired_stores = defaultdict(dict)
+        # emitted with the layer, number of migrated tiles and total number
+        # of tiles to migrate (or None if unknown) as tiles are being migrated
+        self._tile_migration_progress = Signal()
+        # emitted with the layer and True if all tiles have been moved (False if the migration
+        # has been stopped, has failed or there was nothing to move) once a migration thread is done
+        self._tile_migration_finished = Signal()
 
         self._prevent_media_indexing = self.dmod.device_id == "android"
 
@@ -84,9 +137,25 @@ class StoreTiles(RanaModule):
         self._llog = self._no_op
         self.modrana.watch('tileLoadingDebug', self._tile_loading_debug_changed_cb, runNow=True)
         self.modrana.watch('tileStorageType', self._primary_tile_storage_type_changed_cb, runNow=True)
+        self.modrana.watch('tileExistenceFilter', self._existence_filter_changed_cb, runNow=True)
+        self.modrana.watch('tileStorageSizeLimit', self._size_limit_changed_cb, runNow=True)
+        self.modrana.watch('tileStorageLayerSizeLimit', self._size_limit_changed_cb, runNow=True)
+        self.modrana.watch('tileStorageExpirySweep', self._expiry_sweep_changed_cb, runNow=True)
         # device modules are loaded and initialized and configs are parsed before "normal"
         # modRana modules are initialized, so we can cache the map folder path in init
 
+    @property
+    def stale_tile_loaded(self):
+        return self._stale_tile_loaded
+
+    @property
+    def tile_migration_progress(self):
+        return self._tile_migration_progress
+
+    @property
+    def tile_migration_finished(self):
+        return self._tile_migration_finished
+
     def _get_existing_stores_for_layer(self, layer):
         """Check for any existing stores for the given layer in persistent storage
            and return a dictionary with the found stores under file storage type keys.
@@ -108,14 +177,147 @@ class StoreTiles(RanaModule):
         # check if the path contains a sqlite tile store
         if SqliteTileStore.is_store(layer_folder_path):
             self._llog("sqlite tile store has been found for layer %s" % layer)
-            store_tuple = (constants.TILE_STORAGE_SQLITE, SqliteTileStore(layer_folder_path))
+            store_tuple = (constants.TILE_STORAGE_SQLITE, self._create_sqlite_store(layer_folder_path))
+            store_tuples.append(store_tuple)
+        # check if the path contains a MBTiles file (such as an offline tile pack)
+        if MBTilesTileStore.is_store(layer_folder_path):
+            self._llog("MBTiles store has been found for layer %s" % layer)
+            store_tuple = (constants.TILE_STORAGE_MBTILES, self._create_mbtiles_store(layer_folder_path))
             store_tuples.append(store_tuple)
+        # check if the path contains any read only tile packs
+        if TilePackStore.is_store(layer_folder_path):
+            self._llog("tile pack store has been found for layer %s" % layer)
+            store_tuples.append((constants.TILE_STORAGE_PACK, TilePackStore(layer_folder_path)))
 
         self._llog("%d existing stores have been found for layer %s" % (len(store_tuples), layer), start)
+        self._init_existence_filter(layer, layer_folder_path, store_tuples)
+        # resume an interrupted tile migration (if any)
+        journal = MigrationJournal.load(os.path.join(layer_folder_path, TILE_MIGRATION_JOURNAL_FILE_NAME))
+        if journal is not None:
+            self.log.info("resuming migration of tiles of layer %s from %s to %s store",
+                          layer, journal.source_type, journal.target_type)
+            # the migration thread waits for the stores to be added
+            # as it needs the tile storage management lock
+            self._start_migration(layer, journal)
         # sort the tuples so that the primary tile storage type (if any) is first
         store_tuples.sort(key=self._sort_store_tuples)
         return OrderedDict(store_tuples)
 
+    def _get_stores_stamp(self, store_tuples):
+        """Get a combined modification stamp of the given stores
+
+        :returns: stamp keyed by store type or None if some of the stores can't provide a stamp
+        :rtype: dict or None
+        """
+        stamp = {}
+        for store_type, store in store_tuples:
+            store_stamp = store.get_modification_stamp()
+            if store_stamp is None:
+                return None
+            stamp[store_type] = store_stamp
+        return stamp
+
+    def _init_existence_filter(self, layer, layer_folder_path, store_tuples):
+        """Load the tile existence filter for the given layer or start building it
+           from the existing stores in the background.
+
+        NOTE: this needs to be called before anything is written to the stores,
+              so that the store modification stamps match those saved with the filter
+        """
+        if not store_tuples:
+            # no tiles are stored for the layer, so the empty filter is complete
+            existence_filter = TileExistenceFilter()
+            existence_filter.set_ready()
+            self._existence_filters[layer] = existence_filter
+            return
+        stamp = self._get_stores_stamp(store_tuples)
+        filter_path = os.path.join(layer_folder_path, EXISTENCE_FILTER_FILE_NAME)
+        existence_filter = None
+        if stamp is not None:
+            existence_filter = TileExistenceFilter.load(filter_path, stamp)
+        if existence_filter:
+            self._llog("tile existence filter loaded for layer %s" % layer)
+            self._existence_filters[layer] = existence_filter
+        else:
+            existence_filter = TileExistenceFilter()
+            self._existence_filters[layer] = existence_filter
+            stores = [store for _store_type, store in store_tuples]
+            t = threads.ModRanaThread(name=constants.THREAD_TILE_EXISTENCE_FILTER_BUILDER,
+                                      target=lambda: self._build_existence_filter(layer, existence_filter, stores))
+            threads.threadMgr.add(t)
+
+    def _build_existence_filter(self, layer, existence_filter, stores):
+        """Add all tiles from the given stores to the existence filter"""
+        start = time.time()
+        try:
+            for store in stores:
+                existence_filter.add_many(store.iter_tiles())
+        except Exception:
+            self.log.exception("building tile existence filter for layer %s failed", layer)
+            return
+        existence_filter.set_ready()
+        self.log.debug("tile existence filter for layer %s built in %1.2f ms",
+                       layer, (time.time() - start) * 1000)
+
+    def _save_existence_filters(self):
+        """Save tile existence filters next to the (already closed) stores"""
+        for layer, existence_filter in self._existence_filters.items():
+            store_odict = self._stores.get(layer)
+            if not existence_filter.ready or not store_odict:
+                continue
+            stamp = self._get_stores_stamp(store_odict.items())
+            if stamp is None:
+                continue
+            layer_folder_path = os.path.join(self.modrana.paths.map_folder_path, layer.folder_name)
+            try:
+                existence_filter.save(os.path.join(layer_folder_path, EXISTENCE_FILTER_FILE_NAME), stamp)
+            except Exception:
+                self.log.exception("saving tile existence filter for layer %s failed", layer)
+
+    def _might_be_stored(self, lzxy):
+        """Report if the tile might be stored according to the existence filter of its layer
+
+        :returns: False if the tile is definitely not stored, True if it might be
+        :rtype: bool
+        """
+        if not self._use_existence_filter:
+            return True
+        existence_filter = self._existence_filters.get(lzxy[0])
+        if existence_filter is None:
+            return True
+        return existence_filter.might_contain(lzxy[1], lzxy[2], lzxy[3])
+
+    def _create_sqlite_store(self, layer_folder_path):
+        """Create a sqlite tile store for the given layer folder path
+           with write batching and concurrency mode configured from persistent options.
+        """
+        batch_size = int(self.get("sqliteTileDatabaseBatchSize",
+                                  constants.DEFAULT_SQLITE_TILE_DATABASE_BATCH_SIZE))
+        commit_interval = float(self.get("sqliteTileDatabaseCommitInterval",
+                                         constants.DEFAULT_SQLITE_TILE_DATABASE_COMMIT_INTERVAL))
+        wal_mode = bool(self.get("sqliteTileDatabaseWAL",
+                                 constants.DEFAULT_SQLITE_TILE_DATABASE_WAL))
+        deduplicate = bool(self.get("sqliteTileDatabaseDeduplicate",
+                                    constants.DEFAULT_SQLITE_TILE_DATABASE_DEDUPLICATE))
+        return SqliteTileStore(layer_folder_path,
+                               batch_size=batch_size,
+                               flush_interval=commit_interval,
+                               wal_mode=wal_mode,
+                               deduplicate=deduplicate)
+
+    def _create_mbtiles_store(self, layer_folder_path):
+        """Create a MBTiles store for the given layer folder path
+           with write batching and concurrency mode configured from persistent options.
+        """
+        batch_size = int(self.get("sqliteTileDatabaseBatchSize",
+                                  constants.DEFAULT_SQLITE_TILE_DATABASE_BATCH_SIZE))
+        wal_mode = bool(self.get("sqliteTileDatabaseWAL",
+                                 constants.DEFAULT_SQLITE_TILE_DATABASE_WAL))
+        return MBTilesTileStore(layer_folder_path,
+                                prevent_media_indexing=self._prevent_media_indexing,
+                                batch_size=batch_size,
+                                wal_mode=wal_mode)
+
     def _get_stores_for_reading(self, layer):
         """Get an iterable of stores for the given layer
            - store corresponding to primary storage type is always first (if any)
@@ -128,33 +330,45 @@ class StoreTiles(RanaModule):
         """Get a store for writing tiles corresponding to the given layer
            and current primary tile storage type.
         """
+        return self._get_or_create_store(layer, self._primary_tile_storage_type)
+
+    def _get_or_create_store(self, layer, store_type):
+        """Get a store of the given type for the given layer, creating it if needed"""
         with self._tile_storage_management_lock:
-            store = self._stores[layer].get(self._primary_tile_storage_type)
+            store = self._stores[layer].get(store_type)
             if store is None:
                 start = time.clock()
-                self._llog("store type %s not found for layer %s" % (self._primary_tile_storage_type, layer))
+                self._llog("store type %s not found for layer %s" % (store_type, layer))
                 layer_folder_path = os.path.join(self.modrana.paths.map_folder_path, layer.folder_name)
-                if self._primary_tile_storage_type == constants.TILE_STORAGE_FILES:
-                    store_type = constants.TILE_STORAGE_FILES
+                store = self._retired_stores[layer].pop(store_type, None)
+                if store is not None:
+                    self._llog("using retired %s store for layer %s again" % (store_type, layer))
+                elif store_type == constants.TILE_STORAGE_FILES:
                     store = FileBasedTileStore(
                         layer_folder_path, prevent_media_indexing=self._prevent_media_indexing
                     )
                     self._llog("adding file based store for layer %s" % layer)
+                elif store_type == constants.TILE_STORAGE_MBTILES:
+                    store = self._create_mbtiles_store(layer_folder_path)
+                    self._llog("adding MBTiles store for layer %s" % layer)
                 else:  # sqlite tile store
                     store_type = constants.TILE_STORAGE_SQLITE
-                    store = SqliteTileStore(layer_folder_path)
-                    self._llog("adding file based store for layer %s" % layer)
+                    store = self._create_sqlite_store(layer_folder_path)
+                    self._llog("adding sqlite store for layer %s" % layer)
                 # add the store to the stores dict while keeping the primary-storage-type first ordering
                 self._add_store_for_layer(layer, (store_type, store))
-                self._llog("added store type %s for layer %s" % (self._primary_tile_storage_type, layer), start)
+                self._llog("added store type %s for layer %s" % (store_type, layer), start)
             return store
 
     def _sort_store_tuples(self, key):
-        # stores corresponding to the current primary stile storage type should go first
-        if key[0] == self._primary_tile_storage_type:
+        # read only tile packs go first, followed by stores
+        # corresponding to the current primary stile storage type
+        if key[0] == constants.TILE_STORAGE_PACK:
             return 0
-        else:
+        elif key[0] == self._primary_tile_storage_type:
             return 1
+        else:
+            return 2
 
     def _sort_layer_odict(self, layer):
         """Sort the ordered dict for the given layer according to
@@ -173,6 +387,8 @@ class StoreTiles(RanaModule):
             store_tuples.append(store_tuple)
             store_tuples.sort(key=self._sort_store_tuples)
             self._stores[layer] = OrderedDict(store_tuples)
+        # the new store might have some of the tiles remembered as missing
+        self._negative_cache.clear()
 
     def _primary_tile_storage_type_changed_cb(self, key, oldValue, newValue):
         start = time.clock()
@@ -190,6 +406,247 @@ class StoreTiles(RanaModule):
                 self._sort_layer_odict(layer)
             self._llog("ordered dicts resorted", start)
 
+    def _existence_filter_changed_cb(self, key, oldValue, newValue):
+        if newValue is None:
+            newValue = constants.DEFAULT_TILE_EXISTENCE_FILTER
+        self._use_existence_filter = bool(newValue)
+
+    def _size_limit_changed_cb(self, key, oldValue, newValue):
+        mebi_byte = 1024 * 1024
+        self._size_limit = int(self.get("tileStorageSizeLimit",
+                                        constants.DEFAULT_TILE_STORAGE_SIZE_LIMIT)) * mebi_byte
+        self._layer_size_limit = int(self.get("tileStorageLayerSizeLimit",
+                                              constants.DEFAULT_TILE_STORAGE_LAYER_SIZE_LIMIT)) * mebi_byte
+        if self._size_limit or self._layer_size_limit:
+            self._start_eviction_thread()
+            # check the new budgets right away
+            self._eviction_event.set()
+
+    def _start_eviction_thread(self):
+        """Start the background job enforcing the tile storage size budgets (if not already running)"""
+        with self._tile_storage_management_lock:
+            if self._eviction_thread is not None or self._eviction_stop_requested:
+                return
+            self._eviction_thread = threads.ModRanaThread(name=constants.THREAD_TILE_STORAGE_EVICTION,
+                                                          target=self._eviction_loop)
+            threads.threadMgr.add(self._eviction_thread)
+
+    def _eviction_loop(self):
+        while True:
+            self._eviction_event.wait(constants.TILE_STORAGE_EVICTION_INTERVAL)
+            self._eviction_event.clear()
+            if self._eviction_stop_requested:
+                break
+            if not self._size_limit and not self._layer_size_limit:
+                continue
+            self._tiles_stored_since_eviction = 0
+            try:
+                self.enforce_size_limits()
+            except Exception:
+                self.log.exception("tile storage eviction failed")
+
+    def _evict_from_stores(self, sized_stores, bytes_to_free):
+        """Free space from the given stores, proportionally to their size
+
+        :param list sized_stores: list of (store, size in bytes) tuples
+        :param int bytes_to_free: how much space to free in total
+        :returns: how much space has been freed in bytes & list of (store, size in bytes) tuples
+                  with sizes of the stores after the eviction
+        :rtype: (int, list) tuple
+        """
+        total_size = sum(size for _store, size in sized_stores)
+        if not total_size:
+            return 0, sized_stores
+        freed = 0
+        evicted_sized_stores = []
+        for store, size in sized_stores:
+            store_share = int(bytes_to_free * size / float(total_size)) + 1
+            store_freed = store.evict(min(store_share, size))
+            freed += store_freed
+            evicted_sized_stores.append((store, size - store_freed))
+        return freed, evicted_sized_stores
+
+    def enforce_size_limits(self):
+        """Evict least recently accessed tiles from stores that are over the size budgets
+
+        The per layer budget is enforced first, followed by the global budget. If multiple
+        stores need to free space, each frees space proportional to its size.
+        Stores that can't report their size (such as read only tile packs) are not counted.
+
+        :returns: how much space has been freed in bytes
+        :rtype: int
+        """
+        start = time.time()
+        with self._tile_storage_management_lock:
+            layer_stores = [(layer, list(store_odict.values())) for layer, store_odict in self._stores.items()]
+        freed = 0
+        all_sized_stores = []
+        for layer, stores in layer_stores:
+            sized_stores = []
+            for store in stores:
+                size = store.get_size()
+                if size is not None:
+                    sized_stores.append((store, size))
+            layer_size = sum(size for _store, size in sized_stores)
+            if self._layer_size_limit and layer_size > self._layer_size_limit:
+                self.log.info("layer %s is over its tile storage budget (%d > %d bytes)",
+                              layer, layer_size, self._layer_size_limit)
+                layer_freed, sized_stores = self._evict_from_stores(sized_stores,
+                                                                    layer_size - self._layer_size_limit)
+                freed += layer_freed
+            all_sized_stores.extend(sized_stores)
+        total_size = sum(size for _store, size in all_sized_stores)
+        if self._size_limit and total_size > self._size_limit:
+            self.log.info("tile storage is over its budget (%d > %d bytes)", total_size, self._size_limit)
+            freed += self._evict_from_stores(all_sized_stores, total_size - self._size_limit)[0]
+        if freed:
+            self.log.info("%d bytes of tiles evicted in %1.2f s", freed, time.time() - start)
+        return freed
+
+    def _expiry_sweep_changed_cb(self, key, oldValue, newValue):
+        self._expiry_sweep_enabled = bool(self.get("tileStorageExpirySweep",
+                                                   constants.DEFAULT_TILE_STORAGE_EXPIRY_SWEEP))
+        if self._expiry_sweep_enabled:
+            with self._tile_storage_management_lock:
+                if self._expiry_thread is not None or self._eviction_stop_requested:
+                    return
+                self._expiry_thread = threads.ModRanaThread(name=constants.THREAD_TILE_STORAGE_EXPIRY,
+                                                            target=self._expiry_loop)
+                threads.threadMgr.add(self._expiry_thread)
+
+    def _expiry_loop(self):
+        while True:
+            self._expiry_event.wait(constants.TILE_STORAGE_EXPIRY_SWEEP_INTERVAL)
+            # wait for tile loading to calm down
+            while not self._eviction_stop_requested:
+                idle_for = time.time() - self._last_tile_request
+                if idle_for >= constants.TILE_STORAGE_EXPIRY_IDLE_TIME:
+                    break
+                self._expiry_event.wait(constants.TILE_STORAGE_EXPIRY_IDLE_TIME - idle_for)
+            if self._eviction_stop_requested:
+                break
+            if not self._expiry_sweep_enabled:
+                continue
+            try:
+                self.sweep_expired_tiles(chunk_delay=constants.TILE_STORAGE_EXPIRY_CHUNK_DELAY)
+            except Exception:
+                self.log.exception("expired tile sweep failed")
+
+    def _get_sweep_timestamp(self, layer):
+        """Return the timestamp before which stored tiles of the layer are no longer useful
+
+        :returns: the timestamp or None if tiles of the layer should not be swept
+        :rtype: float or None
+        """
+        expiry_timestamp = self._get_expiry_timestamp(layer)
+        if expiry_timestamp is None:
+            return None
+        if layer.stale_while_revalidate:
+            # timed-out tiles can still be shown until they are past the maximum staleness
+            if layer.max_staleness is None:
+                return None
+            return min(expiry_timestamp, time.time() - layer.max_staleness*60*60)
+        return expiry_timestamp
+
+    def _sweep_should_stop(self):
+        """Report if an ongoing expired tile sweep should stop
+
+        The sweep stops on shutdown and once tiles are being loaded again
+        (it will continue with the next sweep).
+        """
+        if self._eviction_stop_requested:
+            return True
+        return time.time() - self._last_tile_request < constants.TILE_STORAGE_EXPIRY_IDLE_TIME
+
+    def sweep_expired_tiles(self, chunk_delay=0):
+        """Delete timed-out tiles from stores of all layers that have been used so far
+
+        Tiles are deleted in chunks, so that the sweep does not block tile loading
+        and it stops early once tiles are requested again.
+
+        :param float chunk_delay: how long to wait between deleting chunks of tiles (in seconds)
+        :returns: number of deleted tiles
+        :rtype: int
+        """
+        start = time.time()
+        with self._tile_storage_management_lock:
+            layer_stores = [(layer, list(store_odict.values())) for layer, store_odict in self._stores.items()]
+
+        def chunk_callback(store_deleted_count):
+            if chunk_delay:
+                self._expiry_event.wait(chunk_delay)
+            return not self._sweep_should_stop()
+
+        deleted_count = 0
+        for layer, stores in layer_stores:
+            sweep_timestamp = self._get_sweep_timestamp(layer)
+            if sweep_timestamp is None:
+                continue
+            for store in stores:
+                if self._sweep_should_stop():
+                    self.log.debug("expired tile sweep interrupted")
+                    return deleted_count
+                try:
+                    deleted_count += store.delete_older_than(sweep_timestamp, chunk_callback=chunk_callback)
+                except NotImplementedError:
+                    pass
+        if deleted_count:
+            self.log.info("%d expired tiles deleted in %1.2f s", deleted_count, time.time() - start)
+        return deleted_count
+
+    def delete_region(self, layer, bbox, zoom_range):
+        """Delete all tiles of a layer in an area from all stores of the layer
+
+        :param layer: the layer to delete the tiles for
+        :param tuple bbox: (lat1, lon1, lat2, lon2) corners of the area
+        :param tuple zoom_range: (min zoom, max zoom) inclusive zoom level range
+        :returns: number of deleted tiles
+        :rtype: int
+        """
+        lat1, lon1, lat2, lon2 = bbox
+        # the Web Mercator projection can't represent the poles
+        max_lat = 85.0511
+        north = min(max(lat1, lat2), max_lat)
+        south = max(min(lat1, lat2), -max_lat)
+        west = min(lon1, lon2)
+        east = max(lon1, lon2)
+        tile_ranges = []
+        for z in range(zoom_range[0], zoom_range[1] + 1):
+            last_tile = int(tilenames.numTiles(z)) - 1
+            min_x, min_y = tilenames.tileXY(north, west, z)
+            max_x, max_y = tilenames.tileXY(south, east, z)
+            tile_ranges.append((z, max(0, min_x), min(last_tile, max_x), max(0, min_y), min(last_tile, max_y)))
+        with self._tile_storage_management_lock:
+            stores = list(self._get_stores_for_reading(layer))
+        deleted_count = 0
+        for store in stores:
+            try:
+                deleted_count += store.delete_region(tile_ranges)
+            except NotImplementedError:
+                self.log.warning("can't delete region from %s", store)
+        # the existence filter does not need to be updated, it only
+        # reports the deleted tiles as possibly stored
+        self.log.info("%d tiles of layer %s deleted from region %s", deleted_count, layer, bbox)
+        return deleted_count
+
+    def delete_older_than(self, layer, timestamp):
+        """Delete all tiles of a layer older than the given timestamp from all stores of the layer
+
+        :param layer: the layer to delete the tiles for
+        :param timestamp: UNIX timestamp
+        :returns: number of deleted tiles
+        :rtype: int
+        """
+        with self._tile_storage_management_lock:
+            stores = list(self._get_stores_for_reading(layer))
+        deleted_count = 0
+        for store in stores:
+            try:
+                deleted_count += store.delete_older_than(timestamp)
+            except NotImplementedError:
+                self.log.warning("can't delete old tiles from %s", store)
+        return deleted_count
+
     def _tile_loading_debug_changed_cb(self, key, oldValue, newValue):
         if newValue:
             self.log.debug("tile loading debug messages state: enabled")
@@ -208,12 +665,20 @@ class StoreTiles(RanaModule):
 
     def get_tile_data(self, lzxy):
         start = time.clock()
+        self._last_tile_request = time.time()
         layer = lzxy[0]
         self._llog("tile requested: %s" % str(lzxy))
         with self._tile_storage_management_lock:
             stores = self._get_stores_for_reading(layer)
             self._llog("tile %s got stores: %s" % (str(lzxy), list(stores)))
+        if not self._might_be_stored(lzxy):
+            self._llog("tile not stored according to existence filter: %s" % str(lzxy), start)
+            return None
+        if self._negative_cache.is_missing(lzxy):
+            self._llog("tile recently not found: %s" % str(lzxy), start)
+            return None
 
+        generation = self._negative_cache.generation
         for store in stores:
             tile_tuple = store.get_tile(lzxy)
             if tile_tuple is not None:
@@ -229,6 +694,10 @@ class StoreTiles(RanaModule):
                                                        dt,
                                                        timestamp))
                     if timestamp < dt:
+                        if self._can_use_stale_tile(layer, timestamp):
+                            self._llog("returning timed-out tile while it is refreshed: %s" % str(lzxy), start)
+                            self._stale_tile_loaded(lzxy)
+                            return tile_data
                         self.log.debug("not loading timed-out tile: %s" % str(lzxy))
                         return None # pretend the tile is not stored
                     else:  # still fresh enough
@@ -238,6 +707,7 @@ class StoreTiles(RanaModule):
                     self._llog("returning tile data for: %s" % str(lzxy), start)
                     return tile_data
         # nothing found in any store (or no stores)
+        self._negative_cache.add(lzxy, generation)
         self._llog("tile not found: %s" % str(lzxy), start)
         return None
 
@@ -247,6 +717,13 @@ class StoreTiles(RanaModule):
         layer = lzxy[0]
         with self._tile_storage_management_lock:
             stores = self._get_stores_for_reading(layer)
+        if not self._might_be_stored(lzxy):
+            self._llog("tile not stored according to existence filter: %s" % str(lzxy), start)
+            return False
+        if self._negative_cache.is_missing(lzxy):
+            self._llog("tile recently not found: %s" % str(lzxy), start)
+            return False
+        generation = self._negative_cache.generation
         for store in stores:
             tile_tuple = store.tile_is_stored(lzxy)
             if tile_tuple is not False:
@@ -272,19 +749,504 @@ class StoreTiles(RanaModule):
                     self._llog("we have tile: %s" % str(lzxy), start)
                     return True
         # nothing found in any store (or no stores)
+        self._negative_cache.add(lzxy, generation)
         self._llog("we have not found tile: %s" % str(lzxy), start)
         return False
 
-    def store_tile_data(self, lzxy, tile_data):
+    def _get_expiry_timestamp(self, layer):
+        """Return the timestamp before which tiles of the given layer are considered timed-out
+
+        :returns: expiry timestamp or None if tiles of the layer never time out
+        :rtype: float or None
+        """
+        if layer.timeout is None:
+            return None
+        # layer.timeout is in hours, convert to seconds
+        return time.time() - layer.timeout*60*60
+
+    def _can_use_stale_tile(self, layer, timestamp):
+        """Report if a timed-out tile can still be used while a fresh tile is being downloaded
+
+        :param layer: layer of the tile
+        :param timestamp: timestamp of the timed-out tile
+        :returns: True if the layer uses stale-while-revalidate and the tile
+                  is not older than the maximum staleness of the layer
+        :rtype: bool
+        """
+        if not layer.stale_while_revalidate:
+            return False
+        if layer.max_staleness is None:
+            return True
+        # max staleness is in hours, convert to seconds
+        return timestamp >= time.time() - layer.max_staleness*60*60
+
+    def _group_by_layer(self, lzxy_iterable):
+        """Group lzxy tuples by layer
+
+        :returns: dictionary of lzxy tuple lists, keyed by layer
+        :rtype: dict
+        """
+        tiles_by_layer = OrderedDict()
+        for lzxy in lzxy_iterable:
+            tiles_by_layer.setdefault(lzxy[0], []).append(lzxy)
+        return tiles_by_layer
+
+    def _get_tiles_to_look_up(self, lzxy_list):
+        """Get tiles that might be stored according to the existence filter
+        and have not been recently not found
+
+        :param list lzxy_list: list of lzxy tuples
+        :returns: set of lzxy tuples to look for in the stores
+        :rtype: set
+        """
+        return set(lzxy for lzxy in lzxy_list
+                   if self._might_be_stored(lzxy) and not self._negative_cache.is_missing(lzxy))
+
+    def get_tiles_data(self, lzxy_iterable):
+        """Get data for multiple tiles at once
+
+        The tiles are requested from each store in bulk, which is much faster
+        than calling get_tile_data() for every tile. Just like with get_tile_data()
+        timed-out tiles are reported as not found.
+
+        :param lzxy_iterable: an iterable of lzxy tuples
+        :returns: a dictionary of tile data keyed by lzxy tuple for all tiles that
+                  have been found
+        :rtype: dict
+        """
+        start = time.time()
+        self._last_tile_request = start
+        found_tiles = {}
+        for layer, layer_tiles in self._group_by_layer(lzxy_iterable).items():
+            with self._tile_storage_management_lock:
+                stores = list(self._get_stores_for_reading(layer))
+            expiry_timestamp = self._get_expiry_timestamp(layer)
+            remaining = self._get_tiles_to_look_up(layer_tiles)
+            generation = self._negative_cache.generation
+            for store in stores:
+                if not remaining:
+                    break
+                for lzxy, (tile_data, timestamp) in store.get_tiles(remaining).items():
+                    remaining.discard(lzxy)
+                    if expiry_timestamp is not None and timestamp < expiry_timestamp:
+                        if self._can_use_stale_tile(layer, timestamp):
+                            found_tiles[lzxy] = tile_data
+                            self._stale_tile_loaded(lzxy)
+                        else:
+                            self.log.debug("not loading timed-out tile: %s" % str(lzxy))
+                    else:
+                        found_tiles[lzxy] = tile_data
+            for lzxy in remaining:
+                self._negative_cache.add(lzxy, generation)
+        self._llog("%d tiles found in bulk in %1.2f ms" % (len(found_tiles), (time.time() - start) * 1000))
+        return found_tiles
+
+    def tiles_are_stored(self, lzxy_iterable):
+        """Report which of the given tiles are stored
+
+        Just like with tile_is_stored() timed-out tiles are reported as not stored.
+
+        :param lzxy_iterable: an iterable of lzxy tuples
+        :returns: set of lzxy tuples of tiles that are stored
+        :rtype: set
+        """
+        start = time.time()
+        self._last_tile_request = start
+        stored_tiles = set()
+        for layer, layer_tiles in self._group_by_layer(lzxy_iterable).items():
+            with self._tile_storage_management_lock:
+                stores = list(self._get_stores_for_reading(layer))
+            expiry_timestamp = self._get_expiry_timestamp(layer)
+            remaining = self._get_tiles_to_look_up(layer_tiles)
+            generation = self._negative_cache.generation
+            for store in stores:
+                if not remaining:
+                    break
+                for lzxy, timestamp in store.tiles_stored(remaining).items():
+                    remaining.discard(lzxy)
+                    if expiry_timestamp is not None and timestamp < expiry_timestamp:
+                        self.log.debug("reporting we don't have timed-out tile: %s" % str(lzxy))
+                    else:
+                        stored_tiles.add(lzxy)
+            for lzxy in remaining:
+                self._negative_cache.add(lzxy, generation)
+        self._llog("%d tiles reported as stored in bulk in %1.2f ms" % (len(stored_tiles), (time.time() - start) * 1000))
+        return stored_tiles
+
+    def build_tile_pack(self, layer, pack_name=None, store_type=None):
+        """Build a read only tile pack from tiles of the given layer in a background thread
+
+        Once built, the tile pack is used for reading tiles of the layer before the other stores.
+
+        :param layer: layer to build the tile pack for
+        :param str pack_name: name of the tile pack file (without extension),
+                              defaults to a name based on the current date and time
+        :param str store_type: type of the store to build the tile pack from,
+                               defaults to the primary tile storage type
+        :returns: the builder thread
+        :rtype: threads.ModRanaThread
+        """
+        if store_type is None:
+            store_type = self._primary_tile_storage_type
+        if pack_name is None:
+            pack_name = time.strftime("%Y%m%d_%H%M%S")
+        layer_folder_path = os.path.join(self.modrana.paths.map_folder_path, layer.folder_name)
+        pack_path = os.path.join(layer_folder_path, pack_name + TILE_PACK_FILE_EXTENSION)
+
+        def build():
+            with self._tile_storage_management_lock:
+                source_store = self._stores[layer].get(store_type)
+            if source_store is None:
+                self.log.error("can't build tile pack for layer %s, no %s store found", layer, store_type)
+                return None
+            # make sure tiles in flight are included
+            source_store.flush()
+            thread.status = "building tile pack"
+
+            def progress(tile_count):
+                thread.status = "%d tiles packed" % tile_count
+
+            tile_count = build_tile_pack(source_store, layer, pack_path, progress_callback=progress)
+            # replace the tile pack store of the layer (if any) with one including the new pack
+            # - the old tile pack store is not closed as other threads might be reading from it,
+            #   its memory mappings are released once it is garbage collected
+            pack_store = TilePackStore(layer_folder_path)
+            with self._tile_storage_management_lock:
+                store_tuples = [store_tuple for store_tuple in self._stores[layer].items()
+                                if store_tuple[0] != constants.TILE_STORAGE_PACK]
+                store_tuples.append((constants.TILE_STORAGE_PACK, pack_store))
+                store_tuples.sort(key=self._sort_store_tuples)
+                self._stores[layer] = OrderedDict(store_tuples)
+            thread.status = "tile pack with %d tiles built" % tile_count
+            return tile_count
+
+        thread = threads.ModRanaThread(name=constants.THREAD_TILE_PACK_BUILDER, target=build)
+        threads.threadMgr.add(thread)
+        return thread
+
+    def deduplicate_tiles(self, layer):
+        """Deduplicate tiles already stored in the sqlite store of the given layer in a background thread
+
+        Tiles stored once this is done are only deduplicated if the
+        sqliteTileDatabaseDeduplicate option is enabled.
+
+        :param layer: layer to deduplicate tiles for
+        :returns: the deduplication thread
+        :rtype: threads.ModRanaThread
+        """
+
+        def deduplicate():
+            with self._tile_storage_management_lock:
+                store = self._stores[layer].get(constants.TILE_STORAGE_SQLITE)
+            if store is None:
+                self.log.error("can't deduplicate tiles for layer %s, no sqlite store found", layer)
+                return None
+            thread.status = "deduplicating tiles"
+
+            def progress(tile_count):
+                thread.status = "%d tiles deduplicated" % tile_count
+
+            tile_count, saved = store.deduplicate_tiles(progress_callback=progress)
+            message = "%d tiles deduplicated, %1.1f MiB saved" % (tile_count, saved / (1024.0 * 1024.0))
+            thread.status = message
+            self.notify(message, 5000)
+            return tile_count, saved
+
+        thread = threads.ModRanaThread(name=constants.THREAD_TILE_DEDUPLICATION, target=deduplicate)
+        threads.threadMgr.add(thread)
+        return thread
+
+    def migrate_tiles(self, layer, source_type=None, target_type=None):
+        """Move tiles of the given layer from one store to another in a background thread
+
+        Once all tiles have been moved, the source store is no longer used for reading
+        tiles and it is deleted on shutdown. The migration is resumed once the stores
+        of the layer are opened again if it is interrupted (such as by modRana being closed).
+
+        :param layer: layer to migrate tiles for
+        :param str source_type: type of the store to move the tiles from, defaults to
+                                the sqlite or file based type, whichever is not the target type
+        :param str target_type: type of the store to move the tiles to,
+                                defaults to the primary tile storage type
+        :returns: the migration thread or None if the tiles can't be migrated
+        :rtype: threads.ModRanaThread or None
+        """
+        if target_type is None:
+            target_type = self._primary_tile_storage_type
+        if source_type is None:
+            if target_type == constants.TILE_STORAGE_FILES:
+                source_type = constants.TILE_STORAGE_SQLITE
+            else:
+                source_type = constants.TILE_STORAGE_FILES
+        if source_type == target_type or constants.TILE_STORAGE_PACK in (source_type, target_type):
+            self.log.error("can't migrate tiles of layer %s from %s to %s store", layer, source_type, target_type)
+            return None
+        layer_folder_path = os.path.join(self.modrana.paths.map_folder_path, layer.folder_name)
+        journal_path = os.path.join(layer_folder_path, TILE_MIGRATION_JOURNAL_FILE_NAME)
+        journal = MigrationJournal.load(journal_path)
+        if journal is None or (journal.source_type, journal.target_type) != (source_type, target_type):
+            journal = MigrationJournal(journal_path, source_type, target_type)
+        return self._start_migration(layer, journal)
+
+    def migrate_all_tiles(self, target_type=None):
+        """Move tiles of all layers to the store of the given type in background threads
+
+        Tiles of each layer are moved from one of its stores of other types at a time,
+        the other ones can be migrated once it is done.
+
+        :param str target_type: type of the store to move the tiles to,
+                                defaults to the primary tile storage type
+        :returns: number of migrations started
+        :rtype: int
+        """
+        if target_type is None:
+            target_type = self._primary_tile_storage_type
+        map_layers = self.m.get('mapLayers', None)
+        if map_layers is None:
+            return 0
+        started = 0
+        for layer in map_layers.getLayerList():
+            layer_folder_path = os.path.join(self.modrana.paths.map_folder_path, layer.folder_name)
+            if not os.path.isdir(layer_folder_path):
+                # no tiles stored for the layer
+                continue
+            with self._tile_storage_management_lock:
+                source_types = [store_type for store_type in self._stores[layer].keys()
+                                if store_type not in (target_type, constants.TILE_STORAGE_PACK)]
+            if source_types and self.migrate_tiles(layer, source_type=source_types[0],
+                                                   target_type=target_type) is not None:
+                started += 1
+        return started
+
+    def _start_migration(self, layer, journal):
+        """Start a tile migration thread for the given layer & migration journal"""
+
+        def run_migration():
+            with self._tile_storage_management_lock:
+                if layer in self._migrations:
+                    self.log.warning("tiles of layer %s are already being migrated", layer)
+                    return None
+                source_store = self._stores[layer].get(journal.source_type)
+                if source_store is None:
+                    self.log.info("no %s store found for layer %s, nothing to migrate", journal.source_type, layer)
+                    journal.remove()
+                    return None
+                target_store = self._get_or_create_store(layer, journal.target_type)
+                reader_count = int(self.get("tileStorageMigrationReaderCount",
+                                            constants.DEFAULT_TILE_STORAGE_MIGRATION_READER_COUNT))
+                migration = TileMigration(source_store, target_store, layer, journal, reader_count=reader_count)
+                self._migrations[layer] = migration
+            if self._eviction_stop_requested:
+                # shutting down
+                migration.stop()
+            thread.status = "migrating tiles"
+
+            def progress(migrated_count, total_count):
+                if total_count:
+                    thread.status = "%d/%d tiles migrated" % (migrated_count, total_count)
+                    thread.progress = migrated_count / float(total_count)
+                else:
+                    thread.status = "%d tiles migrated" % migrated_count
+                self._tile_migration_progress(layer, migrated_count, total_count)
+
+            try:
+                finished = migration.run(progress_callback=progress)
+            finally:
+                with self._tile_storage_management_lock:
+                    self._migrations.pop(layer, None)
+            if finished:
+                # drop the source store from the read chain
+                with self._tile_storage_management_lock:
+                    store_tuples = [store_tuple for store_tuple in self._stores[layer].items()
+                                    if store_tuple[0] != journal.source_type]
+                    self._stores[layer] = OrderedDict(store_tuples)
+                    self._retired_stores[layer][journal.source_type] = source_store
+                message = "%d tiles moved to %s storage" % (journal.migrated_count, journal.target_type)
+                self.notify(message, 5000)
+            else:
+                message = "tile migration stopped after %d tiles" % journal.migrated_count
+            thread.status = message
+            return finished
+
+        def migrate():
+            finished = False
+            try:
+                finished = run_migration()
+                return finished
+            finally:
+                self._tile_migration_finished(layer, bool(finished))
+
+        thread = threads.ModRanaThread(name=constants.THREAD_TILE_STORAGE_MIGRATION, target=migrate)
+        with self._tile_storage_management_lock:
+            self._migration_threads = [t for t in self._migration_threads if t.is_alive()]
+            self._migration_threads.append(thread)
+        threads.threadMgr.add(thread)
+        return thread
+
+    def stop_tile_migration(self, layer):
+        """Stop migration of tiles of the given layer (if running), it is resumed once
+        the stores of the layer are opened again or once migrate_tiles() is called
+        """
+        with self._tile_storage_management_lock:
+            migration = self._migrations.get(layer)
+        if migration is not None:
+            migration.stop()
+
+    def stop_all_tile_migrations(self):
+        """Stop all running tile migrations, they are resumed once the stores
+        of the layers are opened again
+        """
+        with self._tile_storage_management_lock:
+            migrations = list(self._migrations.values())
+        for migration in migrations:
+            migration.stop()
+
+    def repack_tiles(self, layer):
+        """Repack the storage databases of the sqlite store of the given layer in a background thread
+
+        Tiles are moved to as few storage databases as possible and the emptied
+        storage databases are deleted.
+
+        :param layer: layer to repack tiles for
+        :returns: the repacking thread
+        :rtype: threads.ModRanaThread
+        """
+
+        def repack():
+            with self._tile_storage_management_lock:
+                store = self._stores[layer].get(constants.TILE_STORAGE_SQLITE)
+            if store is None:
+                self.log.error("can't repack tiles for layer %s, no sqlite store found", layer)
+                return None
+            thread.status = "repacking tiles"
+
+            def progress(tile_count):
+                thread.status = "%d tiles repacked" % tile_count
+
+            tile_count, removed_count = store.repack(progress_callback=progress)
+            message = "%d tiles repacked, %d tile databases removed" % (tile_count, removed_count)
+            thread.status = message
+            self.notify(message, 5000)
+            return tile_count, removed_count
+
+        thread = threads.ModRanaThread(name=constants.THREAD_TILE_STORAGE_REPACK, target=repack)
+        threads.threadMgr.add(thread)
+        return thread
+
+    def store_tile_data(self, lzxy, tile_data, etag=None, last_modified=None):
         start = time.clock()
         self._llog("store tile data for: %s" % str(lzxy))
         store = self._get_store_for_writing(lzxy[0])
         self._llog("store tile data for: %s into %s" % (str(lzxy), store))
-        store.store_tile_data(lzxy, tile_data)
+        store.store_tile_data(lzxy, tile_data, etag=etag, last_modified=last_modified)
+        self._negative_cache.discard(lzxy)
+        existence_filter = self._existence_filters.get(lzxy[0])
+        if existence_filter is not None:
+            existence_filter.add(lzxy[1], lzxy[2], lzxy[3])
+        if self._eviction_thread is not None:
+            self._tiles_stored_since_eviction += 1
+            if self._tiles_stored_since_eviction >= constants.TILE_STORAGE_EVICTION_TILE_COUNT:
+                self._tiles_stored_since_eviction = 0
+                self._eviction_event.set()
         self._llog("stored tile data for: %s" % str(lzxy), start)
 
+    def tile_download_finished(self, lzxy):
+        """Forget that the tile has recently not been found, as it might be stored now
+
+        Called once a download of the tile finishes, no matter if the download
+        succeeded or not, so the next lookup of the tile checks the stores again.
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+        """
+        self._negative_cache.discard(lzxy)
+
+    def get_tile_stats(self, layer):
+        """Get per zoom level statistics of tiles stored for a layer
+
+        The stores keep the statistics up to date as tiles are stored and deleted,
+        so this is cheap even for big stores (see the tile_storage.stats module).
+
+        :param layer: the layer to get the statistics for
+        :returns: combined statistics of all stores of the layer or None
+                  if none of the stores can provide statistics
+        :rtype: core.tile_storage.stats.TileStats or None
+        """
+        with self._tile_storage_management_lock:
+            stores = list(self._get_stores_for_reading(layer))
+        layer_stats = None
+        for store in stores:
+            store_stats = store.get_stats()
+            if store_stats is not None:
+                if layer_stats is None:
+                    layer_stats = TileStats()
+                layer_stats.merge(store_stats)
+        return layer_stats
+
+    def get_tile_validators(self, lzxy):
+        """Get HTTP cache validators of a stored tile
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+        :returns: (etag, last_modified) tuple or None if no store has validators for the tile
+        :rtype: tuple or None
+        """
+        layer = lzxy[0]
+        with self._tile_storage_management_lock:
+            stores = list(self._get_stores_for_reading(layer))
+        for store in stores:
+            validators = store.get_tile_validators(lzxy)
+            if validators is not None:
+                return validators
+        return None
+
+    def touch_tile(self, lzxy, etag=None, last_modified=None):
+        """Mark a stored tile as fresh after the tile server reported it has not been modified
+
+        :param tuple lzxy: layer, z, x, y coordinate tuple describing a single tile
+        :param etag: new ETag of the tile (if any)
+        :param last_modified: new Last-Modified value of the tile (if any)
+        :returns: True if the tile has been touched in some store, else False
+        :rtype: bool
+        """
+        layer = lzxy[0]
+        with self._tile_storage_management_lock:
+            stores = list(self._get_stores_for_reading(layer))
+        for store in stores:
+            if store.touch_tile(lzxy, etag=etag, last_modified=last_modified):
+                self._llog("touched tile: %s in %s" % (str(lzxy), store))
+                return True
+        return False
+
+    def delete_tile(self, lzxy):
+        """Delete the tile from all stores of its layer"""
+        layer = lzxy[0]
+        with self._tile_storage_management_lock:
+            stores = list(self._get_stores_for_reading(layer))
+        for store in stores:
+            store.delete_tile(lzxy)
+        existence_filter = self._existence_filters.get(layer)
+        if existence_filter is not None:
+            existence_filter.remove(lzxy[1], lzxy[2], lzxy[3])
+        self._llog("deleted tile: %s" % str(lzxy))
+
     def shutdown(self):
         start = time.clock()
+        # stop the eviction & expiry jobs (if running) before closing the stores
+        self._eviction_stop_requested = True
+        self._eviction_event.set()
+        self._expiry_event.set()
+        if self._eviction_thread is not None:
+            self._eviction_thread.join()
+        if self._expiry_thread is not None:
+            self._expiry_thread.join()
+        # stop any tile migrations, they are resumed on next start
+        with self._tile_storage_management_lock:
+            migrations = list(self._migrations.values())
+            migration_threads = list(self._migration_threads)
+        for migration in migrations:
+            migration.stop()
+        for migration_thread in migration_threads:
+            if migration_thread.is_alive():
+                migration_thread.join()
         # close all stores
         self.log.debug("closing tile stores")
         layer_count = 0
@@ -295,5 +1257,13 @@ class StoreTiles(RanaModule):
                     store.close()
                     store_count+=1
             layer_count+=1
+            # all tiles have been moved away from the retired stores
+            # - close them first, so that any writer threads they have are stopped
+            for retired_stores in self._retired_stores.values():
+                for store in retired_stores.values():
+                    store.close()
+                    store.clear()
+            # the stores are now closed, so their modification stamps are final
+            self._save_existence_filters()
         self.log.debug("closed all tile stores (for %d layers, %d stores in total in %s)"
                        % (layer_count, store_count, utils.get_elapsed_time_string(start)))
@@ -0,0 +1,148 @@
+import asyncio
+import threading
+import unittest
+
+from core import threads
+from core.async_http import HTTPClient
+from core.async_pool import EventLoopThread, AsyncTaskPool
+
+TILE = b"\x89PNG\r\n\x1a\n tile"
+
+async def _serve(reader, writer):
+    """Mock tile server, the path selects how the response is sent"""
+    try:
+        while True:
+            request = await reader.readuntil(b"\r\n\r\n")
+            path = request.split(b" ")[1]
+            if path == b"/chunked":
+                writer.write(b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                             b"4\r\n\x89PNG\r\n9\r\n\r\n\x1a\n tile\r\n0\r\n\r\n")
+            elif path == b"/close":
+                writer.write(b"HTTP/1.1 200 OK\r\nConnection: close\r\n\r\n" + TILE)
+                await writer.drain()
+                break
+            elif path == b"/cached":
+                if b"If-None-Match: \"1\"" in request:
+                    writer.write(b"HTTP/1.1 304 Not Modified\r\nETag: \"1\"\r\n\r\n")
+                else:
+                    writer.write(b"HTTP/1.1 200 OK\r\nETag: \"1\"\r\nContent-Length: %d\r\n\r\n" % len(TILE) + TILE)
+            else:
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(TILE) + TILE)
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+        # the client has closed the connection or the test is done
+        pass
+    finally:
+        writer.close()
+
+def _runWithServer(test):
+    """Run test(client, baseUrl) coroutine against the mock tile server"""
+    async def run():
+        server = await asyncio.start_server(_serve, "127.0.0.1", 0)
+        client = HTTPClient(headers={"User-Agent": "modRanaTest"})
+        try:
+            return await test(client, "http://127.0.0.1:%d" % server.sockets[0].getsockname()[1])
+        finally:
+            await client.close()
+            server.close()
+            await server.wait_closed()
+    return asyncio.run(run())
+
+class AsyncHTTPClientTests(unittest.TestCase):
+
+    def keep_alive_test(self):
+        """Check that a connection is reused for subsequent requests"""
+        async def test(client, baseUrl):
+            responses = []
+            for i in range(3):
+                responses.append(await client.request("GET", baseUrl + "/tile.png"))
+            return responses, client.connectionCount
+        responses, connectionCount = _runWithServer(test)
+        self.assertEqual([r.data for r in responses], [TILE] * 3)
+        self.assertEqual(responses[0].status, 200)
+        self.assertEqual(connectionCount, 1)
+
+    def body_framing_test(self):
+        """Check chunked & close delimited response bodies"""
+        async def test(client, baseUrl):
+            chunked = await client.request("GET", baseUrl + "/chunked")
+            closed = await client.request("GET", baseUrl + "/close")
+            # the server has closed the connection, so a new one is needed
+            after = await client.request("GET", baseUrl + "/tile.png")
+            return chunked, closed, after, client.connectionCount
+        chunked, closed, after, connectionCount = _runWithServer(test)
+        self.assertEqual(chunked.data, TILE)
+        self.assertEqual(closed.data, TILE)
+        self.assertEqual(after.data, TILE)
+        self.assertEqual(connectionCount, 2)
+
+    def not_modified_test(self):
+        """Check conditional requests & responses without a body"""
+        async def test(client, baseUrl):
+            fresh = await client.request("GET", baseUrl + "/cached")
+            cached = await client.request("GET", baseUrl + "/cached",
+                                          headers={"If-None-Match": fresh.getheaders()["etag"]})
+            head = await client.request("HEAD", baseUrl + "/tile.png")
+            return fresh, cached, head
+        fresh, cached, head = _runWithServer(test)
+        self.assertEqual(fresh.data, TILE)
+        self.assertEqual(cached.status, 304)
+        self.assertEqual(cached.data, b"")
+        self.assertEqual(head.data, b"")
+
+class AsyncTaskPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        if threads.threadMgr is None:
+            threads.initThreading()
+        self.loopThread = EventLoopThread("asyncTaskPoolTest")
+
+    def tearDown(self):
+        self.loopThread.stop()
+
+    def task_limit_test(self):
+        """Check that at most maxTasks tasks run at once & that all tasks are run"""
+        lock = threading.Lock()
+        counts = {"running": 0, "maxRunning": 0, "done": 0}
+
+        async def task():
+            with lock:
+                counts["running"] += 1
+                counts["maxRunning"] = max(counts["maxRunning"], counts["running"])
+            await asyncio.sleep(0.01)
+            with lock:
+                counts["running"] -= 1
+                counts["done"] += 1
+
+        pool = AsyncTaskPool(self.loopThread, 5, taskBufferSize=-1)
+        for i in range(20):
+            pool.submit(task)
+        pool.shutdown(join=True, asynchronous=False)
+        self.assertEqual(counts["done"], 20)
+        self.assertEqual(counts["maxRunning"], 5)
+        self.assertRaises(RuntimeError, pool.submit, task)
+
+    def leak_test(self):
+        """Check that the oldest waiting task is leaked once the stack is full"""
+        started = threading.Event()
+        release = threading.Event()
+
+        async def blocker():
+            started.set()
+            while not release.is_set():
+                await asyncio.sleep(0.01)
+
+        async def task(index):
+            pass
+
+        pool = AsyncTaskPool(self.loopThread, 1, taskBufferSize=1, leak=True)
+        pool.submit(blocker)
+        started.wait(5)
+        self.assertIsNone(pool.submit(task, 1))
+        self.assertIsNone(pool.submit(task, 2))
+        # the stack holds maxTasks + taskBufferSize tasks
+        self.assertEqual(pool.submit(task, 3), (task, (1,), {}))
+        self.assertEqual(pool.qsize(), 2)
+        release.set()
+        pool.shutdown(join=True, asynchronous=False)
+        self.assertEqual(pool.qsize(), 0)
@@ -22,7 +22,12 @@ revision=1
   group="osm"
   icon="mapnik"
   timeout=240.5
+  stale_while_revalidate=yes
+  max_staleness=480
   connection_timeout=30
+  subdomains=a,b,c
+  subdomain_selection=round_robin
+  max_connections_per_host=4
 
 [[osm_landscape]]
   label=Landscape
@@ -59,6 +64,8 @@ class MapLayerTests(unittest.TestCase):
         self.assertEqual(layer.group_id, "osm")
         self.assertEqual(layer.icon, "mapnik")
         self.assertEqual(layer.timeout, 240.5)
+        self.assertTrue(layer.stale_while_revalidate)
+        self.assertEqual(layer.max_staleness, 480.0)
 
         expected_dict = {
             "id": "mapnik",
@@ -72,6 +79,21 @@ class MapLayerTests(unittest.TestCase):
             "group_id": "osm",
             "icon": "mapnik",
             "timeout": 240.5,
-            "connection_timeout": 30
+            "stale_while_revalidate": True,
+            "max_staleness": 480.0,
+            "connection_timeout": 30,
+            "subdomains": ["a", "b", "c"],
+            "subdomain_selection": "round_robin",
+            "max_connections_per_host": 4
         }
-        self.assertDictEqual(layer.dict, expected_dict)
\ No newline at end of file
+        self.assertDictEqual(layer.dict, expected_dict)
+
+    def layer_defaults_test(self):
+        """Check optional layer properties have sensible defaults."""
+        layer = MapLayer(layerId="osm_landscape", config=config["layers"]["osm_landscape"])
+        self.assertIsNone(layer.timeout)
+        self.assertFalse(layer.stale_while_revalidate)
+        self.assertIsNone(layer.max_staleness)
+        self.assertEqual(layer.subdomains, [])
+        self.assertEqual(layer.subdomain_selection, "hash")
+        self.assertIsNone(layer.max_connections_per_host)
@@ -0,0 +1,73 @@
+import unittest
+import tempfile
+import shutil
+import os
+
+from core import memory
+from core.memory import MemoryStatus, CacheSizeController
+
+MEMINFO = """MemTotal:        1000000 kB
+MemFree:          100000 kB
+MemAvailable:     400000 kB
+Buffers:           20000 kB
+Cached:           200000 kB
+HugePages_Total:       0
+"""
+
+class MemoryTests(unittest.TestCase):
+
+    def meminfo_test(self):
+        """Check that /proc/meminfo is parsed correctly"""
+        meminfo = memory.parse_meminfo(MEMINFO)
+        self.assertEqual(meminfo["MemTotal"], 1000000 * 1024)
+        self.assertEqual(meminfo["HugePages_Total"], 0)
+        self.assertEqual(memory.get_available_memory(meminfo), 400000 * 1024)
+        # older kernels don't report MemAvailable
+        del meminfo["MemAvailable"]
+        self.assertEqual(memory.get_available_memory(meminfo), 320000 * 1024)
+
+    def read_memory_status_test(self):
+        """Check reading memory status from /proc like files"""
+        folder = tempfile.mkdtemp()
+        try:
+            meminfo_path = os.path.join(folder, "meminfo")
+            statm_path = os.path.join(folder, "statm")
+            with open(meminfo_path, "w") as f:
+                f.write(MEMINFO)
+            with open(statm_path, "w") as f:
+                f.write("5000 1000 200 10 0 800 0\n")
+            status = memory.read_memory_status(meminfo_path, statm_path)
+            self.assertEqual(status.total, 1000000 * 1024)
+            self.assertEqual(status.available, 400000 * 1024)
+            self.assertEqual(status.rss, 1000 * os.sysconf("SC_PAGE_SIZE"))
+            # RSS is optional
+            status = memory.read_memory_status(meminfo_path, os.path.join(folder, "missing"))
+            self.assertIsNone(status.rss)
+            self.assertIsNone(memory.read_memory_status(os.path.join(folder, "missing")))
+        finally:
+            shutil.rmtree(folder)
+
+    def scale_limit_test(self):
+        """Check that only positive cache limits are scaled and never become unlimited"""
+        self.assertEqual(memory.scale_limit(400, 0.25), 100)
+        self.assertEqual(memory.scale_limit(400, 4.0), 1600)
+        self.assertEqual(memory.scale_limit(3, 0.25), 1)
+        self.assertEqual(memory.scale_limit(0, 0.25), 0)
+        self.assertEqual(memory.scale_limit(-1, 4.0), -1)
+
+    def controller_test(self):
+        """Check that the cache scale follows memory pressure within its range"""
+        controller = CacheSizeController(min_scale=0.25, max_scale=2.0)
+        # neither low nor plenty of memory
+        self.assertIsNone(controller.update(MemoryStatus(1000, 200)))
+        # low on memory
+        self.assertEqual(controller.update(MemoryStatus(1000, 50)), 0.5)
+        self.assertEqual(controller.update(MemoryStatus(1000, 50)), 0.25)
+        self.assertIsNone(controller.update(MemoryStatus(1000, 50)))
+        # the process uses too much memory
+        controller = CacheSizeController(min_scale=0.25, max_scale=2.0)
+        self.assertEqual(controller.update(MemoryStatus(1000, 500, rss=600)), 0.5)
+        # plenty of memory
+        for i in range(10):
+            controller.update(MemoryStatus(1000, 500, rss=100))
+        self.assertEqual(controller.scale, 2.0)
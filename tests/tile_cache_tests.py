@@ -0,0 +1,93 @@
+import unittest
+
+from core.tile_cache import TileCache, FilteredTileCache, asBuffer
+
+class TileCacheTests(unittest.TestCase):
+
+    def lru_eviction_test(self):
+        """Check that the least recently used item is evicted once the cache is full"""
+        cache = TileCache(maxItems=3)
+        for key in ("a", "b", "c"):
+            cache.put(key, b"1")
+        # a hit makes "a" the most recently used item
+        self.assertEqual(cache.get("a"), b"1")
+        cache.put("d", b"1")
+        self.assertNotIn("b", cache)
+        self.assertIn("a", cache)
+        self.assertIn("c", cache)
+        self.assertIn("d", cache)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.evictions, 1)
+
+    def byte_budget_test(self):
+        """Check that the cache is also limited by total item size"""
+        cache = TileCache(maxItems=100, maxBytes=10)
+        cache.put("a", b"1234")
+        cache.put("b", b"1234")
+        self.assertEqual(cache.byteCount, 8)
+        cache.put("c", b"1234")
+        self.assertNotIn("a", cache)
+        self.assertEqual(cache.byteCount, 8)
+        # replacing an item updates the byte count
+        cache.put("b", b"12")
+        self.assertEqual(cache.byteCount, 6)
+        # an explicit size overrides the size function
+        cache.put("d", "not bytes", size=5)
+        self.assertNotIn("c", cache)
+        self.assertEqual(cache.byteCount, 7)
+        # lowering the limits evicts items right away
+        cache.setLimits(maxBytes=5)
+        self.assertEqual(len(cache), 1)
+        self.assertIn("d", cache)
+
+    def counters_test(self):
+        """Check the hit & miss counters and item removal"""
+        cache = TileCache(maxItems=10)
+        cache.put("a", b"123")
+        cache.get("a")
+        cache.get("a")
+        self.assertIsNone(cache.get("b"))
+        # peek does not count as a hit or miss
+        self.assertEqual(cache.peek("a"), b"123")
+        self.assertIsNone(cache.peek("b"))
+        stats = cache.getStats()
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["evictions"], 0)
+        self.assertEqual(stats["items"], 1)
+        self.assertEqual(stats["bytes"], 3)
+        self.assertTrue(cache.remove("a"))
+        self.assertFalse(cache.remove("a"))
+        self.assertEqual(cache.byteCount, 0)
+        cache.put("a", b"1")
+        cache.put("b", b"22")
+        self.assertEqual(cache.removeMatching(lambda key, value: len(value) > 1), 1)
+        self.assertEqual(len(cache), 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.byteCount, 0)
+        cache.resetCounters()
+        self.assertEqual(cache.hits, 0)
+        self.assertEqual(cache.misses, 0)
+
+    def as_buffer_test(self):
+        """Check that bytearrays are not copied when converted to a buffer"""
+        data = bytearray(b"tile")
+        self.assertIs(asBuffer(data), data)
+        self.assertEqual(asBuffer(b"tile"), data)
+        self.assertEqual(asBuffer(memoryview(b"tile")), data)
+
+class FilteredTileCacheTests(unittest.TestCase):
+
+    def remove_tile_test(self):
+        """Check that all filtered versions of a tile are removed, but no other tiles"""
+        cache = FilteredTileCache(maxItems=10)
+        cache.put(("tile1", "night"), b"1")
+        cache.put(("tile1", "invert"), b"2")
+        cache.put(("tile2", "night"), b"3")
+        self.assertEqual(cache.removeTile("tile1"), 2)
+        self.assertNotIn(("tile1", "night"), cache)
+        self.assertNotIn(("tile1", "invert"), cache)
+        self.assertEqual(cache.get(("tile2", "night")), b"3")
+        self.assertEqual(cache.removeTile("tile3"), 0)
+        self.assertEqual(cache.byteCount, 1)
@@ -0,0 +1,33 @@
+import unittest
+from io import BytesIO
+
+from core import tile_filters
+from core.tile_filters import invertFilter, dimFilter, nightFilter, getFilter
+
+class TileFilterTests(unittest.TestCase):
+
+    def combined_filter_test(self):
+        """Check that filters combined with then() apply both filters"""
+        night = nightFilter()
+        self.assertEqual(night.filterId, "night")
+        # black is inverted to white & then dimmed
+        self.assertEqual(night.offset, (0.8 * 255, 0.8 * 255, 0.8 * 255))
+        self.assertEqual(night.matrix[0], (-0.8, 0.0, 0.0))
+        combined = dimFilter(0.5).then(invertFilter())
+        self.assertEqual(combined.filterId, "dim0.5+invert")
+        self.assertEqual(combined.matrix[1], (0.0, -0.5, 0.0))
+        self.assertEqual(combined.offset, (255.0, 255.0, 255.0))
+        self.assertIsNone(getFilter("no such filter"))
+        self.assertEqual(getFilter("invert").filterId, "invert")
+
+    @unittest.skipUnless(tile_filters.FILTERING_AVAILABLE, "NumPy or PIL not available")
+    def invert_tile_test(self):
+        """Check that a tile image is decoded, inverted & encoded again"""
+        from PIL import Image
+        image = Image.new("RGBA", (2, 2), (10, 20, 30, 128))
+        data = BytesIO()
+        image.save(data, "PNG")
+        filtered = invertFilter().applyToTileData(data.getvalue())
+        self.assertIsInstance(filtered, bytearray)
+        filteredImage = Image.open(BytesIO(bytes(filtered)))
+        self.assertEqual(filteredImage.getpixel((1, 1)), (245, 235, 225, 128))
@@ -0,0 +1,82 @@
+import unittest
+
+from core.tile_scheduler import TileDownloadScheduler, Viewport
+
+class _Layer(object):
+    def __init__(self, layerId):
+        self.id = layerId
+
+OSM = _Layer("mapnik")
+OTHER = _Layer("other")
+
+def _drain(scheduler):
+    requests = []
+    while True:
+        request = scheduler.pop()
+        if request is None:
+            return requests
+        requests.append(request.lzxy)
+
+class TileDownloadSchedulerTests(unittest.TestCase):
+
+    def lifo_without_viewport_test(self):
+        """Check that without a viewport the newest request is handled first"""
+        scheduler = TileDownloadScheduler()
+        for x in range(3):
+            scheduler.add((OSM, 10, x, 0))
+        scheduler.add((OSM, 10, 0, 1), lowPriority=True)
+        self.assertEqual(_drain(scheduler),
+                         [(OSM, 10, 2, 0), (OSM, 10, 1, 0), (OSM, 10, 0, 0), (OSM, 10, 0, 1)])
+
+    def viewport_priority_test(self):
+        """Check that tiles closest to the viewport centre & zoom level are handled first"""
+        scheduler = TileDownloadScheduler()
+        scheduler.setViewports([Viewport(["mapnik"], 10, 100, 100, 4, 4)])
+        scheduler.add((OSM, 10, 101, 101))
+        scheduler.add((OSM, 10, 100, 100))
+        scheduler.add((OSM, 9, 50, 50))
+        scheduler.add((OSM, 10, 105, 101))
+        self.assertEqual(_drain(scheduler),
+                         [(OSM, 10, 101, 101), (OSM, 10, 100, 100), (OSM, 10, 105, 101), (OSM, 9, 50, 50)])
+
+    def cancel_test(self):
+        """Check that requests out of view are cancelled once the viewport changes"""
+        scheduler = TileDownloadScheduler(margin=1)
+        for x in range(100, 110):
+            scheduler.add((OSM, 10, x, 100))
+        scheduler.add((OTHER, 10, 100, 100))
+        scheduler.add((OSM, 13, 800, 800))
+        cancelled = scheduler.setViewports([Viewport(["mapnik"], 10, 100, 100, 2, 2)])
+        self.assertEqual(len(cancelled), 9)
+        # tiles in the viewport & its margin are kept, closest to the centre first
+        self.assertEqual(_drain(scheduler), [(OSM, 10, 101, 100), (OSM, 10, 100, 100), (OSM, 10, 102, 100)])
+        self.assertEqual(scheduler.getStats()["cancelled"], 9)
+
+    def drop_when_full_test(self):
+        """Check that the least important request is dropped once the scheduler is full"""
+        scheduler = TileDownloadScheduler(maxSize=2)
+        scheduler.setViewports([Viewport(["mapnik"], 10, 100, 100, 2, 2)])
+        self.assertIsNone(scheduler.add((OSM, 10, 100, 100)))
+        self.assertIsNone(scheduler.add((OSM, 10, 150, 100)))
+        self.assertEqual(scheduler.add((OSM, 10, 101, 101)).lzxy, (OSM, 10, 150, 100))
+        # a refresh is less important than any download
+        self.assertEqual(scheduler.add((OSM, 10, 100, 101), lowPriority=True).lzxy, (OSM, 10, 100, 101))
+        # the same request again does not take more space
+        self.assertIsNone(scheduler.add((OSM, 10, 100, 100)))
+        self.assertEqual(len(scheduler), 2)
+        self.assertEqual(scheduler.getStats()["dropped"], 2)
+
+    def wasted_download_test(self):
+        """Check that downloads finished once out of view are counted as wasted"""
+        scheduler = TileDownloadScheduler()
+        scheduler.add((OSM, 10, 100, 100))
+        scheduler.add((OSM, 10, 101, 100))
+        first = scheduler.pop()
+        second = scheduler.pop()
+        scheduler.requestDone(first)
+        scheduler.setViewports([Viewport(["mapnik"], 10, 0, 0, 2, 2)])
+        scheduler.requestDone(second)
+        stats = scheduler.getStats()
+        self.assertEqual(stats["completed"], 2)
+        self.assertEqual(stats["wasted"], 1)
+        self.assertEqual(stats["queued"], 0)
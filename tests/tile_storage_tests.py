@@ -0,0 +1,1103 @@
+import unittest
+import tempfile
+import shutil
+import threading
+import os
+import sqlite3
+import time
+import json
+
+from core.tile_storage.sqlite_store import SqliteTileStore, get_tile_key, get_tile_zxy
+from core.tile_storage.files_store import FileBasedTileStore
+from core.tile_storage.existence_filter import TileExistenceFilter
+from core.tile_storage.negative_cache import NegativeTileCache
+from core.tile_storage.mbtiles_store import MBTilesTileStore, flip_y
+from core.tile_storage.pack_store import TilePackStore, build_tile_pack
+from core.tile_storage.exceptions import TileStoreWriteFailed
+from core.tile_storage.migration import TileMigration, MigrationJournal, TILE_MIGRATION_JOURNAL_FILE_NAME
+
+PNG_HEADER = b"\211PNG\r\n\032\n"
+
+class FakeLayer(object):
+    def __init__(self, layer_type="png"):
+        self.type = layer_type
+
+def get_tile_data(index):
+    return PNG_HEADER + ("tile %d" % index).encode("utf-8")
+
+def create_v1_store(store_path, zxy_list):
+    """Create a SQLite tile store using the version 1 format"""
+    lookup = sqlite3.connect(os.path.join(store_path, "lookup.sqlite"))
+    lookup.execute("create table tiles (z integer, x integer, y integer, store_filename string, "
+                   "extension varchar(10), unix_epoch_timestamp integer, primary key (z, x, y, extension))")
+    lookup.execute("create table version (v integer)")
+    lookup.execute("insert into version values (1)")
+    store = sqlite3.connect(os.path.join(store_path, "store.sqlite.0"))
+    store.execute("create table tiles (z integer, x integer, y integer, tile blob, "
+                  "extension varchar(10), unix_epoch_timestamp integer, primary key (z, x, y, extension))")
+    store.execute("create table version (v integer)")
+    store.execute("insert into version values (1)")
+    for i, (z, x, y) in enumerate(zxy_list):
+        lookup.execute("insert into tiles values (?, ?, ?, ?, ?, ?)", (z, x, y, "store.sqlite.0", "png", 1000 + i))
+        store.execute("insert into tiles values (?, ?, ?, ?, ?, ?)", (z, x, y, get_tile_data(i), "png", 1000 + i))
+    lookup.commit()
+    store.commit()
+    lookup.close()
+    store.close()
+
+class SqliteTileStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.store_path = tempfile.mkdtemp()
+        self.layer = FakeLayer()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_path)
+
+    def write_behind_test(self):
+        """Test that pending tiles are readable and written by flush()."""
+        # long flush interval so that only flush() or a full batch writes the tiles
+        store = SqliteTileStore(self.store_path, batch_size=1000, flush_interval=3600)
+        lzxy = (self.layer, 3, 1, 2)
+        store.store_tile_data(lzxy, get_tile_data(1))
+        # the tile should be visible before it is written
+        self.assertEqual(store.get_tile(lzxy)[0], get_tile_data(1))
+        self.assertTrue(store.tile_is_stored(lzxy))
+        store.flush()
+        # after flush the tile should be in the database
+        self.assertFalse(store._pending)
+        self.assertEqual(store.get_tile(lzxy)[0], get_tile_data(1))
+        store.close()
+
+        # the tile should survive a store reopen
+        store = SqliteTileStore(self.store_path)
+        self.assertEqual(store.get_tile(lzxy)[0], get_tile_data(1))
+        self.assertFalse(store.tile_is_stored((self.layer, 3, 1, 3)))
+        store.close()
+
+    def clear_test(self):
+        """Test that clear() closes the store & deletes its databases without deadlocking."""
+        store = SqliteTileStore(self.store_path, batch_size=1000, flush_interval=3600)
+        store.store_tile_data((self.layer, 3, 1, 2), get_tile_data(1))
+        store.flush()
+        store.store_tile_data((self.layer, 3, 1, 3), get_tile_data(2))
+        thread = threading.Thread(target=store.clear)
+        thread.daemon = True
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertFalse([name for name in os.listdir(self.store_path) if "sqlite" in name])
+
+    def write_failure_test(self):
+        """Test that flush() reports failed writes & the failed tiles are kept pending."""
+        store = SqliteTileStore(self.store_path, batch_size=1000, flush_interval=3600)
+        lzxy = (self.layer, 3, 1, 2)
+        write_batch = store._write_batch
+        failed_batches = []
+
+        def write_batch_once_failing(batch):
+            if not failed_batches:
+                failed_batches.append(batch)
+                raise IOError("disk full")
+            write_batch(batch)
+
+        store._write_batch = write_batch_once_failing
+        store.store_tile_data(lzxy, get_tile_data(1))
+        self.assertRaises(TileStoreWriteFailed, store.flush)
+        self.assertEqual(len(failed_batches), 1)
+        self.assertTrue(store.tile_is_stored(lzxy))
+        # the next flush writes the tile
+        store.flush()
+        self.assertFalse(store._pending)
+        store.close()
+        store = SqliteTileStore(self.store_path)
+        self.assertEqual(store.get_tile(lzxy)[0], get_tile_data(1))
+        store.close()
+
+    def batch_write_test(self):
+        """Test that full batches are written by the writer thread."""
+        store = SqliteTileStore(self.store_path, batch_size=10, flush_interval=3600)
+        for i in range(25):
+            store.store_tile_data((self.layer, 10, i, 0), get_tile_data(i))
+        # overwrite a tile that might still be pending
+        store.store_tile_data((self.layer, 10, 24, 0), get_tile_data(100))
+        store.close()
+        store = SqliteTileStore(self.store_path)
+        for i in range(24):
+            self.assertEqual(store.get_tile((self.layer, 10, i, 0))[0], get_tile_data(i))
+        self.assertEqual(store.get_tile((self.layer, 10, 24, 0))[0], get_tile_data(100))
+        store.close()
+
+    def delete_tile_test(self):
+        """Test that both pending and written tiles can be deleted."""
+        store = SqliteTileStore(self.store_path, batch_size=1000, flush_interval=3600)
+        written = (self.layer, 5, 1, 1)
+        pending = (self.layer, 5, 1, 2)
+        store.store_tile_data(written, get_tile_data(1))
+        store.flush()
+        store.store_tile_data(pending, get_tile_data(2))
+        store.delete_tile(written)
+        store.delete_tile(pending)
+        store.flush()
+        self.assertIsNone(store.get_tile(written))
+        self.assertIsNone(store.get_tile(pending))
+        store.close()
+
+    def wal_mode_test(self):
+        """Test that WAL mode stores can be read from multiple threads and stores."""
+        store = SqliteTileStore(self.store_path, wal_mode=True)
+        self.assertTrue(store.wal_mode)
+        for i in range(10):
+            store.store_tile_data((self.layer, 8, i, 0), get_tile_data(i))
+        store.flush()
+
+        results = {}
+        def read_tiles(thread_index):
+            results[thread_index] = [store.get_tile((self.layer, 8, i, 0))[0] for i in range(10)]
+        read_threads = [threading.Thread(target=read_tiles, args=(i,)) for i in range(4)]
+        for thread in read_threads:
+            thread.start()
+        for thread in read_threads:
+            thread.join()
+        for thread_index in range(4):
+            self.assertEqual(results[thread_index], [get_tile_data(i) for i in range(10)])
+
+        # a second store instance (as if from another process) should be able
+        # to read from the databases while the first one is still open
+        second_store = SqliteTileStore(self.store_path, wal_mode=True)
+        self.assertEqual(second_store.get_tile((self.layer, 8, 5, 0))[0], get_tile_data(5))
+        second_store.close()
+        store.close()
+
+    def bulk_read_test(self):
+        """Test bulk tile reads from both pending and written tiles."""
+        store = SqliteTileStore(self.store_path, batch_size=1000, flush_interval=3600)
+        written = [(self.layer, 12, i, i) for i in range(500)]
+        for i, lzxy in enumerate(written):
+            store.store_tile_data(lzxy, get_tile_data(i))
+        store.flush()
+        pending = (self.layer, 12, 1000, 1000)
+        store.store_tile_data(pending, get_tile_data(1000))
+        missing = (self.layer, 12, 2000, 2000)
+        requested = written + [pending, missing]
+
+        found_tiles = store.get_tiles(requested)
+        self.assertEqual(len(found_tiles), 501)
+        self.assertNotIn(missing, found_tiles)
+        self.assertEqual(found_tiles[written[42]][0], get_tile_data(42))
+        self.assertEqual(found_tiles[pending][0], get_tile_data(1000))
+
+        stored_tiles = store.tiles_stored(requested)
+        self.assertEqual(set(stored_tiles.keys()), set(written + [pending]))
+        store.close()
+
+    def tile_key_test(self):
+        """Test that tile keys round-trip and preserve zoom level ordering."""
+        for zxy in [(0, 0, 0), (1, 1, 0), (15, 17602, 10744), (28, 2**28 - 1, 2**28 - 1)]:
+            self.assertEqual(get_tile_zxy(get_tile_key(*zxy)), zxy)
+        self.assertLess(get_tile_key(5, 31, 31), get_tile_key(6, 0, 0))
+        self.assertRaises(ValueError, get_tile_key, 29, 0, 0)
+
+    def v1_migration_test(self):
+        """Test that version 1 stores are readable and get migrated to version 2."""
+        zxy_list = [(10, x, y) for x in range(30) for y in range(40)]
+        create_v1_store(self.store_path, zxy_list)
+        store = SqliteTileStore(self.store_path, batch_size=1000, flush_interval=3600)
+        # tiles should be readable while the migration is in progress
+        self.assertEqual(store.get_tile((self.layer, 10, 3, 4))[0], get_tile_data(3 * 40 + 4))
+        # overwrite a tile before it is migrated
+        store.store_tile_data((self.layer, 10, 29, 39), get_tile_data(5000))
+        store.flush()
+        deadline = time.time() + 30
+        while store.migrating and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(store.migrating)
+        found_tiles = store.get_tiles([(self.layer,) + zxy for zxy in zxy_list])
+        self.assertEqual(len(found_tiles), len(zxy_list))
+        self.assertEqual(found_tiles[(self.layer, 10, 7, 8)], (get_tile_data(7 * 40 + 8), 1000 + 7 * 40 + 8))
+        self.assertEqual(found_tiles[(self.layer, 10, 29, 39)][0], get_tile_data(5000))
+        store.close()
+
+        for db_name in ("lookup.sqlite", "store.sqlite.0"):
+            connection = sqlite3.connect(os.path.join(self.store_path, db_name))
+            tables = [row[0] for row in connection.execute("select name from sqlite_master where type='table'")]
+            self.assertNotIn("tiles", tables)
+            self.assertEqual(connection.execute("select v from version").fetchone()[0], 2)
+            connection.close()
+
+        # the migrated store should be readable after reopening
+        store = SqliteTileStore(self.store_path)
+        self.assertFalse(store.migrating)
+        self.assertEqual(store.get_tile((self.layer, 10, 3, 4))[0], get_tile_data(3 * 40 + 4))
+        store.close()
+
+    def iter_tiles_test(self):
+        """Test listing of all tiles & modification stamp of the store."""
+        store = SqliteTileStore(self.store_path, wal_mode=True)
+        stored = [(10, x, y) for x in range(20) for y in range(30)]
+        for zxy in stored[:500]:
+            store.store_tile_data((self.layer,) + zxy, get_tile_data(0))
+        store.flush()
+        # pending tiles should be listed as well
+        for zxy in stored[500:]:
+            store.store_tile_data((self.layer,) + zxy, get_tile_data(0))
+        self.assertEqual(sorted(set(store.iter_tiles())), stored)
+        store.close()
+        stamp = store.get_modification_stamp()
+        # just opening the store should not change the stamp
+        store = SqliteTileStore(self.store_path, wal_mode=True)
+        self.assertEqual(stamp, store.get_modification_stamp())
+        store.store_tile_data((self.layer, 11, 0, 0), get_tile_data(0))
+        store.close()
+        self.assertNotEqual(stamp, store.get_modification_stamp())
+
+    def evict_test(self):
+        """Test that least recently accessed tiles are evicted first."""
+        store = SqliteTileStore(self.store_path)
+        stored = [(self.layer, 12, x, 0) for x in range(40)]
+        for lzxy in stored:
+            store.store_tile_data(lzxy, get_tile_data(lzxy[2]) + b"\0" * 8000)
+        store.flush()
+        self.assertEqual(store._lookup_db_connection.execute("pragma auto_vacuum").fetchone()[0], 2)
+        # pretend all tiles have been last accessed long ago and then read some of them
+        with store._db_lock:
+            store._lookup_db_connection.execute("update tiles_v2 set last_access=0")
+            store._lookup_db_connection.commit()
+        recently_read = stored[30:]
+        self.assertEqual(len(store.get_tiles(recently_read[:5])), 5)
+        for lzxy in recently_read[5:]:
+            self.assertIsNotNone(store.get_tile(lzxy))
+        size = store.get_size()
+        freed = store.evict(size // 2)
+        self.assertTrue(freed >= size // 2)
+        self.assertTrue(store.get_size() <= size - freed)
+        # the freed pages should be returned to the filesystem
+        store_db_path = os.path.join(self.store_path, "store.sqlite.0")
+        self.assertTrue(os.path.getsize(store_db_path) < size - freed)
+        for lzxy in recently_read:
+            self.assertIsNotNone(store.get_tile(lzxy))
+        self.assertIsNone(store.get_tile(stored[0]))
+        self.assertTrue(len(list(store.iter_tiles())) < len(stored))
+        store.close()
+
+    def deduplication_test(self):
+        """Test that identical tiles share tile data in deduplication mode."""
+        store = SqliteTileStore(self.store_path, deduplicate=True)
+        blank_tile = PNG_HEADER + b"\0" * 4000
+        blank = [(self.layer, 14, x, 0) for x in range(20)]
+        unique = [(self.layer, 14, x, 1) for x in range(5)]
+        for lzxy in blank:
+            store.store_tile_data(lzxy, blank_tile)
+        for lzxy in unique:
+            store.store_tile_data(lzxy, get_tile_data(lzxy[2]))
+        store.flush()
+
+        def get_blob_refcounts():
+            store_connection = store._storage_databases["store.sqlite.0"]
+            with store._db_lock:
+                return sorted(row[0] for row in store_connection.execute("select refcount from tile_blobs"))
+
+        self.assertEqual(get_blob_refcounts(), [1] * 5 + [20])
+        self.assertEqual(store.get_tile(blank[3])[0], blank_tile)
+        found_tiles = store.get_tiles(blank + unique)
+        self.assertEqual(len(found_tiles), 25)
+        self.assertEqual(found_tiles[unique[2]][0], get_tile_data(2))
+        # replacing & deleting tiles should keep the reference counts up to date
+        store.store_tile_data(unique[0], get_tile_data(0))
+        store.store_tile_data(unique[1], blank_tile)
+        store.delete_tile(blank[0])
+        store.delete_tile(unique[2])
+        store.flush()
+        self.assertEqual(get_blob_refcounts(), [1] * 3 + [20])
+        self.assertEqual(store.get_tile(unique[0])[0], get_tile_data(0))
+        store.close()
+        # deduplicated tiles should be readable without deduplication mode
+        store = SqliteTileStore(self.store_path, wal_mode=True)
+        self.assertEqual(store.get_tile(unique[1])[0], blank_tile)
+        self.assertEqual(store.get_tiles(blank)[blank[5]][0], blank_tile)
+        # & replaced by tiles that are not deduplicated
+        store.store_tile_data(unique[1], get_tile_data(1))
+        store.flush()
+        self.assertEqual(get_blob_refcounts(), [1] * 3 + [19])
+        store.close()
+
+    def deduplicate_tiles_test(self):
+        """Test conversion of an existing store to deduplicated tiles."""
+        store = SqliteTileStore(self.store_path)
+        blank_tile = PNG_HEADER + b"\0" * 20000
+        stored = [(self.layer, 13, x, 0) for x in range(30)]
+        for lzxy in stored:
+            store.store_tile_data(lzxy, blank_tile)
+        store.store_tile_data((self.layer, 13, 0, 1), get_tile_data(1))
+        tile_count, saved = store.deduplicate_tiles()
+        self.assertEqual(tile_count, 31)
+        self.assertTrue(saved >= 20 * len(blank_tile))
+        self.assertEqual(store.get_tile(stored[7])[0], blank_tile)
+        self.assertEqual(store.get_tile((self.layer, 13, 0, 1))[0], get_tile_data(1))
+        # already deduplicated tiles are not converted again
+        self.assertEqual(store.deduplicate_tiles()[0], 0)
+        store.close()
+
+    def validators_test(self):
+        """Test storing HTTP cache validators & touching tiles."""
+        store = SqliteTileStore(self.store_path, batch_size=1000, flush_interval=3600)
+        lzxy = (self.layer, 11, 3, 4)
+        store.store_tile_data(lzxy, get_tile_data(1), etag='"abc"', last_modified="Mon, 01 Jan 2018 00:00:00 GMT")
+        self.assertEqual(store.get_tile_validators(lzxy), ('"abc"', "Mon, 01 Jan 2018 00:00:00 GMT"))
+        store.flush()
+        self.assertEqual(store.get_tile_validators(lzxy), ('"abc"', "Mon, 01 Jan 2018 00:00:00 GMT"))
+        # pretend the tile has been stored long ago
+        tile_key = get_tile_key(11, 3, 4)
+        with store._db_lock:
+            store._lookup_db_connection.execute("update tiles_v2 set unix_epoch_timestamp=1000 where tile_key=?",
+                                                (tile_key,))
+            store._lookup_db_connection.commit()
+        self.assertEqual(store.tile_is_stored(lzxy), (True, 1000))
+        # touched tiles are fresh right away, even before the touch is written
+        self.assertTrue(store.touch_tile(lzxy, etag='"def"'))
+        self.assertTrue(store.tile_is_stored(lzxy)[1] > 1000)
+        self.assertTrue(store.get_tile(lzxy)[1] > 1000)
+        self.assertTrue(store.get_tiles([lzxy])[lzxy][1] > 1000)
+        self.assertEqual(store.get_tile_validators(lzxy), ('"def"', "Mon, 01 Jan 2018 00:00:00 GMT"))
+        self.assertFalse(store.touch_tile((self.layer, 11, 3, 5)))
+        store.close()
+
+        store = SqliteTileStore(self.store_path)
+        self.assertTrue(store.tile_is_stored(lzxy)[1] > 1000)
+        self.assertEqual(store.get_tile(lzxy)[0], get_tile_data(1))
+        self.assertEqual(store.get_tile_validators(lzxy), ('"def"', "Mon, 01 Jan 2018 00:00:00 GMT"))
+        # a tile stored without validators has none
+        store.store_tile_data(lzxy, get_tile_data(2))
+        store.flush()
+        self.assertIsNone(store.get_tile_validators(lzxy))
+        store.close()
+
+    def stats_test(self):
+        """Test that tile statistics are kept up to date and survive a store reopen."""
+        store = SqliteTileStore(self.store_path)
+        for x in range(10):
+            store.store_tile_data((self.layer, 12, x, 0), get_tile_data(x))
+        store.store_tile_data((self.layer, 3, 0, 0), get_tile_data(100))
+        store.flush()
+        stats = store.get_stats().get_zooms()
+        self.assertEqual(sorted(stats.keys()), [3, 12])
+        self.assertEqual(stats[12][:2], [10, sum(len(get_tile_data(x)) for x in range(10))])
+        self.assertEqual(stats[3][:2], [1, len(get_tile_data(100))])
+        # replacing a tile replaces its size in the statistics
+        store.store_tile_data((self.layer, 12, 0, 0), get_tile_data(1000))
+        store.delete_tile((self.layer, 3, 0, 0))
+        store.flush()
+        stats = store.get_stats()
+        self.assertEqual(sorted(stats.get_zooms().keys()), [12])
+        self.assertEqual(stats.tile_count, 10)
+        self.assertEqual(stats.byte_count, sum(len(get_tile_data(x)) for x in range(1, 10)) + len(get_tile_data(1000)))
+        store.close()
+
+        # stores without the statistics table get it filled when opened
+        connection = sqlite3.connect(os.path.join(self.store_path, "lookup.sqlite"))
+        connection.execute("drop table tile_stats")
+        connection.commit()
+        connection.close()
+        store = SqliteTileStore(self.store_path)
+        self.assertEqual(store.get_stats().get_zooms()[12][:2], [stats.tile_count, stats.byte_count])
+        # evicted tiles are no longer counted
+        store.evict(1)
+        self.assertEqual(store.get_stats().tile_count, len(list(store.iter_tiles())))
+        store.close()
+
+    def delete_region_test(self):
+        """Test deleting tiles in tile coordinate ranges, including not yet migrated tiles."""
+        create_v1_store(self.store_path, [(5, 1, 1), (5, 9, 9)])
+        store = SqliteTileStore(self.store_path)
+        stored = [(self.layer, 5, x, y) for x in range(8) for y in range(8)]
+        for i, lzxy in enumerate(stored):
+            store.store_tile_data(lzxy, get_tile_data(i))
+        store.store_tile_data((self.layer, 6, 2, 2), get_tile_data(100))
+        # some tiles are still pending when the region is deleted
+        deleted_count = store.delete_region([(5, 2, 4, 1, 6)])
+        # 3 x 6 tiles in the version 2 tables, (5, 1, 1) from the version 1 tables is outside the range
+        self.assertEqual(deleted_count, 18)
+        for lzxy in stored:
+            in_region = 2 <= lzxy[2] <= 4 and 1 <= lzxy[3] <= 6
+            self.assertEqual(bool(store.tile_is_stored(lzxy)), not in_region)
+        self.assertTrue(store.tile_is_stored((self.layer, 6, 2, 2)))
+        self.assertEqual(store.delete_region([(5, 9, 9, 9, 9)]), 1)
+        self.assertFalse(store.tile_is_stored((self.layer, 5, 9, 9)))
+        self.assertEqual(store.get_stats().tile_count, len(list(store.iter_tiles())))
+        store.close()
+
+    def delete_older_than_test(self):
+        """Test deleting old tiles a chunk at a time."""
+        store = SqliteTileStore(self.store_path)
+        for x in range(10):
+            store.store_tile_data((self.layer, 10, x, 0), get_tile_data(x))
+        store.flush()
+        with store._db_lock:
+            store._lookup_db_connection.execute(
+                "update tiles_v2 set unix_epoch_timestamp=1000 where tile_key<?", (get_tile_key(10, 5, 0),))
+            store._lookup_db_connection.commit()
+        # touched tiles are no longer old, even if the touch has not been written yet
+        store.touch_tile((self.layer, 10, 0, 0))
+        chunks = []
+        self.assertEqual(store.delete_older_than(2000, chunk_callback=chunks.append), 4)
+        self.assertEqual(chunks, [4])
+        self.assertTrue(store.tile_is_stored((self.layer, 10, 0, 0)))
+        self.assertFalse(store.tile_is_stored((self.layer, 10, 1, 0)))
+        self.assertEqual(store.get_stats().tile_count, 6)
+        # the deletion stops once the callback returns False
+        import core.tile_storage.sqlite_store as sqlite_store
+        chunk_size = sqlite_store.SQLITE_DELETION_CHUNK_SIZE
+        sqlite_store.SQLITE_DELETION_CHUNK_SIZE = 2
+        try:
+            self.assertEqual(store.delete_older_than(time.time() + 10, chunk_callback=lambda count: False), 2)
+        finally:
+            sqlite_store.SQLITE_DELETION_CHUNK_SIZE = chunk_size
+        self.assertEqual(store.get_stats().tile_count, 4)
+        store.close()
+
+    def repack_test(self):
+        """Test moving tiles to as few storage databases as possible."""
+        for wal_mode in (False, True):
+            store_path = tempfile.mkdtemp(dir=self.store_path)
+            store = SqliteTileStore(store_path, wal_mode=wal_mode)
+            stored = [(self.layer, 12, x, 0) for x in range(30)]
+            # spread the tiles over three storage databases
+            for i, lzxy in enumerate(stored):
+                store_name = "store.sqlite.%d" % (i // 10)
+                store._will_it_fit_in = lambda name, size, store_name=store_name: name == store_name
+                store.store_tile_data(lzxy, get_tile_data(i))
+                store.flush()
+            self.assertEqual(len(store._storage_databases), 3)
+            # warm up the read connections before the storage databases are deleted
+            self.assertEqual(store.get_tile(stored[25])[0], get_tile_data(25))
+            del store._will_it_fit_in
+            progress = []
+            self.assertEqual(store.repack(progress_callback=progress.append), (20, 2))
+            self.assertEqual(progress[-1], 20)
+            self.assertEqual(sorted(store._storage_databases.keys()), ["store.sqlite.0"])
+            self.assertFalse(os.path.exists(os.path.join(store_path, "store.sqlite.2")))
+            self.assertEqual(store.get_tile(stored[25])[0], get_tile_data(25))
+            found_tiles = store.get_tiles(stored)
+            self.assertEqual(sorted(found_tiles.keys()), sorted(stored))
+            self.assertEqual(found_tiles[stored[15]][0], get_tile_data(15))
+            self.assertEqual(store.get_stats().tile_count, 30)
+            # nothing left to repack
+            self.assertEqual(store.repack(), (0, 0))
+            store.store_tile_data((self.layer, 12, 100, 0), get_tile_data(100))
+            store.close()
+            store = SqliteTileStore(store_path, wal_mode=wal_mode)
+            self.assertEqual(len(list(store.iter_tiles())), 31)
+            self.assertEqual(store.get_tile(stored[29])[0], get_tile_data(29))
+            store.close()
+
+class FileBasedTileStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.store_path = tempfile.mkdtemp()
+        self.layer = FakeLayer()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_path)
+
+    def bulk_read_test(self):
+        """Test bulk tile reads including fuzzy extension matching."""
+        store = FileBasedTileStore(self.store_path)
+        stored = [(self.layer, 3, x, y) for x in range(3) for y in range(3)]
+        for lzxy in stored:
+            store.store_tile_data(lzxy, get_tile_data(lzxy[2] * 10 + lzxy[3]))
+        # a tile stored with a different extension should be found with fuzzy matching
+        jpg_lzxy = (FakeLayer("jpg"), 3, 5, 5)
+        store.store_tile_data(jpg_lzxy, get_tile_data(55))
+        fuzzy_lzxy = (self.layer, 3, 5, 5)
+        missing = (self.layer, 4, 0, 0)
+        requested = stored + [fuzzy_lzxy, missing]
+
+        found_tiles = store.get_tiles(requested)
+        self.assertEqual(set(found_tiles.keys()), set(stored + [fuzzy_lzxy]))
+        self.assertEqual(found_tiles[(self.layer, 3, 2, 1)][0], get_tile_data(21))
+        self.assertEqual(found_tiles[fuzzy_lzxy][0], get_tile_data(55))
+
+        stored_tiles = store.tiles_stored(requested, fuzzy_matching=False)
+        self.assertEqual(set(stored_tiles.keys()), set(stored))
+
+    def runtime_added_store_test(self):
+        """Test that tiles from storage databases added at runtime can be read."""
+        for wal_mode in (False, True):
+            store_path = tempfile.mkdtemp(dir=self.store_path)
+            store = SqliteTileStore(store_path, wal_mode=wal_mode)
+            first = (self.layer, 6, 1, 1)
+            store.store_tile_data(first, get_tile_data(1))
+            store.flush()
+            # warm up the read connections before the new store is added
+            self.assertEqual(store.get_tile(first)[0], get_tile_data(1))
+            # pretend the first storage database is full
+            store._will_it_fit_in = lambda store_name, size: store_name != "store.sqlite.0"
+            second = (self.layer, 6, 1, 2)
+            store.store_tile_data(second, get_tile_data(2))
+            store.flush()
+            self.assertEqual(sorted(store._storage_databases.keys()),
+                             ["store.sqlite.0", "store.sqlite.1"])
+            self.assertEqual(store.get_tile(first)[0], get_tile_data(1))
+            self.assertEqual(store.get_tile(second)[0], get_tile_data(2))
+            found_tiles = store.get_tiles([first, second, (self.layer, 6, 1, 3)])
+            self.assertEqual(set(found_tiles.keys()), set([first, second]))
+            store.close()
+
+    def iter_tiles_test(self):
+        """Test listing of all tiles & modification stamp of the store."""
+        store = FileBasedTileStore(self.store_path)
+        stored = [(self.layer, 3, x, y) for x in range(3) for y in range(3)]
+        for lzxy in stored:
+            store.store_tile_data(lzxy, get_tile_data(0))
+        self.assertEqual(sorted(store.iter_tiles()), sorted(lzxy[1:] for lzxy in stored))
+        stamp = store.get_modification_stamp()
+        self.assertEqual(stamp, store.get_modification_stamp())
+        store.store_tile_data((self.layer, 4, 0, 0), get_tile_data(0))
+        self.assertNotEqual(stamp, store.get_modification_stamp())
+        store.get_stats()
+        store.close()
+        stamp = store.get_modification_stamp()
+        # just opening the store should not change the stamp
+        store = FileBasedTileStore(self.store_path)
+        self.assertEqual(stamp, store.get_modification_stamp())
+        self.assertIsNotNone(store._stats)
+        # adding a tile to an existing folder changes the stamp as well
+        store.store_tile_data((self.layer, 3, 0, 5), get_tile_data(0))
+        self.assertNotEqual(stamp, store.get_modification_stamp())
+        # the saved statistics are not used if the store has not been closed after a modification
+        store = FileBasedTileStore(self.store_path)
+        self.assertIsNone(store._stats)
+        self.assertEqual(store.get_stats().tile_count, len(stored) + 2)
+
+    def directory_index_test(self):
+        """Test that the directory index is kept up to date by the store."""
+        store = FileBasedTileStore(self.store_path)
+        lzxy = (self.layer, 7, 3, 5)
+        # index the (not yet existing) folder
+        self.assertFalse(store.tile_is_stored(lzxy))
+        store.store_tile_data(lzxy, get_tile_data(1))
+        self.assertEqual(store.get_tile(lzxy)[0], get_tile_data(1))
+        self.assertTrue(store.tile_is_stored(lzxy))
+        # a primary tile file that is not an image should be skipped by fuzzy matching
+        # in favor of other image files for the same coordinates
+        with open(os.path.join(self.store_path, "7", "3", "6.png"), "wb") as f:
+            f.write(b"not an image")
+        store.store_tile_data((FakeLayer("jpg"), 7, 3, 6), get_tile_data(2))
+        store._forget_folder(7, 3)
+        self.assertEqual(store.get_tile((self.layer, 7, 3, 6))[0], get_tile_data(2))
+        self.assertEqual(store.get_tile((self.layer, 7, 3, 6), fuzzy_matching=False)[0], b"not an image")
+        store.delete_tile(lzxy)
+        self.assertFalse(store.tile_is_stored(lzxy))
+        self.assertIsNone(store.get_tile(lzxy))
+
+    def evict_test(self):
+        """Test that tiles from least recently accessed folders are evicted first."""
+        store = FileBasedTileStore(self.store_path)
+        stored = [(self.layer, 9, x, 1) for x in range(10)]
+        for lzxy in stored:
+            store.store_tile_data(lzxy, get_tile_data(lzxy[2]))
+            # pretend the tile folder has been last accessed long ago
+            folder_path = os.path.join(self.store_path, "9", str(lzxy[2]))
+            os.utime(folder_path, (1000 + lzxy[2], 1000 + lzxy[2]))
+        # an older tile in one of the folders
+        store.store_tile_data((self.layer, 9, 1, 2), get_tile_data(100), timestamp=500)
+        os.utime(os.path.join(self.store_path, "9", "1"), (1001, 1001))
+        recently_read = stored[5:]
+        for lzxy in recently_read:
+            self.assertIsNotNone(store.get_tile(lzxy))
+        store.flush()
+        # access times are saved per folder, not to the tile files
+        with open(os.path.join(self.store_path, "tile_access.json")) as f:
+            self.assertEqual(sorted(json.load(f).keys()), sorted("9/%d" % lzxy[2] for lzxy in recently_read))
+        self.assertEqual(os.path.getmtime(os.path.join(self.store_path, "9", "5", "1.png")),
+                         store.get_tile(stored[5])[1])
+        size = store.get_size()
+        self.assertEqual(size, sum(len(get_tile_data(lzxy[2])) for lzxy in stored) + len(get_tile_data(100)))
+        self.assertEqual(store.evict(1), len(get_tile_data(0)))
+        self.assertFalse(store.tile_is_stored(stored[0]))
+        # the emptied x-level folder should be gone
+        self.assertFalse(os.path.exists(os.path.join(self.store_path, "9", "0")))
+        # the oldest tile in a folder is evicted first
+        self.assertEqual(store.evict(1), len(get_tile_data(100)))
+        self.assertTrue(store.tile_is_stored(stored[1]))
+        # a failed removal is not counted as evicted
+        real_remove = os.remove
+
+        def failing_remove(path):
+            if path.endswith(os.path.join("9", "2", "1.png")):
+                raise OSError("read only")
+            real_remove(path)
+
+        os.remove = failing_remove
+        try:
+            self.assertEqual(store.evict(len(get_tile_data(2))), len(get_tile_data(3)))
+        finally:
+            os.remove = real_remove
+        self.assertTrue(store.tile_is_stored(stored[2]))
+        self.assertFalse(store.tile_is_stored(stored[3]))
+        for lzxy in recently_read:
+            self.assertTrue(store.tile_is_stored(lzxy))
+        store.evict(size)
+        self.assertEqual(store.get_size(), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.store_path, "9")))
+
+    def validators_test(self):
+        """Test the validators sidecar file & touching tiles."""
+        store = FileBasedTileStore(self.store_path)
+        lzxy = (self.layer, 8, 2, 3)
+        store.store_tile_data(lzxy, get_tile_data(1), etag='"abc"')
+        self.assertEqual(store.get_tile_validators(lzxy), ('"abc"', None))
+        self.assertIsNone(store.get_tile_validators((self.layer, 8, 2, 4)))
+        # the sidecar file is not a tile
+        self.assertEqual(list(store.iter_tiles()), [(8, 2, 3)])
+        file_path = os.path.join(self.store_path, "8", "2", "3.png")
+        os.utime(file_path, (1000, 1000))
+        store._forget_folder(8, 2)
+        self.assertEqual(store.tile_is_stored(lzxy), (True, 1000))
+        self.assertTrue(store.touch_tile(lzxy, last_modified="Mon, 01 Jan 2018 00:00:00 GMT"))
+        self.assertTrue(store.tile_is_stored(lzxy)[1] > 1000)
+        self.assertEqual(store.get_tile_validators(lzxy), ('"abc"', "Mon, 01 Jan 2018 00:00:00 GMT"))
+        self.assertFalse(store.touch_tile((self.layer, 8, 2, 4)))
+        # validators are dropped together with the tile, so that the folder can be removed
+        store.delete_tile(lzxy)
+        self.assertIsNone(store.get_tile_validators(lzxy))
+        self.assertFalse(os.path.exists(os.path.join(self.store_path, "8")))
+
+    def stats_test(self):
+        """Test tile statistics of the file based store, including the saved statistics."""
+        store = FileBasedTileStore(self.store_path)
+        for x in range(5):
+            store.store_tile_data((self.layer, 6, x, 1), get_tile_data(x))
+        store.store_tile_data((self.layer, 6, 0, 1), get_tile_data(1000))
+        store.delete_tile((self.layer, 6, 4, 1))
+        expected_bytes = sum(len(get_tile_data(x)) for x in range(1, 4)) + len(get_tile_data(1000))
+        # statistics are built by a scan first & then kept up to date
+        self.assertEqual(store.get_stats().tile_count, 4)
+        store.store_tile_data((self.layer, 7, 0, 0), get_tile_data(7))
+        self.assertEqual(store.get_stats().get_zooms()[6][:2], [4, expected_bytes])
+        self.assertEqual(store.get_stats().get_zooms()[7][:2], [1, len(get_tile_data(7))])
+        store.close()
+        store = FileBasedTileStore(self.store_path)
+        self.assertIsNotNone(store._stats)
+        self.assertEqual(store.get_stats().tile_count, 5)
+        # the size comes from the loaded statistics without listing the tile files
+        iter_tile_files = store._iter_tile_files
+        store._iter_tile_files = None
+        self.assertEqual(store.get_size(), expected_bytes + len(get_tile_data(7)))
+        store._iter_tile_files = iter_tile_files
+        self.assertEqual(list(store.iter_tiles()).count((7, 0, 0)), 1)
+
+    def delete_region_test(self):
+        """Test deleting tiles in tile coordinate ranges from the file based store."""
+        store = FileBasedTileStore(self.store_path)
+        stored = [(self.layer, 5, x, y) for x in range(4) for y in range(4)]
+        for i, lzxy in enumerate(stored):
+            store.store_tile_data(lzxy, get_tile_data(i), etag='"%d"' % i)
+        self.assertEqual(store.delete_region([(5, 1, 2, 0, 3), (6, 0, 10, 0, 10)]), 8)
+        self.assertEqual(sorted(store.iter_tiles()),
+                         sorted(lzxy[1:] for lzxy in stored if lzxy[2] in (0, 3)))
+        # emptied folders are removed, together with the validators
+        self.assertFalse(os.path.exists(os.path.join(self.store_path, "5", "1")))
+        self.assertIsNone(store.get_tile_validators((self.layer, 5, 1, 1)))
+        self.assertEqual(store.get_tile_validators((self.layer, 5, 0, 1)), ('"1"', None))
+        self.assertEqual(store.get_stats().tile_count, 8)
+
+    def delete_older_than_test(self):
+        """Test deleting old tiles from the file based store."""
+        store = FileBasedTileStore(self.store_path)
+        for x in range(3):
+            for y in range(2):
+                store.store_tile_data((self.layer, 4, x, y), get_tile_data(y))
+                if x < 2:
+                    file_path = os.path.join(self.store_path, "4", str(x), "%d.png" % y)
+                    os.utime(file_path, (1000, 1000))
+        chunks = []
+        self.assertEqual(store.delete_older_than(2000, chunk_callback=chunks.append), 4)
+        self.assertEqual(chunks, [2, 4])
+        self.assertEqual(sorted(store.iter_tiles()), [(4, 2, 0), (4, 2, 1)])
+        self.assertFalse(os.path.exists(os.path.join(self.store_path, "4", "0")))
+        self.assertEqual(store.get_stats().tile_count, 2)
+        # the deletion stops once the callback returns False
+        self.assertEqual(store.delete_older_than(time.time() + 10, chunk_callback=lambda count: False), 2)
+
+class MBTilesTileStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.store_path = tempfile.mkdtemp()
+        self.layer = FakeLayer()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_path)
+
+    def read_write_test(self):
+        """Test storing & reading tiles, including the TMS y coordinate flip."""
+        self.assertFalse(MBTilesTileStore.is_store(self.store_path))
+        store = MBTilesTileStore(self.store_path, batch_size=10, wal_mode=True)
+        stored = [(self.layer, 4, x, y) for x in range(5) for y in range(5)]
+        for i, lzxy in enumerate(stored):
+            store.store_tile_data(lzxy, get_tile_data(i))
+        # some tiles are still pending, some are already written
+        self.assertEqual(store.get_tile(stored[3])[0], get_tile_data(3))
+        self.assertEqual(store.get_tile(stored[24])[0], get_tile_data(24))
+        store.close()
+        self.assertTrue(MBTilesTileStore.is_store(self.store_path))
+
+        connection = sqlite3.connect(os.path.join(self.store_path, "tiles.mbtiles"))
+        # XYZ y 1 is TMS row 14 on zoom level 4
+        row = connection.execute("select tile_data from tiles where zoom_level=4 and tile_column=0 and tile_row=14").fetchone()
+        self.assertEqual(bytes(row[0]), get_tile_data(1))
+        self.assertEqual(dict(connection.execute("select name, value from metadata"))["format"], "png")
+        connection.close()
+
+        store = MBTilesTileStore(self.store_path)
+        missing = (self.layer, 4, 10, 10)
+        found_tiles = store.get_tiles(stored + [missing])
+        self.assertEqual(set(found_tiles.keys()), set(stored))
+        self.assertEqual(found_tiles[stored[7]][0], get_tile_data(7))
+        self.assertEqual(set(store.tiles_stored(stored + [missing]).keys()), set(stored))
+        self.assertFalse(store.tile_is_stored(missing))
+        self.assertEqual(sorted(store.iter_tiles()), sorted(lzxy[1:] for lzxy in stored))
+        store.delete_tile(stored[0])
+        self.assertIsNone(store.get_tile(stored[0]))
+        store.close()
+
+    def delete_region_test(self):
+        """Test deleting tiles in tile coordinate ranges from the MBTiles store."""
+        store = MBTilesTileStore(self.store_path, batch_size=10)
+        stored = [(self.layer, 4, x, y) for x in range(5) for y in range(5)]
+        for i, lzxy in enumerate(stored):
+            store.store_tile_data(lzxy, get_tile_data(i))
+        self.assertEqual(store.delete_region([(4, 0, 1, 3, 4)]), 4)
+        self.assertEqual(sorted(store.iter_tiles()),
+                         sorted(lzxy[1:] for lzxy in stored if not (lzxy[2] <= 1 and lzxy[3] >= 3)))
+        store.close()
+
+    def timestamps_test(self):
+        """Test that tiles keep their write time & tiles without one use the file timestamp."""
+        store = MBTilesTileStore(self.store_path)
+        store.store_tile_data((self.layer, 4, 0, 0), get_tile_data(0))
+        store.close()
+        # a tile added by another tool has no write time
+        connection = sqlite3.connect(os.path.join(self.store_path, "tiles.mbtiles"))
+        connection.execute("insert into tiles values (4, 1, 1, ?)", (sqlite3.Binary(get_tile_data(1)),))
+        connection.commit()
+        connection.close()
+        file_timestamp = 1000
+        os.utime(os.path.join(self.store_path, "tiles.mbtiles"), (file_timestamp, file_timestamp))
+
+        store = MBTilesTileStore(self.store_path)
+        written = (self.layer, 4, 0, 0)
+        foreign = (self.layer, 4, 1, flip_y(4, 1))
+        migrated = (self.layer, 4, 2, 2)
+        store.store_tile_data(migrated, get_tile_data(2), timestamp=2000)
+        write_timestamp = store.get_tile(written)[1]
+        self.assertTrue(write_timestamp > file_timestamp)
+        self.assertEqual(store.get_tile(foreign)[1], file_timestamp)
+        self.assertEqual(store.tile_is_stored(migrated), (True, 2000))
+        store.flush()
+        # writing tiles does not make the other tiles fresh
+        self.assertEqual(store.get_tile(foreign)[1], file_timestamp)
+        self.assertEqual(store.tiles_stored([written, foreign, migrated]),
+                         {written: write_timestamp, foreign: file_timestamp, migrated: 2000})
+        self.assertEqual(store.get_tiles([migrated])[migrated], (get_tile_data(2), 2000))
+        # only tiles with a write time are deleted based on their age
+        self.assertEqual(store.delete_older_than(3000), 1)
+        self.assertEqual(sorted(store.iter_tiles()), sorted([written[1:], foreign[1:]]))
+        store.close()
+
+    def stats_test(self):
+        """Test per zoom level statistics of the MBTiles store."""
+        store = MBTilesTileStore(self.store_path)
+        for x in range(5):
+            store.store_tile_data((self.layer, 6, x, 1), get_tile_data(x), timestamp=1000 + x)
+        store.store_tile_data((self.layer, 7, 0, 0), get_tile_data(7), timestamp=2000)
+        store.flush()
+        stats = store.get_stats().get_zooms()
+        self.assertEqual(stats[6], [5, sum(len(get_tile_data(x)) for x in range(5)), 1000, 1004])
+        self.assertEqual(stats[7], [1, len(get_tile_data(7)), 2000, 2000])
+        store.delete_tile((self.layer, 7, 0, 0))
+        self.assertEqual(sorted(store.get_stats().get_zooms().keys()), [6])
+        store.close()
+
+    def evict_test(self):
+        """Test that never accessed & least recently accessed tiles are evicted first."""
+        store = MBTilesTileStore(self.store_path)
+        stored = [(self.layer, 12, x, 0) for x in range(40)]
+        for lzxy in stored:
+            store.store_tile_data(lzxy, get_tile_data(lzxy[2]) + b"\0" * 8000)
+        store.flush()
+        # a tile added by another tool has never been accessed
+        foreign = (self.layer, 12, 100, 0)
+        with store._db_lock:
+            store._connection.execute("insert into tiles values (12, 100, ?, ?)",
+                                      (flip_y(12, 0), sqlite3.Binary(get_tile_data(100))))
+            # pretend all the other tiles have been last accessed long ago
+            store._connection.execute("update tile_timestamps set last_access=0")
+            store._connection.commit()
+        recently_read = stored[30:]
+        self.assertEqual(len(store.get_tiles(recently_read[:5])), 5)
+        for lzxy in recently_read[5:]:
+            self.assertIsNotNone(store.get_tile(lzxy))
+        size = store.get_size()
+        store.evict(1)
+        self.assertIsNone(store.get_tile(foreign))
+        freed = store.evict(size // 2)
+        self.assertTrue(freed >= size // 2)
+        self.assertTrue(store.get_size() <= size - freed)
+        # the freed pages should be returned to the filesystem
+        self.assertTrue(os.path.getsize(store.db_path) < size - freed)
+        for lzxy in recently_read:
+            self.assertIsNotNone(store.get_tile(lzxy))
+        self.assertIsNone(store.get_tile(stored[0]))
+        store.close()
+
+    def write_failure_test(self):
+        """Test that flush() reports failed writes & the failed tiles are kept pending."""
+        store = MBTilesTileStore(self.store_path, batch_size=1000)
+        lzxy = (self.layer, 4, 1, 2)
+        connection = store._connection
+
+        class FailingConnection(object):
+            def executemany(self, query, parameters):
+                raise sqlite3.OperationalError("disk full")
+
+            def __getattr__(self, name):
+                return getattr(connection, name)
+
+        store._connection = FailingConnection()
+        store.store_tile_data(lzxy, get_tile_data(1))
+        self.assertRaises(TileStoreWriteFailed, store.flush)
+        self.assertEqual(store.get_tile(lzxy)[0], get_tile_data(1))
+        # the next flush writes the tile
+        store._connection = connection
+        store.flush()
+        self.assertFalse(store._pending)
+        store.close()
+        store = MBTilesTileStore(self.store_path)
+        self.assertEqual(store.get_tile(lzxy)[0], get_tile_data(1))
+        store.close()
+
+class TilePackStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.store_path = tempfile.mkdtemp()
+        self.layer = FakeLayer()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_path)
+
+    def build_and_read_test(self):
+        """Test building tile packs from other stores and reading from them."""
+        self.assertFalse(TilePackStore.is_store(self.store_path))
+        sqlite_store = SqliteTileStore(os.path.join(self.store_path, "sqlite"))
+        files_store = FileBasedTileStore(os.path.join(self.store_path, "files"))
+        sqlite_tiles = [(self.layer, 14, x, y) for x in range(20) for y in range(20)]
+        files_tiles = [(self.layer, 3, x, 0) for x in range(5)]
+        for i, lzxy in enumerate(sqlite_tiles):
+            sqlite_store.store_tile_data(lzxy, get_tile_data(i))
+        for i, lzxy in enumerate(files_tiles):
+            files_store.store_tile_data(lzxy, get_tile_data(1000 + i))
+        sqlite_store.flush()
+        pack_folder = os.path.join(self.store_path, "packs")
+        os.mkdir(pack_folder)
+        self.assertEqual(build_tile_pack(sqlite_store, self.layer, os.path.join(pack_folder, "a.tilepack")), 400)
+        self.assertEqual(build_tile_pack(files_store, self.layer, os.path.join(pack_folder, "b.tilepack")), 5)
+        sqlite_store.close()
+
+        self.assertTrue(TilePackStore.is_store(pack_folder))
+        pack_store = TilePackStore(pack_folder)
+        tile_data, timestamp = pack_store.get_tile(sqlite_tiles[123])
+        self.assertIsInstance(tile_data, memoryview)
+        self.assertEqual(bytes(tile_data), get_tile_data(123))
+        self.assertEqual(bytes(pack_store.get_tile(files_tiles[2])[0]), get_tile_data(1002))
+        self.assertTrue(pack_store.tile_is_stored(sqlite_tiles[0]))
+        self.assertIsNone(pack_store.get_tile((self.layer, 14, 100, 100)))
+        self.assertFalse(pack_store.tile_is_stored((self.layer, 2, 0, 0)))
+        self.assertEqual(sorted(pack_store.iter_tiles()),
+                         sorted(lzxy[1:] for lzxy in sqlite_tiles + files_tiles))
+        stats = pack_store.get_stats().get_zooms()
+        self.assertEqual(stats[14][0], 400)
+        self.assertEqual(stats[3][:2], [5, sum(len(get_tile_data(1000 + i)) for i in range(5))])
+        # closing the store should not fail while tile data is still referenced
+        pack_store.close()
+        self.assertEqual(bytes(tile_data), get_tile_data(123))
+
+class TileMigrationTests(unittest.TestCase):
+
+    def setUp(self):
+        self.store_path = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.store_path, TILE_MIGRATION_JOURNAL_FILE_NAME)
+        self.layer = FakeLayer()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_path)
+
+    def files_to_sqlite_test(self):
+        """Test moving tiles between stores, including their timestamps & validators."""
+        files_store = FileBasedTileStore(self.store_path)
+        stored = [(self.layer, 10, x, y) for x in range(6) for y in range(50)]
+        for i, lzxy in enumerate(stored):
+            files_store.store_tile_data(lzxy, get_tile_data(i))
+        files_store.store_tile_data(stored[0], get_tile_data(0), etag='"abc"')
+        os.utime(os.path.join(self.store_path, "10", "0", "1.png"), (1000, 1000))
+        files_store._forget_folder(10, 0)
+        sqlite_store = SqliteTileStore(self.store_path)
+        journal = MigrationJournal(self.journal_path, "files", "sqlite")
+        migration = TileMigration(files_store, sqlite_store, self.layer, journal, reader_count=3, chunk_size=16)
+        progress = []
+        self.assertTrue(migration.run(progress_callback=lambda migrated, total: progress.append((migrated, total))))
+        self.assertEqual(progress[-1], (300, 300))
+        self.assertFalse(os.path.exists(self.journal_path))
+        # the source store is empty, including the tile folders
+        self.assertEqual(list(files_store.iter_tiles()), [])
+        self.assertFalse(FileBasedTileStore.is_store(self.store_path))
+        found_tiles = sqlite_store.get_tiles(stored)
+        self.assertEqual(len(found_tiles), 300)
+        self.assertEqual(found_tiles[stored[77]][0], get_tile_data(77))
+        self.assertEqual(sqlite_store.get_tile_validators(stored[0]), ('"abc"', None))
+        self.assertEqual(sqlite_store.tile_is_stored(stored[1]), (True, 1000))
+        self.assertEqual(sqlite_store.get_stats().tile_count, 300)
+        sqlite_store.close()
+
+    def write_failure_test(self):
+        """Test that tiles are not deleted from the source store if writing them fails."""
+        files_store = FileBasedTileStore(self.store_path)
+        stored = [(self.layer, 10, x, 0) for x in range(20)]
+        for i, lzxy in enumerate(stored):
+            files_store.store_tile_data(lzxy, get_tile_data(i))
+        sqlite_store = SqliteTileStore(self.store_path)
+
+        def write_batch_failing(batch):
+            raise IOError("disk full")
+
+        sqlite_store._write_batch = write_batch_failing
+        journal = MigrationJournal(self.journal_path, "files", "sqlite")
+        migration = TileMigration(files_store, sqlite_store, self.layer, journal, reader_count=1, chunk_size=5)
+        self.assertFalse(migration.run())
+        self.assertEqual(len(files_store.get_tiles(stored)), 20)
+        # drop the tiles that could not be written
+        sqlite_store._pending.clear()
+        sqlite_store.close()
+
+    def resume_test(self):
+        """Test that a stopped migration can be resumed using its journal."""
+        sqlite_store = SqliteTileStore(self.store_path)
+        stored = [(self.layer, 9, x, y) for x in range(10) for y in range(20)]
+        for i, lzxy in enumerate(stored):
+            sqlite_store.store_tile_data(lzxy, get_tile_data(i))
+        sqlite_store.flush()
+        files_store = FileBasedTileStore(self.store_path)
+        journal = MigrationJournal(self.journal_path, "sqlite", "files")
+        migration = TileMigration(sqlite_store, files_store, self.layer, journal, reader_count=2, chunk_size=10)
+
+        def progress(migrated_count, total_count):
+            if migrated_count >= 50:
+                migration.stop()
+
+        self.assertFalse(migration.run(progress_callback=progress))
+        journal = MigrationJournal.load(self.journal_path)
+        self.assertEqual((journal.source_type, journal.target_type), ("sqlite", "files"))
+        self.assertEqual(journal.total_count, 200)
+        self.assertTrue(50 <= journal.migrated_count < 200)
+        # every tile is in exactly one of the stores
+        self.assertEqual(sorted(list(sqlite_store.iter_tiles()) + list(files_store.iter_tiles())),
+                         sorted(lzxy[1:] for lzxy in stored))
+
+        migration = TileMigration(sqlite_store, files_store, self.layer, journal)
+        self.assertTrue(migration.run())
+        self.assertEqual(journal.migrated_count, 200)
+        self.assertIsNone(MigrationJournal.load(self.journal_path))
+        self.assertEqual(list(sqlite_store.iter_tiles()), [])
+        self.assertEqual(files_store.get_tile(stored[123])[0], get_tile_data(123))
+        self.assertEqual(files_store.get_stats().tile_count, 200)
+        sqlite_store.close()
+
+class TileExistenceFilterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.folder_path = tempfile.mkdtemp()
+        self.filter_path = os.path.join(self.folder_path, "tile_existence.filter")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder_path)
+
+    def get_filled_filter(self):
+        existence_filter = TileExistenceFilter()
+        # low zoom tiles go to a bitmap, high zoom ones to a Bloom filter
+        # that needs to grow a couple times to hold all the tiles
+        existence_filter.add_many((5, x, y) for x in range(32) for y in range(0, 32, 2))
+        existence_filter.add_many((16, x, y) for x in range(100) for y in range(200))
+        existence_filter.set_ready()
+        return existence_filter
+
+    def might_contain_test(self):
+        """Test that the filter has no false negatives and few false positives."""
+        existence_filter = TileExistenceFilter()
+        # all tiles might be stored until the filter is ready
+        self.assertTrue(existence_filter.might_contain(16, 1, 1))
+        existence_filter = self.get_filled_filter()
+        for x in range(100):
+            for y in range(200):
+                self.assertTrue(existence_filter.might_contain(16, x, y))
+        false_positives = sum(existence_filter.might_contain(16, x, y)
+                              for x in range(1000, 1100) for y in range(100))
+        self.assertLess(false_positives, 500)
+        # the bitmap is exact and supports removal
+        self.assertTrue(existence_filter.might_contain(5, 3, 4))
+        self.assertFalse(existence_filter.might_contain(5, 3, 5))
+        existence_filter.remove(5, 3, 4)
+        self.assertFalse(existence_filter.might_contain(5, 3, 4))
+        self.assertFalse(existence_filter.might_contain(7, 0, 0))
+
+    def save_load_test(self):
+        """Test that the filter is only loaded if the stamp matches."""
+        existence_filter = self.get_filled_filter()
+        existence_filter.save(self.filter_path, {"sqlite": [1, 2.5]})
+        self.assertIsNone(TileExistenceFilter.load(self.filter_path, {"sqlite": [1, 3.5]}))
+        loaded_filter = TileExistenceFilter.load(self.filter_path, {"sqlite": [1, 2.5]})
+        self.assertTrue(loaded_filter.ready)
+        for zxy in [(5, 3, 4), (5, 3, 5), (16, 50, 50), (16, 500, 500), (17, 0, 0)]:
+            self.assertEqual(loaded_filter.might_contain(*zxy), existence_filter.might_contain(*zxy))
+        # truncated files should not be loaded
+        with open(self.filter_path, "rb") as f:
+            data = f.read()
+        with open(self.filter_path, "wb") as f:
+            f.write(data[:-10])
+        self.assertIsNone(TileExistenceFilter.load(self.filter_path, {"sqlite": [1, 2.5]}))
+
+class NegativeTileCacheTests(unittest.TestCase):
+
+    def miss_test(self):
+        """Check that misses are remembered until discarded, expired or pushed out"""
+        layer = FakeLayer()
+        cache = NegativeTileCache(max_size=2, ttl=60)
+        lzxy = (layer, 1, 0, 0)
+        self.assertFalse(cache.is_missing(lzxy))
+        cache.add(lzxy, cache.generation)
+        self.assertTrue(cache.is_missing(lzxy))
+        self.assertEqual(cache.hits, 1)
+        cache.discard(lzxy)
+        self.assertFalse(cache.is_missing(lzxy))
+        # the cache is limited in size
+        for x in range(3):
+            cache.add((layer, 1, x, 0), cache.generation)
+        self.assertEqual(len(cache), 2)
+        self.assertFalse(cache.is_missing((layer, 1, 0, 0)))
+        self.assertTrue(cache.is_missing((layer, 1, 2, 0)))
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        # misses expire
+        expiring_cache = NegativeTileCache(ttl=-1)
+        expiring_cache.add(lzxy, expiring_cache.generation)
+        self.assertFalse(expiring_cache.is_missing(lzxy))
+
+    def stale_miss_test(self):
+        """Check that a miss is not remembered if the tile might have been stored during the lookup"""
+        layer = FakeLayer()
+        cache = NegativeTileCache(ttl=60)
+        lzxy = (layer, 1, 0, 0)
+        generation = cache.generation
+        # the tile is stored while it is being looked up
+        cache.discard(lzxy)
+        cache.add(lzxy, generation)
+        self.assertFalse(cache.is_missing(lzxy))
@@ -0,0 +1,79 @@
+import unittest
+
+from core.tiles import getViewportTiles, TileUrlTemplate, quadTree
+from core.tile_hosts import HostShards, SELECTION_ROUND_ROBIN
+
+class TilesTests(unittest.TestCase):
+
+    def viewport_tiles_test(self):
+        """Check that viewport tiles include the margin, wrap in x & are clipped in y"""
+        zxyList = getViewportTiles(10, 5, 6, 2, 1)
+        self.assertEqual(zxyList, [(10, 5, 6), (10, 6, 6)])
+        zxyList = getViewportTiles(10, 5, 6, 2, 1, margin=1)
+        self.assertEqual(len(zxyList), 4 * 3)
+        self.assertIn((10, 4, 5), zxyList)
+        self.assertIn((10, 7, 7), zxyList)
+        # the viewport crosses the antimeridian & the top of the map
+        zxyList = getViewportTiles(3, 7, 0, 1, 1, margin=1)
+        self.assertEqual(zxyList, [(3, 0, 0), (3, 0, 1), (3, 6, 0), (3, 6, 1), (3, 7, 0), (3, 7, 1)])
+        # viewport wider than the world at zoom level 0
+        self.assertEqual(getViewportTiles(0, 0, 0, 3, 3), [(0, 0, 0)])
+
+    def url_template_test(self):
+        """Check tile URLs of all the coordinate types"""
+        template = TileUrlTemplate("https://tile.example.org/100%/", "osm", "png")
+        self.assertEqual(template.getUrl(3, 4, 5), "https://tile.example.org/100%/3/4/5.png")
+        template = TileUrlTemplate("https://example.org/vt?lyrs=t&x=${x}&y=${y}&z=${z}&$$",
+                                   "web_mercator_substitution")
+        self.assertEqual(template.getUrl(3, 4, 5), "https://example.org/vt?lyrs=t&x=4&y=5&z=3&$")
+        template = TileUrlTemplate("https://example.org/vt/", "google")
+        self.assertEqual(template.getUrl(3, 4, 5), "https://example.org/vt/&x=4&y=5&z=3")
+        template = TileUrlTemplate("https://example.org/?a=1", "yahoo")
+        self.assertEqual(template.getUrl(3, 4, 1), "https://example.org/?a=1&x=4&y=2&z=4&r=1")
+        template = TileUrlTemplate("https://example.org/", "quadtree")
+        self.assertEqual(template.getUrl(3, 4, 5), "https://example.org/%s?g=452" % quadTree(4, 5, 3))
+        template = TileUrlTemplate("https://example.org/${quadindex}.png", "quadtree_substitution")
+        self.assertEqual(template.getUrl(3, 4, 5), "https://example.org/%s.png" % quadTree(4, 5, 3))
+
+    def url_template_subdomains_test(self):
+        """Check that the subdomain placeholder is replaced by the selected subdomain"""
+        template = TileUrlTemplate("https://{s}.tile.example.org/", "osm", "png", ["a", "b", "c"])
+        self.assertEqual(template.getUrl(3, 4, 5), "https://a.tile.example.org/3/4/5.png")
+        self.assertEqual(template.getUrl(3, 4, 6), "https://b.tile.example.org/3/4/6.png")
+        self.assertEqual(template.getUrl(3, 4, 5, "a"), "https://a.tile.example.org/3/4/5.png")
+        template = TileUrlTemplate("https://${s}.example.org/${z}/${x}/${y}", "web_mercator_substitution",
+                                   subdomains=["a", "b"])
+        self.assertEqual(template.getUrl(3, 4, 5), "https://b.example.org/3/4/5")
+        # a placeholder without subdomains is a layer configuration error
+        self.assertRaises(ValueError, TileUrlTemplate, "https://{s}.tile.example.org/", "osm", "png")
+
+class HostShardsTests(unittest.TestCase):
+
+    def selection_test(self):
+        """Check hash & round robin subdomain selection"""
+        shards = HostShards(["a", "b", "c"])
+        self.assertEqual(shards.select(1, 2, 3), shards.select(1, 2, 3))
+        self.assertEqual(set(shards.select(5, x, 0) for x in range(3)), {"a", "b", "c"})
+        shards = HostShards(["a", "b", "c"], SELECTION_ROUND_ROBIN)
+        self.assertEqual([shards.select(1, 0, 0) for i in range(4)], ["a", "b", "c", "a"])
+        self.assertIsNone(HostShards([]).select(1, 0, 0))
+
+    def health_test(self):
+        """Check that a failing host is skipped until it works again"""
+        shards = HostShards(["a", "b"], failureThreshold=2, retryInterval=60)
+        shards.reportFailure("a")
+        self.assertTrue(shards.isHealthy("a"))
+        shards.reportStatus("a", 503)
+        self.assertFalse(shards.isHealthy("a"))
+        # tiles hashed to the failing host are downloaded from the other one
+        self.assertEqual(set(shards.select(5, x, 0) for x in range(4)), {"b"})
+        # the failing host is still used if no host is healthy
+        shards.reportFailure("b")
+        shards.reportFailure("b")
+        self.assertEqual(shards.select(5, 0, 0), "a")
+        shards.reportStatus("a", 200)
+        self.assertTrue(shards.isHealthy("a"))
+        stats = shards.getStats()
+        self.assertEqual(stats["a"]["requests"], 3)
+        self.assertEqual(stats["a"]["failures"], 2)
+        self.assertFalse(stats["b"]["healthy"])